@@ -1,6 +1,6 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_file, make_response, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_file, make_response, send_from_directory, g
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, or_
+from sqlalchemy import text, or_, event
 from sqlalchemy.orm import joinedload
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, date
@@ -24,12 +24,11 @@ from reportlab.lib.units import inch
 from reportlab.lib import colors
 from io import BytesIO
 import hashlib
+import threading
+import time
 import json
+from collections import OrderedDict
 from decimal import Decimal
-try:
-    from ofxparse import OfxParser
-except ImportError:
-    OfxParser = None
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import atexit
@@ -62,11 +61,50 @@ app.config['SESSION_COOKIE_SECURE'] = False  # Para desenvolvimento local
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+# Paginação das listagens (dashboard, lançamentos)
+app.config['ITENS_POR_PAGINA'] = int(os.getenv('ITENS_POR_PAGINA', 50))
+# Cartões de empresas vinculadas por página nos painéis do contador/BPO
+app.config['EMPRESAS_POR_PAGINA'] = int(os.getenv('EMPRESAS_POR_PAGINA', 20))
+
+# Linhas gravadas por transação na importação de planilhas
+app.config['IMPORTACAO_TAMANHO_LOTE'] = int(os.getenv('IMPORTACAO_TAMANHO_LOTE', 1000))
+
+# Linhas lidas por lote (yield_per) nas exportações Excel em streaming
+app.config['EXPORTACAO_TAMANHO_LOTE'] = int(os.getenv('EXPORTACAO_TAMANHO_LOTE', 1000))
+# Margem (segundos) descontada do X-Exportado-Em da exportação incremental, para que
+# o próximo since releia lançamentos gravados por transações ainda abertas na consulta
+app.config['EXPORTACAO_MARGEM_SINCRONIA'] = int(os.getenv('EXPORTACAO_MARGEM_SINCRONIA', 300))
+
+# Cubo de períodos (DRE/fluxo de caixa) pré-calculado todas as noites: meses para
+# trás das granularidades mês/trimestre e dias para trás da granularidade dia
+app.config['CUBO_MESES_PRECALCULO'] = int(os.getenv('CUBO_MESES_PRECALCULO', 24))
+app.config['CUBO_DIAS_PRECALCULO'] = int(os.getenv('CUBO_DIAS_PRECALCULO', 90))
+# Intervalo (minutos) do pré-cálculo da carteira do mês atual dos contadores/BPO
+app.config['CARTEIRA_MINUTOS_PRECALCULO'] = int(os.getenv('CARTEIRA_MINUTOS_PRECALCULO', 10))
+
+# Jobs em segundo plano (importações, backups, exportações): threads por processo,
+# jobs simultâneos por empresa e dias de retenção dos artefatos em uploads/jobs/
+app.config['JOBS_HABILITADOS'] = os.getenv('JOBS_HABILITADOS', '1') == '1'
+app.config['JOBS_THREADS'] = int(os.getenv('JOBS_THREADS', 2))
+app.config['JOBS_POR_EMPRESA'] = int(os.getenv('JOBS_POR_EMPRESA', 1))
+app.config['JOBS_DIAS_RETENCAO'] = int(os.getenv('JOBS_DIAS_RETENCAO', 7))
+
 # Configuração da pasta de upload para relatórios
 app.config['UPLOAD_FOLDER'] = 'uploads'
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+# Cache de permissões por processo: número de entradas e arquivo de sinal com que os
+# processos (workers do gunicorn na mesma máquina) avisam uns aos outros de alterações.
+# Sem arquivo de sinal (vazio), as versões são relidas do banco a cada requisição.
+app.config['PERMISSOES_CACHE_TAMANHO'] = int(os.getenv('PERMISSOES_CACHE_TAMANHO', 2048))
+app.config['PERMISSOES_ARQUIVO_SINAL'] = os.getenv(
+    'PERMISSOES_ARQUIVO_SINAL', os.path.join(app.config['UPLOAD_FOLDER'], 'permissoes.versao')
+)
+# Segundos em que as empresas autorizadas de um contador/sub-usuário ficam em cache
+# (alterações feitas pelas rotas de vínculo e de permissões invalidam antes disso)
+app.config['CONTADOR_VINCULOS_TTL'] = int(os.getenv('CONTADOR_VINCULOS_TTL', 60))
+
 # Configurar logging para Flask (simplificado)
 if not app.debug:
     app.logger.setLevel(logging.INFO)
@@ -360,7 +398,9 @@ with app.app_context():
             'total_compras': 'INTEGER DEFAULT 0',
             'lancamentos_ids': 'TEXT',
             'vendas_ids': 'TEXT',
-            'compras_ids': 'TEXT'
+            'compras_ids': 'TEXT',
+            'linhas_total': 'INTEGER DEFAULT 0',
+            'linhas_processadas': 'INTEGER DEFAULT 0'
         }
 
         for coluna, tipo in colunas_importacao.items():
@@ -541,6 +581,20 @@ class Lancamento(db.Model):
     eh_transferencia = db.Column(db.Boolean, default=False)  # Indica se é uma transferência
     transferencia_id = db.Column(db.Integer, nullable=True)  # ID do lançamento par na transferência
 
+    # Índices compostos para as consultas por empresa/período (dashboard, listagens, relatórios, DRE)
+    __table_args__ = (
+        db.Index('idx_lancamento_empresa_data', 'empresa_id', 'data_prevista'),
+        db.Index('idx_lancamento_empresa_realizada', 'empresa_id', 'data_realizada', 'realizado'),
+        db.Index('idx_lancamento_empresa_tipo_realizado', 'empresa_id', 'tipo', 'realizado'),
+        db.Index('idx_lancamento_conta_caixa_realizado', 'conta_caixa_id', 'realizado', 'data_realizada'),
+        db.Index('idx_lancamento_plano_conta_empresa', 'plano_conta_id', 'empresa_id'),
+        db.Index('idx_lancamento_usuario_empresa', 'usuario_id', 'empresa_id'),
+        db.Index('idx_lancamento_venda', 'venda_id'),
+        db.Index('idx_lancamento_compra', 'compra_id'),
+        db.Index('idx_lancamento_empresa_edicao', 'empresa_id', 'data_ultima_edicao'),
+        db.Index('idx_lancamento_empresa_criacao', 'empresa_id', 'data_criacao'),
+    )
+
     # Relacionamentos
     usuario = db.relationship('Usuario', backref='lancamentos', lazy=True, foreign_keys=[usuario_id])
     usuario_criacao = db.relationship('Usuario', foreign_keys=[usuario_criacao_id], lazy=True)
@@ -676,7 +730,9 @@ class Importacao(db.Model):
     total_compras = db.Column(db.Integer, default=0)
     sucessos = db.Column(db.Integer, default=0)
     erros = db.Column(db.Integer, default=0)
-    status = db.Column(db.String(20), default='concluida')  # concluida, desfeita
+    status = db.Column(db.String(20), default='concluida')  # processando, concluida, desfeita
+    linhas_total = db.Column(db.Integer, default=0)  # Linhas válidas da planilha
+    linhas_processadas = db.Column(db.Integer, default=0)  # Progresso da gravação em lotes
     lancamentos_ids = db.Column(db.Text)  # JSON com IDs dos lançamentos criados
     vendas_ids = db.Column(db.Text)  # JSON com IDs das vendas criadas
     compras_ids = db.Column(db.Text)  # JSON com IDs das compras criadas
@@ -713,27 +769,95 @@ class ContaCaixa(db.Model):
 
     # Relacionamentos
     lancamentos = db.relationship('Lancamento', backref='conta_caixa', lazy=True)
+    saldos_diarios = db.relationship('SaldoContaCaixaDiario', backref='conta_caixa', lazy=True,
+                                     cascade='all, delete-orphan')
 
     def calcular_saldo_atual(self):
         """
         Calcula o saldo atual da conta baseado nos lançamentos realizados
         Fórmula: saldo_inicial + entradas_realizadas - saidas_realizadas
+        Os totais realizados vêm do snapshot diário (SaldoContaCaixaDiario).
         """
-        from sqlalchemy import and_
+        entradas, saidas = saldos_contas_caixa_ate([self.id]).get(self.id, (0.0, 0.0))
+        return (self.saldo_inicial or 0) + entradas - saidas
 
-        # Buscar apenas lançamentos realizados desta conta
-        lancamentos_realizados = Lancamento.query.filter(
-            and_(
-                Lancamento.conta_caixa_id == self.id,
-                Lancamento.realizado == True
-            )
-        ).all()
+class SaldoContaCaixaDiario(db.Model):
+    """
+    Snapshot diário de saldo por conta caixa.
+    Uma linha por (conta_caixa_id, data) com as entradas/saídas realizadas no dia
+    e os totais acumulados até o dia. Mantido incrementalmente a cada flush de
+    Lancamento; o saldo em uma data é uma única leitura indexada.
+    A data do movimento é data_realizada (ou data_prevista quando ausente).
+    """
+    __tablename__ = 'saldo_conta_caixa_diario'
+    __table_args__ = (
+        db.UniqueConstraint('conta_caixa_id', 'data', name='uq_saldo_conta_caixa_data'),
+    )
 
-        # Calcular totais
-        entradas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'entrada'])
-        saidas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'saida'])
+    id = db.Column(db.Integer, primary_key=True)
+    conta_caixa_id = db.Column(db.Integer, db.ForeignKey('conta_caixa.id'), nullable=False)
+    data = db.Column(db.Date, nullable=False)
+    entradas_dia = db.Column(db.Float, default=0.0)
+    saidas_dia = db.Column(db.Float, default=0.0)
+    entradas_acumuladas = db.Column(db.Float, default=0.0)
+    saidas_acumuladas = db.Column(db.Float, default=0.0)
+
+class MovimentoEstoque(db.Model):
+    """
+    Razão de movimentos de estoque, somente inclusão.
+    Cada venda, compra ou ajuste gera linhas com a variação de quantidade por
+    produto (nome normalizado, como nas vendas/compras); alterações e exclusões
+    geram linhas de estorno em vez de editar as anteriores. O estoque em uma
+    data é a soma das quantidades até ela e o preço médio vem das linhas de compra.
+    """
+    __tablename__ = 'movimento_estoque'
+    __table_args__ = (
+        db.Index('idx_movimento_estoque_produto', 'empresa_id', 'produto', 'data'),
+        db.Index('idx_movimento_estoque_origem', 'origem', 'origem_id'),
+    )
 
-        return self.saldo_inicial + entradas - saidas
+    id = db.Column(db.Integer, primary_key=True)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False)
+    produto = db.Column(db.String(200), nullable=False)
+    quantidade = db.Column(db.Float, nullable=False)  # positiva entra, negativa sai
+    custo_unitario = db.Column(db.Float, nullable=True)  # apenas compras
+    origem = db.Column(db.String(20), nullable=False)  # venda, compra ou ajuste
+    origem_id = db.Column(db.Integer, nullable=True)
+    data = db.Column(db.Date, nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    observacao = db.Column(db.String(255))
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ItemCarrinho(db.Model):
+    """
+    Itens dos carrinhos de vendas/compras, uma linha por item.
+    Espelha o JSON Lancamento.itens_carrinho, que continua sendo gravado para as
+    telas: as linhas de um lançamento são regravadas a cada flush em que o JSON
+    ou o vínculo com a venda/compra muda. nome é o nome normalizado do produto e
+    produto_id é preenchido quando o produto existe no estoque da empresa.
+    """
+    __tablename__ = 'item_carrinho'
+    __table_args__ = (
+        db.Index('idx_item_carrinho_produto', 'produto_id'),
+        db.Index('idx_item_carrinho_empresa_nome', 'empresa_id', 'nome'),
+        db.Index('idx_item_carrinho_lancamento', 'lancamento_id'),
+        db.Index('idx_item_carrinho_venda', 'venda_id'),
+        db.Index('idx_item_carrinho_compra', 'compra_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    lancamento_id = db.Column(db.Integer, db.ForeignKey('lancamento.id', ondelete='CASCADE'), nullable=False)
+    venda_id = db.Column(db.Integer, db.ForeignKey('venda.id', ondelete='SET NULL'), nullable=True)
+    compra_id = db.Column(db.Integer, db.ForeignKey('compra.id', ondelete='SET NULL'), nullable=True)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produto.id', ondelete='SET NULL'), nullable=True)
+    ordem = db.Column(db.Integer, default=0)  # posição do item no carrinho
+    nome = db.Column(db.String(200), nullable=False)
+    tipo = db.Column(db.String(20))  # produto, mercadoria, servico...
+    quantidade = db.Column(db.Float, default=1)
+    preco_unitario = db.Column(db.Float, default=0)
+    desconto = db.Column(db.Float, default=0)
+    total = db.Column(db.Float, default=0)
 
 class Venda(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -758,6 +882,13 @@ class Venda(db.Model):
     desconto = db.Column(db.Float, default=0.0)  # Valor do desconto
     valor_final = db.Column(db.Float)  # Valor final após desconto
 
+    __table_args__ = (
+        db.Index('idx_venda_empresa_data', 'empresa_id', 'data_prevista'),
+        db.Index('idx_venda_empresa_realizada', 'empresa_id', 'data_realizada', 'realizado'),
+        db.Index('idx_venda_usuario_empresa', 'usuario_id', 'empresa_id'),
+        db.Index('idx_venda_cliente', 'cliente_id'),
+    )
+
     # Relacionamentos
     cliente = db.relationship('Cliente', backref='vendas')
     usuario = db.relationship('Usuario', backref='vendas', lazy=True)
@@ -786,6 +917,13 @@ class Compra(db.Model):
     numero_parcelas = db.Column(db.Integer, default=1)  # Número de parcelas
     valor_parcela = db.Column(db.Float)  # Valor de cada parcela
 
+    __table_args__ = (
+        db.Index('idx_compra_empresa_data', 'empresa_id', 'data_prevista'),
+        db.Index('idx_compra_empresa_realizada', 'empresa_id', 'data_realizada', 'realizado'),
+        db.Index('idx_compra_usuario_empresa', 'usuario_id', 'empresa_id'),
+        db.Index('idx_compra_fornecedor', 'fornecedor_id'),
+    )
+
     # Relacionamentos
     fornecedor = db.relationship('Fornecedor', backref='compras')
     usuario = db.relationship('Usuario', backref='compras', lazy=True)
@@ -806,6 +944,13 @@ class Parcela(db.Model):
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
     data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('idx_parcela_venda', 'venda_id', 'numero'),
+        db.Index('idx_parcela_compra', 'compra_id', 'numero'),
+        db.Index('idx_parcela_lancamento', 'lancamento_id'),
+        db.Index('idx_parcela_usuario_vencimento', 'usuario_id', 'data_vencimento', 'realizado'),
+    )
+
     # Relacionamentos
     lancamento = db.relationship('Lancamento', backref='parcelas')
 
@@ -927,6 +1072,26 @@ class PermissaoSubUsuario(db.Model):
     # Relacionamentos
     empresa = db.relationship('Empresa', backref='permissoes_sub_usuarios')
 
+class VersaoPermissao(db.Model):
+    """
+    Versão das permissões de uma categoria, usuário ou sub-usuário, incrementada
+    a cada alteração. Cada processo compara estas versões com as das entradas do
+    CachePermissoes para descartar as desatualizadas.
+    """
+    __tablename__ = 'versao_permissao'
+    __table_args__ = (
+        db.UniqueConstraint('escopo', 'referencia_id', name='uq_versao_permissao'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    escopo = db.Column(db.String(20), nullable=False)  # categoria, usuario, sub_usuario
+    referencia_id = db.Column(db.Integer, nullable=False)
+    versao = db.Column(db.Integer, nullable=False, default=1)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<VersaoPermissao {self.escopo} {self.referencia_id} v{self.versao}>'
+
 class Voucher(db.Model):
     """Modelo para vouchers de assinatura"""
     __tablename__ = 'voucher'
@@ -1061,14 +1226,389 @@ class DreConfiguracao(db.Model):
     def __repr__(self):
         return f'<DreConfiguracao {self.codigo} - {self.descricao}>'
 
+class CuboPeriodoCache(db.Model):
+    """
+    Cache do cubo período × plano de contas (DRE e fluxo de caixa) de períodos
+    fechados. Cada linha guarda os valores de um período de calendário (dia, mês
+    ou trimestre) de uma empresa; é removida quando um lançamento com data
+    dentro do período é criado, alterado ou excluído.
+    """
+    __tablename__ = 'cubo_periodo_cache'
+    __table_args__ = (
+        db.UniqueConstraint('empresa_id', 'granularidade', 'periodo_inicio', name='uq_cubo_periodo_cache'),
+        db.Index('idx_cubo_periodo_empresa_datas', 'empresa_id', 'periodo_inicio', 'periodo_fim'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False)
+    granularidade = db.Column(db.String(10), nullable=False)  # 'dia', 'mes', 'trimestre'
+    periodo_inicio = db.Column(db.Date, nullable=False)
+    periodo_fim = db.Column(db.Date, nullable=False)
+    dados = db.Column(db.Text, nullable=False)  # JSON: {plano_conta_id: {'dre', 'entradas', 'saidas'}}
+    data_calculo = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CuboPeriodoCache {self.empresa_id} {self.granularidade} {self.periodo_inicio}>'
+
+class CarteiraContadorCache(db.Model):
+    """
+    Cache da carteira de um contador/BPO (totais por empresa vinculada) para um
+    período e uma data de referência (vencidos dependem de "hoje"). Gravado pela
+    tarefa agendada precalcular_carteiras_contadores; é removido quando
+    lançamentos, contas caixa ou a DRE de uma empresa autorizada mudam, e
+    ignorado quando o conjunto de empresas autorizadas é outro.
+    """
+    __tablename__ = 'carteira_contador_cache'
+    __table_args__ = (
+        db.UniqueConstraint('contador_id', 'periodo_inicio', 'periodo_fim', 'data_referencia',
+                            name='uq_carteira_contador_cache'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    contador_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=False, index=True)
+    periodo_inicio = db.Column(db.Date, nullable=False)
+    periodo_fim = db.Column(db.Date, nullable=False)
+    data_referencia = db.Column(db.Date, nullable=False)
+    dados = db.Column(db.Text, nullable=False)  # JSON: lista de totais por empresa
+    data_calculo = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<CarteiraContadorCache {self.contador_id} {self.periodo_inicio} {self.periodo_fim}>'
+
+class Job(db.Model):
+    """
+    Tarefa longa (importação, backup, exportação, sincronização) executada em
+    segundo plano pelo ExecutorJobs. Guarda a requisição original para ser
+    repetida fora do worker HTTP e a resposta produzida por ela.
+    """
+    __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('idx_job_status_executar_apos', 'status', 'executar_apos'),
+        db.Index('idx_job_empresa_status', 'empresa_id', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)  # importacao, backup, exportacao, estoque
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), nullable=True)
+    status = db.Column(db.String(20), default='pendente')  # pendente, executando, concluido, erro
+    progresso = db.Column(db.Integer, default=0)  # 0 a 100
+    mensagem = db.Column(db.String(255))
+    tentativas = db.Column(db.Integer, default=0)
+    max_tentativas = db.Column(db.Integer, default=1)
+    parametros = db.Column(db.Text)  # JSON: rota, método, formulário, arquivos e sessão da requisição
+    resultado = db.Column(db.Text)  # JSON: status HTTP, corpo, redirecionamento e mensagens flash
+    arquivo = db.Column(db.String(500))  # Artefato gerado, em uploads/jobs/<id>/
+    arquivo_nome = db.Column(db.String(255))
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    data_inicio = db.Column(db.DateTime)
+    data_fim = db.Column(db.DateTime)
+    data_sinal = db.Column(db.DateTime)  # Último sinal de vida do processo que executa o job
+    executar_apos = db.Column(db.DateTime)  # Espera antes de uma nova tentativa
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.tipo} {self.status}>'
+
+def garantir_indices_modelos():
+    """
+    Cria os índices declarados em __table_args__ que ainda não existem no banco.
+    db.create_all() só cria índices junto com tabelas novas; em bancos já existentes
+    (SQLite ou PostgreSQL) os índices são criados aqui com checkfirst.
+    """
+    verificados = []
+    for tabela in db.metadata.tables.values():
+        for indice in tabela.indexes:
+            try:
+                indice.create(bind=db.engine, checkfirst=True)
+                verificados.append(indice.name)
+            except Exception as e:
+                print(f"  ⚠️  Erro ao criar índice '{indice.name}': {str(e)}")
+    return verificados
+
 # Garantir criação de todas as tabelas após todos os modelos estarem definidos
 # (necessário em Gunicorn/produção onde __main__ não é executado)
 with app.app_context():
     try:
         db.create_all()
+        garantir_indices_modelos()
     except Exception as _e:
         print(f"⚠️ Aviso ao garantir criação de tabelas: {_e}")
 
+# ===== SNAPSHOT DIÁRIO DE SALDOS DAS CONTAS CAIXA =====
+
+def _contribuicao_saldo(lanc):
+    """
+    Retorna (conta_caixa_id, data, entrada, saida) com que um lançamento contribui
+    para o saldo da conta caixa, ou None se não movimenta saldo.
+    Aceita tanto um Lancamento quanto uma linha com as mesmas colunas.
+    """
+    if not lanc.realizado or not lanc.conta_caixa_id or not lanc.valor:
+        return None
+    data = lanc.data_realizada or lanc.data_prevista
+    if lanc.tipo == 'entrada':
+        return lanc.conta_caixa_id, data, lanc.valor, 0.0
+    if lanc.tipo == 'saida':
+        return lanc.conta_caixa_id, data, 0.0, lanc.valor
+    return None
+
+
+def _aplicar_movimento_saldo(conexao, conta_caixa_id, data, entradas, saidas):
+    """Soma um movimento ao dia e a todos os acumulados posteriores da conta."""
+    tabela = SaldoContaCaixaDiario.__table__
+    c = tabela.c
+
+    resultado = conexao.execute(
+        tabela.update()
+        .where(c.conta_caixa_id == conta_caixa_id, c.data == data)
+        .values(entradas_dia=c.entradas_dia + entradas,
+                saidas_dia=c.saidas_dia + saidas,
+                entradas_acumuladas=c.entradas_acumuladas + entradas,
+                saidas_acumuladas=c.saidas_acumuladas + saidas)
+    )
+    if resultado.rowcount == 0:
+        anterior = conexao.execute(
+            db.select(c.entradas_acumuladas, c.saidas_acumuladas)
+            .where(c.conta_caixa_id == conta_caixa_id, c.data < data)
+            .order_by(c.data.desc())
+            .limit(1)
+        ).first()
+        entradas_anteriores, saidas_anteriores = (anterior or (0.0, 0.0))
+        conexao.execute(tabela.insert().values(
+            conta_caixa_id=conta_caixa_id,
+            data=data,
+            entradas_dia=entradas,
+            saidas_dia=saidas,
+            entradas_acumuladas=(entradas_anteriores or 0.0) + entradas,
+            saidas_acumuladas=(saidas_anteriores or 0.0) + saidas
+        ))
+
+    conexao.execute(
+        tabela.update()
+        .where(c.conta_caixa_id == conta_caixa_id, c.data > data)
+        .values(entradas_acumuladas=c.entradas_acumuladas + entradas,
+                saidas_acumuladas=c.saidas_acumuladas + saidas)
+    )
+
+
+@event.listens_for(db.session, 'before_flush')
+def _saldo_capturar_estado_anterior(sessao, flush_context, instances):
+    """
+    Guarda, antes do flush, o estado gravado no banco dos lançamentos alterados/excluídos:
+    a contribuição de saldo (snapshot diário) e as datas (invalidação do cubo de períodos).
+    """
+    from sqlalchemy import inspect as sa_inspect
+
+    ids = []
+    for obj in list(sessao.dirty) + list(sessao.deleted):
+        if isinstance(obj, Lancamento):
+            identidade = sa_inspect(obj).identity
+            if identidade:
+                ids.append(identidade[0])
+
+    anteriores = sessao.info.setdefault('saldo_contribuicoes_anteriores', {})
+    datas_anteriores = sessao.info.setdefault('cubo_datas_anteriores', {})
+    if ids:
+        linhas = sessao.connection().execute(
+            db.select(Lancamento.id, Lancamento.realizado, Lancamento.conta_caixa_id, Lancamento.tipo,
+                      Lancamento.valor, Lancamento.data_realizada, Lancamento.data_prevista,
+                      Lancamento.empresa_id)
+            .where(Lancamento.id.in_(ids))
+        ).all()
+        for linha in linhas:
+            anteriores[linha.id] = _contribuicao_saldo(linha)
+            datas_anteriores[linha.id] = (linha.empresa_id, linha.data_prevista, linha.data_realizada)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _saldo_aplicar_movimentos(sessao, flush_context):
+    """Atualiza o snapshot diário com a diferença entre o estado anterior e o novo de cada lançamento."""
+    from collections import defaultdict
+    from sqlalchemy import inspect as sa_inspect
+
+    anteriores = sessao.info.pop('saldo_contribuicoes_anteriores', {})
+    contas_excluidas = set()
+    movimentos = defaultdict(lambda: [0.0, 0.0])
+
+    def acumular(contribuicao, sinal):
+        if contribuicao:
+            conta_caixa_id, data, entrada, saida = contribuicao
+            movimentos[(conta_caixa_id, data)][0] += sinal * entrada
+            movimentos[(conta_caixa_id, data)][1] += sinal * saida
+
+    for obj in sessao.new:
+        if isinstance(obj, Lancamento):
+            acumular(_contribuicao_saldo(obj), 1)
+
+    for obj in sessao.dirty:
+        if isinstance(obj, Lancamento):
+            identidade = sa_inspect(obj).identity
+            if identidade and identidade[0] in anteriores:
+                acumular(anteriores[identidade[0]], -1)
+                acumular(_contribuicao_saldo(obj), 1)
+
+    for obj in sessao.deleted:
+        identidade = sa_inspect(obj).identity
+        if isinstance(obj, Lancamento) and identidade:
+            acumular(anteriores.get(identidade[0]), -1)
+        elif isinstance(obj, ContaCaixa) and identidade:
+            contas_excluidas.add(identidade[0])
+
+    conexao = None
+    for (conta_caixa_id, data), (entradas, saidas) in movimentos.items():
+        if conta_caixa_id in contas_excluidas or (abs(entradas) < 1e-9 and abs(saidas) < 1e-9):
+            continue
+        conexao = conexao or sessao.connection()
+        _aplicar_movimento_saldo(conexao, conta_caixa_id, data, entradas, saidas)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _saldo_descartar_estado_anterior(sessao):
+    sessao.info.pop('saldo_contribuicoes_anteriores', None)
+    sessao.info.pop('cubo_datas_anteriores', None)
+
+
+def saldos_contas_caixa_ate(conta_ids, data_limite=None):
+    """
+    Retorna {conta_caixa_id: (entradas, saidas)} realizados até data_limite (inclusive),
+    lendo a última linha do snapshot de cada conta. Sem data_limite considera tudo.
+    """
+    conta_ids = [cid for cid in conta_ids if cid]
+    if not conta_ids:
+        return {}
+
+    S = SaldoContaCaixaDiario
+    ultimas = db.session.query(S.conta_caixa_id, db.func.max(S.data).label('data')).filter(
+        S.conta_caixa_id.in_(conta_ids)
+    )
+    if data_limite:
+        ultimas = ultimas.filter(S.data <= data_limite)
+    ultimas = ultimas.group_by(S.conta_caixa_id).subquery()
+
+    linhas = db.session.query(S.conta_caixa_id, S.entradas_acumuladas, S.saidas_acumuladas).join(
+        ultimas, db.and_(S.conta_caixa_id == ultimas.c.conta_caixa_id, S.data == ultimas.c.data)
+    ).all()
+
+    return {linha.conta_caixa_id: (float(linha.entradas_acumuladas or 0), float(linha.saidas_acumuladas or 0))
+            for linha in linhas}
+
+
+def _movimentos_diarios_por_varredura(conta_ids=None):
+    """Soma os lançamentos realizados por (conta, dia) direto da tabela lancamento."""
+    data_movimento = db.func.coalesce(Lancamento.data_realizada, Lancamento.data_prevista)
+    query = db.session.query(
+        Lancamento.conta_caixa_id,
+        data_movimento.label('data'),
+        db.func.coalesce(db.func.sum(db.case((Lancamento.tipo == 'entrada', Lancamento.valor), else_=0)), 0).label('entradas'),
+        db.func.coalesce(db.func.sum(db.case((Lancamento.tipo == 'saida', Lancamento.valor), else_=0)), 0).label('saidas')
+    ).filter(
+        Lancamento.realizado == True,
+        Lancamento.conta_caixa_id.isnot(None)
+    )
+    if conta_ids is not None:
+        query = query.filter(Lancamento.conta_caixa_id.in_(conta_ids))
+    return query.group_by(Lancamento.conta_caixa_id, data_movimento).order_by(
+        Lancamento.conta_caixa_id, data_movimento
+    ).all()
+
+
+def reconstruir_saldos_contas_caixa(conta_ids=None):
+    """
+    Reconstrói do zero o snapshot diário a partir dos lançamentos realizados.
+    Sem conta_ids reconstrói todas as contas. Retorna o número de linhas geradas.
+    """
+    query_exclusao = SaldoContaCaixaDiario.query
+    if conta_ids is not None:
+        query_exclusao = query_exclusao.filter(SaldoContaCaixaDiario.conta_caixa_id.in_(conta_ids))
+    query_exclusao.delete(synchronize_session=False)
+
+    linhas = []
+    conta_atual, entradas_acumuladas, saidas_acumuladas = None, 0.0, 0.0
+    for mov in _movimentos_diarios_por_varredura(conta_ids):
+        if mov.conta_caixa_id != conta_atual:
+            conta_atual, entradas_acumuladas, saidas_acumuladas = mov.conta_caixa_id, 0.0, 0.0
+        entradas_acumuladas += float(mov.entradas)
+        saidas_acumuladas += float(mov.saidas)
+        linhas.append({
+            'conta_caixa_id': mov.conta_caixa_id,
+            'data': mov.data,
+            'entradas_dia': float(mov.entradas),
+            'saidas_dia': float(mov.saidas),
+            'entradas_acumuladas': entradas_acumuladas,
+            'saidas_acumuladas': saidas_acumuladas
+        })
+
+    for inicio in range(0, len(linhas), 1000):
+        db.session.execute(SaldoContaCaixaDiario.__table__.insert(), linhas[inicio:inicio + 1000])
+    db.session.commit()
+    return len(linhas)
+
+
+def verificar_saldos_contas_caixa(conta_ids=None, tolerancia=0.01):
+    """
+    Confere o snapshot diário contra o cálculo por varredura completa dos lançamentos.
+    Retorna lista de divergências (vazia quando o snapshot está consistente).
+    """
+    esperado = {}
+    for mov in _movimentos_diarios_por_varredura(conta_ids):
+        esperado[(mov.conta_caixa_id, mov.data)] = (float(mov.entradas), float(mov.saidas))
+
+    query = db.session.query(
+        SaldoContaCaixaDiario.conta_caixa_id, SaldoContaCaixaDiario.data,
+        SaldoContaCaixaDiario.entradas_dia, SaldoContaCaixaDiario.saidas_dia,
+        SaldoContaCaixaDiario.entradas_acumuladas, SaldoContaCaixaDiario.saidas_acumuladas
+    )
+    if conta_ids is not None:
+        query = query.filter(SaldoContaCaixaDiario.conta_caixa_id.in_(conta_ids))
+    registrado = {(l.conta_caixa_id, l.data): l for l in query.all()}
+
+    divergencias = []
+    acumulado = {}
+    for chave in sorted(set(esperado) | set(registrado)):
+        conta_caixa_id, data = chave
+        entradas_dia, saidas_dia = esperado.get(chave, (0.0, 0.0))
+        entradas_acum, saidas_acum = acumulado.get(conta_caixa_id, (0.0, 0.0))
+        entradas_acum, saidas_acum = entradas_acum + entradas_dia, saidas_acum + saidas_dia
+        acumulado[conta_caixa_id] = (entradas_acum, saidas_acum)
+
+        linha = registrado.get(chave)
+        if linha is None:
+            if entradas_dia or saidas_dia:
+                divergencias.append({
+                    'conta_caixa_id': conta_caixa_id,
+                    'data': data,
+                    'campo': 'linha_ausente',
+                    'esperado': round(entradas_dia - saidas_dia, 2),
+                    'registrado': None
+                })
+            continue
+
+        for campo, valor_esperado in (('entradas_dia', entradas_dia), ('saidas_dia', saidas_dia),
+                                      ('entradas_acumuladas', entradas_acum), ('saidas_acumuladas', saidas_acum)):
+            valor_registrado = float(getattr(linha, campo) or 0)
+            if abs(valor_registrado - valor_esperado) > tolerancia:
+                divergencias.append({
+                    'conta_caixa_id': conta_caixa_id,
+                    'data': data,
+                    'campo': campo,
+                    'esperado': round(valor_esperado, 2),
+                    'registrado': round(valor_registrado, 2)
+                })
+    return divergencias
+
+
+# Construir o snapshot na primeira inicialização após a criação da tabela
+with app.app_context():
+    try:
+        if not db.session.query(SaldoContaCaixaDiario.id).first() and db.session.query(Lancamento.id).filter(
+            Lancamento.realizado == True, Lancamento.conta_caixa_id.isnot(None)
+        ).first():
+            print("Construindo snapshot diário de saldos das contas caixa...")
+            total_linhas = reconstruir_saldos_contas_caixa()
+            print(f"✅ Snapshot de saldos criado ({total_linhas} linhas)")
+    except Exception as e:
+        print(f"⚠️ Aviso: Não foi possível construir o snapshot de saldos: {str(e)}")
+        db.session.rollback()
+
 # ===== INICIALIZAÇÃO DOS SERVIÇOS =====
 def obter_modelos():
     """Retorna dicionário com todos os modelos para os serviços"""
@@ -1120,13 +1660,377 @@ def validar_sessao_ativa():
 
     return False, None, None
 
+# ===== CACHE DE PERMISSÕES =====
+
+class CachePermissoes:
+    """
+    Cache LRU, por processo, das permissões de categorias ('categoria' →
+    frozenset de (modulo, acao)), de usuários sem categoria ('usuario' →
+    frozenset, ou None quando não há Permissao cadastrada), da categoria de
+    cada sub-usuário ('sub_usuario' → (existe, categoria_id)) e das empresas
+    que contadores e sub-usuários podem acessar ('contador' e ('sub_usuario',
+    'empresas') → frozenset de empresa_id).
+
+    Cada entrada guarda a versão (VersaoPermissao) com que foi carregada e é
+    recarregada quando a versão muda ou, se tiver validade, quando expira.
+    Itens diferentes de uma mesma referência compartilham a versão. As versões só são relidas do banco quando
+    o arquivo de sinal muda, o que outro processo faz ao gravar uma alteração;
+    assim uma verificação de permissão não consulta o banco.
+    """
+
+    _SEM_LEITURA = object()
+
+    def __init__(self, capacidade=2048, arquivo_sinal=None):
+        self.capacidade = capacidade
+        self.arquivo_sinal = arquivo_sinal
+        self.trava = threading.Lock()
+        self.itens = OrderedDict()
+        self.versoes = {}
+        self.sinal = self._SEM_LEITURA  # Conteúdo do arquivo de sinal na última leitura das versões
+
+    def _ler_sinal(self):
+        try:
+            with open(self.arquivo_sinal, encoding='utf-8') as arquivo:
+                return arquivo.read()
+        except OSError:
+            return ''
+
+    def sincronizar(self):
+        """Relê as versões do banco se houve alteração desde a última leitura (uma vez por requisição)"""
+        sinal = self._ler_sinal() if self.arquivo_sinal else None
+        if sinal is not None and sinal == self.sinal:
+            return
+        versoes = {
+            (escopo, referencia_id): versao
+            for escopo, referencia_id, versao in db.session.query(
+                VersaoPermissao.escopo, VersaoPermissao.referencia_id, VersaoPermissao.versao
+            )
+        }
+        with self.trava:
+            self.versoes = versoes
+            self.sinal = sinal
+
+    def obter(self, escopo, referencia_id, carregar, item=None, validade=None):
+        """
+        Valor em cache para (escopo, referencia_id, item); carregar() é chamado
+        na ausência, se desatualizado ou depois de validade segundos.
+        """
+        chave = (escopo, referencia_id, item)
+        agora = time.monotonic()
+        with self.trava:
+            versao = self.versoes.get((escopo, referencia_id), 0)
+            entrada = self.itens.get(chave)
+            if entrada is not None and entrada[0] == versao and (entrada[2] is None or entrada[2] > agora):
+                self.itens.move_to_end(chave)
+                return entrada[1]
+
+        valor = carregar()
+        with self.trava:
+            self.itens[chave] = (versao, valor, agora + validade if validade else None)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.capacidade:
+                self.itens.popitem(last=False)
+        return valor
+
+    def descartar(self, referencias):
+        """Remove as entradas de (escopo, referencia_id) alteradas por este processo e força a releitura das versões"""
+        referencias = set(referencias)
+        with self.trava:
+            for chave in [chave for chave in self.itens if chave[:2] in referencias]:
+                del self.itens[chave]
+            self.sinal = self._SEM_LEITURA
+
+    def sinalizar(self):
+        """Avisa os demais processos que há versões novas, regravando o arquivo de sinal"""
+        if not self.arquivo_sinal:
+            return
+        try:
+            temporario = f'{self.arquivo_sinal}.{os.getpid()}.tmp'
+            with open(temporario, 'w', encoding='utf-8') as arquivo:
+                arquivo.write(f'{os.getpid()}:{datetime.utcnow().isoformat()}:{id(arquivo)}')
+            os.replace(temporario, self.arquivo_sinal)
+        except OSError as e:
+            app.logger.warning(f"Não foi possível gravar o sinal do cache de permissões: {e}")
+
+    def limpar(self):
+        with self.trava:
+            self.itens.clear()
+            self.versoes = {}
+            self.sinal = self._SEM_LEITURA
+
+
+cache_permissoes = CachePermissoes(
+    capacidade=app.config['PERMISSOES_CACHE_TAMANHO'],
+    arquivo_sinal=app.config['PERMISSOES_ARQUIVO_SINAL'] or None,
+)
+
+
+def registrar_alteracao_permissoes(escopo, referencia_ids):
+    """
+    Incrementa, na transação atual, a versão das permissões das categorias,
+    usuários, sub-usuários ou contadores informados (escopo 'categoria',
+    'usuario', 'sub_usuario' ou 'contador'). Deve ser chamada antes do commit
+    por quem altera Permissao, PermissaoCategoria, a categoria ou as empresas
+    (PermissaoSubUsuario) de um sub-usuário ou os vínculos (VinculoContador)
+    autorizados de um contador.
+    """
+    ids = {int(referencia_id) for referencia_id in referencia_ids if referencia_id}
+    if not ids:
+        return
+
+    tabela = VersaoPermissao.__table__
+    agora = datetime.utcnow()
+    existentes = {
+        referencia_id for (referencia_id,) in db.session.query(VersaoPermissao.referencia_id).filter(
+            VersaoPermissao.escopo == escopo,
+            VersaoPermissao.referencia_id.in_(ids)
+        )
+    }
+    if existentes:
+        db.session.execute(
+            tabela.update().where(
+                tabela.c.escopo == escopo,
+                tabela.c.referencia_id.in_(existentes)
+            ).values(versao=tabela.c.versao + 1, data_atualizacao=agora)
+        )
+    novos = ids - existentes
+    if novos:
+        db.session.execute(tabela.insert(), [
+            {'escopo': escopo, 'referencia_id': referencia_id, 'versao': 1, 'data_atualizacao': agora}
+            for referencia_id in novos
+        ])
+    db.session.info.setdefault('permissoes_alteradas', set()).update((escopo, r) for r in ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _permissoes_avisar_alteracao(sessao):
+    alteradas = sessao.info.pop('permissoes_alteradas', None)
+    if alteradas:
+        cache_permissoes.descartar(alteradas)
+        cache_permissoes.sinalizar()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _permissoes_descartar_alteracao(sessao):
+    sessao.info.pop('permissoes_alteradas', None)
+
+
+def _sincronizar_cache_requisicao():
+    from flask import has_request_context
+
+    if has_request_context():
+        contexto_requisicao().sincronizar_cache()
+
+
+def empresas_autorizadas_contador(contador_id):
+    """Empresas com vínculo autorizado (VinculoContador) com o contador, via cache_permissoes"""
+    _sincronizar_cache_requisicao()
+    return cache_permissoes.obter('contador', contador_id, lambda: frozenset(
+        empresa_id for (empresa_id,) in db.session.query(VinculoContador.empresa_id).filter(
+            VinculoContador.contador_id == contador_id,
+            VinculoContador.status == 'autorizado'
+        )
+    ), validade=app.config['CONTADOR_VINCULOS_TTL'])
+
+
+def empresas_permitidas_sub_usuario(sub_usuario_id):
+    """Empresas que o sub-usuário do contador pode acessar (PermissaoSubUsuario), via cache_permissoes"""
+    _sincronizar_cache_requisicao()
+    return cache_permissoes.obter('sub_usuario', sub_usuario_id, lambda: frozenset(
+        empresa_id for (empresa_id,) in db.session.query(PermissaoSubUsuario.empresa_id).filter(
+            PermissaoSubUsuario.sub_usuario_id == sub_usuario_id
+        )
+    ), item='empresas', validade=app.config['CONTADOR_VINCULOS_TTL'])
+
+
+# ===== CONTEXTO DA REQUISIÇÃO =====
+
+MENSAGEM_SEM_PERMISSAO_MODULO = 'Você não tem permissão para acessar este módulo. Entre em contato com o usuário master.'
+
+# Chaves da sessão que determinam usuário, empresa efetiva e permissões
+_CHAVES_CONTEXTO_SESSAO = (
+    'usuario_id', 'sub_usuario_id', 'sub_usuario_id_original', 'usuario_tipo', 'empresa_id',
+    'empresa_id_original', 'contador_id', 'acesso_contador',
+)
+
+
+class ContextoRequisicao:
+    """
+    Usuário, empresa, empresa efetiva e permissões da requisição atual,
+    resolvidos uma única vez e guardados em flask.g.
+
+    Os hooks before_request, verificar_acesso_modulo() e obter_empresa_id_sessao()
+    leem daqui em vez de consultar Usuario, Empresa, VinculoContador e as
+    permissões a cada chamada. Cada valor só é carregado quando usado pela
+    primeira vez; as permissões vêm do cache_permissoes.
+
+    permissoes é None quando o usuário tem acesso total; caso contrário, é o
+    conjunto de pares (modulo, acao) liberados.
+    """
+
+    _NAO_CARREGADO = object()
+
+    def __init__(self, requisicao, chave):
+        self.requisicao = requisicao
+        self.chave = chave
+        self._usuario = self._NAO_CARREGADO
+        self._empresa = self._NAO_CARREGADO
+        self._empresa_id = self._NAO_CARREGADO
+        self._permissoes = self._NAO_CARREGADO
+        self._cache_sincronizado = False
+
+    def sincronizar_cache(self):
+        """Atualiza as versões do cache_permissoes uma vez por requisição"""
+        if not self._cache_sincronizado:
+            cache_permissoes.sincronizar()
+            self._cache_sincronizado = True
+
+    @property
+    def usuario(self):
+        if self._usuario is self._NAO_CARREGADO:
+            usuario_id = session.get('usuario_id')
+            self._usuario = db.session.get(Usuario, usuario_id) if usuario_id else None
+        return self._usuario
+
+    @property
+    def empresa(self):
+        """Empresa gravada na sessão (a vinculada, quando o contador acessa um cliente)"""
+        if self._empresa is self._NAO_CARREGADO:
+            empresa_id = session.get('empresa_id')
+            self._empresa = db.session.get(Empresa, empresa_id) if empresa_id else None
+        return self._empresa
+
+    @property
+    def empresa_id(self):
+        if self._empresa_id is self._NAO_CARREGADO:
+            self._empresa_id = _resolver_empresa_id_sessao(session, self.usuario)
+            # A resolução pode encerrar o acesso de contador na sessão
+            self.chave = _chave_contexto_sessao()
+        return self._empresa_id
+
+    @property
+    def permissoes(self):
+        if self._permissoes is self._NAO_CARREGADO:
+            self._permissoes = self._carregar_permissoes()
+        return self._permissoes
+
+    def _permissoes_categoria(self, categoria_id):
+        return cache_permissoes.obter('categoria', categoria_id, lambda: frozenset(
+            db.session.query(PermissaoCategoria.modulo, PermissaoCategoria.acao).filter(
+                PermissaoCategoria.categoria_id == categoria_id,
+                PermissaoCategoria.ativo == True
+            ).all()
+        ))
+
+    def _permissoes_usuario(self, usuario_id):
+        def carregar():
+            linhas = db.session.query(Permissao.modulo, Permissao.acao, Permissao.ativo).filter(
+                Permissao.usuario_id == usuario_id
+            ).all()
+            if not linhas:
+                return None
+            return frozenset((modulo, acao) for modulo, acao, ativo in linhas if ativo)
+
+        return cache_permissoes.obter('usuario', usuario_id, carregar)
+
+    def _permissoes_sub_usuario(self, sub_usuario_id):
+        def carregar():
+            sub = db.session.get(SubUsuarioContador, sub_usuario_id)
+            return (sub is not None, sub.categoria_id if sub else None)
+
+        existe, categoria_id = cache_permissoes.obter('sub_usuario', sub_usuario_id, carregar)
+        if not existe:
+            return frozenset()
+        # Sem categoria = "Sem restrições" → acesso total
+        return self._permissoes_categoria(categoria_id) if categoria_id else None
+
+    def _carregar_permissoes(self):
+        """
+        Regras:
+        - Admin e usuario_principal: acesso total
+        - Contador em acesso_contador (empresa vinculada): acesso total, exceto
+          sub-usuário com categoria, que segue a PermissaoCategoria dela
+        - sub_contador: PermissaoCategoria da categoria do sub-usuário (sem categoria = acesso total)
+        - Usuario tipo='usuario' com categoria_id: PermissaoCategoria da categoria
+        - Usuario tipo='usuario' sem categoria: Permissao individual; sem nenhuma
+          Permissao cadastrada, acesso total (compatibilidade com usuários antigos)
+
+        Categorias, permissões individuais e a categoria dos sub-usuários vêm do
+        cache_permissoes.
+        """
+        tipo = session.get('usuario_tipo')
+
+        if tipo in ('admin', 'usuario_principal'):
+            return None
+
+        self.sincronizar_cache()
+
+        if session.get('acesso_contador'):
+            sub_usuario_id = session.get('sub_usuario_id_original')
+            if not sub_usuario_id:
+                return None  # Contador master = acesso total
+            return self._permissoes_sub_usuario(sub_usuario_id)
+
+        if tipo == 'sub_contador':
+            sub_usuario_id = session.get('sub_usuario_id')
+            return self._permissoes_sub_usuario(sub_usuario_id) if sub_usuario_id else frozenset()
+
+        if tipo == 'usuario':
+            u = self.usuario
+            if not u:
+                return frozenset()
+            if u.tipo in ('admin', 'usuario_principal'):
+                return None
+            if u.categoria_id:
+                return self._permissoes_categoria(u.categoria_id)
+            return self._permissoes_usuario(u.id)
+
+        return None
+
+    def tem_permissao(self, modulo, acao):
+        permissoes = self.permissoes
+        return permissoes is None or (modulo, acao) in permissoes
+
+
+def _chave_contexto_sessao():
+    return tuple(session.get(chave) for chave in _CHAVES_CONTEXTO_SESSAO)
+
+
+def contexto_requisicao():
+    """
+    Contexto da requisição atual (flask.g). É recriado quando a sessão troca de
+    usuário ou de empresa no meio da requisição (login, acesso de contador) e a
+    cada requisição reproduzida por um job.
+    """
+    requisicao = request._get_current_object()
+    contexto = g.get('contexto_requisicao')
+    if contexto is None or contexto.requisicao is not requisicao or contexto.chave != _chave_contexto_sessao():
+        contexto = ContextoRequisicao(requisicao, _chave_contexto_sessao())
+        g.contexto_requisicao = contexto
+    return contexto
+
+
 # Função auxiliar para obter empresa_id correta da sessão
 def obter_empresa_id_sessao(session, usuario):
     """
     Retorna a empresa_id correta baseada na sessão.
     Se acesso_contador estiver ativo, valida o vínculo e retorna a empresa vinculada.
     Caso contrário, retorna a empresa do usuário.
+
+    Dentro de uma requisição, para o usuário da sessão, o resultado vem do
+    contexto da requisição e o vínculo é validado uma única vez.
     """
+    from flask import has_request_context, session as sessao_requisicao
+
+    if has_request_context() and session is sessao_requisicao:
+        contexto = contexto_requisicao()
+        if usuario is contexto.usuario:
+            return contexto.empresa_id
+    return _resolver_empresa_id_sessao(session, usuario)
+
+
+def _resolver_empresa_id_sessao(session, usuario):
+    """Valida o vínculo do contador (pelo cache_permissoes) e retorna a empresa_id efetiva"""
     if session.get('acesso_contador') and session.get('empresa_id'):
         # SEGURANÇA: Validar que o vínculo ainda está autorizado
         empresa_vinculada_id = session.get('empresa_id')
@@ -1139,22 +2043,11 @@ def obter_empresa_id_sessao(session, usuario):
 
         if contador_id:
             # Verificar se o vínculo existe e está autorizado
-            vinculo = VinculoContador.query.filter_by(
-                contador_id=contador_id,
-                empresa_id=empresa_vinculada_id,
-                status='autorizado'
-            ).first()
-
-            if vinculo:
+            if empresa_vinculada_id in empresas_autorizadas_contador(contador_id):
                 # Vínculo válido - para sub-usuários, verificar permissão adicional
                 if session.get('usuario_tipo') == 'sub_contador':
                     sub_usuario_id = session.get('sub_usuario_id')
-                    permissao = PermissaoSubUsuario.query.filter_by(
-                        sub_usuario_id=sub_usuario_id,
-                        empresa_id=empresa_vinculada_id
-                    ).first()
-
-                    if not permissao:
+                    if empresa_vinculada_id not in empresas_permitidas_sub_usuario(sub_usuario_id):
                         # Sub-usuário sem permissão - limpar sessão
                         session.pop('acesso_contador', None)
                         session.pop('empresa_id', None)
@@ -1173,113 +2066,484 @@ def obter_empresa_id_sessao(session, usuario):
     return usuario.empresa_id if usuario and usuario.empresa_id else None
 
 
-# ===== CONTROLE DE ACESSO POR MÓDULO =====
+# ===== JOBS EM SEGUNDO PLANO =====
 
-_MODULOS_PREFIXOS = {
-    '/lancamentos':     'lancamentos',
-    '/novo-lancamento': 'lancamentos',
-    '/clientes':        'clientes',
-    '/novo-cliente':    'clientes',
-    '/fornecedores':    'fornecedores',
-    '/novo-fornecedor': 'fornecedores',
-    '/vendas':          'vendas',
-    '/nova-venda':      'vendas',
-    '/compras':         'compras',
-    '/nova-compra':     'compras',
-    '/estoque':         'estoque',
-    '/relatorios':      'relatorios',
-    '/dre':             'relatorios',
-    '/plano-contas':    'plano_contas',
-    '/importacao':      'importacao',
-    '/conciliacao':     'conciliacao',
-    '/conta-caixa':     'configuracoes',
-}
+def pasta_job(job_id):
+    """Pasta dos arquivos recebidos e dos artefatos gerados por um job (uploads/jobs/<id>)."""
+    return os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], 'jobs', str(job_id)))
 
-def _modulo_da_url(path):
-    for prefixo, modulo in _MODULOS_PREFIXOS.items():
-        if path == prefixo or path.startswith(prefixo + '/'):
-            return modulo
-    return None
 
-def _acao_da_requisicao(path, method):
-    if method == 'GET':
-        return 'visualizar'
-    p = path.lower()
-    if any(k in p for k in ('deletar', 'excluir', 'remover')):
-        return 'deletar'
-    if any(k in p for k in ('editar', 'atualizar')):
-        return 'editar'
-    return 'criar'
+# Chaves da sessão gravadas no job e restauradas na execução: só a identidade do
+# usuário, da empresa e do acesso de contador/sub-usuário
+_CHAVES_SESSAO_JOB = _CHAVES_CONTEXTO_SESSAO + ('tipo_conta', 'usuario_id_original')
 
-def verificar_acesso_modulo(modulo, acao):
+
+class FalhaRotaJob(Exception):
     """
-    Verifica se o usuário atual tem acesso ao módulo/ação.
-    Retorna (tem_acesso: bool, mensagem: str).
+    Exceção levantada pela rota durante a execução do job. A rota pode ter
+    gravado parte do trabalho, então o job não é repetido.
+    """
+
+
+def _erro_transitorio(erro):
+    """Falhas momentâneas de banco/rede, que justificam uma nova tentativa do job."""
+    from sqlalchemy.exc import OperationalError, DisconnectionError, TimeoutError as TimeoutPool
+    return isinstance(erro, (OperationalError, DisconnectionError, TimeoutPool, TimeoutError, ConnectionError))
 
-    Regras:
-    - Admin e usuario_principal: acesso total
-    - Contador em acesso_contador (empresa vinculada): acesso total
-    - sub_contador: verifica PermissaoCategoria da categoria do sub-usuário
-    - Usuario tipo='usuario' com categoria_id: verifica PermissaoCategoria (tempo real)
-    - Usuario tipo='usuario' sem categoria e sem Permissao: libera (compatibilidade)
+
+def enfileirar_job(tipo, max_tentativas=1):
+    """
+    Registra a requisição atual como job pendente. Os arquivos enviados são
+    gravados na pasta do job; rota, formulário e as chaves de identidade da
+    sessão (_CHAVES_SESSAO_JOB) ficam em Job.parametros.
     """
-    tipo = session.get('usuario_tipo')
+    from werkzeug.utils import secure_filename
 
-    if tipo in ('admin', 'usuario_principal'):
-        return True, ''
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    job = Job(
+        tipo=tipo,
+        usuario_id=usuario.id,
+        empresa_id=obter_empresa_id_sessao(session, usuario),
+        status='pendente',
+        max_tentativas=max_tentativas,
+        mensagem='Aguardando execução'
+    )
+    db.session.add(job)
+    db.session.flush()
+
+    arquivos = {}
+    for campo, enviados in request.files.lists():
+        pasta = os.path.join(pasta_job(job.id), 'entrada')
+        os.makedirs(pasta, exist_ok=True)
+        for i, enviado in enumerate(enviados):
+            caminho = os.path.join(pasta, f"{campo}_{i}_{secure_filename(enviado.filename or '') or 'arquivo'}")
+            enviado.save(caminho)
+            arquivos.setdefault(campo, []).append([caminho, enviado.filename])
+
+    job.parametros = json.dumps({
+        'metodo': request.method,
+        'caminho': request.path,
+        'query': request.query_string.decode('latin-1'),
+        'formulario': request.form.to_dict(flat=False),
+        'arquivos': arquivos,
+        'sessao': {chave: session[chave] for chave in _CHAVES_SESSAO_JOB if chave in session},
+    }, default=str)
+    db.session.commit()
+    executor_jobs.acordar()
+    return job
 
-    if session.get('acesso_contador'):
-        # Sub-usuário do contador acessando empresa vinculada: ainda verifica a categoria de permissão
-        sub_id_orig = session.get('sub_usuario_id_original')
-        if sub_id_orig:
-            sub = db.session.get(SubUsuarioContador, sub_id_orig)
-            if not sub:
-                return False, 'Você não tem permissão para acessar este módulo. Entre em contato com o usuário master.'
-            if not sub.categoria_id:
-                return True, ''  # Sem restrições = acesso total
-            perm = PermissaoCategoria.query.filter_by(
-                categoria_id=sub.categoria_id, modulo=modulo, acao=acao, ativo=True
-            ).first()
-            return (perm is not None), ('' if perm else 'Você não tem permissão para acessar este módulo. Entre em contato com o usuário master.')
-        return True, ''  # Contador master = acesso total
 
-    MSG = 'Você não tem permissão para acessar este módulo. Entre em contato com o usuário master.'
+def resposta_job_enfileirado(job):
+    """202 com o id do job para fetch/AJAX; na navegação comum, página que acompanha o job."""
+    dados = {
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('api_status_job', job_id=job.id),
+        'resultado_url': url_for('api_resultado_job', job_id=job.id),
+    }
+    if any(tipo == 'text/html' for tipo, _ in request.accept_mimetypes):
+        usuario = db.session.get(Usuario, session['usuario_id'])
+        return render_template('job_status.html', usuario=usuario, job=job, **dados), 202
+    return jsonify(dados), 202
+
 
-    if tipo == 'sub_contador':
-        sub_id = session.get('sub_usuario_id')
-        sub = db.session.get(SubUsuarioContador, sub_id) if sub_id else None
-        if not sub:
-            return False, MSG
-        # Sem categoria = "Sem restrições" → acesso total
-        if not sub.categoria_id:
-            return True, ''
-        perm = PermissaoCategoria.query.filter_by(
-            categoria_id=sub.categoria_id, modulo=modulo, acao=acao, ativo=True
-        ).first()
-        return (perm is not None), ('' if perm else MSG)
-
-    if tipo == 'usuario':
-        uid = session.get('usuario_id')
-        u = db.session.get(Usuario, uid) if uid else None
-        if not u:
-            return False, MSG
-        if u.tipo in ('admin', 'usuario_principal'):
-            return True, ''
-        if u.categoria_id:
-            perm = PermissaoCategoria.query.filter_by(
-                categoria_id=u.categoria_id, modulo=modulo, acao=acao, ativo=True
-            ).first()
-            return (perm is not None), ('' if perm else MSG)
-        # Sem categoria: verificar Permissao individual
-        perm = Permissao.query.filter_by(usuario_id=uid, modulo=modulo, acao=acao, ativo=True).first()
-        if perm:
-            return True, ''
-        # Sem nenhuma Permissao cadastrada: libera (compatibilidade com usuários antigos)
-        if Permissao.query.filter_by(usuario_id=uid).count() == 0:
-            return True, ''
-        return False, MSG
+def em_segundo_plano(tipo, max_tentativas=1, quando=None):
+    """
+    Decorador de rota: a chamada vira um job e a resposta é o id dele. A rota
+    continua escrita como uma rota comum; o ExecutorJobs a executa depois com a
+    requisição original reconstruída, e a resposta (arquivo, JSON ou
+    redirecionamento com mensagens) fica em /api/jobs/<id>/resultado.
+
+    max_tentativas > 1 só para rotas que podem ser repetidas sem efeito
+    colateral (exportações, backups). quando(**view_args) limita quais
+    chamadas viram job, ex.: só exportações em PDF.
+    """
+    from functools import wraps
+
+    def decorador(view):
+        @wraps(view)
+        def rota(*args, **kwargs):
+            if (g.get('job') is not None or not app.config['JOBS_HABILITADOS']
+                    or 'usuario_id' not in session or (quando and not quando(**kwargs))):
+                return view(*args, **kwargs)
+            return resposta_job_enfileirado(enfileirar_job(tipo, max_tentativas))
+        return rota
+    return decorador
+
+
+def registrar_progresso_job(processados, total, mensagem=None):
+    """Atualiza o progresso do job em execução (sem efeito fora de um job); vai para o banco no próximo commit."""
+    job = g.get('job')
+    if job is None:
+        return
+    job.progresso = min(100, int(processados * 100 / total)) if total else 0
+    if mensagem:
+        job.mensagem = mensagem[:255]
+
+
+def executar_job(job):
+    """
+    Repete a requisição guardada no job num contexto de requisição reconstruído
+    (mesma rota, formulário, arquivos e sessão) e retorna os campos do Job com
+    a resposta: resultado (JSON) e, para downloads, arquivo e arquivo_nome.
+    """
+    from werkzeug.datastructures import MultiDict
+    from werkzeug.http import parse_options_header
+    from werkzeug.utils import secure_filename
+
+    parametros = json.loads(job.parametros)
+    dados = MultiDict()
+    for campo, valores in parametros['formulario'].items():
+        for valor in valores:
+            dados.add(campo, valor)
+    abertos = []
+    for campo, arquivos in parametros['arquivos'].items():
+        for caminho, nome in arquivos:
+            abertos.append(open(caminho, 'rb'))
+            dados.add(campo, (abertos[-1], nome))
+
+    try:
+        with app.test_request_context(parametros['caminho'], method=parametros['metodo'],
+                                      query_string=parametros['query'], data=dados or None):
+            session.update({chave: valor for chave, valor in parametros['sessao'].items()
+                            if chave in _CHAVES_SESSAO_JOB})
+            g.job = job
+            try:
+                resposta = app.full_dispatch_request()
+            except Exception as e:
+                raise FalhaRotaJob(str(e) or type(e).__name__) from e
+            mensagens = session.get('_flashes', [])
+    finally:
+        for arquivo in abertos:
+            arquivo.close()
+
+    campos = {'arquivo': None, 'arquivo_nome': None}
+    resultado = {'status_code': resposta.status_code, 'mimetype': resposta.mimetype, 'mensagens': mensagens}
+    disposicao, opcoes = parse_options_header(resposta.headers.get('Content-Disposition', ''))
+    if resposta.status_code in (301, 302, 303, 307, 308):
+        resultado['redirect'] = resposta.headers.get('Location')
+    elif disposicao == 'attachment':
+        nome = opcoes.get('filename') or f'job_{job.id}'
+        os.makedirs(pasta_job(job.id), exist_ok=True)
+        caminho = os.path.join(pasta_job(job.id), secure_filename(nome) or f'job_{job.id}')
+        resposta.direct_passthrough = False
+        with open(caminho, 'wb') as destino:
+            for bloco in resposta.iter_encoded():
+                destino.write(bloco)
+        campos.update(arquivo=caminho, arquivo_nome=nome)
+    else:
+        resultado['corpo'] = resposta.get_data(as_text=True)
+    resposta.close()
+
+    campos['resultado'] = json.dumps(resultado, default=str)
+    return campos
+
+
+class ExecutorJobs:
+    """
+    Executa os jobs num pool de threads do próprio processo, sem broker: a
+    tabela job é a fila.
+
+    Uma thread despachante lê os jobs pendentes e reivindica cada um com um
+    UPDATE condicional (status ainda pendente e empresa abaixo do limite de
+    jobs simultâneos), o que permite vários processos gunicorn consumindo a
+    mesma fila. Ela também renova o sinal de vida (data_sinal) dos jobs que
+    este processo executa; job em execução sem sinal recente teve o processo
+    encerrado e volta para a fila se ainda houver tentativas. Falhas
+    transitórias antes de a rota começar (e jobs abandonados) são repetidas
+    até max_tentativas, com espera crescente entre as tentativas; exceções e
+    respostas 5xx da própria rota não, pois ela pode ter gravado parte do
+    trabalho.
+    """
+
+    # Intervalo entre consultas à fila (segundos); enfileirar acorda o despachante antes
+    INTERVALO = 2.0
+    # Job em execução sem sinal de vida por esse tempo é considerado abandonado
+    TEMPO_SEM_SINAL = timedelta(minutes=5)
+    # Espera antes da tentativa n + 1: ESPERA_RETENTATIVA * 2^(n - 1)
+    ESPERA_RETENTATIVA = timedelta(seconds=30)
+
+    def __init__(self, threads=2, limite_por_empresa=1):
+        self.threads = threads
+        self.limite_por_empresa = limite_por_empresa
+        self.em_execucao = set()
+        self.trava = threading.Lock()
+        self.despertar = threading.Event()
+        self.pool = None
+        self.despachante = None
+
+    def iniciar(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self.trava:
+            if self.despachante is not None:
+                return
+            self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='job')
+            self.despachante = threading.Thread(target=self._laco, name='jobs-despachante', daemon=True)
+            self.despachante.start()
+
+    def parar(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def acordar(self):
+        self.despertar.set()
+
+    def _laco(self):
+        while True:
+            self.despertar.wait(self.INTERVALO)
+            self.despertar.clear()
+            try:
+                with app.app_context():
+                    self.despachar()
+            except Exception as e:
+                app.logger.error(f"[Jobs] Erro no despachante: {str(e)}")
+
+    def despachar(self):
+        """Renova o sinal dos jobs locais, recupera abandonados e inicia pendentes até encher o pool."""
+        agora = datetime.utcnow()
+        with self.trava:
+            locais = list(self.em_execucao)
+
+        if locais:
+            Job.query.filter(Job.id.in_(locais), Job.status == 'executando').update(
+                {Job.data_sinal: agora}, synchronize_session=False)
+        abandonados = Job.query.filter(Job.status == 'executando', Job.data_sinal < agora - self.TEMPO_SEM_SINAL)
+        if locais:
+            abandonados = abandonados.filter(Job.id.notin_(locais))
+        for job in abandonados.all():
+            self.encerrar_tentativa(job, 'Execução interrompida', transitorio=True)
+        db.session.commit()
+
+        livres = self.threads - len(locais)
+        if livres <= 0:
+            return
+        ocupados = dict(db.session.query(Job.empresa_id, db.func.count(Job.id)).filter(
+            Job.status == 'executando'
+        ).group_by(Job.empresa_id).all())
+        pendentes = Job.query.filter(
+            Job.status == 'pendente',
+            db.or_(Job.executar_apos.is_(None), Job.executar_apos <= agora)
+        ).order_by(Job.id).limit(50).all()
+
+        for job in pendentes:
+            if livres <= 0:
+                break
+            if ocupados.get(job.empresa_id, 0) >= self.limite_por_empresa or not self.reivindicar(job, agora):
+                continue
+            ocupados[job.empresa_id] = ocupados.get(job.empresa_id, 0) + 1
+            livres -= 1
+            with self.trava:
+                self.em_execucao.add(job.id)
+            self.pool.submit(self._executar, job.id)
+
+    def reivindicar(self, job, agora):
+        """Marca o job como em execução se nenhum outro processo o pegou e a empresa está abaixo do limite."""
+        if job.empresa_id is not None:
+            # Bloqueia a linha da empresa até o commit: sob READ COMMITTED, duas
+            # reivindicações simultâneas da mesma empresa veriam a mesma contagem
+            # de jobs em execução e passariam ambas pelo limite
+            db.session.query(Empresa.id).filter(Empresa.id == job.empresa_id).with_for_update().first()
+
+        outros = db.aliased(Job)
+        mesma_empresa = (outros.empresa_id == job.empresa_id) if job.empresa_id is not None else outros.empresa_id.is_(None)
+        em_execucao_empresa = db.select(db.func.count(outros.id)).where(
+            mesma_empresa, outros.status == 'executando'
+        ).scalar_subquery()
+
+        atualizados = Job.query.filter(
+            Job.id == job.id, Job.status == 'pendente', em_execucao_empresa < self.limite_por_empresa
+        ).update({
+            Job.status: 'executando',
+            Job.tentativas: Job.tentativas + 1,
+            Job.data_inicio: agora,
+            Job.data_sinal: agora,
+            Job.mensagem: 'Em execução',
+        }, synchronize_session=False)
+        db.session.commit()
+        return atualizados == 1
+
+    def encerrar_tentativa(self, job, mensagem, transitorio):
+        """Reagenda o job (falha transitória com tentativas restantes) ou o marca com erro."""
+        if transitorio and (job.tentativas or 0) < (job.max_tentativas or 1):
+            job.status = 'pendente'
+            job.executar_apos = datetime.utcnow() + self.ESPERA_RETENTATIVA * 2 ** max((job.tentativas or 1) - 1, 0)
+            job.mensagem = f'Nova tentativa agendada: {mensagem}'[:255]
+        else:
+            job.status = 'erro'
+            job.data_fim = datetime.utcnow()
+            job.mensagem = mensagem[:255]
+
+    def _executar(self, job_id):
+        try:
+            with app.app_context():
+                erro = None
+                try:
+                    campos = executar_job(db.session.get(Job, job_id))
+                except Exception as e:
+                    erro = e
+                    app.logger.error(f"[Jobs] Job {job_id} falhou: {str(e)}\n{traceback.format_exc()}")
+                # Descarta o que a rota deixou pendente antes de gravar o desfecho
+                db.session.rollback()
+
+                job = db.session.get(Job, job_id)
+                if erro is not None:
+                    self.encerrar_tentativa(job, str(erro) or type(erro).__name__, _erro_transitorio(erro))
+                else:
+                    for campo, valor in campos.items():
+                        setattr(job, campo, valor)
+                    status_code = json.loads(campos['resultado'])['status_code']
+                    job.status = 'concluido' if status_code < 400 else 'erro'
+                    job.progresso = 100
+                    job.mensagem = 'Concluído' if status_code < 400 else f'A rota respondeu com erro {status_code}'
+                    job.data_fim = datetime.utcnow()
+                db.session.commit()
+        except Exception as e:
+            app.logger.error(f"[Jobs] Erro ao finalizar job {job_id}: {str(e)}")
+        finally:
+            with self.trava:
+                self.em_execucao.discard(job_id)
+            self.acordar()
+
+
+executor_jobs = ExecutorJobs(app.config['JOBS_THREADS'], app.config['JOBS_POR_EMPRESA'])
+
+
+@app.before_request
+def iniciar_executor_jobs():
+    """
+    Inicia o executor de jobs na primeira requisição do processo. Só processos
+    que atendem requisições (workers do gunicorn, servidor local) consomem a
+    fila; scripts que importam app não reivindicam jobs que não vão terminar.
+    """
+    executor_jobs.iniciar()
+
+
+def limpar_jobs_antigos():
+    """Remove jobs terminados há mais de JOBS_DIAS_RETENCAO dias e seus arquivos em uploads/jobs/."""
+    import shutil
+
+    with app.app_context():
+        limite = datetime.utcnow() - timedelta(days=app.config['JOBS_DIAS_RETENCAO'])
+        antigos = Job.query.filter(Job.status.in_(['concluido', 'erro']), Job.data_fim < limite).all()
+        for job in antigos:
+            shutil.rmtree(pasta_job(job.id), ignore_errors=True)
+            db.session.delete(job)
+        db.session.commit()
+        if antigos:
+            app.logger.info(f"[Jobs] {len(antigos)} job(s) antigo(s) removido(s)")
+
+
+def _job_do_usuario(job_id):
+    """Job do usuário logado, ou (None, resposta de erro)."""
+    if 'usuario_id' not in session:
+        return None, (jsonify({'error': 'Usuário não autenticado'}), 401)
+    job = db.session.get(Job, job_id)
+    if not job or job.usuario_id != session['usuario_id']:
+        return None, (jsonify({'error': 'Job não encontrado'}), 404)
+    return job, None
+
+
+@app.route('/api/jobs/<int:job_id>')
+def api_status_job(job_id):
+    """Status e progresso de um job em segundo plano"""
+    job, erro = _job_do_usuario(job_id)
+    if erro:
+        return erro
+
+    terminado = job.status in ('concluido', 'erro')
+    return jsonify({
+        'id': job.id,
+        'tipo': job.tipo,
+        'status': job.status,
+        'progresso': job.progresso or 0,
+        'mensagem': job.mensagem,
+        'tentativas': job.tentativas or 0,
+        'terminado': terminado,
+        'tem_arquivo': bool(job.arquivo),
+        'resultado_url': url_for('api_resultado_job', job_id=job.id) if terminado else None,
+        'data_criacao': job.data_criacao.strftime('%d/%m/%Y %H:%M:%S') if job.data_criacao else None,
+        'data_fim': job.data_fim.strftime('%d/%m/%Y %H:%M:%S') if job.data_fim else None,
+    })
+
+
+@app.route('/api/jobs/<int:job_id>/resultado')
+def api_resultado_job(job_id):
+    """Resposta produzida pelo job: o arquivo gerado, o JSON da rota ou o redirecionamento com as mensagens"""
+    job, erro = _job_do_usuario(job_id)
+    if erro:
+        return erro
+
+    if job.status not in ('concluido', 'erro'):
+        return jsonify({'error': 'Job ainda em execução', 'status': job.status}), 409
+    if not job.resultado:
+        return jsonify({'success': False, 'error': job.mensagem or 'Falha ao executar o job'}), 500
+
+    resultado = json.loads(job.resultado)
+    if job.arquivo:
+        if not os.path.exists(job.arquivo):
+            return jsonify({'error': 'Arquivo do job não está mais disponível'}), 410
+        return send_file(job.arquivo, as_attachment=True, download_name=job.arquivo_nome,
+                         mimetype=resultado.get('mimetype'))
+
+    for categoria, mensagem in resultado.get('mensagens', []):
+        flash(mensagem, categoria)
+    if resultado.get('redirect'):
+        return redirect(resultado['redirect'])
+    return app.response_class(resultado.get('corpo', ''), status=resultado['status_code'],
+                              mimetype=resultado.get('mimetype'))
+
+
+# ===== CONTROLE DE ACESSO POR MÓDULO =====
+
+_MODULOS_PREFIXOS = {
+    '/lancamentos':     'lancamentos',
+    '/novo-lancamento': 'lancamentos',
+    '/clientes':        'clientes',
+    '/novo-cliente':    'clientes',
+    '/fornecedores':    'fornecedores',
+    '/novo-fornecedor': 'fornecedores',
+    '/vendas':          'vendas',
+    '/nova-venda':      'vendas',
+    '/compras':         'compras',
+    '/nova-compra':     'compras',
+    '/estoque':         'estoque',
+    '/relatorios':      'relatorios',
+    '/dre':             'relatorios',
+    '/plano-contas':    'plano_contas',
+    '/importacao':      'importacao',
+    '/conciliacao':     'conciliacao',
+    '/conta-caixa':     'configuracoes',
+}
+
+def _modulo_da_url(path):
+    for prefixo, modulo in _MODULOS_PREFIXOS.items():
+        if path == prefixo or path.startswith(prefixo + '/'):
+            return modulo
+    return None
+
+def _acao_da_requisicao(path, method):
+    if method == 'GET':
+        return 'visualizar'
+    p = path.lower()
+    if any(k in p for k in ('deletar', 'excluir', 'remover')):
+        return 'deletar'
+    if any(k in p for k in ('editar', 'atualizar')):
+        return 'editar'
+    return 'criar'
+
+def verificar_acesso_modulo(modulo, acao):
+    """
+    Verifica se o usuário atual tem acesso ao módulo/ação.
+    Retorna (tem_acesso: bool, mensagem: str).
 
-    return True, ''
+    As permissões do usuário são carregadas uma vez por requisição no
+    ContextoRequisicao (ver ContextoRequisicao._carregar_permissoes para as regras).
+    """
+    if contexto_requisicao().tem_permissao(modulo, acao):
+        return True, ''
+    return False, MENSAGEM_SEM_PERMISSAO_MODULO
 
 
 # Funções auxiliares para parcelamento
@@ -1713,7 +2977,7 @@ def atualizar_ultimo_acesso():
                     should_update = False
             
             if should_update:
-                usuario = Usuario.query.get(session['usuario_id'])
+                usuario = contexto_requisicao().usuario
                 if usuario:
                     usuario.ultimo_acesso = datetime.now()
                     db.session.commit()
@@ -1737,11 +3001,9 @@ def check_subscription_status():
         ):
             return
             
-        empresa_id = session.get('empresa_id')
-        if empresa_id:
-            empresa = db.session.get(Empresa, empresa_id)
-            if empresa and empresa.dias_assinatura is not None and empresa.dias_assinatura <= 0:
-                return redirect(url_for('assinatura_suspensa'))
+        empresa = contexto_requisicao().empresa
+        if empresa and empresa.dias_assinatura is not None and empresa.dias_assinatura <= 0:
+            return redirect(url_for('assinatura_suspensa'))
 
 @app.route('/assinatura_suspensa')
 def assinatura_suspensa():
@@ -2036,6 +3298,108 @@ def logout():
     session.clear()
     return redirect(url_for('landing'))
 
+def calcular_totais_dashboard(empresa_id, inicio_periodo, fim_periodo, hoje):
+    """
+    Calcula todos os totais dos cards do dashboard em uma única consulta.
+    Retorna dict '<status>_<tipo>' -> total (ex.: 'vencido_entrada').
+    """
+    return calcular_totais_dashboard_empresas([empresa_id], inicio_periodo, fim_periodo, hoje)[empresa_id]
+
+
+def calcular_totais_dashboard_empresas(empresa_ids, inicio_periodo, fim_periodo, hoje):
+    """
+    Totais dos cards do dashboard de várias empresas em uma única consulta
+    agrupada por empresa. Cada combinação tipo × status vira uma coluna
+    SUM(CASE ...), evitando carregar os lançamentos para somar em Python.
+    Retorna {empresa_id: {'<status>_<tipo>': total}} para todas as empresas.
+    """
+    pendente = Lancamento.realizado == False
+    sem_transferencia = db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
+    prevista_no_periodo = Lancamento.data_prevista.between(inicio_periodo, fim_periodo)
+    realizada_no_periodo = Lancamento.data_realizada.between(inicio_periodo, fim_periodo)
+
+    status = {
+        # Pendentes com vencimento hoje
+        'hoje': db.and_(pendente, Lancamento.data_prevista == hoje),
+        # Pendentes do período (cards "a receber"/"a pagar")
+        'pendente_periodo': db.and_(pendente, prevista_no_periodo),
+        # Realizados no período, sem transferências
+        'realizado_periodo': db.and_(Lancamento.realizado == True, realizada_no_periodo, sem_transferencia),
+        # A vencer: não realizado e data_prevista no futuro
+        'a_vencer': db.and_(pendente, prevista_no_periodo, Lancamento.data_prevista > hoje, sem_transferencia),
+        # Vencido: não realizado e data_prevista no passado
+        'vencido': db.and_(pendente, prevista_no_periodo, Lancamento.data_prevista < hoje, sem_transferencia),
+        # Agendado: tem data_realizada futura
+        'agendado': db.and_(pendente, Lancamento.data_realizada.isnot(None), Lancamento.data_realizada > hoje,
+                            realizada_no_periodo, sem_transferencia),
+    }
+
+    colunas = []
+    for nome_status, condicao in status.items():
+        for tipo in ('entrada', 'saida'):
+            colunas.append(
+                db.func.coalesce(db.func.sum(
+                    db.case((db.and_(Lancamento.tipo == tipo, condicao), Lancamento.valor), else_=0)
+                ), 0).label(f'{nome_status}_{tipo}')
+            )
+
+    totais = {empresa_id: {coluna.name: 0.0 for coluna in colunas} for empresa_id in empresa_ids}
+    if not totais:
+        return totais
+
+    linhas = db.session.query(Lancamento.empresa_id, *colunas).filter(
+        Lancamento.empresa_id.in_(list(totais)),
+        db.or_(prevista_no_periodo, realizada_no_periodo, Lancamento.data_prevista == hoje)
+    ).group_by(Lancamento.empresa_id).all()
+
+    for linha in linhas:
+        valores = linha._mapping
+        totais[linha.empresa_id] = {coluna.name: float(valores[coluna.name] or 0) for coluna in colunas}
+    return totais
+
+
+def resumo_financeiro_empresas(empresa_ids, inicio_periodo, fim_periodo):
+    """
+    Resumo financeiro do período de várias empresas (cartões do contador/BPO)
+    em uma única consulta agrupada por empresa, tipo e realizado. Considera os
+    lançamentos dos usuários ativos de cada empresa: realizados pela
+    data_realizada e pendentes pela data_prevista.
+    Retorna {empresa_id: {'saldo_periodo', 'total_entradas', 'total_saidas',
+    'total_entrada_pendente', 'total_saida_pendente'}} para todas as empresas.
+    """
+    resumos = {
+        empresa_id: {'saldo_periodo': 0.0, 'total_entradas': 0.0, 'total_saidas': 0.0,
+                     'total_entrada_pendente': 0.0, 'total_saida_pendente': 0.0}
+        for empresa_id in empresa_ids
+    }
+    if not resumos:
+        return resumos
+
+    linhas = db.session.query(
+        Usuario.empresa_id, Lancamento.tipo, Lancamento.realizado,
+        db.func.coalesce(db.func.sum(Lancamento.valor), 0)
+    ).join(Usuario, Lancamento.usuario_id == Usuario.id).filter(
+        Usuario.empresa_id.in_(list(resumos)),
+        Usuario.ativo == True,
+        Lancamento.tipo.in_(('entrada', 'saida')),
+        db.or_(
+            db.and_(Lancamento.realizado == True, Lancamento.data_realizada.between(inicio_periodo, fim_periodo)),
+            db.and_(Lancamento.realizado == False, Lancamento.data_prevista.between(inicio_periodo, fim_periodo))
+        )
+    ).group_by(Usuario.empresa_id, Lancamento.tipo, Lancamento.realizado).all()
+
+    for empresa_id, tipo, realizado, total in linhas:
+        if realizado:
+            chave = 'total_entradas' if tipo == 'entrada' else 'total_saidas'
+        else:
+            chave = 'total_entrada_pendente' if tipo == 'entrada' else 'total_saida_pendente'
+        resumos[empresa_id][chave] += float(total or 0)
+
+    for resumo in resumos.values():
+        resumo['saldo_periodo'] = resumo['total_entradas'] - resumo['total_saidas']
+    return resumos
+
+
 @app.route('/dashboard')
 def dashboard():
     # Verificar se está logado (pode ser usuario_id ou sub_usuario_id com acesso_contador)
@@ -2182,172 +3546,48 @@ def dashboard():
         flash('Erro ao obter empresa associada', 'error')
         return redirect(url_for('login'))
     
-    # Obter todos os usuários da empresa correta para sincronizar dados
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id_correta, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
-    
-    # Contas de entrada hoje (pendentes) - todos os usuários da empresa correta
-    entrada_hoje = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.data_prevista == hoje,
-        Lancamento.realizado == False
-    ).all()
-    
-    # Contas de saida hoje (pendentes) - todos os usuários da empresa correta
-    saida_hoje = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.data_prevista == hoje,
-        Lancamento.realizado == False
-    ).all()
-    
-    # Contas de entrada do mês (pendentes) - todos os usuários da empresa correta
-    entrada_mes = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo
-    ).all()
-    
-    # Contas de saida do mês (pendentes) - todos os usuários da empresa correta
-    saida_mes = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo
-    ).all()
-    
-    # Buscar lançamentos agendados para hoje (precisam de confirmação)
-    # Estes são lançamentos que têm data_realizada = hoje mas ainda não foram confirmados como realizados
-    # Ou seja: data_realizada = hoje E realizado = False (precisam de confirmação do usuário)
-    hoje = datetime.now().date()
-    lancamentos_agendados_hoje = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.data_realizada == hoje,
-        Lancamento.realizado == False  # Apenas os que ainda não foram confirmados como realizados
-    ).all()
-    
-    # Calcular totais
-    total_entrada_hoje = sum(l.valor for l in entrada_hoje)
-    total_saida_hoje = sum(l.valor for l in saida_hoje)
-    total_entrada_mes = sum(l.valor for l in entrada_mes)
-    total_saida_mes = sum(l.valor for l in saida_mes)
-    
-    # Calcular entradas e saidas realizadas no período - todos os usuários da empresa correta
-    # Transferências entre contas são excluídas (não representam receita/despesa real)
-    entradas_periodo = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.realizado == True,
-        Lancamento.data_realizada >= inicio_periodo,
-        Lancamento.data_realizada <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
+    # Todos os totais dos cards em uma única consulta agregada
+    totais = calcular_totais_dashboard(empresa_id_correta, inicio_periodo, fim_periodo, hoje)
 
-    saidas_periodo = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.realizado == True,
-        Lancamento.data_realizada >= inicio_periodo,
-        Lancamento.data_realizada <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    
-    # Calcular totais apenas com lançamentos financeiros realizados no período
-    # Observação: O card exibe "Apenas lançamentos realizados", portanto usamos somente a tabela Lancamento
-    total_entradas_periodo = sum(l.valor for l in entradas_periodo)
-    total_saidas_periodo = sum(l.valor for l in saidas_periodo)
-    
+    total_entrada_hoje = totais['hoje_entrada']
+    total_saida_hoje = totais['hoje_saida']
+    total_entrada_mes = totais['pendente_periodo_entrada']
+    total_saida_mes = totais['pendente_periodo_saida']
+
+    # Card "Apenas lançamentos realizados": transferências entre contas são excluídas
+    total_entradas_periodo = totais['realizado_periodo_entrada']
+    total_saidas_periodo = totais['realizado_periodo_saida']
     saldo_periodo = total_entradas_periodo - total_saidas_periodo
-    
-    # Calcular totais por status no período
-    # Realizado: já foi realizado (saldo = entradas - saidas)
-    total_realizado_entradas = sum(l.valor for l in entradas_periodo)
-    total_realizado_saidas = sum(l.valor for l in saidas_periodo)
-    total_realizado = total_realizado_entradas - total_realizado_saidas
-    
-    # A vencer: não realizado e data_prevista no futuro
-    a_vencer_entradas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista > hoje,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    a_vencer_saidas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista > hoje,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    total_a_vencer = sum(l.valor for l in a_vencer_entradas) - sum(l.valor for l in a_vencer_saidas)
 
-    # Vencido: não realizado e data_prevista no passado
-    vencido_entradas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista < hoje,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    vencido_saidas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.realizado == False,
-        Lancamento.data_prevista < hoje,
-        Lancamento.data_prevista >= inicio_periodo,
-        Lancamento.data_prevista <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    total_vencido = sum(l.valor for l in vencido_entradas) - sum(l.valor for l in vencido_saidas)
+    # Totais por status no período (saldo = entradas - saidas)
+    total_realizado = saldo_periodo
+    total_a_vencer = totais['a_vencer_entrada'] - totais['a_vencer_saida']
+    total_vencido = totais['vencido_entrada'] - totais['vencido_saida']
+    total_agendado = totais['agendado_entrada'] - totais['agendado_saida']
 
-    # Agendado: tem data_realizada futura
-    agendado_entradas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'entrada',
-        Lancamento.realizado == False,
-        Lancamento.data_realizada.isnot(None),
-        Lancamento.data_realizada > hoje,
-        Lancamento.data_realizada >= inicio_periodo,
-        Lancamento.data_realizada <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    agendado_saidas = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id_correta,
-        Lancamento.tipo == 'saida',
-        Lancamento.realizado == False,
-        Lancamento.data_realizada.isnot(None),
-        Lancamento.data_realizada > hoje,
-        Lancamento.data_realizada >= inicio_periodo,
-        Lancamento.data_realizada <= fim_periodo,
-        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-    ).all()
-    total_agendado = sum(l.valor for l in agendado_entradas) - sum(l.valor for l in agendado_saidas)
+    # Quadros de contas do período: apenas a página exibida é carregada
+    itens_por_pagina = app.config['ITENS_POR_PAGINA']
+    pagina_receber = request.args.get('pagina_receber', 1, type=int)
+    pagina_pagar = request.args.get('pagina_pagar', 1, type=int)
 
-    # Buscar todas as contas de saida e entrada do período para os quadros
-    todas_contas_entrada = Lancamento.query.filter(
+    paginacao_entrada = Lancamento.query.filter(
         Lancamento.empresa_id == empresa_id_correta,
         Lancamento.tipo == 'entrada',
         Lancamento.data_prevista >= inicio_periodo,
         Lancamento.data_prevista <= fim_periodo
-    ).order_by(Lancamento.data_prevista).all()
-    
-    todas_contas_saida = Lancamento.query.filter(
+    ).order_by(Lancamento.data_prevista, Lancamento.id).paginate(
+        page=pagina_receber, per_page=itens_por_pagina, error_out=False
+    )
+    paginacao_saida = Lancamento.query.filter(
         Lancamento.empresa_id == empresa_id_correta,
         Lancamento.tipo == 'saida',
         Lancamento.data_prevista >= inicio_periodo,
         Lancamento.data_prevista <= fim_periodo
-    ).order_by(Lancamento.data_prevista).all()
+    ).order_by(Lancamento.data_prevista, Lancamento.id).paginate(
+        page=pagina_pagar, per_page=itens_por_pagina, error_out=False
+    )
+    todas_contas_entrada = paginacao_entrada.items
+    todas_contas_saida = paginacao_saida.items
     
     # Obter alertas do usuário
     try:
@@ -2369,6 +3609,7 @@ def dashboard():
     
     # Verificar se é contador/BPO acessando dashboard de empresa vinculada
     empresas_vinculadas_resumo = []
+    paginacao_empresas = None
     tipo_conta = session.get('tipo_conta')
     usuario_tipo = session.get('usuario_tipo')
     acesso_contador = session.get('acesso_contador')
@@ -2377,74 +3618,23 @@ def dashboard():
     if (tipo_conta == 'contador_bpo' or usuario_tipo == 'sub_contador') and not acesso_contador:
         contador_id = session.get('empresa_id') or session.get('contador_id')
         
-        # Buscar empresas vinculadas autorizadas
-        vinculos_autorizados = VinculoContador.query.filter_by(
+        # Empresas vinculadas autorizadas: apenas a página exibida é carregada
+        pagina_empresas = request.args.get('pagina_empresas', 1, type=int)
+        paginacao_empresas = VinculoContador.query.options(
+            joinedload(VinculoContador.empresa)
+        ).filter_by(
             contador_id=contador_id,
             status='autorizado'
-        ).all()
+        ).order_by(VinculoContador.id).paginate(
+            page=pagina_empresas, per_page=app.config['EMPRESAS_POR_PAGINA'], error_out=False
+        )
         
-        # Para cada empresa vinculada, calcular resumo financeiro
-        for vinculo in vinculos_autorizados:
-            empresa_vinculada = vinculo.empresa
-            
-            # Obter usuários da empresa vinculada
-            usuarios_empresa_vinculada = Usuario.query.filter_by(
-                empresa_id=empresa_vinculada.id, 
-                ativo=True
-            ).all()
-            usuarios_ids_vinculada = [u.id for u in usuarios_empresa_vinculada]
-            
-            # Entradas realizadas no período
-            receitas_vinculada = Lancamento.query.filter(
-                Lancamento.usuario_id.in_(usuarios_ids_vinculada),
-                Lancamento.tipo == 'entrada',
-                Lancamento.realizado == True,
-                Lancamento.data_realizada >= inicio_periodo,
-                Lancamento.data_realizada <= fim_periodo
-            ).all()
-            
-            # Saídas realizadas no período
-            despesas_vinculada = Lancamento.query.filter(
-                Lancamento.usuario_id.in_(usuarios_ids_vinculada),
-                Lancamento.tipo == 'saida',
-                Lancamento.realizado == True,
-                Lancamento.data_realizada >= inicio_periodo,
-                Lancamento.data_realizada <= fim_periodo
-            ).all()
-            
-            # Contas a receber pendentes no período
-            contas_receber_vinculada = Lancamento.query.filter(
-                Lancamento.usuario_id.in_(usuarios_ids_vinculada),
-                Lancamento.tipo == 'entrada',
-                Lancamento.realizado == False,
-                Lancamento.data_prevista >= inicio_periodo,
-                Lancamento.data_prevista <= fim_periodo
-            ).all()
-            
-            # Contas a pagar pendentes no período
-            contas_pagar_vinculada = Lancamento.query.filter(
-                Lancamento.usuario_id.in_(usuarios_ids_vinculada),
-                Lancamento.tipo == 'saida',
-                Lancamento.realizado == False,
-                Lancamento.data_prevista >= inicio_periodo,
-                Lancamento.data_prevista <= fim_periodo
-            ).all()
-            
-            # Calcular totais
-            total_receitas_vinculada = sum(l.valor for l in receitas_vinculada)
-            total_despesas_vinculada = sum(l.valor for l in despesas_vinculada)
-            saldo_vinculada = total_receitas_vinculada - total_despesas_vinculada
-            total_receber_vinculada = sum(l.valor for l in contas_receber_vinculada)
-            total_pagar_vinculada = sum(l.valor for l in contas_pagar_vinculada)
-            
-            empresas_vinculadas_resumo.append({
-                'empresa': empresa_vinculada,
-                'saldo_periodo': saldo_vinculada,
-                'total_entradas': total_receitas_vinculada,
-                'total_saidas': total_despesas_vinculada,
-                'total_entrada_pendente': total_receber_vinculada,
-                'total_saida_pendente': total_pagar_vinculada
-            })
+        # Resumo financeiro de todas as empresas da página em uma única consulta agrupada
+        resumos = resumo_financeiro_empresas(
+            [vinculo.empresa_id for vinculo in paginacao_empresas.items], inicio_periodo, fim_periodo
+        )
+        for vinculo in paginacao_empresas.items:
+            empresas_vinculadas_resumo.append({'empresa': vinculo.empresa, **resumos[vinculo.empresa_id]})
     
     # Calcular saldo por ContaCaixa
     contas_caixa_resumo = []
@@ -2454,21 +3644,12 @@ def dashboard():
         ativo=True,
     ).join(Usuario).filter(Usuario.empresa_id == empresa_id_correta).all()
     
-    # Para cada conta, calcular o saldo considerando apenas os lançamentos realizados
-    # Para manter coerência com o saldo do banco, precisamos considerar TODOS os lançamentos
-    # realizados *até* o 'fim_periodo' (ou seja, saldo_inicial + (entradas até fim_periodo) - (saídas até fim_periodo))
+    # Saldo de cada conta até o fim do período: saldo_inicial + (entradas até fim_periodo) - (saídas até fim_periodo)
+    # Lido do snapshot diário em uma única consulta para todas as contas
+    saldos_realizados = saldos_contas_caixa_ate([conta.id for conta in contas_caixa], fim_periodo)
     for conta in contas_caixa:
-        lancamentos_conta = Lancamento.query.filter(
-            Lancamento.conta_caixa_id == conta.id,
-            Lancamento.realizado == True,
-            Lancamento.data_realizada <= fim_periodo, # Só considera o que foi realizado até o fim do período filtrado
-            db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
-        ).all()
-        
-        entradas_conta = sum(l.valor for l in lancamentos_conta if l.tipo == 'entrada')
-        saidas_conta = sum(l.valor for l in lancamentos_conta if l.tipo == 'saida')
-        
-        saldo_conta = conta.saldo_inicial + entradas_conta - saidas_conta
+        entradas_conta, saidas_conta = saldos_realizados.get(conta.id, (0.0, 0.0))
+        saldo_conta = (conta.saldo_inicial or 0) + entradas_conta - saidas_conta
         
         contas_caixa_resumo.append({
             'id': conta.id,
@@ -2489,10 +3670,6 @@ def dashboard():
     return render_template('dashboard.html',
                          usuario=usuario,
                          assinatura_expirada=assinatura_expirada,
-                         entrada_hoje=entrada_hoje,
-                         saida_hoje=saida_hoje,
-                         entrada_mes=entrada_mes,
-                         saida_mes=saida_mes,
                          total_entrada_hoje=total_entrada_hoje,
                          total_saida_hoje=total_saida_hoje,
                          total_entrada_mes=total_entrada_mes,
@@ -2507,15 +3684,17 @@ def dashboard():
                          alertas=alertas,
                          anos_disponiveis=anos_disponiveis,
                          meses=meses,
-                         lancamentos_agendados_hoje=lancamentos_agendados_hoje,
                          vinculos_pendentes=vinculos_pendentes,
                          empresas_vinculadas_resumo=empresas_vinculadas_resumo,
+                         paginacao_empresas=paginacao_empresas,
                          total_realizado=total_realizado,
                          total_a_vencer=total_a_vencer,
                          total_vencido=total_vencido,
                          total_agendado=total_agendado,
                          todas_contas_entrada=todas_contas_entrada,
                          todas_contas_saida=todas_contas_saida,
+                         paginacao_entrada=paginacao_entrada,
+                         paginacao_saida=paginacao_saida,
                          contas_caixa_resumo=contas_caixa_resumo,
                          hoje=hoje)
 
@@ -2855,6 +4034,333 @@ def deletar_usuario_admin(user_id):
             'redirect': False
         }), 500
 
+# ===== FILTROS DE LANÇAMENTOS =====
+
+def _parse_data_filtro(valor):
+    """Converte data do filtro (DD/MM/AAAA ou AAAA-MM-DD). Retorna None se vazia ou inválida."""
+    if not valor:
+        return None
+    valor = valor.strip()
+    try:
+        if '/' in valor:
+            return datetime.strptime(valor, '%d/%m/%Y').date()
+        return datetime.strptime(valor, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def _parse_valor_filtro(valor):
+    """Converte valor numérico do filtro aceitando vírgula decimal. Retorna None se inválido."""
+    if not valor:
+        return None
+    try:
+        return float(str(valor).strip().replace(',', '.'))
+    except ValueError:
+        return None
+
+
+class FiltroLancamentos:
+    """
+    Filtros de lançamentos compilados uma única vez a partir dos argumentos da
+    requisição e aplicados por /lancamentos, /api/lancamentos/totais e pelos
+    relatórios/exportações de lançamentos.
+
+    perfil='listagem': status por data (realizado/pendente/agendado/vencido) e
+    busca em descrição, cliente, fornecedor ou valor aproximado.
+    perfil='relatorio': status pelo campo realizado e busca em descrição,
+    produto/serviço ou valor exato, além dos filtros próprios do relatório.
+    """
+
+    PERFIS = ('listagem', 'relatorio')
+
+    def __init__(self, empresa_id, hoje=None, perfil='listagem', tipo=None, categoria=None,
+                 data_inicio=None, data_fim=None, status=None, conta_caixa_id=None,
+                 notas_fiscais=(), ids=(), busca=None, cliente=None, fornecedor=None,
+                 descricao=None, valor_min=None, valor_max=None):
+        if perfil not in self.PERFIS:
+            raise ValueError(f'Perfil de filtro inválido: {perfil}')
+
+        # Datas invertidas: corrigir a ordem
+        if data_inicio and data_fim and data_inicio > data_fim:
+            data_inicio, data_fim = data_fim, data_inicio
+
+        self.empresa_id = empresa_id
+        self.hoje = hoje or datetime.now().date()
+        self.perfil = perfil
+        self.tipo = tipo or None
+        self.categoria = categoria or None
+        self.data_inicio = data_inicio
+        self.data_fim = data_fim
+        self.status = status or None
+        self.conta_caixa_id = conta_caixa_id
+        self.notas_fiscais = tuple(notas_fiscais)
+        self.ids = tuple(sorted(set(ids)))
+        self.busca = busca or None
+        self.valor_busca = _parse_valor_filtro(self.busca) if self.busca and not self.ids else None
+        self.cliente = cliente or None
+        self.fornecedor = fornecedor or None
+        self.descricao = descricao or None
+        self.valor_min = valor_min
+        self.valor_max = valor_max
+        # Textos exibidos nos campos de data do template e datas que não puderam ser lidas
+        self.data_inicio_texto = data_inicio.strftime('%d/%m/%Y') if data_inicio else ''
+        self.data_fim_texto = data_fim.strftime('%d/%m/%Y') if data_fim else ''
+        self.datas_invalidas = []
+
+    @classmethod
+    def da_requisicao(cls, args, empresa_id, perfil='listagem', mes_corrente_padrao=False, hoje=None):
+        """
+        Monta o filtro a partir de request.args.
+        mes_corrente_padrao: sem datas, busca ou nota fiscal, limita ao mês corrente
+        (comportamento da tela de lançamentos).
+        """
+        hoje = hoje or datetime.now().date()
+        data_inicio_raw = (args.get('data_inicio') or '').strip()
+        data_fim_raw = (args.get('data_fim') or '').strip()
+        busca = (args.get('busca') or '').strip()
+        nf_raw = (args.get('nota_fiscal') or '').strip()
+
+        datas_invalidas = []
+        usar_mes_corrente = mes_corrente_padrao and not data_inicio_raw and not data_fim_raw and not busca and not nf_raw
+        if usar_mes_corrente:
+            import calendar
+            data_inicio = hoje.replace(day=1)
+            data_fim = hoje.replace(day=calendar.monthrange(hoje.year, hoje.month)[1])
+        else:
+            data_inicio = _parse_data_filtro(data_inicio_raw)
+            data_fim = _parse_data_filtro(data_fim_raw)
+            if data_inicio_raw and not data_inicio:
+                datas_invalidas.append('data_inicio')
+            if data_fim_raw and not data_fim:
+                datas_invalidas.append('data_fim')
+
+        conta_caixa_id = None
+        try:
+            conta_caixa_id = int(args.get('conta_caixa_id')) if args.get('conta_caixa_id') else None
+        except (ValueError, TypeError):
+            pass
+
+        # Nota fiscal: múltiplas NFs separadas por ponto e vírgula
+        notas_fiscais = [n.strip() for n in nf_raw.split(';') if n.strip()]
+
+        # Busca por ID(s): "#83" ou "#83, #84, #85" — prioridade sobre a busca textual
+        ids = [int(m) for m in re.findall(r'#(\d+)', busca)]
+
+        filtro = cls(
+            empresa_id, hoje=hoje, perfil=perfil,
+            tipo=args.get('tipo'), categoria=args.get('categoria'),
+            data_inicio=data_inicio, data_fim=data_fim, status=args.get('status'),
+            conta_caixa_id=conta_caixa_id, notas_fiscais=notas_fiscais, ids=ids, busca=busca,
+            cliente=(args.get('cliente') or '').strip(), fornecedor=(args.get('fornecedor') or '').strip(),
+            descricao=(args.get('descricao') or '').strip(),
+            valor_min=_parse_valor_filtro(args.get('valor_min')),
+            valor_max=_parse_valor_filtro(args.get('valor_max')),
+        )
+        filtro.datas_invalidas = datas_invalidas
+        # Datas digitadas continuam aparecendo como o usuário informou
+        if not usar_mes_corrente:
+            filtro.data_inicio_texto = '' if 'data_inicio' in datas_invalidas else data_inicio_raw
+            filtro.data_fim_texto = '' if 'data_fim' in datas_invalidas else data_fim_raw
+        return filtro
+
+    def _condicao_status(self):
+        hoje = self.hoje
+        if self.perfil == 'relatorio':
+            if self.status == 'realizado':
+                return Lancamento.realizado == True
+            if self.status == 'pendente':
+                return Lancamento.realizado == False
+            return None
+
+        if self.status == 'realizado':
+            return db.and_(Lancamento.data_realizada.isnot(None), Lancamento.data_realizada <= hoje)
+        if self.status == 'pendente':
+            return db.and_(Lancamento.data_realizada.is_(None), Lancamento.data_prevista >= hoje)
+        if self.status == 'agendado':
+            return db.and_(Lancamento.data_realizada.isnot(None), Lancamento.data_realizada > hoje)
+        if self.status == 'vencido':
+            return db.and_(Lancamento.data_realizada.is_(None), Lancamento.data_prevista < hoje)
+        return None
+
+    def aplicar(self, query):
+        """Aplica os filtros a uma query de Lancamento já restrita à empresa."""
+        if self.tipo:
+            query = query.filter(Lancamento.tipo == self.tipo)
+        if self.categoria:
+            query = query.filter(Lancamento.categoria == self.categoria)
+
+        # Filtro por data (sempre em cima de data_prevista / vencimento)
+        if self.data_inicio and self.data_fim:
+            query = query.filter(Lancamento.data_prevista.between(self.data_inicio, self.data_fim))
+        elif self.data_inicio:
+            query = query.filter(Lancamento.data_prevista >= self.data_inicio)
+        elif self.data_fim:
+            query = query.filter(Lancamento.data_prevista <= self.data_fim)
+
+        condicao_status = self._condicao_status()
+        if condicao_status is not None:
+            query = query.filter(condicao_status)
+
+        if self.conta_caixa_id:
+            query = query.filter(Lancamento.conta_caixa_id == self.conta_caixa_id)
+
+        if len(self.notas_fiscais) == 1:
+            query = query.filter(Lancamento.nota_fiscal.ilike(f'%{self.notas_fiscais[0]}%'))
+        elif self.notas_fiscais:
+            query = query.filter(Lancamento.nota_fiscal.in_(self.notas_fiscais))
+
+        if self.ids:
+            # Filtra diretamente por ID(s) sem join desnecessário
+            if len(self.ids) == 1:
+                query = query.filter(Lancamento.id == self.ids[0])
+            else:
+                query = query.filter(Lancamento.id.in_(self.ids))
+        elif self.busca:
+            termo = f'%{self.busca}%'
+            if self.perfil == 'relatorio':
+                condicoes = [Lancamento.descricao.ilike(termo), Lancamento.produto_servico.ilike(termo)]
+                if self.valor_busca is not None:
+                    condicoes.append(Lancamento.valor == self.valor_busca)
+            else:
+                query = query.join(Cliente, Lancamento.cliente_id == Cliente.id, isouter=True).join(
+                    Fornecedor, Lancamento.fornecedor_id == Fornecedor.id, isouter=True)
+                condicoes = [
+                    Lancamento.descricao.ilike(termo),
+                    Cliente.nome.ilike(termo),
+                    Fornecedor.nome.ilike(termo),
+                ]
+                if self.valor_busca is not None:
+                    condicoes.append(db.func.abs(Lancamento.valor - self.valor_busca) < 0.01)
+            query = query.filter(db.or_(*condicoes))
+
+        # Filtros exclusivos do relatório (cliente da venda / fornecedor da compra vinculada)
+        if self.cliente:
+            cliente_venda = db.aliased(Cliente)
+            query = query.join(Venda, Lancamento.venda_id == Venda.id).join(
+                cliente_venda, Venda.cliente_id == cliente_venda.id).filter(cliente_venda.nome.ilike(f'%{self.cliente}%'))
+        if self.fornecedor:
+            fornecedor_compra = db.aliased(Fornecedor)
+            query = query.join(Compra, Lancamento.compra_id == Compra.id).join(
+                fornecedor_compra, Compra.fornecedor_id == fornecedor_compra.id).filter(fornecedor_compra.nome.ilike(f'%{self.fornecedor}%'))
+        if self.descricao:
+            query = query.filter(Lancamento.descricao.ilike(f'%{self.descricao}%'))
+        if self.valor_min is not None:
+            query = query.filter(Lancamento.valor >= self.valor_min)
+        if self.valor_max is not None:
+            query = query.filter(Lancamento.valor <= self.valor_max)
+
+        return query
+
+    def consulta(self):
+        """Query de Lancamento da empresa com todos os filtros aplicados."""
+        return self.aplicar(Lancamento.query.filter(Lancamento.empresa_id == self.empresa_id))
+
+
+def calcular_totais_lancamentos(filtro, excluir_transferencias=True):
+    """
+    Calcula os totais por tipo × status da listagem de lançamentos em uma
+    única consulta agregada sobre os mesmos filtros (FiltroLancamentos) da listagem.
+    Retorna dict '<tipo>_<status>' -> total (ex.: 'entrada_vencida') e
+    'quantidade' com o número de lançamentos que atendem aos filtros.
+    """
+    hoje = filtro.hoje
+    nao_realizado = db.or_(Lancamento.realizado == False, Lancamento.realizado.is_(None))
+    sem_data_realizada = Lancamento.data_realizada.is_(None)
+
+    status = {
+        'total': db.true(),
+        # Realizado: tem data_realizada <= hoje OU (realizado=True sem data_realizada)
+        'realizada': db.or_(
+            Lancamento.data_realizada <= hoje,
+            db.and_(Lancamento.realizado == True, sem_data_realizada)
+        ),
+        # Agendado: tem data_realizada futura (data_realizada > hoje)
+        'agendada': Lancamento.data_realizada > hoje,
+        # Pendente: não realizado e sem data_realizada (a vencer + vencido)
+        'pendente': db.and_(nao_realizado, sem_data_realizada),
+        # A vencer: não realizado, sem data_realizada E data_prevista >= hoje
+        'a_vencer': db.and_(nao_realizado, sem_data_realizada, Lancamento.data_prevista >= hoje),
+        # Vencido: não realizado, sem data_realizada E data_prevista < hoje
+        'vencida': db.and_(nao_realizado, sem_data_realizada, Lancamento.data_prevista < hoje),
+    }
+
+    # Transferências entre contas não representam receita/despesa real
+    filtro_transferencia = db.true()
+    if excluir_transferencias:
+        filtro_transferencia = db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
+
+    colunas = [db.func.count(Lancamento.id).label('quantidade')]
+    for nome_status, condicao in status.items():
+        for tipo in ('entrada', 'saida'):
+            colunas.append(
+                db.func.coalesce(db.func.sum(
+                    db.case((db.and_(Lancamento.tipo == tipo, filtro_transferencia, condicao), Lancamento.valor), else_=0)
+                ), 0).label(f'{tipo}_{nome_status}')
+            )
+
+    linha = filtro.consulta().with_entities(*colunas).one()
+    totais = {chave: float(valor or 0) for chave, valor in linha._mapping.items()}
+    totais['quantidade'] = int(linha.quantidade or 0)
+    return totais
+
+
+def _ler_cursor_lancamentos(cursor):
+    """Converte o cursor '<AAAA-MM-DD>_<id>' em (data_prevista, id). Retorna None se inválido."""
+    if not cursor:
+        return None
+    try:
+        data_str, id_str = cursor.rsplit('_', 1)
+        return datetime.strptime(data_str, '%Y-%m-%d').date(), int(id_str)
+    except (ValueError, TypeError):
+        return None
+
+
+def _gerar_cursor_lancamentos(lancamento):
+    return f"{lancamento.data_prevista.isoformat()}_{lancamento.id}"
+
+
+def paginar_lancamentos_keyset(query, cursor=None, por_pagina=50, direcao='proxima'):
+    """
+    Paginação por cursor (keyset) na ordem (data_prevista DESC, id DESC).
+    Em vez de OFFSET, cada página começa logo após o último item da anterior,
+    então o custo não cresce com o histórico da empresa.
+    Retorna (itens, cursor_anterior, proximo_cursor); cursores são None quando
+    não há página naquela direção.
+    """
+    posicao = _ler_cursor_lancamentos(cursor)
+    voltando = direcao == 'anterior' and posicao is not None
+
+    if posicao:
+        data_cursor, id_cursor = posicao
+        if voltando:
+            query = query.filter(db.or_(
+                Lancamento.data_prevista > data_cursor,
+                db.and_(Lancamento.data_prevista == data_cursor, Lancamento.id > id_cursor)
+            )).order_by(Lancamento.data_prevista.asc(), Lancamento.id.asc())
+        else:
+            query = query.filter(db.or_(
+                Lancamento.data_prevista < data_cursor,
+                db.and_(Lancamento.data_prevista == data_cursor, Lancamento.id < id_cursor)
+            )).order_by(Lancamento.data_prevista.desc(), Lancamento.id.desc())
+    else:
+        query = query.order_by(Lancamento.data_prevista.desc(), Lancamento.id.desc())
+
+    # Busca um item a mais só para saber se existe outra página
+    itens = query.limit(por_pagina + 1).all()
+    tem_mais = len(itens) > por_pagina
+    itens = itens[:por_pagina]
+
+    if voltando:
+        itens.reverse()
+        tem_anterior, tem_proxima = tem_mais, True
+    else:
+        tem_anterior, tem_proxima = posicao is not None, tem_mais
+
+    cursor_anterior = _gerar_cursor_lancamentos(itens[0]) if itens and tem_anterior else None
+    proximo_cursor = _gerar_cursor_lancamentos(itens[-1]) if itens and tem_proxima else None
+    return itens, cursor_anterior, proximo_cursor
+
+
 @app.route('/lancamentos')
 def lancamentos():
     if 'usuario_id' not in session:
@@ -2874,184 +4380,58 @@ def lancamentos():
     usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id_correta, ativo=True).all()
     usuarios_ids = [u.id for u in usuarios_empresa]
     
-    # Aplicar filtros
-    query = Lancamento.query.options(
-        db.joinedload(Lancamento.cliente),
-        db.joinedload(Lancamento.fornecedor),
-        db.joinedload(Lancamento.usuario)
-    ).filter(Lancamento.empresa_id == empresa_id_correta)
-    
-    # Filtro por tipo
-    tipo = request.args.get('tipo')
-    if tipo:
-        query = query.filter(Lancamento.tipo == tipo)
-    
-    # Filtro por categoria
-    categoria = request.args.get('categoria')
-    if categoria:
-        query = query.filter(Lancamento.categoria == categoria)
-    
-    # Filtro por data (sempre em cima de data_prevista / vencimento)
-    def _parse_data(valor: str):
-        if not valor:
-            return None
-        valor = valor.strip()
-        try:
-            if '/' in valor:
-                return datetime.strptime(valor, '%d/%m/%Y').date()
-            return datetime.strptime(valor, '%Y-%m-%d').date()
-        except ValueError:
-            return None
-
-    hoje_completo = datetime.now()
-    hoje = hoje_completo.date()
-    
-    # Datas padrão: primeiro e último dia do mês corrente
-    primeiro_dia_mes = hoje.replace(day=1)
-    import calendar
-    ultimo_dia_mes = hoje.replace(day=calendar.monthrange(hoje.year, hoje.month)[1])
-
-    data_inicio_raw = request.args.get('data_inicio', '')
-    data_fim_raw = request.args.get('data_fim', '')
-    
-    # Se não houver filtros de data e não houver busca, usar o mês corrente como padrão
-    if not data_inicio_raw and not data_fim_raw and not request.args.get('busca') and not request.args.get('nota_fiscal'):
-        data_inicio_obj = primeiro_dia_mes
-        data_fim_obj = ultimo_dia_mes
-        # Atualizar strings para exibir no template
-        data_inicio_str = primeiro_dia_mes.strftime('%d/%m/%Y')
-        data_fim_str = ultimo_dia_mes.strftime('%d/%m/%Y')
-    else:
-        data_inicio_obj = _parse_data(data_inicio_raw)
-        data_fim_obj = _parse_data(data_fim_raw)
-        data_inicio_str = data_inicio_raw
-        data_fim_str = data_fim_raw
-
-    # Se ambas as datas foram passadas e estão invertidas, corrigir a ordem
-    if data_inicio_obj and data_fim_obj and data_inicio_obj > data_fim_obj:
-        data_inicio_obj, data_fim_obj = data_fim_obj, data_inicio_obj
-
-    if data_inicio_obj and data_fim_obj:
-        query = query.filter(Lancamento.data_prevista.between(data_inicio_obj, data_fim_obj))
-    elif data_inicio_obj:
-        query = query.filter(Lancamento.data_prevista >= data_inicio_obj)
-    elif data_fim_obj:
-        query = query.filter(Lancamento.data_prevista <= data_fim_obj)
-    
-    # Filtro por status
-    status = request.args.get('status')
+    # Aplicar filtros (sem datas, busca ou nota fiscal, usa o mês corrente como padrão)
     hoje = datetime.now().date()
-    if status == 'realizado':
-        query = query.filter(Lancamento.data_realizada.isnot(None), Lancamento.data_realizada <= hoje)
-    elif status == 'pendente':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.is_(None),
-                Lancamento.data_prevista >= hoje
-            )
-        )
-    elif status == 'agendado':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.isnot(None),
-                Lancamento.data_realizada > hoje
-            )
-        )
-    elif status == 'vencido':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.is_(None),
-                Lancamento.data_prevista < hoje
-            )
-        )
-    
-    # Filtro por Conta Caixa
-    conta_caixa_id = request.args.get('conta_caixa_id')
-    if conta_caixa_id:
-        try:
-            conta_caixa_id = int(conta_caixa_id)
-            query = query.filter(Lancamento.conta_caixa_id == conta_caixa_id)
-        except (ValueError, TypeError):
-            pass
-
-    # Filtro por Nota Fiscal (Suporte a múltiplos NFs separados por ponto e vírgula)
-    nf_raw = request.args.get('nota_fiscal', '').strip()
-    if nf_raw:
-        nfs = [n.strip() for n in nf_raw.split(';') if n.strip()]
-        if nfs:
-            if len(nfs) == 1:
-                query = query.filter(Lancamento.nota_fiscal.ilike(f'%{nfs[0]}%'))
-            else:
-                query = query.filter(Lancamento.nota_fiscal.in_(nfs))
-    
-    # Filtro por busca (descrição, cliente, fornecedor, valor ou ID com #)
-    busca = request.args.get('busca')
-    if busca and busca.strip():
-        busca_clean = busca.strip()
-
-        # Busca por ID(s): "#83" ou "#83, #84, #85" — prioridade máxima
-        import re as _re
-        _ids_buscados = [int(m) for m in _re.findall(r'#(\d+)', busca_clean)]
-        if _ids_buscados:
-            # Filtra diretamente por ID(s) sem join desnecessário
-            if len(_ids_buscados) == 1:
-                query = query.filter(Lancamento.id == _ids_buscados[0])
-            else:
-                query = query.filter(Lancamento.id.in_(_ids_buscados))
-        else:
-            query = query.join(Cliente, Lancamento.cliente_id == Cliente.id, isouter=True).join(
-                Fornecedor, Lancamento.fornecedor_id == Fornecedor.id, isouter=True)
-            # Verificar se a busca é um número (valor)
-            try:
-                valor_busca = float(busca_clean.replace(',', '.'))
-                query = query.filter(
-                    db.or_(
-                        Lancamento.descricao.ilike(f'%{busca_clean}%'),
-                        Cliente.nome.ilike(f'%{busca_clean}%'),
-                        Fornecedor.nome.ilike(f'%{busca_clean}%'),
-                        db.func.abs(Lancamento.valor - valor_busca) < 0.01
-                    )
-                )
-            except ValueError:
-                query = query.filter(
-                    db.or_(
-                        Lancamento.descricao.ilike(f'%{busca_clean}%'),
-                        Cliente.nome.ilike(f'%{busca_clean}%'),
-                        Fornecedor.nome.ilike(f'%{busca_clean}%')
-                    )
-                )
+    filtro = FiltroLancamentos.da_requisicao(request.args, empresa_id_correta, mes_corrente_padrao=True, hoje=hoje)
+    query = filtro.consulta()
+    data_inicio_str = filtro.data_inicio_texto
+    data_fim_str = filtro.data_fim_texto
     
-    # Ordenar e executar query
-    lancamentos = query.order_by(Lancamento.data_prevista.desc()).all()
+    # Página atual (paginação por cursor em data_prevista/id)
+    try:
+        por_pagina = int(request.args.get('por_pagina', app.config['ITENS_POR_PAGINA']))
+    except (ValueError, TypeError):
+        por_pagina = app.config['ITENS_POR_PAGINA']
+    por_pagina = max(1, min(por_pagina, 500))
+    try:
+        pagina = max(1, int(request.args.get('pagina', 1)))
+    except (ValueError, TypeError):
+        pagina = 1
 
-    # Data atual para verificar status
-    hoje = datetime.now().date()
+    lancamentos, cursor_anterior, proximo_cursor = paginar_lancamentos_keyset(
+        query.options(
+            db.joinedload(Lancamento.cliente),
+            db.joinedload(Lancamento.fornecedor),
+            db.joinedload(Lancamento.usuario)
+        ),
+        cursor=request.args.get('cursor'),
+        por_pagina=por_pagina,
+        direcao=request.args.get('direcao', 'proxima')
+    )
+    if not cursor_anterior:
+        pagina = 1
 
-    # Calcular totais financeiros dinâmicos baseados nos filtros aplicados
+    # Calcular totais financeiros dinâmicos baseados nos filtros aplicados (todas as páginas)
     # Transferências entre contas são excluídas dos totais (não representam receita/despesa real)
-    def nao_transferencia(l):
-        return not l.eh_transferencia
+    totais = calcular_totais_lancamentos(filtro)
+    total_lancamentos = totais['quantidade']
 
-    entradas_totais = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l)])
-    saidas_totais = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l)])
-    # Saldo atual considera apenas entradas e saidas REALIZADAS
-    entradas_totais_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l) and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
-    saidas_totais_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l) and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
-    saldo_atual = entradas_totais_realizadas - saidas_totais_realizadas
-
-    # Totais por status (baseado na nova lógica)
+    entradas_totais = totais['entrada_total']
+    saidas_totais = totais['saida_total']
     # Realizado: tem data_realizada <= hoje OU (realizado=True sem data_realizada)
-    entradas_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l) and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
-    saidas_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l) and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
+    entradas_realizadas = totais['entrada_realizada']
+    saidas_realizadas = totais['saida_realizada']
+    # Saldo atual considera apenas entradas e saidas REALIZADAS
+    saldo_atual = entradas_realizadas - saidas_realizadas
     # Agendado: tem data_realizada futura (data_realizada > hoje)
-    entradas_agendadas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l) and l.data_realizada and l.data_realizada > hoje])
-    saidas_agendadas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l) and l.data_realizada and l.data_realizada > hoje])
+    entradas_agendadas = totais['entrada_agendada']
+    saidas_agendadas = totais['saida_agendada']
     # A vencer: não realizado, sem data_realizada E data_prevista >= hoje
-    entradas_a_vencer = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l) and not l.realizado and not l.data_realizada and l.data_prevista >= hoje])
-    saidas_a_vencer = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l) and not l.realizado and not l.data_realizada and l.data_prevista >= hoje])
+    entradas_a_vencer = totais['entrada_a_vencer']
+    saidas_a_vencer = totais['saida_a_vencer']
     # Vencido: não realizado, sem data_realizada E data_prevista < hoje
-    entradas_vencidas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and nao_transferencia(l) and not l.realizado and not l.data_realizada and l.data_prevista < hoje])
-    saidas_vencidas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and nao_transferencia(l) and not l.realizado and not l.data_realizada and l.data_prevista < hoje])
+    entradas_vencidas = totais['entrada_vencida']
+    saidas_vencidas = totais['saida_vencida']
 
     # Saldos por status
     saldo_realizado = entradas_realizadas - saidas_realizadas
@@ -3074,24 +4454,11 @@ def lancamentos():
 
     # Calcular saldos acumulados por conta-caixa até data_fim (apenas lançamentos realizados)
     # "Realizado até data_fim" = data_realizada <= data_fim, ou (realizado=True sem data_realizada, data_prevista <= data_fim)
-    data_limite_saldo = data_fim_obj or hoje
+    data_limite_saldo = filtro.data_fim or hoje
     saldos_contas_caixa = []
+    saldos_realizados = saldos_contas_caixa_ate([conta.id for conta in contas_caixa], data_limite_saldo)
     for conta in contas_caixa:
-        filtro_base = [
-            Lancamento.empresa_id == empresa_id_correta,
-            Lancamento.conta_caixa_id == conta.id,
-            Lancamento.realizado == True,
-            db.or_(
-                Lancamento.data_realizada <= data_limite_saldo,
-                db.and_(Lancamento.data_realizada.is_(None), Lancamento.data_prevista <= data_limite_saldo)
-            )
-        ]
-        total_ent = db.session.query(
-            db.func.coalesce(db.func.sum(Lancamento.valor), 0)
-        ).filter(*filtro_base, Lancamento.tipo == 'entrada').scalar() or 0.0
-        total_sai = db.session.query(
-            db.func.coalesce(db.func.sum(Lancamento.valor), 0)
-        ).filter(*filtro_base, Lancamento.tipo == 'saida').scalar() or 0.0
+        total_ent, total_sai = saldos_realizados.get(conta.id, (0.0, 0.0))
         saldos_contas_caixa.append({
             'nome': conta.nome,
             'saldo': round(float(total_ent) - float(total_sai), 2)
@@ -3124,7 +4491,10 @@ def lancamentos():
                           saldo_realizado=saldo_realizado, saldo_a_vencer=saldo_a_vencer,
                           saldo_vencido=saldo_vencido, saldo_agendado=saldo_agendado,
                           saldos_contas_caixa=saldos_contas_caixa,
-                          data_limite_saldo=data_limite_saldo)
+                          data_limite_saldo=data_limite_saldo,
+                          # Paginação por cursor
+                          total_lancamentos=total_lancamentos, pagina=pagina, por_pagina=por_pagina,
+                          cursor_anterior=cursor_anterior, proximo_cursor=proximo_cursor)
 
 @app.route('/lancamentos/excluir-lote', methods=['POST'])
 def excluir_lancamentos_lote():
@@ -3203,6 +4573,560 @@ def excluir_lancamentos_lote():
 
 # Rota removida - duplicada. Ver linha 11611 para a implementação completa
 
+# ===== LEITURA DE OFX EM STREAMING =====
+
+class TransacaoOfx:
+    """Transação de extrato OFX (mesmos atributos da Transaction do ofxparse)."""
+
+    __slots__ = ('id', 'type', 'date', 'user_date', 'amount', 'payee', 'memo', 'checknum')
+
+    def __init__(self, id, type, date, user_date, amount, payee, memo, checknum):
+        self.id = id
+        self.type = type
+        self.date = date
+        self.user_date = user_date
+        self.amount = amount
+        self.payee = payee
+        self.memo = memo
+        self.checknum = checknum
+
+    def __repr__(self):
+        return f'<TransacaoOfx {self.id} {self.amount}>'
+
+
+def _data_hora_ofx(texto):
+    """Converte 20101106160000.00[-5:EST] em datetime UTC (mesma regra do ofxparse)."""
+    fuso = re.search(r"\[(?P<tz>[-+]?\d+\.?\d*)\:\w*\]$", texto)
+    deslocamento = timedelta(hours=float(fuso.group('tz')) if fuso else 0)
+
+    fracao = re.search(r"^[0-9]*\.([0-9]{0,5})", texto)
+    milissegundos = timedelta(seconds=float("0." + fracao.group(1)) if fracao else 0)
+
+    try:
+        return datetime.strptime(texto[:14], '%Y%m%d%H%M%S') - deslocamento + milissegundos
+    except ValueError:
+        if texto[:8] == "00000000":
+            return None
+        return datetime.strptime(texto[:8], '%Y%m%d') - deslocamento + milissegundos
+
+
+def _valor_ofx(texto):
+    """Converte TRNAMT em Decimal aceitando 10,000.50 / 10.000,50 / 10000,50 / 1 025,53."""
+    if re.search(r'.*\..*,', texto):
+        texto = texto.replace('.', '')
+    if re.search(r'.*,.*\.', texto):
+        texto = texto.replace(',', '')
+    if '.' not in texto and ',' in texto:
+        texto = texto.replace(',', '.')
+    texto = texto.replace(' ', '').replace('+', '')
+    try:
+        return Decimal(texto)
+    except ArithmeticError:
+        # Alguns bancos usam transação "null" para avisos de mudança de taxa
+        if texto in ('null', '-null'):
+            return Decimal('0')
+        raise ValueError(f"Valor de transação inválido: '{texto}'")
+
+
+class LeitorOfx:
+    """
+    Leitor incremental de extratos OFX (SGML 1.x e XML 2.x).
+
+    Lê o arquivo em blocos e entrega as transações do primeiro extrato
+    (STMTRS/CCSTMTRS) à medida que cada <STMTTRN> termina, sem montar a árvore
+    do documento inteiro. As datas mínima/máxima e os dados da conta são
+    acumulados durante a leitura. Campos e conversões seguem o ofxparse, então
+    o resultado é o mesmo de OfxParser.parse(...).account.statement.transactions.
+    """
+
+    TAMANHO_BLOCO = 64 * 1024
+    _TAG = re.compile(r'<(/?)([A-Za-z0-9_.]+)>')
+
+    def __init__(self, arquivo, tamanho_bloco=None):
+        self.arquivo = arquivo
+        self.tamanho_bloco = tamanho_bloco or self.TAMANHO_BLOCO
+        self.numero_conta = ''
+        self.agencia = ''
+        self.codigo_banco = ''
+        self.fid_instituicao = ''
+        self.quantidade = 0
+        self.data_minima = None
+        self.data_maxima = None
+        self.extrato_encontrado = False
+
+    @staticmethod
+    def _codificacao(cabecalho):
+        """Codificação declarada no cabeçalho SGML (ENCODING/CHARSET) ou UTF-8."""
+        campos = {}
+        for linha in cabecalho.splitlines():
+            chave, sep, valor = linha.partition(b':')
+            if sep:
+                campos[chave.strip().upper()] = valor.strip().decode('ascii', 'replace')
+        if campos.get(b'ENCODING') == 'USASCII':
+            charset = campos.get(b'CHARSET', '1252')
+            return 'iso-8859-1' if charset == '8859-1' else f'cp{charset}'
+        return 'utf-8'
+
+    def _tokens(self):
+        """Gera (fechamento, tag, texto seguinte) para cada tag do arquivo."""
+        import codecs
+        from html import unescape
+
+        def ler_bloco():
+            bloco = self.arquivo.read(self.tamanho_bloco)
+            return bloco.encode('utf-8') if isinstance(bloco, str) else bloco
+
+        # O cabeçalho SGML (antes da primeira tag) define a codificação do restante
+        bloco = ler_bloco()
+        while b'<' not in bloco:
+            continuacao = ler_bloco()
+            if not continuacao:
+                break
+            bloco += continuacao
+        inicio_tags = bloco.find(b'<')
+        decodificador = codecs.getincrementaldecoder(
+            self._codificacao(bloco[:inicio_tags] if inicio_tags >= 0 else bloco)
+        )(errors='replace')
+
+        pendente = ''
+        while True:
+            fim_arquivo = not bloco
+            pendente += decodificador.decode(bloco, final=fim_arquivo)
+
+            tags = list(self._TAG.finditer(pendente))
+            # Antes do fim do arquivo a última tag fica para o próximo bloco: o texto dela pode continuar
+            completas = tags if fim_arquivo else tags[:-1]
+            for indice, tag in enumerate(completas):
+                fim_texto = tags[indice + 1].start() if indice + 1 < len(tags) else len(pendente)
+                yield tag.group(1) == '/', tag.group(2).upper(), unescape(pendente[tag.end():fim_texto]).strip()
+            if fim_arquivo:
+                return
+            if completas:
+                pendente = pendente[tags[-1].start():]
+            bloco = ler_bloco()
+
+    def _transacao(self, campos):
+        if 'TRNAMT' not in campos:
+            raise ValueError('Transação OFX sem valor (TRNAMT)')
+        if not campos.get('DTPOSTED'):
+            raise ValueError('Transação OFX sem data (DTPOSTED)')
+        if not campos.get('FITID'):
+            raise ValueError('Transação OFX sem identificador (FITID)')
+
+        data = _data_hora_ofx(campos['DTPOSTED'])
+        if data is None:
+            raise ValueError(f"Data de transação inválida: '{campos['DTPOSTED']}'")
+        data_usuario = _data_hora_ofx(campos['DTUSER']) if campos.get('DTUSER') else None
+
+        return TransacaoOfx(
+            id=campos['FITID'],
+            type=campos.get('TRNTYPE', '').lower(),
+            date=data,
+            user_date=data_usuario,
+            amount=_valor_ofx(campos['TRNAMT']),
+            payee=campos.get('NAME', ''),
+            memo=campos.get('MEMO', ''),
+            checknum=campos.get('CHECKNUM', ''),
+        )
+
+    def transacoes(self):
+        """Gera as transações do extrato na ordem do arquivo."""
+        estado_extrato = 'antes'  # 'antes' | 'dentro' | 'depois'
+        dentro_fi = False
+        conta = {}
+        campos = None
+
+        for fechamento, tag, texto in self._tokens():
+            if fechamento:
+                if tag == 'STMTTRN' and campos is not None:
+                    yield self._registrar(self._transacao(campos))
+                    campos = None
+                elif tag in ('STMTRS', 'CCSTMTRS') and estado_extrato == 'dentro':
+                    estado_extrato = 'depois'
+                elif tag == 'FI':
+                    dentro_fi = False
+                continue
+
+            if tag in ('STMTRS', 'CCSTMTRS'):
+                if estado_extrato == 'antes':
+                    estado_extrato = 'dentro'
+                    self.extrato_encontrado = True
+            elif tag == 'STMTTRN':
+                if estado_extrato == 'dentro':
+                    campos = {}
+            elif tag == 'FI':
+                dentro_fi = True
+            elif campos is not None:
+                campos.setdefault(tag, texto)
+            elif estado_extrato == 'dentro':
+                conta.setdefault(tag, texto)
+                self.numero_conta = conta.get('ACCTID', '')
+                self.agencia = conta.get('BRANCHID', '')
+                self.codigo_banco = conta.get('BANKID', '')
+            elif dentro_fi and tag == 'FID' and not self.fid_instituicao:
+                self.fid_instituicao = texto
+
+        if not self.extrato_encontrado:
+            raise ValueError('Nenhum extrato bancário encontrado no arquivo OFX')
+
+    def _registrar(self, transacao):
+        self.quantidade += 1
+        data = transacao.date.date()
+        if self.data_minima is None or data < self.data_minima:
+            self.data_minima = data
+        if self.data_maxima is None or data > self.data_maxima:
+            self.data_maxima = data
+        return transacao
+
+    def lotes(self, tamanho=500):
+        """Gera as transações em listas de até `tamanho` itens."""
+        lote = []
+        for transacao in self.transacoes():
+            lote.append(transacao)
+            if len(lote) >= tamanho:
+                yield lote
+                lote = []
+        if lote:
+            yield lote
+
+
+# ===== CONCILIAÇÃO OFX: MATCHING DE CANDIDATOS =====
+
+# Componentes maiores que isso (linhas² × colunas) usam seleção gulosa por score
+LIMITE_ATRIBUICAO_OTIMA_OFX = 2_000_000
+
+
+def _tokens_texto(texto):
+    """Palavras com mais de 3 letras, em minúsculas (mesma regra das regras de conciliação)."""
+    if not texto:
+        return frozenset()
+    return frozenset(w.lower() for w in str(texto).split() if len(w) > 3)
+
+
+def _data_transacao_ofx(tx):
+    data = tx.date.date() if hasattr(tx.date, 'date') else tx.date
+    if isinstance(data, datetime):
+        data = data.date()
+    return data
+
+
+def _indexar_candidatos_ofx(lancamentos, cache=None):
+    """
+    Indexa os lançamentos candidatos por tipo, ordenados pelo valor em centavos
+    (e id), com datas e palavras da descrição calculadas uma única vez.
+    cache: {lancamento_id: candidato} reaproveitado entre lotes.
+    Retorna {tipo: (centavos_ordenados, candidatos)}; cada candidato tem 'chave'.
+    """
+    from collections import defaultdict
+
+    cache = {} if cache is None else cache
+    por_tipo = defaultdict(list)
+    for lanc in lancamentos:
+        if lanc.tipo not in ('entrada', 'saida'):
+            continue
+        candidato = cache.get(lanc.id)
+        if candidato is None:
+            valor = float(lanc.valor)
+            datas = [lanc.data_prevista]
+            if lanc.data_realizada:
+                datas.append(lanc.data_realizada)
+            centavos = int(round(valor * 100))
+            candidato = cache[lanc.id] = {
+                'chave': (lanc.tipo, centavos, lanc.id), 'lancamento': lanc, 'valor': valor,
+                'datas': datas, 'data_prevista': lanc.data_prevista,
+                'tokens': _tokens_texto(lanc.descricao), 'realizado': bool(lanc.realizado)
+            }
+        por_tipo[lanc.tipo].append(candidato)
+
+    indice = {}
+    for tipo, candidatos in por_tipo.items():
+        candidatos.sort(key=lambda candidato: candidato['chave'])
+        indice[tipo] = ([candidato['chave'][1] for candidato in candidatos], candidatos)
+    return indice
+
+
+def _score_candidato_ofx(transacao, candidato):
+    """
+    Score de um possível match entre transação OFX e lançamento do sistema
+    (data até 40, descrição até 30 e valor até 30 pontos). Retorna -1 se
+    os critérios obrigatórios não forem atendidos.
+    """
+    valor_abs = transacao['valor_abs']
+
+    # Obrigatório: valor dentro de 1% ou R$0,05 de tolerância
+    diferenca_valor = abs(candidato['valor'] - valor_abs)
+    if diferenca_valor > max(0.05, valor_abs * 0.01):
+        return -1
+
+    # Obrigatório: até 15 dias da data_prevista ou da data_realizada
+    min_diff_dias = min(abs((d - transacao['data']).days) for d in candidato['datas'])
+    if min_diff_dias > 15:
+        return -1
+
+    date_score = max(0, 40 - min_diff_dias * 2)
+
+    desc_score = 0
+    memo_words, desc_words = transacao['tokens'], candidato['tokens']
+    if memo_words and desc_words:
+        common = memo_words & desc_words
+        desc_score = int(30 * len(common) / max(len(memo_words), len(desc_words)))
+
+    value_score = max(0, 30 - int(diferenca_valor * 100))
+
+    return date_score + desc_score + value_score
+
+
+def _atribuicao_otima(pesos, linhas, colunas):
+    """
+    Atribuição de peso máximo (algoritmo húngaro) entre linhas e colunas.
+    pesos: {(linha, coluna): peso > 0}; pares ausentes não podem ser atribuídos.
+    Retorna {linha: coluna}.
+    """
+    transposto = len(linhas) > len(colunas)
+    if transposto:
+        linhas, colunas = colunas, linhas
+        pesos = {(c, l): p for (l, c), p in pesos.items()}
+
+    n, m = len(linhas), len(colunas)
+    infinito = float('inf')
+    u, v = [0.0] * (n + 1), [0.0] * (m + 1)
+    p, caminho = [0] * (m + 1), [0] * (m + 1)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [infinito] * (m + 1)
+        usado = [False] * (m + 1)
+        while True:
+            usado[j0] = True
+            i0 = p[j0]
+            linha = linhas[i0 - 1]
+            delta, j1 = infinito, 0
+            for j in range(1, m + 1):
+                if not usado[j]:
+                    atual = -pesos.get((linha, colunas[j - 1]), 0) - u[i0] - v[j]
+                    if atual < minv[j]:
+                        minv[j], caminho[j] = atual, j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(m + 1):
+                if usado[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = caminho[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    atribuicao = {}
+    for j in range(1, m + 1):
+        if p[j] and (linhas[p[j] - 1], colunas[j - 1]) in pesos:
+            linha, coluna = linhas[p[j] - 1], colunas[j - 1]
+            if transposto:
+                linha, coluna = coluna, linha
+            atribuicao[linha] = coluna
+    return atribuicao
+
+
+class ConciliadorOfx:
+    """
+    Encontra, para cada transação OFX, o lançamento do sistema correspondente.
+
+    Os candidatos são indexados por tipo e valor (busca binária dentro da
+    tolerância), então cada transação só é comparada com lançamentos de valor
+    compatível. A escolha é uma atribuição global ótima (cada lançamento usado
+    no máximo uma vez, maximizando a soma dos scores) em vez de gulosa na ordem
+    do extrato. Lançamentos pendentes com score >= 30 têm prioridade sobre os
+    já realizados.
+
+    As transações podem chegar em lotes (adicionar): os scores de cada lote são
+    calculados assim que ele é lido, com candidatos carregados só para a janela
+    de datas do lote via carregar_candidatos(data_inicio, data_fim). A
+    atribuição, que depende de todas as transações, é feita em resultado().
+    """
+
+    # Diferença máxima entre a transação e a data prevista/realizada do lançamento
+    JANELA_DIAS = 15
+
+    def __init__(self, carregar_candidatos=None):
+        self.carregar_candidatos = carregar_candidatos
+        self.candidatos = {}
+        # Por transação: [(chave do candidato, score)]
+        self.arestas = []
+
+    @classmethod
+    def da_empresa(cls, empresa_id):
+        """Conciliador que carrega os candidatos da empresa por janela de datas de cada lote."""
+        def carregar_candidatos(data_inicio, data_fim):
+            return Lancamento.query.filter(
+                Lancamento.empresa_id == empresa_id,
+                db.or_(
+                    db.and_(Lancamento.data_prevista >= data_inicio, Lancamento.data_prevista <= data_fim),
+                    db.and_(Lancamento.data_realizada >= data_inicio, Lancamento.data_realizada <= data_fim)
+                )
+            ).all()
+        return cls(carregar_candidatos)
+
+    def adicionar(self, transacoes, lancamentos=None):
+        from bisect import bisect_left, bisect_right
+
+        transacoes = list(transacoes)
+        if not transacoes:
+            return
+        datas = [_data_transacao_ofx(tx) for tx in transacoes]
+        if lancamentos is None:
+            lancamentos = self.carregar_candidatos(min(datas) - timedelta(days=self.JANELA_DIAS),
+                                                   max(datas) + timedelta(days=self.JANELA_DIAS))
+        indice = _indexar_candidatos_ofx(lancamentos, self.candidatos)
+
+        for tx, data in zip(transacoes, datas):
+            arestas = []
+            self.arestas.append(arestas)
+            valor = float(tx.amount)
+            transacao = {
+                'valor_abs': abs(valor),
+                'data': data,
+                'tokens': _tokens_texto(getattr(tx, 'memo', None)),
+            }
+            tipo = 'entrada' if valor >= 0 else 'saida'
+            if tipo not in indice:
+                continue
+            centavos, candidatos = indice[tipo]
+            tolerancia = int(max(0.05, transacao['valor_abs'] * 0.01) * 100) + 1
+            valor_centavos = int(round(transacao['valor_abs'] * 100))
+            inicio = bisect_left(centavos, valor_centavos - tolerancia)
+            fim = bisect_right(centavos, valor_centavos + tolerancia)
+            for candidato in candidatos[inicio:fim]:
+                score = _score_candidato_ofx(transacao, candidato)
+                if score >= 0:
+                    arestas.append((candidato['chave'], score))
+
+    def resultado(self, data_prevista_min=None, data_prevista_max=None):
+        """
+        Retorna lista alinhada com as transações de (lancamento ou None, score).
+        data_prevista_min/max restringem os candidatos pela data prevista (pool
+        de candidatos da tela, calculado a partir do extrato inteiro).
+        """
+        candidatos = {candidato['chave']: candidato for candidato in self.candidatos.values()}
+
+        # Arestas transação → candidato com score válido
+        pesos, scores = {}, {}
+        adjacencia = {}
+        for i, arestas in enumerate(self.arestas):
+            for chave_candidato, score in arestas:
+                data_prevista = candidatos[chave_candidato]['data_prevista']
+                if (data_prevista_min and data_prevista < data_prevista_min) or \
+                        (data_prevista_max and data_prevista > data_prevista_max):
+                    continue
+                realizado = candidatos[chave_candidato]['realizado']
+                pesos[(i, chave_candidato)] = score + 1 + (100 if not realizado and score >= 30 else 0)
+                scores[(i, chave_candidato)] = score
+                adjacencia.setdefault(i, []).append(chave_candidato)
+                adjacencia.setdefault(chave_candidato, []).append(i)
+
+        # Componentes conexos do grafo transação × candidato, resolvidos separadamente
+        visitados = set()
+        atribuicao = {}
+        for origem in [i for i in range(len(self.arestas)) if i in adjacencia]:
+            if origem in visitados:
+                continue
+            pilha, componente = [origem], []
+            visitados.add(origem)
+            while pilha:
+                no = pilha.pop()
+                componente.append(no)
+                for vizinho in adjacencia[no]:
+                    if vizinho not in visitados:
+                        visitados.add(vizinho)
+                        pilha.append(vizinho)
+
+            linhas = sorted(no for no in componente if isinstance(no, int))
+            colunas = sorted(no for no in componente if not isinstance(no, int))
+            pesos_componente = {(i, c): pesos[(i, c)] for i in linhas for c in adjacencia[i]}
+
+            if len(linhas) == 1 or len(colunas) == 1 or \
+                    min(len(linhas), len(colunas)) ** 2 * max(len(linhas), len(colunas)) <= LIMITE_ATRIBUICAO_OTIMA_OFX:
+                atribuicao.update(_atribuicao_otima(pesos_componente, linhas, colunas))
+            else:
+                # Componente muito grande: maiores scores primeiro
+                usados = set()
+                for (i, c), _ in sorted(pesos_componente.items(), key=lambda item: (-item[1], item[0][0], item[0][1])):
+                    if i not in atribuicao and c not in usados:
+                        atribuicao[i] = c
+                        usados.add(c)
+
+        resultado = []
+        for i in range(len(self.arestas)):
+            chave_candidato = atribuicao.get(i)
+            if chave_candidato is None:
+                resultado.append((None, -1))
+            else:
+                resultado.append((candidatos[chave_candidato]['lancamento'], scores[(i, chave_candidato)]))
+        return resultado
+
+
+class IndiceRegrasConciliacao:
+    """
+    Índice invertido (palavra-chave → regras) das ConciliacaoRegra de uma empresa.
+
+    Montado uma vez por requisição: cada memo só é pontuado contra as regras que
+    compartilham ao menos uma palavra-chave com ele, em vez de contra todas as
+    regras da empresa. O score é o mesmo de ConciliacaoRegra.score_match e, em
+    caso de empate, vence a regra que aparece primeiro na lista (como no laço
+    original).
+    """
+
+    SCORE_MINIMO = 30  # 30% de sobreposição de palavras-chave
+
+    def __init__(self, regras):
+        self.regras = list(regras)
+        self.qtd_palavras = []
+        self.por_palavra = {}
+        for posicao, regra in enumerate(self.regras):
+            palavras = regra.get_keywords_set()
+            self.qtd_palavras.append(len(palavras))
+            for palavra in palavras:
+                self.por_palavra.setdefault(palavra, []).append(posicao)
+
+    @classmethod
+    def da_empresa(cls, empresa_id):
+        return cls(ConciliacaoRegra.query.filter_by(empresa_id=empresa_id).order_by(ConciliacaoRegra.id).all())
+
+    def __bool__(self):
+        return bool(self.regras)
+
+    def melhor_regra(self, memo_text):
+        """Retorna (regra, score) da regra com maior score para o memo, ou (None, 0)."""
+        palavras_memo = _tokens_texto(memo_text)
+        if not palavras_memo:
+            return None, 0
+
+        em_comum = {}
+        for palavra in palavras_memo:
+            for posicao in self.por_palavra.get(palavra, ()):
+                em_comum[posicao] = em_comum.get(posicao, 0) + 1
+
+        melhor_posicao, melhor_score = None, 0
+        for posicao in sorted(em_comum):
+            score = int(100 * em_comum[posicao] / max(len(palavras_memo), self.qtd_palavras[posicao]))
+            if score > melhor_score:
+                melhor_posicao, melhor_score = posicao, score
+        if melhor_posicao is None:
+            return None, 0
+        return self.regras[melhor_posicao], melhor_score
+
+    def sugerir(self, memo_text):
+        """Regra sugerida para o memo (score mínimo de 30%), ou None."""
+        regra, score = self.melhor_regra(memo_text)
+        return regra if score >= self.SCORE_MINIMO else None
+
 @app.route('/conciliacao', methods=['GET', 'POST'])
 def conciliacao():
     valido, session_user, tipo_usuario = validar_sessao_ativa()
@@ -3226,23 +5150,23 @@ def conciliacao():
             flash('Por favor, envie um arquivo no formato .ofx', 'error')
             return redirect(request.url)
             
-        if OfxParser is None:
-            flash('Erro no sistema: biblioteca ofxparse não está instalada.', 'error')
-            return redirect(request.url)
-
         try:
-            # Parse OFX file
-            ofx = OfxParser.parse(file)
-            account = ofx.account
-            statement = account.statement
+            # Leitura do OFX em streaming: os scores de matching de cada lote são
+            # calculados enquanto o restante do arquivo ainda está sendo lido
+            leitor = LeitorOfx(file)
+            conciliador = ConciliadorOfx.da_empresa(empresa_id)
+            transacoes_ofx = []
+            for lote in leitor.lotes():
+                transacoes_ofx.extend(lote)
+                conciliador.adicionar(lote)
             
             # ===== EXTRAIR INFO DA CONTA BANCÁRIA DO OFX =====
             ofx_account_info = None
             conta_caixa_detectada = None
             try:
-                ofx_account_num = str(getattr(account, 'account_id', '') or '').strip()
-                ofx_banco = str(getattr(getattr(account, 'institution', None), 'fid', '') or '').strip()
-                ofx_agencia = str(getattr(account, 'branch_id', '') or '').strip()
+                ofx_account_num = leitor.numero_conta
+                ofx_banco = leitor.fid_instituicao
+                ofx_agencia = leitor.agencia
                 
                 if ofx_account_num or ofx_banco:
                     ofx_account_info = {
@@ -3275,17 +5199,10 @@ def conciliacao():
             # Use selected if available, else detected
             conta_caixa_ativa = conta_caixa_selecionada or conta_caixa_detectada
             
-            # Definir range de datas baseado no OFX
-            dates = []
-            for tx in statement.transactions:
-                dt = tx.date.date() if hasattr(tx.date, 'date') else tx.date
-                if isinstance(dt, datetime):
-                    dt = dt.date()
-                dates.append(dt)
-
-            if dates:
-                ofx_min_date = min(dates)
-                ofx_max_date = max(dates)
+            # Range de datas do OFX (acumulado durante a leitura)
+            if leitor.quantidade:
+                ofx_min_date = leitor.data_minima
+                ofx_max_date = leitor.data_maxima
             else:
                 hoje = datetime.utcnow().date()
                 ofx_min_date = hoje - timedelta(days=30)
@@ -3302,119 +5219,26 @@ def conciliacao():
                 Lancamento.data_prevista <= ofx_max_date
             ).order_by(Lancamento.data_prevista).all()
 
-            # Pool de candidatos para matching (janela mais ampla, inclui dias próximos)
-            candidatos_matching = Lancamento.query.filter(
-                Lancamento.empresa_id == empresa_id,
-                Lancamento.data_prevista >= match_min_date,
-                Lancamento.data_prevista <= match_max_date
-            ).all()
-
-            # Listas para matching (priorizar os não realizados)
-            disponiveis = [l for l in candidatos_matching if not l.realizado]
-            disponiveis_realizados = [l for l in candidatos_matching if l.realizado]
-            
+            # Matching indexado por tipo/valor com atribuição global (pendentes têm prioridade),
+            # com pool de candidatos na janela ampliada (inclui dias próximos)
             ofx_transactions = []
-            
-            def _score_match(tx, lanc):
-                """
-                Score a potencial match between an OFX transaction and a system lancamento.
-                Returns a score >= 0. Higher is better. Returns -1 if mandatory criteria fail.
-                """
-                tx_amount = float(tx.amount)
-                tx_abs_amount = abs(tx_amount)
-                
-                # Mandatory: same type (entrada/saída)
-                if tx_amount >= 0 and lanc.tipo != 'entrada':
-                    return -1
-                if tx_amount < 0 and lanc.tipo != 'saida':
-                    return -1
-                
-                # Mandatory: value must match within 1% or R$0.05 tolerance
-                if abs(float(lanc.valor) - tx_abs_amount) > max(0.05, tx_abs_amount * 0.01):
-                    return -1
-                
-                # Score: date proximity (within 15 days)
-                data_banco = tx.date.date() if hasattr(tx.date, 'date') else tx.date
-                if isinstance(data_banco, datetime):
-                    data_banco = data_banco.date()
-                
-                # Compare against data_prevista and data_realizada (if exists)
-                dates_to_check = [lanc.data_prevista]
-                if hasattr(lanc, 'data_realizada') and lanc.data_realizada:
-                    dates_to_check.append(lanc.data_realizada)
-                
-                min_diff_dias = min(abs((d - data_banco).days) for d in dates_to_check)
-                
-                if min_diff_dias > 15:
-                    return -1  # Too far apart in time
-                
-                # Date score: closer = better (max 40 points)
-                date_score = max(0, 40 - min_diff_dias * 2)
-                
-                # Score: description/memo similarity (max 30 points)
-                desc_score = 0
-                try:
-                    memo_words = set(w.lower() for w in tx.memo.split() if len(w) > 3)
-                    desc_words = set(w.lower() for w in lanc.descricao.split() if len(w) > 3)
-                    if memo_words and desc_words:
-                        common = memo_words & desc_words
-                        desc_score = int(30 * len(common) / max(len(memo_words), len(desc_words)))
-                except Exception:
-                    pass
-                
-                # Base value match score: 30 points
-                value_diff = abs(float(lanc.valor) - tx_abs_amount)
-                value_score = max(0, 30 - int(value_diff * 100))
-                
-                return date_score + desc_score + value_score
-            
-            for tx in statement.transactions:
-                best_match = None
-                best_score = -1
-                best_is_realizado = False
-                
-                # Check pendings first (priority), then realizados
-                for candidate_list, is_realizado in [(disponiveis, False), (disponiveis_realizados, True)]:
-                    for lanc in candidate_list:
-                        score = _score_match(tx, lanc)
-                        if score > best_score:
-                            best_score = score
-                            best_match = lanc
-                            best_is_realizado = is_realizado
-                    
-                    # If we found a good match in pendings, don't bother checking realizados
-                    if best_score >= 30:
-                        break
-                
-                ofx_item = {'tx': tx, 'match': best_match, 'score': best_score, 'regra': None}
-                ofx_transactions.append(ofx_item)
-                
+            for tx, (best_match, best_score) in zip(transacoes_ofx,
+                                                     conciliador.resultado(match_min_date, match_max_date)):
+                ofx_transactions.append({'tx': tx, 'match': best_match, 'score': best_score, 'regra': None})
                 if best_match:
                     # Inject OFX match info onto lancamento for use in right panel template
                     best_match.ofx_match = tx
                     best_match.ofx_score = best_score
-                    if not best_is_realizado and best_match in disponiveis:
-                        disponiveis.remove(best_match)
-                    elif best_is_realizado and best_match in disponiveis_realizados:
-                        disponiveis_realizados.remove(best_match)
             
             # ===== CARREGAR REGRAS DE CONCILIAÇÃO (Memória por Empresa) =====
             # Load saved rules for this empresa and attach best match to each unmatched OFX transaction
             try:
-                regras_empresa = ConciliacaoRegra.query.filter_by(empresa_id=empresa_id).all()
-                if regras_empresa:
+                indice_regras = IndiceRegrasConciliacao.da_empresa(empresa_id)
+                if indice_regras:
                     for ofx_item in ofx_transactions:
                         if ofx_item['match'] is None:  # Only for unmatched transactions
-                            tx = ofx_item['tx']
-                            best_regra = None
-                            best_regra_score = 0
-                            for regra in regras_empresa:
-                                s = regra.score_match(tx.memo)
-                                if s > best_regra_score:
-                                    best_regra_score = s
-                                    best_regra = regra
-                            if best_regra and best_regra_score >= 30:  # 30% keyword overlap minimum
-                                ofx_item['regra'] = best_regra
+                            # 30% keyword overlap minimum
+                            ofx_item['regra'] = indice_regras.sugerir(ofx_item['tx'].memo)
             except Exception as regra_err:
                 db.session.rollback()
                 app.logger.error(f'[OFX] Erro ao carregar regras de conciliação: {str(regra_err)}')
@@ -5590,6 +7414,7 @@ def api_produtos_sugestoes():
     })
 
 @app.route('/estoque/sincronizar')
+@em_segundo_plano('estoque')
 def sincronizar_estoque():
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
@@ -5608,14 +7433,25 @@ def sincronizar_estoque():
         sucesso_consolidacao, mensagem_consolidacao = consolidar_produtos_duplicados(usuario.id)
         
         # Depois sincronizar estoque
-        sucesso, mensagem = sincronizar_estoque_usuario(usuario.id)
-        if sucesso:
-            flash(f'Estoque sincronizado com sucesso! {mensagem}. {mensagem_consolidacao}', 'success')
-        else:
-            flash(f'Erro ao sincronizar estoque: {mensagem}', 'error')
+        sucesso, mensagem, alteracoes = sincronizar_estoque_usuario(usuario.id)
     except Exception as e:
         db.session.rollback()
-        flash(f'Erro ao sincronizar estoque: {str(e)}', 'error')
+        sucesso, mensagem, alteracoes, mensagem_consolidacao = False, str(e), [], ''
+
+    # ?formato=json devolve o relatório completo (útil no resultado do job)
+    if request.args.get('formato') == 'json':
+        return jsonify({'success': sucesso, 'mensagem': mensagem, 'consolidacao': mensagem_consolidacao,
+                        'alteracoes': alteracoes}), (200 if sucesso else 500)
+
+    if sucesso:
+        flash(f'Estoque sincronizado com sucesso! {mensagem}. {mensagem_consolidacao}', 'success')
+        for a in alteracoes[:20]:
+            flash(f"{a['nome']}: estoque {a['estoque_anterior'] or 0} → {a['estoque_novo']}, "
+                  f"custo R$ {a['preco_custo_anterior'] or 0:.2f} → R$ {a['preco_custo_novo']:.2f}", 'info')
+        if len(alteracoes) > 20:
+            flash(f'... e mais {len(alteracoes) - 20} produto(s) alterado(s).', 'info')
+    else:
+        flash(f'Erro ao sincronizar estoque: {mensagem}', 'error')
     
     return redirect(url_for('estoque'))
 
@@ -5754,6 +7590,11 @@ def ajustar_estoque(produto_id):
                 flash('Estoque insuficiente para saída.', 'error')
                 return redirect(url_for('ajustar_estoque', produto_id=produto_id))
         
+        if tipo_ajuste in ('entrada', 'saida'):
+            registrar_ajuste_estoque(_empresa_id_est, produto.nome,
+                                     quantidade if tipo_ajuste == 'entrada' else -quantidade,
+                                     usuario.id, motivo)
+        
         # Se estoque > 0 após ajuste, ativar automaticamente
         if produto.estoque > 0:
             produto.ativo = True
@@ -5792,6 +7633,11 @@ def editar_produto(produto_id):
         estoque_novo = int(request.form['estoque'])
         produto.estoque = estoque_novo
         
+        # Registrar a diferença para o estoque calculado como ajuste no razão
+        diferenca = estoque_novo - calcular_estoque_produto(produto.nome, usuario.id)
+        if diferenca:
+            registrar_ajuste_estoque(empresa_id, produto.nome, diferenca, usuario.id, 'Edição do produto')
+        
         # Processar campo ativo
         produto.ativo = 'ativo' in request.form
         
@@ -6158,6 +8004,7 @@ def deletar_conta(conta_id):
     try:
         nome_conta = conta.nome
         # Remover configurações DRE que referenciam esta conta antes de deletar
+        invalidar_carteiras_empresas([conta.empresa_id])
         DreConfiguracao.query.filter_by(plano_conta_id=conta.id).delete(synchronize_session=False)
         db.session.delete(conta)
         db.session.commit()
@@ -8215,156 +10062,476 @@ def consolidar_produtos_duplicados(usuario_id):
         app.logger.error(f"Erro ao consolidar produtos: {str(e)}")
         return False, f"Erro ao consolidar produtos: {str(e)}"
 
-def calcular_preco_medio_produto(nome_produto, usuario_id):
-    """
-    Calcula o preço médio ponderado de um produto baseado em todas as compras
-    (independente do status "realizado")
-    """
-    # Buscar o usuário para obter a empresa_id
-    usuario = db.session.get(Usuario, usuario_id)
-    if not usuario:
-        return 0
-    
-    # Buscar todos os usuários da mesma empresa
-    empresa_id = obter_empresa_id_sessao(session, usuario)
+# ===== ITENS DE CARRINHO =====
 
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
-    
-    app.logger.info(f"Calculando preço médio para produto {nome_produto} - Usuários da empresa: {usuarios_ids}")
-    
-    # Buscar todas as compras para este produto pelo campo produto (item principal)
-    compras_todas = Compra.query.filter(
-        Compra.produto == nome_produto,
-        Compra.empresa_id == empresa_id,
-        Compra.tipo_compra == 'mercadoria'
-    ).all()
-    compras_ids_contadas = {c.id for c in compras_todas}
+def _numero_item(valor, padrao=0.0):
+    """Converte quantidade/preço de um item do JSON (aceita vírgula decimal)."""
+    if valor is None or valor == '':
+        return padrao
+    try:
+        return float(str(valor).replace(',', '.'))
+    except (ValueError, TypeError):
+        return padrao
 
-    # Calcular preço médio ponderado (compras via campo produto principal)
-    valor_total = 0
-    quantidade_total = 0
 
-    for compra in compras_todas:
-        valor_total += compra.quantidade * compra.preco_custo
-        quantidade_total += compra.quantidade
+def _linhas_itens_carrinho(lancamento):
+    """Converte o JSON itens_carrinho de uma linha de lançamento nas linhas de item_carrinho."""
+    try:
+        itens = json.loads(lancamento.itens_carrinho) if lancamento.itens_carrinho else []
+    except (ValueError, TypeError):
+        itens = []
+    if not isinstance(itens, list):
+        return []
 
-    # Também contabilizar itens secundários de carrinho multi-item
-    import json as _json_preco
-    nome_norm = normalizar_nome_produto(nome_produto)
-    lancamentos_multi = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id,
-        Lancamento.compra_id.isnot(None),
-        Lancamento.itens_carrinho.isnot(None)
-    ).all()
-    for lanc in lancamentos_multi:
-        if lanc.compra_id in compras_ids_contadas:
+    linhas = []
+    for ordem, item in enumerate(itens):
+        if not isinstance(item, dict) or not str(item.get('nome') or '').strip():
             continue
-        try:
-            itens = _json_preco.loads(lanc.itens_carrinho)
-            for item in itens:
-                if normalizar_nome_produto(item.get('nome', '')) == nome_norm:
-                    qtd_item = float(item.get('qtd', 1))
-                    preco_item = float(item.get('preco', 0))
-                    valor_total += qtd_item * preco_item
-                    quantidade_total += qtd_item
-                    compras_ids_contadas.add(lanc.compra_id)
-        except Exception:
-            pass
+        linhas.append(dict(
+            lancamento_id=lancamento.id,
+            venda_id=lancamento.venda_id,
+            compra_id=lancamento.compra_id,
+            empresa_id=lancamento.empresa_id,
+            produto_id=None,
+            ordem=ordem,
+            nome=normalizar_nome_produto(str(item['nome']))[:200],
+            tipo=item.get('tipo') or None,
+            quantidade=_numero_item(item.get('qtd'), 1.0),
+            preco_unitario=_numero_item(item.get('preco')),
+            desconto=_numero_item(item.get('desconto')),
+            total=_numero_item(item.get('total'))
+        ))
+    return linhas
+
+
+def _produtos_por_nome(conexao, empresa_ids, nomes, tamanho_lote=500):
+    """Retorna {(empresa_id, nome): produto_id} dos produtos da empresa com esses nomes."""
+    produtos = {}
+    nomes = sorted(nomes)
+    for inicio in range(0, len(nomes), tamanho_lote):
+        for linha in conexao.execute(
+            db.select(Usuario.empresa_id, Produto.nome, db.func.min(Produto.id).label('id'))
+            .join(Usuario, Produto.usuario_id == Usuario.id)
+            .where(Usuario.empresa_id.in_(empresa_ids), Produto.nome.in_(nomes[inicio:inicio + tamanho_lote]))
+            .group_by(Usuario.empresa_id, Produto.nome)
+        ):
+            produtos[(linha.empresa_id, linha.nome)] = linha.id
+    return produtos
 
-    if quantidade_total > 0:
-        preco_medio = valor_total / quantidade_total
-        app.logger.info(f"Preço médio calculado para {nome_produto}: R$ {preco_medio:.2f} (baseado em {len(compras_ids_contadas)} compras)")
-        return preco_medio
-    else:
-        app.logger.info(f"Nenhuma compra encontrada para produto {nome_produto}")
-        return 0
 
-def calcular_estoque_produto(nome_produto, usuario_id):
+def gravar_itens_carrinho(conexao, lancamento_ids, tamanho_lote=500):
     """
-    Calcula a quantidade em estoque de um produto baseado em todas as compras e vendas
-    (independente do status "realizado")
+    Regrava as linhas de item_carrinho dos lançamentos informados a partir do JSON
+    gravado no banco (lançamentos sem carrinho ou excluídos ficam sem linhas).
+    Retorna o número de itens gravados.
     """
-    # Buscar o usuário para obter a empresa_id
+    tabela = ItemCarrinho.__table__
+    lancamento_ids = sorted(lancamento_ids)
+    total = 0
+    for inicio in range(0, len(lancamento_ids), tamanho_lote):
+        lote = lancamento_ids[inicio:inicio + tamanho_lote]
+        conexao.execute(tabela.delete().where(tabela.c.lancamento_id.in_(lote)))
+
+        linhas = []
+        for lancamento in conexao.execute(
+            db.select(Lancamento.id, Lancamento.empresa_id, Lancamento.venda_id, Lancamento.compra_id,
+                      Lancamento.itens_carrinho)
+            .where(Lancamento.id.in_(lote), Lancamento.itens_carrinho.isnot(None))
+        ):
+            linhas.extend(_linhas_itens_carrinho(lancamento))
+        if not linhas:
+            continue
+
+        produtos = _produtos_por_nome(conexao, {l['empresa_id'] for l in linhas}, {l['nome'] for l in linhas})
+        for linha in linhas:
+            linha['produto_id'] = produtos.get((linha['empresa_id'], linha['nome']))
+        conexao.execute(tabela.insert(), linhas)
+        total += len(linhas)
+    return total
+
+
+@event.listens_for(db.session, 'after_flush')
+def _itens_carrinho_sincronizar(sessao, flush_context):
+    """
+    Mantém item_carrinho igual ao JSON dos lançamentos gravados no flush e vincula
+    os itens aos produtos criados ou renomeados. Registrado antes do razão de
+    estoque, que lê os itens gravados aqui.
+    """
+    from sqlalchemy import inspect as sa_inspect
+
+    lancamento_ids, produtos, produtos_excluidos = set(), [], []
+    for colecao in (sessao.new, sessao.dirty, sessao.deleted):
+        for obj in colecao:
+            estado = sa_inspect(obj)
+            if isinstance(obj, Lancamento):
+                if colecao is sessao.new and not estado.dict.get('itens_carrinho'):
+                    continue
+                if colecao is sessao.dirty and not any(
+                    estado.attrs[campo].history.has_changes()
+                    for campo in ('itens_carrinho', 'venda_id', 'compra_id', 'empresa_id')
+                ):
+                    continue
+                identidade = estado.identity
+                lancamento_ids.add(identidade[0] if identidade else estado.dict.get('id'))
+            elif isinstance(obj, Produto):
+                if colecao is sessao.deleted:
+                    if estado.identity:
+                        produtos_excluidos.append(estado.identity[0])
+                elif colecao is sessao.new or estado.attrs.nome.history.has_changes():
+                    produtos.append(obj)
+
+    lancamento_ids.discard(None)
+    if not lancamento_ids and not produtos and not produtos_excluidos:
+        return
+
+    conexao = sessao.connection()
+    if lancamento_ids:
+        gravar_itens_carrinho(conexao, lancamento_ids)
+
+    tabela = ItemCarrinho.__table__
+    if produtos_excluidos:
+        conexao.execute(tabela.update().where(tabela.c.produto_id.in_(produtos_excluidos)).values(produto_id=None))
+    for produto in produtos:
+        conexao.execute(tabela.update().where(tabela.c.produto_id == produto.id).values(produto_id=None))
+        conexao.execute(
+            tabela.update()
+            .where(tabela.c.produto_id.is_(None),
+                   tabela.c.nome == normalizar_nome_produto(produto.nome),
+                   tabela.c.empresa_id == db.select(Usuario.empresa_id)
+                   .where(Usuario.id == produto.usuario_id).scalar_subquery())
+            .values(produto_id=produto.id)
+        )
+
+
+def migrar_itens_carrinho(empresa_ids=None, tamanho_lote=500):
+    """
+    Gera item_carrinho a partir do JSON itens_carrinho dos lançamentos existentes
+    (carga inicial ou correção). Sem empresa_ids migra todas as empresas.
+    Retorna o número de itens gravados.
+    """
+    query = db.session.query(Lancamento.id).filter(Lancamento.itens_carrinho.isnot(None))
+    if empresa_ids is not None:
+        query = query.filter(Lancamento.empresa_id.in_(empresa_ids))
+        ItemCarrinho.query.filter(ItemCarrinho.empresa_id.in_(empresa_ids)).delete(synchronize_session=False)
+    else:
+        ItemCarrinho.query.delete(synchronize_session=False)
+
+    total_itens = gravar_itens_carrinho(db.session.connection(), [l.id for l in query], tamanho_lote)
+    db.session.commit()
+    return total_itens
+
+
+# Migrar os carrinhos em JSON na primeira inicialização após a criação da tabela
+with app.app_context():
+    try:
+        if not db.session.query(ItemCarrinho.id).first() and db.session.query(Lancamento.id).filter(
+            Lancamento.itens_carrinho.isnot(None)
+        ).first():
+            print("Migrando itens de carrinho para a tabela item_carrinho...")
+            total_itens = migrar_itens_carrinho()
+            print(f"✅ Itens de carrinho migrados ({total_itens} itens)")
+    except Exception as e:
+        print(f"⚠️ Aviso: Não foi possível migrar os itens de carrinho: {str(e)}")
+        db.session.rollback()
+
+# ===== RAZÃO DE MOVIMENTOS DE ESTOQUE =====
+
+# Tipo de venda/compra (e de item de carrinho) que movimenta estoque em cada origem;
+# itens de carrinho antigos não têm tipo
+TIPO_ESTOQUE_ORIGEM = {'venda': 'produto', 'compra': 'mercadoria'}
+
+
+def _itens_estoque(origem, linha, carrinho):
+    """
+    Retorna {(produto, custo_unitario): quantidade} que uma venda/compra movimenta:
+    o produto principal e os demais itens do carrinho (linhas de item_carrinho).
+    Em carrinhos com vários itens o produto principal é a lista de nomes e só
+    os itens contam. Quantidades de venda são negativas. Só vendas de produto e
+    compras de mercadoria (e, nelas, itens do mesmo tipo) movimentam estoque;
+    compra sem preco_custo usa valor / quantidade como custo unitário.
+    """
+    tipo_estoque = TIPO_ESTOQUE_ORIGEM[origem]
+    if linha.tipo != tipo_estoque:
+        return {}
+    sinal = -1 if origem == 'venda' else 1
+    itens = {}
+    principal = normalizar_nome_produto(linha.produto) if linha.produto else None
+    if principal and not (carrinho and ',' in principal):
+        quantidade = float(linha.quantidade or 1)
+        custo = None
+        if origem == 'compra':
+            custo = float(linha.preco_custo if linha.preco_custo is not None
+                          else (linha.valor or 0) / (linha.quantidade or 1))
+        itens[(principal, custo)] = sinal * quantidade
+
+    for item in carrinho:
+        if item.tipo not in (None, '', tipo_estoque) or (item.nome == principal and itens):
+            continue
+        custo = float(item.preco_unitario or 0) if origem == 'compra' else None
+        itens[(item.nome, custo)] = itens.get((item.nome, custo), 0.0) + sinal * float(item.quantidade or 0)
+    return itens
+
+
+def _movimentos_estoque_esperados(conexao, origem, ids):
+    """Retorna {origem_id: (empresa_id, usuario_id, data, itens)} das vendas/compras existentes em ids."""
+    if origem == 'venda':
+        colunas = (Venda.id, Venda.empresa_id, Venda.usuario_id, Venda.produto, Venda.quantidade,
+                   Venda.data_prevista, Venda.tipo_venda.label('tipo'), db.literal(None).label('preco_custo'),
+                   Venda.valor)
+        chave_item = ItemCarrinho.venda_id
+    else:
+        colunas = (Compra.id, Compra.empresa_id, Compra.usuario_id, Compra.produto, Compra.quantidade,
+                   Compra.data_prevista, Compra.tipo_compra.label('tipo'), Compra.preco_custo, Compra.valor)
+        chave_item = ItemCarrinho.compra_id
+    modelo = Venda if origem == 'venda' else Compra
+
+    # O carrinho fica no primeiro lançamento (primeira parcela) da venda/compra
+    carrinhos, primeiro_lancamento = {}, {}
+    for item in conexao.execute(
+        db.select(chave_item.label('origem_id'), ItemCarrinho.lancamento_id, ItemCarrinho.nome,
+                  ItemCarrinho.tipo, ItemCarrinho.quantidade, ItemCarrinho.preco_unitario)
+        .where(chave_item.in_(ids))
+        .order_by(ItemCarrinho.lancamento_id, ItemCarrinho.ordem)
+    ):
+        if primeiro_lancamento.setdefault(item.origem_id, item.lancamento_id) == item.lancamento_id:
+            carrinhos.setdefault(item.origem_id, []).append(item)
+
+    return {
+        linha.id: (linha.empresa_id, linha.usuario_id, linha.data_prevista,
+                   _itens_estoque(origem, linha, carrinhos.get(linha.id, [])))
+        for linha in conexao.execute(db.select(*colunas).where(modelo.id.in_(ids)))
+    }
+
+
+def _diferencas_movimentos_estoque(conexao, origem, ids):
+    """
+    Compara o que as vendas/compras em ids deveriam ter movimentado com o que
+    está no razão e retorna as linhas que faltam para igualar os dois.
+    """
+    M = MovimentoEstoque
+    esperados = _movimentos_estoque_esperados(conexao, origem, ids)
+
+    saldo = {}
+    for linha in conexao.execute(
+        db.select(M.origem_id, M.empresa_id, M.produto, M.custo_unitario, M.data,
+                  db.func.sum(M.quantidade).label('quantidade'))
+        .where(M.origem == origem, M.origem_id.in_(ids))
+        .group_by(M.origem_id, M.empresa_id, M.produto, M.custo_unitario, M.data)
+    ):
+        chave = (linha.origem_id, linha.empresa_id, linha.produto, linha.custo_unitario, linha.data)
+        saldo[chave] = saldo.get(chave, 0.0) - float(linha.quantidade or 0)
+
+    for origem_id, (empresa_id, _, data, itens) in esperados.items():
+        for (produto, custo), quantidade in itens.items():
+            chave = (origem_id, empresa_id, produto, custo, data)
+            saldo[chave] = saldo.get(chave, 0.0) + quantidade
+
+    return [
+        dict(empresa_id=empresa_id, produto=produto, quantidade=quantidade, custo_unitario=custo,
+             origem=origem, origem_id=origem_id, data=data,
+             usuario_id=esperados[origem_id][1] if origem_id in esperados else None,
+             observacao=None if origem_id in esperados else 'Estorno', data_criacao=datetime.utcnow())
+        for (origem_id, empresa_id, produto, custo, data), quantidade in saldo.items()
+        if abs(quantidade) > 1e-9
+    ]
+
+
+def registrar_movimentos_estoque(conexao, origens, tamanho_lote=500):
+    """
+    Acrescenta ao razão os movimentos (ou estornos) pendentes das vendas/compras
+    informadas em origens ({'venda': ids, 'compra': ids}). Retorna o número de linhas incluídas.
+    """
+    total = 0
+    for origem, ids in origens.items():
+        ids = sorted(ids)
+        for inicio in range(0, len(ids), tamanho_lote):
+            linhas = _diferencas_movimentos_estoque(conexao, origem, ids[inicio:inicio + tamanho_lote])
+            if linhas:
+                conexao.execute(MovimentoEstoque.__table__.insert(), linhas)
+                total += len(linhas)
+    return total
+
+
+@event.listens_for(db.session, 'after_flush')
+def _estoque_registrar_movimentos(sessao, flush_context):
+    """
+    Registra no razão de estoque as vendas/compras criadas, alteradas ou excluídas
+    no flush, inclusive quando só o carrinho do lançamento vinculado mudou.
+    """
+    from sqlalchemy import inspect as sa_inspect
+
+    origens = {'venda': set(), 'compra': set()}
+    for colecao in (sessao.new, sessao.dirty, sessao.deleted):
+        for obj in colecao:
+            if not isinstance(obj, (Venda, Compra, Lancamento)):
+                continue
+            estado = sa_inspect(obj)
+            if isinstance(obj, (Venda, Compra)):
+                identidade = estado.identity
+                obj_id = identidade[0] if identidade else estado.dict.get('id')
+                if obj_id:
+                    origens['venda' if isinstance(obj, Venda) else 'compra'].add(obj_id)
+                continue
+
+            # Lançamento: só interessa quando o carrinho ou o vínculo com a venda/compra mudou
+            if colecao is sessao.dirty:
+                if not any(estado.attrs[campo].history.has_changes()
+                           for campo in ('itens_carrinho', 'venda_id', 'compra_id')):
+                    continue
+            elif 'itens_carrinho' in estado.dict and not estado.dict['itens_carrinho']:
+                continue
+            for campo, origem in (('venda_id', 'venda'), ('compra_id', 'compra')):
+                historico = estado.attrs[campo].history
+                origens[origem].update(v for v in historico.sum() if v)
+
+    if origens['venda'] or origens['compra']:
+        registrar_movimentos_estoque(sessao.connection(), origens)
+
+
+def registrar_ajuste_estoque(empresa_id, produto, quantidade, usuario_id=None, observacao=None):
+    """Inclui no razão um ajuste manual de estoque (quantidade positiva ou negativa)."""
+    movimento = MovimentoEstoque(
+        empresa_id=empresa_id,
+        produto=normalizar_nome_produto(produto),
+        quantidade=quantidade,
+        origem='ajuste',
+        data=datetime.now().date(),
+        usuario_id=usuario_id,
+        observacao=(observacao or '')[:255] or None
+    )
+    db.session.add(movimento)
+    return movimento
+
+
+def resumo_estoque(empresa_id, produtos=None, data_limite=None):
+    """
+    Retorna {produto: (quantidade, preco_medio)} a partir do razão, com os movimentos
+    até data_limite (inclusive) ou todos. O preço médio é ponderado pelas compras
+    (None quando o produto não tem compras). produtos restringe aos nomes informados.
+    """
+    M = MovimentoEstoque
+    compra = M.origem == 'compra'
+    query = db.session.query(
+        M.produto,
+        db.func.coalesce(db.func.sum(M.quantidade), 0).label('quantidade'),
+        db.func.sum(db.case((compra, M.quantidade * M.custo_unitario), else_=0)).label('custo_compras'),
+        db.func.sum(db.case((compra, M.quantidade), else_=0)).label('qtd_compras')
+    ).filter(M.empresa_id == empresa_id)
+    if produtos is not None:
+        query = query.filter(M.produto.in_([normalizar_nome_produto(p) for p in produtos]))
+    if data_limite:
+        query = query.filter(M.data <= data_limite)
+
+    resumo = {}
+    for linha in query.group_by(M.produto).all():
+        quantidade = float(linha.quantidade or 0)
+        qtd_compras = float(linha.qtd_compras or 0)
+        preco_medio = float(linha.custo_compras or 0) / qtd_compras if qtd_compras > 1e-9 else None
+        resumo[linha.produto] = (int(quantidade) if quantidade.is_integer() else quantidade, preco_medio)
+    return resumo
+
+
+def _empresas_filtro(query, coluna, empresa_ids):
+    return query if empresa_ids is None else query.filter(coluna.in_(empresa_ids))
+
+
+def reconstruir_movimentos_estoque(empresa_ids=None):
+    """
+    Reconstrói as linhas de venda/compra do razão a partir das vendas e compras
+    existentes (carga inicial ou correção). Os ajustes manuais são preservados.
+    Sem empresa_ids reconstrói todas as empresas. Retorna o número de linhas geradas.
+    """
+    M = MovimentoEstoque
+    _empresas_filtro(M.query.filter(M.origem.in_(['venda', 'compra'])), M.empresa_id, empresa_ids).delete(
+        synchronize_session=False
+    )
+    origens = {
+        'venda': [v.id for v in _empresas_filtro(db.session.query(Venda.id), Venda.empresa_id, empresa_ids)],
+        'compra': [c.id for c in _empresas_filtro(db.session.query(Compra.id), Compra.empresa_id, empresa_ids)],
+    }
+    total_linhas = registrar_movimentos_estoque(db.session.connection(), origens)
+    db.session.commit()
+    return total_linhas
+
+
+def verificar_movimentos_estoque(empresa_ids=None, tamanho_lote=500):
+    """
+    Confere o razão contra as vendas e compras existentes. Retorna a lista de
+    diferenças (vazia quando consistente), no formato das linhas que faltariam incluir.
+    """
+    M = MovimentoEstoque
+    conexao = db.session.connection()
+    divergencias = []
+    for origem, modelo in (('venda', Venda), ('compra', Compra)):
+        ids = {linha.id for linha in _empresas_filtro(db.session.query(modelo.id), modelo.empresa_id, empresa_ids)}
+        ids.update(linha.origem_id for linha in _empresas_filtro(
+            db.session.query(M.origem_id).filter(M.origem == origem).distinct(), M.empresa_id, empresa_ids
+        ))
+        ids = sorted(ids)
+        for inicio in range(0, len(ids), tamanho_lote):
+            divergencias.extend(_diferencas_movimentos_estoque(conexao, origem, ids[inicio:inicio + tamanho_lote]))
+    return divergencias
+
+
+# Carga inicial do razão na primeira inicialização após a criação da tabela
+with app.app_context():
+    try:
+        if not db.session.query(MovimentoEstoque.id).first() and (
+            db.session.query(Venda.id).first() or db.session.query(Compra.id).first()
+        ):
+            print("Construindo razão de movimentos de estoque...")
+            total_linhas = reconstruir_movimentos_estoque()
+            print(f"✅ Razão de estoque criado ({total_linhas} linhas)")
+    except Exception as e:
+        print(f"⚠️ Aviso: Não foi possível construir o razão de estoque: {str(e)}")
+        db.session.rollback()
+
+def calcular_preco_medio_produto(nome_produto, usuario_id):
+    """
+    Calcula o preço médio ponderado de um produto baseado em todas as compras
+    (independente do status "realizado"), a partir do razão de movimentos de estoque
+    """
+    # Buscar o usuário para obter a empresa_id
     usuario = db.session.get(Usuario, usuario_id)
     if not usuario:
-        app.logger.error(f"Usuário {usuario_id} não encontrado para cálculo de estoque")
         return 0
-    
-    # Buscar todos os usuários da mesma empresa
+
     empresa_id = obter_empresa_id_sessao(session, usuario)
+    nome_normalizado = normalizar_nome_produto(nome_produto)
 
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
+    _, preco_medio = resumo_estoque(empresa_id, [nome_normalizado]).get(nome_normalizado, (0, None))
+    if preco_medio is None:
+        app.logger.info(f"Nenhuma compra encontrada para produto {nome_produto}")
+        return 0
 
-    # Normalizar nome do produto (remover duplicações como "macbook, macbook")
-    # Pegar apenas o primeiro nome se houver vírgula
-    nomes_produto = [n.strip() for n in nome_produto.split(',')]
-    nome_produto_base = nomes_produto[0] if nomes_produto else nome_produto
+    app.logger.info(f"Preço médio calculado para {nome_produto}: R$ {preco_medio:.2f}")
+    return preco_medio
 
-    # Normalizar nome base para comparação
-    nome_produto_normalizado = normalizar_nome_produto(nome_produto_base)
+def calcular_estoque_produto(nome_produto, usuario_id, data_limite=None):
+    """
+    Calcula a quantidade em estoque de um produto baseado em todas as compras, vendas
+    e ajustes (independente do status "realizado"), a partir do razão de movimentos
+    de estoque. Com data_limite retorna o estoque naquela data.
+    """
+    # Buscar o usuário para obter a empresa_id
+    usuario = db.session.get(Usuario, usuario_id)
+    if not usuario:
+        app.logger.error(f"Usuário {usuario_id} não encontrado para cálculo de estoque")
+        return 0
 
-    # Buscar todas as compras para este produto pelo campo produto (item principal)
-    compras_todas = Compra.query.filter(
-        db.or_(
-            Compra.produto == nome_produto,
-            Compra.produto == nome_produto_base
-        ),
-        Compra.empresa_id == empresa_id,
-        Compra.tipo_compra == 'mercadoria'
-    ).all()
-    compras_ids_contadas = {c.id for c in compras_todas}
+    empresa_id = obter_empresa_id_sessao(session, usuario)
 
-    # Buscar todas as vendas para este produto pelo campo produto (item principal)
-    vendas_todas = Venda.query.filter(
-        db.or_(
-            Venda.produto == nome_produto,
-            Venda.produto == nome_produto_base
-        ),
-        Venda.empresa_id == empresa_id,
-        Venda.tipo_venda == 'produto'
-    ).all()
-    vendas_ids_contadas = {v.id for v in vendas_todas}
+    # Normalizar nome do produto (remover duplicações como "macbook, macbook")
+    # e considerar também apenas o primeiro nome se houver vírgula
+    nomes_produto = [n.strip() for n in nome_produto.split(',')]
+    nome_produto_base = nomes_produto[0] if nomes_produto else nome_produto
+    nomes = {normalizar_nome_produto(nome_produto), normalizar_nome_produto(nome_produto_base)}
 
-    # Calcular quantidade total comprada (compras via campo produto principal)
-    quantidade_comprada = 0
-    for compra in compras_todas:
-        quantidade_comprada += compra.quantidade
+    resumo = resumo_estoque(empresa_id, nomes, data_limite)
+    estoque_calculado = sum(quantidade for quantidade, _ in resumo.values())
 
-    # Calcular quantidade total vendida (vendas via campo produto principal)
-    quantidade_vendida = 0
-    for venda in vendas_todas:
-        quantidade_vendida += venda.quantidade
+    app.logger.info(f"Estoque calculado para {nome_produto}: {estoque_calculado}")
 
-    # Adicionar quantidades de itens secundários de carrinho (multi-item compras/vendas)
-    import json as _json_estoque
-    lancamentos_multi = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id,
-        Lancamento.itens_carrinho.isnot(None)
-    ).all()
-    for lanc in lancamentos_multi:
-        try:
-            itens = _json_estoque.loads(lanc.itens_carrinho)
-            for item in itens:
-                item_nome_norm = normalizar_nome_produto(item.get('nome', ''))
-                if item_nome_norm != nome_produto_normalizado:
-                    continue
-                qtd_item = float(item.get('qtd', 1))
-                if lanc.compra_id and lanc.compra_id not in compras_ids_contadas:
-                    quantidade_comprada += qtd_item
-                    compras_ids_contadas.add(lanc.compra_id)
-                elif lanc.venda_id and lanc.venda_id not in vendas_ids_contadas:
-                    quantidade_vendida += qtd_item
-                    vendas_ids_contadas.add(lanc.venda_id)
-        except Exception:
-            pass
-    
-    # Estoque = Compras - Vendas
-    estoque_calculado = quantidade_comprada - quantidade_vendida
-    
-    app.logger.info(f"Estoque calculado para {nome_produto}: {quantidade_comprada} compras - {quantidade_vendida} vendas = {estoque_calculado}")
-    
     return estoque_calculado
 
 def calcular_data_vencimento_parcela(data_base, numero_parcela, intervalo):
@@ -8429,43 +10596,70 @@ def calcular_data_vencimento_parcela(data_base, numero_parcela, intervalo):
 
 def sincronizar_estoque_usuario(usuario_id):
     """
-    Sincroniza o estoque de todos os produtos de uma empresa com todos os dados de compras e vendas
-    (independente do status "realizado")
+    Sincroniza o estoque e o preço médio de todos os produtos da empresa com as compras,
+    vendas e ajustes (independente do status "realizado"), em operações em lote:
+    o razão de estoque é conferido uma vez contra as vendas, compras e itens de carrinho,
+    os totais de todos os produtos saem de uma única consulta agrupada e os produtos
+    alterados são gravados num único UPDATE em lote.
+    Retorna (sucesso, mensagem, alteracoes), com estoque/preço anteriores e novos
+    de cada produto alterado.
     """
     # Verificar se o usuário existe
     usuario = db.session.get(Usuario, usuario_id)
     if not usuario:
         app.logger.error(f"Usuário {usuario_id} não encontrado para sincronização de estoque")
-        return False, "Usuário não encontrado"
-    
-    # Carregar produtos de toda a empresa usando a função auxiliar
-    produtos = buscar_produtos_empresa(usuario.empresa_id)
-    app.logger.info(f"Sincronizando estoque para {len(produtos)} produtos da empresa {usuario.empresa_id}")
-    
-    for produto in produtos:
-        try:
-            # Calcular estoque real
-            estoque_real = calcular_estoque_produto(produto.nome, usuario_id)
-            
-            # Calcular preço médio real
-            preco_medio_real = calcular_preco_medio_produto(produto.nome, usuario_id)
-            
-            # Atualizar produto
-            produto.estoque = estoque_real
-            produto.preco_custo = preco_medio_real
-            
-            app.logger.info(f"Produto {produto.nome} sincronizado: estoque={estoque_real}, preço_custo={preco_medio_real:.2f}")
-        except Exception as e:
-            app.logger.error(f"Erro ao sincronizar produto {produto.nome}: {str(e)}")
-    
+        return False, "Usuário não encontrado", []
+
+    empresa_id = obter_empresa_id_sessao(session, usuario)
+
     try:
+        # Razão de estoque igual às vendas/compras atuais (só inclui o que faltar)
+        incluidos = registrar_movimentos_estoque(db.session.connection(), {
+            'venda': [v.id for v in db.session.query(Venda.id).filter(Venda.empresa_id == empresa_id)],
+            'compra': [c.id for c in db.session.query(Compra.id).filter(Compra.empresa_id == empresa_id)],
+        })
+        if incluidos:
+            app.logger.warning(f"Razão de estoque da empresa {empresa_id}: {incluidos} movimento(s) pendente(s) incluído(s)")
+
+        resumo = resumo_estoque(empresa_id)
+        produtos = db.session.query(Produto.id, Produto.nome, Produto.estoque, Produto.preco_custo).join(
+            Usuario, Produto.usuario_id == Usuario.id
+        ).filter(Usuario.empresa_id == empresa_id, Usuario.ativo == True).order_by(Produto.nome).all()
+
+        alteracoes = []
+        for produto in produtos:
+            # Mesmo critério de calcular_estoque_produto: nome completo e primeiro nome da lista
+            nome_base = produto.nome.split(',')[0].strip()
+            nomes = {normalizar_nome_produto(produto.nome), normalizar_nome_produto(nome_base)}
+            estoque_real = sum(resumo.get(nome, (0, None))[0] for nome in nomes)
+            preco_medio_real = resumo.get(normalizar_nome_produto(produto.nome), (0, None))[1] or 0
+
+            if estoque_real != (produto.estoque or 0) or abs(preco_medio_real - (produto.preco_custo or 0)) > 1e-6:
+                alteracoes.append({
+                    'id': produto.id,
+                    'nome': produto.nome,
+                    'estoque_anterior': produto.estoque,
+                    'estoque_novo': estoque_real,
+                    'preco_custo_anterior': produto.preco_custo,
+                    'preco_custo_novo': preco_medio_real
+                })
+
+        if alteracoes:
+            db.session.execute(db.update(Produto), [
+                {'id': a['id'], 'estoque': a['estoque_novo'], 'preco_custo': a['preco_custo_novo']}
+                for a in alteracoes
+            ])
         db.session.commit()
-        app.logger.info(f"Estoque sincronizado com sucesso para {len(produtos)} produtos")
-        return True, f"Estoque sincronizado para {len(produtos)} produtos"
+
+        for a in alteracoes:
+            app.logger.info(f"Produto {a['nome']} sincronizado: estoque {a['estoque_anterior']} -> {a['estoque_novo']}, "
+                            f"preço_custo {a['preco_custo_anterior'] or 0:.2f} -> {a['preco_custo_novo']:.2f}")
+        app.logger.info(f"Estoque sincronizado: {len(produtos)} produtos, {len(alteracoes)} alterado(s)")
+        return True, f"Estoque sincronizado para {len(produtos)} produtos ({len(alteracoes)} alterado(s))", alteracoes
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Erro ao fazer commit da sincronização de estoque: {str(e)}")
-        return False, f"Erro ao salvar alterações: {str(e)}"
+        app.logger.error(f"Erro ao sincronizar estoque da empresa {empresa_id}: {str(e)}")
+        return False, f"Erro ao salvar alterações: {str(e)}", []
 
 def resetar_banco():
     """Reseta completamente o banco de dados e cria apenas o administrador"""
@@ -8857,61 +11051,128 @@ def relatorios():
     
     return render_template('relatorios.html', usuario=usuario)
 
-def calcular_dre(empresa_id, data_inicio, data_fim):
+def _valores_dre_por_dia(empresa_id, data_inicio, data_fim, plano_conta_ids=None):
     """
-    Helper que calcula os valores das linhas da DRE para um período.
-    Retorna lista de dicts com a estrutura de cada linha.
-    Usa regime de competência (data_prevista) e exclui transferências.
+    Soma com sinal (entrada +, saída -) dos lançamentos por conta do plano e por
+    dia de referência, em uma única consulta agrupada.
+    Modo híbrido (regime de caixa para realizados):
+    - Lançamentos REALIZADOS: contam em data_realizada (quando de fato entrou/saiu o dinheiro)
+    - Lançamentos PENDENTES:  contam em data_prevista  (competência, projeção futura)
+    Transferências são excluídas. Sem plano_conta_ids considera todas as contas
+    (inclusive lançamentos sem plano de contas). Retorna lista de (plano_conta_id, data, valor).
+    """
+    if plano_conta_ids is not None and not plano_conta_ids:
+        return []
+
+    data_referencia = db.case(
+        (Lancamento.realizado == True, Lancamento.data_realizada),
+        else_=Lancamento.data_prevista
+    )
+    valor_com_sinal = db.case(
+        (Lancamento.tipo == 'entrada', Lancamento.valor),
+        else_=-Lancamento.valor
+    )
+
+    query = db.session.query(
+        Lancamento.plano_conta_id,
+        data_referencia.label('data'),
+        db.func.sum(valor_com_sinal).label('valor')
+    ).filter(Lancamento.empresa_id == empresa_id)
+    if plano_conta_ids is not None:
+        query = query.filter(Lancamento.plano_conta_id.in_(plano_conta_ids))
+
+    linhas = query.filter(
+        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None)),
+        db.or_(
+            db.and_(Lancamento.realizado == True,  Lancamento.data_realizada.between(data_inicio, data_fim)),
+            db.and_(Lancamento.realizado == False, Lancamento.data_prevista.between(data_inicio, data_fim))
+        )
+    ).group_by(Lancamento.plano_conta_id, data_referencia).all()
+
+    resultado = []
+    for plano_conta_id, data_ref, valor in linhas:
+        # SQLite pode devolver a expressão CASE como texto
+        if isinstance(data_ref, str):
+            data_ref = datetime.strptime(data_ref[:10], '%Y-%m-%d').date()
+        elif isinstance(data_ref, datetime):
+            data_ref = data_ref.date()
+        resultado.append((plano_conta_id, data_ref, float(valor or 0)))
+    return resultado
+
+
+def meses_do_intervalo(data_inicio, data_fim):
+    """Divide [data_inicio, data_fim] em períodos mensais: lista de (inicio, fim)."""
+    import calendar
+    periodos = []
+    inicio = data_inicio
+    while inicio <= data_fim:
+        fim_mes = inicio.replace(day=calendar.monthrange(inicio.year, inicio.month)[1])
+        periodos.append((inicio, min(fim_mes, data_fim)))
+        inicio = fim_mes + timedelta(days=1)
+    return periodos
+
+
+def calcular_dre_periodos(empresa_id, periodos):
     """
+    Calcula a DRE para vários períodos de uma vez (ex.: os 12 meses do ano).
+    periodos: lista de (data_inicio, data_fim) em ordem e sem sobreposição.
+    Os valores das contas vêm de uma única consulta agrupada; as linhas de
+    configuração (contas, subtotais e totais) são avaliadas em memória.
+    Retorna lista de dicts por linha com 'valores' (um valor por período).
+    """
+    from bisect import bisect_right
+
     linhas_config = DreConfiguracao.query.filter_by(
         empresa_id=empresa_id,
         ativo=True
     ).order_by(DreConfiguracao.ordem).all()
 
+    qtd_periodos = len(periodos)
+    plano_conta_ids = {l.plano_conta_id for l in linhas_config if l.tipo_linha == 'conta' and l.plano_conta_id}
+
+    # Matriz conta do plano × período
+    valores_conta = {pc_id: [0.0] * qtd_periodos for pc_id in plano_conta_ids}
+    if periodos and plano_conta_ids:
+        inicios = [inicio for inicio, _ in periodos]
+        for plano_conta_id, data_ref, valor in _valores_dre_por_dia(
+                empresa_id, periodos[0][0], periodos[-1][1], plano_conta_ids):
+            indice = bisect_right(inicios, data_ref) - 1
+            if indice >= 0 and data_ref <= periodos[indice][1]:
+                valores_conta[plano_conta_id][indice] += valor
+
+    return _avaliar_linhas_dre(linhas_config, valores_conta, qtd_periodos)
+
+
+def _avaliar_linhas_dre(linhas_config, valores_conta, qtd_periodos):
+    """
+    Avalia em memória as linhas configuradas da DRE (contas, subtotais e totais).
+    valores_conta: {plano_conta_id: [valor por período]}.
+    """
     linhas_dre = []
-    resultado_acumulado = 0
+    resultado_acumulado = [0.0] * qtd_periodos
     valores_bloco = []
 
     for linha_config in linhas_config:
-        valor = 0
+        valores = [0.0] * qtd_periodos
 
         if linha_config.tipo_linha == 'conta' and linha_config.plano_conta_id:
-            # Modo híbrido (regime de caixa para realizados):
-            # - Lançamentos REALIZADOS: filtra por data_realizada (quando de fato entrou/saiu o dinheiro)
-            # - Lançamentos PENDENTES:  filtra por data_prevista  (competência, projeção futura)
-            lancamentos = Lancamento.query.filter(
-                Lancamento.plano_conta_id == linha_config.plano_conta_id,
-                Lancamento.empresa_id == empresa_id,
-                db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None)),
-                db.or_(
-                    db.and_(Lancamento.realizado == True,  Lancamento.data_realizada.between(data_inicio, data_fim)),
-                    db.and_(Lancamento.realizado == False, Lancamento.data_prevista.between(data_inicio, data_fim))
-                )
-            ).all()
-
-            for lanc in lancamentos:
-                if lanc.tipo == 'entrada':
-                    valor += lanc.valor
-                else:
-                    valor -= lanc.valor
-
-            resultado_acumulado += valor
-            valores_bloco.append(valor)
+            valores = list(valores_conta.get(linha_config.plano_conta_id, valores))
+            resultado_acumulado = [a + v for a, v in zip(resultado_acumulado, valores)]
+            valores_bloco.append(valores)
 
         elif linha_config.tipo_linha in ['subtotal', 'total']:
             if linha_config.operacao == '=':
-                valor = resultado_acumulado
-                valores_bloco = []
+                valores = list(resultado_acumulado)
             else:
-                valor = sum(valores_bloco)
-                valores_bloco = []
+                valores = [sum(coluna) for coluna in zip(*valores_bloco)] if valores_bloco else [0.0] * qtd_periodos
+            valores_bloco = []
 
         linhas_dre.append({
             'codigo': linha_config.codigo,
             'descricao': linha_config.descricao,
             'tipo_linha': linha_config.tipo_linha,
             'operacao': linha_config.operacao,
-            'valor': valor,
+            'valores': valores,
             'nivel': linha_config.nivel,
             'negrito': linha_config.negrito or False,
             'linha_acima': linha_config.linha_acima if hasattr(linha_config, 'linha_acima') else False,
@@ -8921,6 +11182,329 @@ def calcular_dre(empresa_id, data_inicio, data_fim):
     return linhas_dre
 
 
+def calcular_dre(empresa_id, data_inicio, data_fim):
+    """
+    Helper que calcula os valores das linhas da DRE para um período.
+    Retorna lista de dicts com a estrutura de cada linha.
+    Usa o modo híbrido de calcular_dre_periodos e exclui transferências.
+    """
+    linhas_dre = calcular_dre_periodos(empresa_id, [(data_inicio, data_fim)])
+    for linha in linhas_dre:
+        linha['valor'] = linha.pop('valores')[0]
+    return linhas_dre
+
+
+# ===== CUBO DE PERÍODOS (DRE E FLUXO DE CAIXA) =====
+
+GRANULARIDADES_CUBO = ('dia', 'mes', 'trimestre')
+MAX_PERIODOS_CUBO = 400
+
+
+def periodos_calendario(data_inicio, data_fim, granularidade):
+    """
+    Períodos de calendário completos (dia, mês ou trimestre) que cobrem
+    [data_inicio, data_fim]. O primeiro e o último período podem começar antes
+    e terminar depois do intervalo pedido. Retorna lista de (inicio, fim).
+    """
+    import calendar
+
+    if granularidade == 'dia':
+        return [(data_inicio + timedelta(days=i), data_inicio + timedelta(days=i))
+                for i in range((data_fim - data_inicio).days + 1)]
+
+    meses_por_periodo = 3 if granularidade == 'trimestre' else 1
+    mes_inicial = ((data_inicio.month - 1) // meses_por_periodo) * meses_por_periodo + 1
+    inicio = data_inicio.replace(month=mes_inicial, day=1)
+
+    periodos = []
+    while inicio <= data_fim:
+        ultimo_mes = inicio.month + meses_por_periodo - 1
+        fim = inicio.replace(month=ultimo_mes, day=calendar.monthrange(inicio.year, ultimo_mes)[1])
+        periodos.append((inicio, fim))
+        inicio = fim + timedelta(days=1)
+    return periodos
+
+
+def _calcular_cubo_periodos(empresa_id, periodos):
+    """
+    Calcula o cubo período × plano de contas para períodos contíguos em ordem.
+    Por conta: 'dre' (modo híbrido da DRE, com sinal), 'entradas' e 'saidas'
+    realizadas por data_realizada (fluxo de caixa). Transferências são excluídas.
+    Retorna lista (um item por período) de {plano_conta_id (str): valores}.
+    """
+    from bisect import bisect_right
+
+    cubo = [{} for _ in periodos]
+    if not periodos:
+        return cubo
+
+    inicios = [inicio for inicio, _ in periodos]
+    data_inicio, data_fim = periodos[0][0], periodos[-1][1]
+
+    def celula(data_ref, plano_conta_id):
+        indice = bisect_right(inicios, data_ref) - 1
+        if indice < 0 or data_ref > periodos[indice][1]:
+            return None
+        chave = str(plano_conta_id) if plano_conta_id else 'sem_plano'
+        return cubo[indice].setdefault(chave, {'dre': 0.0, 'entradas': 0.0, 'saidas': 0.0})
+
+    for plano_conta_id, data_ref, valor in _valores_dre_por_dia(empresa_id, data_inicio, data_fim):
+        valores = celula(data_ref, plano_conta_id)
+        if valores is not None:
+            valores['dre'] += valor
+
+    # Fluxo de caixa: apenas realizados, pela data em que o dinheiro entrou/saiu
+    movimentos = db.session.query(
+        Lancamento.plano_conta_id,
+        Lancamento.data_realizada,
+        Lancamento.tipo,
+        db.func.sum(Lancamento.valor)
+    ).filter(
+        Lancamento.empresa_id == empresa_id,
+        Lancamento.realizado == True,
+        Lancamento.data_realizada.between(data_inicio, data_fim),
+        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
+    ).group_by(Lancamento.plano_conta_id, Lancamento.data_realizada, Lancamento.tipo).all()
+
+    for plano_conta_id, data_realizada, tipo, valor in movimentos:
+        valores = celula(data_realizada, plano_conta_id)
+        if valores is not None:
+            valores['entradas' if tipo == 'entrada' else 'saidas'] += float(valor or 0)
+
+    return cubo
+
+
+def _cubo_periodos_em_cache(empresa_id, granularidade, inicios):
+    """Cubos gravados em CuboPeriodoCache para os inícios de período informados: {inicio: valores}."""
+    if not inicios:
+        return {}
+    return {
+        registro.periodo_inicio: json.loads(registro.dados)
+        for registro in CuboPeriodoCache.query.filter(
+            CuboPeriodoCache.empresa_id == empresa_id,
+            CuboPeriodoCache.granularidade == granularidade,
+            CuboPeriodoCache.periodo_inicio.in_(inicios)
+        ).all()
+    }
+
+
+def _calcular_periodos_faltantes(empresa_id, periodos, em_cache):
+    """
+    Completa o cubo dos períodos que não estão em em_cache com uma única passada
+    sobre o trecho contíguo que contém todos eles.
+    Retorna (cubo por período, índices calculados).
+    """
+    faltantes = [i for i, (inicio, _) in enumerate(periodos) if inicio not in em_cache]
+    cubo = [em_cache.get(inicio) for inicio, _ in periodos]
+    if faltantes:
+        primeiro, ultimo = faltantes[0], faltantes[-1]
+        calculado = _calcular_cubo_periodos(empresa_id, periodos[primeiro:ultimo + 1])
+        for i in faltantes:
+            cubo[i] = calculado[i - primeiro]
+    return cubo, faltantes
+
+
+def obter_cubo_periodos(empresa_id, periodos, granularidade, hoje=None):
+    """
+    Retorna o cubo dos períodos informados (lista de {plano_conta_id: valores})
+    e a lista de flags indicando os períodos fechados.
+    Períodos fechados (inteiramente antes de hoje) são lidos de CuboPeriodoCache;
+    os que faltam no cache e os períodos em aberto são calculados em uma única
+    passada, sem gravar nada: o cache é preenchido por precalcular_cubos_periodos.
+    """
+    hoje = hoje or datetime.now().date()
+    fechados = [fim < hoje for _, fim in periodos]
+    em_cache = _cubo_periodos_em_cache(
+        empresa_id, granularidade,
+        [inicio for (inicio, _), fechado in zip(periodos, fechados) if fechado]
+    )
+    cubo, _ = _calcular_periodos_faltantes(empresa_id, periodos, em_cache)
+    return cubo, fechados
+
+
+def preencher_cubo_periodos(empresa_id, periodos, granularidade, hoje=None):
+    """
+    Calcula e grava em CuboPeriodoCache os períodos fechados que ainda não estão
+    no cache. Retorna a quantidade de períodos gravados.
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    hoje = hoje or datetime.now().date()
+    periodos = [(inicio, fim) for inicio, fim in periodos if fim < hoje]
+    em_cache = _cubo_periodos_em_cache(empresa_id, granularidade, [inicio for inicio, _ in periodos])
+    cubo, faltantes = _calcular_periodos_faltantes(empresa_id, periodos, em_cache)
+    if not faltantes:
+        return 0
+
+    try:
+        db.session.add_all([
+            CuboPeriodoCache(
+                empresa_id=empresa_id,
+                granularidade=granularidade,
+                periodo_inicio=periodos[i][0],
+                periodo_fim=periodos[i][1],
+                dados=json.dumps(cubo[i])
+            ) for i in faltantes
+        ])
+        db.session.commit()
+    except IntegrityError:
+        # Outro processo gravou os mesmos períodos ao mesmo tempo
+        db.session.rollback()
+        return 0
+    return len(faltantes)
+
+
+def precalcular_cubos_periodos():
+    """
+    Tarefa agendada: grava no cache os períodos fechados recentes (dias, meses e
+    trimestres) das empresas com lançamentos, inclusive os que foram
+    invalidados por alterações desde a última execução.
+    """
+    with app.app_context():
+        hoje = datetime.now().date()
+        ontem = hoje - timedelta(days=1)
+        inicio_meses = (hoje.replace(day=1) - timedelta(days=31 * app.config['CUBO_MESES_PRECALCULO'])).replace(day=1)
+        intervalos = {
+            'dia': periodos_calendario(hoje - timedelta(days=app.config['CUBO_DIAS_PRECALCULO']), ontem, 'dia'),
+            'mes': periodos_calendario(inicio_meses, ontem, 'mes'),
+            'trimestre': periodos_calendario(inicio_meses, ontem, 'trimestre'),
+        }
+
+        gravados = 0
+        empresa_ids = [linha[0] for linha in db.session.query(Lancamento.empresa_id).distinct() if linha[0]]
+        for empresa_id in empresa_ids:
+            try:
+                for granularidade, periodos in intervalos.items():
+                    gravados += preencher_cubo_periodos(empresa_id, periodos, granularidade, hoje)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"[Cubo] Erro ao pré-calcular empresa {empresa_id}: {str(e)}")
+        if gravados:
+            app.logger.info(f"[Cubo] {gravados} período(s) gravado(s) no cache")
+
+
+@event.listens_for(db.session, 'after_flush')
+def _cubo_invalidar_periodos(sessao, flush_context):
+    """Remove do cache os períodos fechados que contêm datas de lançamentos criados, alterados ou excluídos."""
+    from collections import defaultdict
+    from sqlalchemy import inspect as sa_inspect
+
+    anteriores = sessao.info.pop('cubo_datas_anteriores', {})
+    datas_por_empresa = defaultdict(set)
+
+    def registrar(empresa_id, *datas):
+        if empresa_id:
+            # Atributos ainda não recarregados do banco podem conter datetime (ex.: importação)
+            datas_por_empresa[empresa_id].update(d.date() if isinstance(d, datetime) else d for d in datas if d)
+
+    for obj in list(sessao.new) + list(sessao.dirty):
+        if isinstance(obj, Lancamento):
+            registrar(obj.empresa_id, obj.data_prevista, obj.data_realizada)
+
+    for obj in list(sessao.dirty) + list(sessao.deleted):
+        if isinstance(obj, Lancamento):
+            identidade = sa_inspect(obj).identity
+            if identidade and identidade[0] in anteriores:
+                registrar(*anteriores[identidade[0]])
+
+    if not datas_por_empresa:
+        return
+
+    tabela = CuboPeriodoCache.__table__
+    conexao = sessao.connection()
+    for empresa_id, datas in datas_por_empresa.items():
+        datas = sorted(datas)
+        if len(datas) > 50:
+            # Muitas datas (ex.: importação): invalida o intervalo inteiro
+            condicao = db.and_(tabela.c.periodo_inicio <= datas[-1], tabela.c.periodo_fim >= datas[0])
+        else:
+            condicao = db.or_(*[
+                db.and_(tabela.c.periodo_inicio <= d, tabela.c.periodo_fim >= d) for d in datas
+            ])
+        conexao.execute(tabela.delete().where(tabela.c.empresa_id == empresa_id, condicao))
+
+
+@app.route('/dre/api/cubo')
+def dre_api_cubo():
+    """
+    API JSON: cubo período × plano de contas para comparação de vários períodos.
+    Parâmetros: data_inicio, data_fim (DD/MM/AAAA ou AAAA-MM-DD) e
+    granularidade ('dia', 'mes' ou 'trimestre'). Retorna os valores por conta,
+    as linhas da DRE configurada e o fluxo de caixa, um valor por período.
+    """
+    if 'usuario_id' not in session:
+        return jsonify({'erro': 'Não autenticado'}), 401
+
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    empresa_id = obter_empresa_id_sessao(session, usuario)
+
+    hoje = datetime.now().date()
+    data_inicio = _parse_data_filtro(request.args.get('data_inicio')) or hoje.replace(month=1, day=1)
+    data_fim = _parse_data_filtro(request.args.get('data_fim')) or hoje
+    if data_inicio > data_fim:
+        data_inicio, data_fim = data_fim, data_inicio
+
+    granularidade = request.args.get('granularidade', 'mes')
+    if granularidade not in GRANULARIDADES_CUBO:
+        return jsonify({'erro': f"Granularidade inválida. Use: {', '.join(GRANULARIDADES_CUBO)}"}), 400
+
+    periodos = periodos_calendario(data_inicio, data_fim, granularidade)
+    if len(periodos) > MAX_PERIODOS_CUBO:
+        return jsonify({'erro': f'Intervalo muito grande: máximo de {MAX_PERIODOS_CUBO} períodos'}), 400
+
+    cubo, fechados = obter_cubo_periodos(empresa_id, periodos, granularidade, hoje)
+    qtd_periodos = len(periodos)
+
+    # Reorganizar como conta -> série por período
+    contas = {}
+    for i, celulas in enumerate(cubo):
+        for chave, valores in celulas.items():
+            serie = contas.setdefault(chave, {
+                'dre': [0.0] * qtd_periodos, 'entradas': [0.0] * qtd_periodos, 'saidas': [0.0] * qtd_periodos
+            })
+            for campo in ('dre', 'entradas', 'saidas'):
+                serie[campo][i] = valores[campo]
+
+    planos = {
+        str(pc.id): pc for pc in PlanoConta.query.filter(
+            PlanoConta.empresa_id == empresa_id,
+            PlanoConta.id.in_([int(chave) for chave in contas if chave.isdigit()])
+        ).all()
+    } if contas else {}
+    for chave, serie in contas.items():
+        pc = planos.get(chave)
+        serie['codigo'] = pc.codigo if pc else ''
+        serie['nome'] = pc.nome if pc else 'Sem Categoria'
+
+    linhas_config = DreConfiguracao.query.filter_by(
+        empresa_id=empresa_id,
+        ativo=True
+    ).order_by(DreConfiguracao.ordem).all()
+    valores_dre = {int(chave): serie['dre'] for chave, serie in contas.items() if chave.isdigit()}
+    linhas_dre = _avaliar_linhas_dre(linhas_config, valores_dre, qtd_periodos)
+
+    entradas = [sum(celulas[c]['entradas'] for c in celulas) for celulas in cubo]
+    saidas = [sum(celulas[c]['saidas'] for c in celulas) for celulas in cubo]
+
+    return jsonify({
+        'granularidade': granularidade,
+        'data_inicio': periodos[0][0].strftime('%d/%m/%Y'),
+        'data_fim': periodos[-1][1].strftime('%d/%m/%Y'),
+        'periodos': [{
+            'data_inicio': inicio.strftime('%d/%m/%Y'),
+            'data_fim': fim.strftime('%d/%m/%Y'),
+            'fechado': fechado
+        } for (inicio, fim), fechado in zip(periodos, fechados)],
+        'contas': contas,
+        'linhas': linhas_dre,
+        'fluxo_caixa': {
+            'entradas': entradas,
+            'saidas': saidas,
+            'saldo': [e - s for e, s in zip(entradas, saidas)]
+        }
+    })
+
+
 @app.route('/dre/api/dados')
 def dre_api_dados():
     """API JSON: retorna dados de uma DRE para um período específico"""
@@ -8951,6 +11535,18 @@ def dre_api_dados():
                 except ValueError:
                     continue
 
+    # periodicidade=mensal: matriz mês × linha (cada linha traz 'valores', um por mês)
+    if request.args.get('periodicidade') == 'mensal':
+        periodos = meses_do_intervalo(data_inicio, data_fim)
+        linhas = calcular_dre_periodos(empresa_id, periodos)
+        return jsonify({
+            'data_inicio': data_inicio.strftime('%d/%m/%Y'),
+            'data_fim': data_fim.strftime('%d/%m/%Y'),
+            'periodos': [{'data_inicio': inicio.strftime('%d/%m/%Y'), 'data_fim': fim.strftime('%d/%m/%Y')}
+                         for inicio, fim in periodos],
+            'linhas': linhas
+        })
+
     linhas = calcular_dre(empresa_id, data_inicio, data_fim)
     return jsonify({
         'data_inicio': data_inicio.strftime('%d/%m/%Y'),
@@ -9011,6 +11607,7 @@ def dre_configurar():
 
     if request.method == 'POST':
         # Remover configurações antigas
+        invalidar_carteiras_empresas([empresa_id])
         DreConfiguracao.query.filter_by(empresa_id=empresa_id).delete()
 
         # Processar linhas serializadas do formulário
@@ -9062,29 +11659,198 @@ def dre_configurar():
                 else:
                     continue
 
-            db.session.add(nova_linha)
+            db.session.add(nova_linha)
+
+        db.session.commit()
+        flash('Configuração da DRE salva com sucesso!', 'success')
+        return redirect(url_for('dre_visualizar'))
+
+    # GET - Exibir formulário de configuração
+    # Buscar contas do plano de contas (apenas analíticas)
+    # Permitir que a mesma conta seja adicionada múltiplas vezes
+    contas_disponiveis = PlanoConta.query.filter_by(
+        empresa_id=empresa_id,
+        natureza='analitica'
+    ).order_by(PlanoConta.codigo).all()
+
+    # Buscar linhas já configuradas
+    linhas_dre = DreConfiguracao.query.filter_by(
+        empresa_id=empresa_id,
+        ativo=True
+    ).order_by(DreConfiguracao.ordem).all()
+
+    return render_template('dre_configurar.html',
+                         contas_disponiveis=contas_disponiveis,
+                         linhas_dre=linhas_dre)
+
+def calcular_relatorio_saldos(empresa_id, usuarios_ids, data_referencia, hoje):
+    """
+    Calcula os saldos do relatório de saldos (totais por status, por conta do
+    plano de contas e por conta caixa) considerando os lançamentos com
+    data_prevista até data_referencia.
+    Usado pela tela /relatorios/saldos e pela exportação.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Buscar os lançamentos da empresa ATÉ a data de referência (inclusive não realizados).
+    # Apenas as colunas usadas no relatório, lidas direto do cursor para um DataFrame
+    # (sem instanciar objetos do ORM); todos os totais saem de groupby vetorizado.
+    resultado = db.session.execute(
+        db.select(
+            Lancamento.tipo, Lancamento.valor, Lancamento.realizado, Lancamento.data_prevista,
+            Lancamento.plano_conta_id, Lancamento.conta_caixa_id
+        ).where(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.data_prevista <= data_referencia
+        )
+    )
+    colunas = list(resultado.keys())
+    df = pd.DataFrame(resultado.all(), columns=colunas)
+    df['valor'] = pd.to_numeric(df['valor']).fillna(0.0).astype(float)
+    df['plano_conta_id'] = pd.to_numeric(df['plano_conta_id']).fillna(0).astype(int)
+    df['conta_caixa_id'] = pd.to_numeric(df['conta_caixa_id']).fillna(0).astype(int)
+
+    # Status de cada lançamento: realizado; senão vencido (< hoje), agendado (= hoje) ou a vencer (> hoje)
+    data_prevista = pd.to_datetime(df['data_prevista'])
+    hoje_ts = pd.Timestamp(hoje)
+    df['status'] = np.select(
+        [df['realizado'].eq(True), data_prevista < hoje_ts, data_prevista == hoje_ts],
+        ['realizado', 'vencido', 'agendado'],
+        default='a_vencer'
+    )
+
+    def _soma(serie, *chave):
+        return float(serie.get(chave, 0.0))
+
+    # Calcular totais globais até a data
+    totais_status = df.groupby(['tipo', 'status'])['valor'].sum()
+
+    total_receitas_realizadas = _soma(totais_status, 'entrada', 'realizado')
+    total_despesas_realizadas = _soma(totais_status, 'saida', 'realizado')
+
+    total_receitas_vencidas = _soma(totais_status, 'entrada', 'vencido')
+    total_despesas_vencidas = _soma(totais_status, 'saida', 'vencido')
+
+    total_receitas_agendadas = _soma(totais_status, 'entrada', 'agendado')
+    total_despesas_agendadas = _soma(totais_status, 'saida', 'agendado')
+
+    total_receitas_a_vencer = _soma(totais_status, 'entrada', 'a_vencer')
+    total_despesas_a_vencer = _soma(totais_status, 'saida', 'a_vencer')
+
+    # Totais consolidados
+    saldo_realizado = total_receitas_realizadas - total_despesas_realizadas
+    total_receitas_pendentes = total_receitas_vencidas + total_receitas_agendadas + total_receitas_a_vencer
+    total_despesas_pendentes = total_despesas_vencidas + total_despesas_agendadas + total_despesas_a_vencer
+    saldo_projetado = saldo_realizado + total_receitas_pendentes - total_despesas_pendentes
+    saldo_vencido = total_receitas_vencidas - total_despesas_vencidas
+
+    # 1. SALDOS POR CONTA DO PLANO DE CONTAS
+    contas_plano = PlanoConta.query.filter_by(empresa_id=empresa_id, ativo=True).order_by(PlanoConta.codigo).all()
+    p_contas_map = {c.id: c for c in contas_plano}
+
+    categorias_receitas = {}
+    categorias_despesas = {}
+
+    def _item_categoria(codigo):
+        return {
+            'realizado': 0.0,
+            'a_vencer': 0.0,
+            'vencido': 0.0,
+            'agendado': 0.0,
+            'total': 0.0,
+            'codigo': codigo
+        }
+
+    # Inicializar todas as contas analíticas
+    for c in contas_plano:
+        if c.natureza == 'analitica':
+            nome_exibicao = f"{c.codigo} - {c.nome}" if c.codigo else c.nome
+            if c.tipo == 'entrada':
+                categorias_receitas[nome_exibicao] = _item_categoria(c.codigo)
+            else:
+                categorias_despesas[nome_exibicao] = _item_categoria(c.codigo)
+
+    def _acumular_categoria(dest, nome, codigo, status, valor):
+        if nome not in dest:
+            # Conta existe mas não foi inicializada (ex: sintética), criar entrada
+            dest[nome] = _item_categoria(codigo)
+        dest[nome][status] += valor
+        dest[nome]['total'] += valor
+
+    # Distribuir valores agrupados por conta do plano e status
+    com_plano = df['plano_conta_id'].isin(list(p_contas_map))
+    for (plano_conta_id, status), valor in df[com_plano].groupby(['plano_conta_id', 'status'])['valor'].sum().items():
+        pc = p_contas_map[plano_conta_id]
+        nome_exibicao = f"{pc.codigo} - {pc.nome}" if pc.codigo else pc.nome
+        dest = categorias_receitas if pc.tipo == 'entrada' else categorias_despesas
+        _acumular_categoria(dest, nome_exibicao, pc.codigo or '', status, float(valor))
+
+    # Lançamentos sem plano de contas - agrupar como "Sem Categoria"
+    for (tipo, status), valor in df[~com_plano].groupby(['tipo', 'status'])['valor'].sum().items():
+        dest = categorias_receitas if tipo == 'entrada' else categorias_despesas
+        _acumular_categoria(dest, "Sem Categoria", '99.SEM', status, float(valor))
+
+    # 2. SALDOS DAS CONTAS CAIXA
+    contas_caixa = ContaCaixa.query.filter(ContaCaixa.usuario_id.in_(usuarios_ids), ContaCaixa.ativo==True).all()
+    totais_conta_caixa = df.groupby(['conta_caixa_id', 'tipo', 'status'])['valor'].sum()
+
+    contas_caixa_detalhadas = []
+    for conta in contas_caixa:
+        # Saldo acumulado realizado até a data_referencia, somado ao saldo inicial da conta
+        saldo_inicial = getattr(conta, 'saldo_inicial', 0) or 0
+
+        # Saldo realizado até a data de referência
+        rec_realizado = _soma(totais_conta_caixa, conta.id, 'entrada', 'realizado')
+        desp_realizado = _soma(totais_conta_caixa, conta.id, 'saida', 'realizado')
+        saldo_atual_conta = saldo_inicial + rec_realizado - desp_realizado
 
-        db.session.commit()
-        flash('Configuração da DRE salva com sucesso!', 'success')
-        return redirect(url_for('dre_visualizar'))
+        # Pendentes até a data de referência
+        rec_por_status = {st: _soma(totais_conta_caixa, conta.id, 'entrada', st) for st in ('vencido', 'agendado', 'a_vencer')}
+        desp_por_status = {st: _soma(totais_conta_caixa, conta.id, 'saida', st) for st in ('vencido', 'agendado', 'a_vencer')}
+        rec_pendente = sum(rec_por_status.values())
+        desp_pendente = sum(desp_por_status.values())
 
-    # GET - Exibir formulário de configuração
-    # Buscar contas do plano de contas (apenas analíticas)
-    # Permitir que a mesma conta seja adicionada múltiplas vezes
-    contas_disponiveis = PlanoConta.query.filter_by(
-        empresa_id=empresa_id,
-        natureza='analitica'
-    ).order_by(PlanoConta.codigo).all()
+        saldo_projetado_conta = saldo_atual_conta + rec_pendente - desp_pendente
 
-    # Buscar linhas já configuradas
-    linhas_dre = DreConfiguracao.query.filter_by(
-        empresa_id=empresa_id,
-        ativo=True
-    ).order_by(DreConfiguracao.ordem).all()
+        contas_caixa_detalhadas.append({
+            'conta': conta,
+            'saldo_atual': saldo_atual_conta,
+            'rec_pendente': rec_pendente,
+            'desp_pendente': desp_pendente,
+            'saldo_projetado': saldo_projetado_conta,
+            # Campos para compatibilidade com template atual
+            'rec_a_vencer': rec_por_status['a_vencer'],
+            'desp_a_vencer': desp_por_status['a_vencer'],
+            'rec_vencido': rec_por_status['vencido'],
+            'desp_vencido': desp_por_status['vencido'],
+            'rec_agendado': rec_por_status['agendado'],
+            'desp_agendado': desp_por_status['agendado'],
+        })
+
+    saldo_total_caixa = sum(c['saldo_atual'] for c in contas_caixa_detalhadas)
+
+    return {
+        'quantidade_lancamentos': len(df),
+        'total_receitas_realizadas': total_receitas_realizadas,
+        'total_despesas_realizadas': total_despesas_realizadas,
+        'total_receitas_vencidas': total_receitas_vencidas,
+        'total_despesas_vencidas': total_despesas_vencidas,
+        'total_receitas_agendadas': total_receitas_agendadas,
+        'total_despesas_agendadas': total_despesas_agendadas,
+        'total_receitas_a_vencer': total_receitas_a_vencer,
+        'total_despesas_a_vencer': total_despesas_a_vencer,
+        'total_receitas_pendentes': total_receitas_pendentes,
+        'total_despesas_pendentes': total_despesas_pendentes,
+        'saldo_realizado': saldo_realizado,
+        'saldo_projetado': saldo_projetado,
+        'saldo_vencido': saldo_vencido,
+        'categorias_receitas': categorias_receitas,
+        'categorias_despesas': categorias_despesas,
+        'contas_caixa_detalhadas': contas_caixa_detalhadas,
+        'saldo_total_caixa': saldo_total_caixa,
+    }
 
-    return render_template('dre_configurar.html',
-                         contas_disponiveis=contas_disponiveis,
-                         linhas_dre=linhas_dre)
 
 @app.route('/relatorios/saldos')
 def relatorio_saldos():
@@ -9118,159 +11884,26 @@ def relatorio_saldos():
         else:
             data_referencia_str = hoje.strftime('%d/%m/%Y')
 
-        # Buscar todos os lançamentos da empresa ATÉ a data de referência (inclusive não realizados)
-        lancamentos_ate_data = Lancamento.query.filter(
-            Lancamento.empresa_id == empresa_id,
-            Lancamento.data_prevista <= data_referencia
-        ).all()
-
-        # Calcular totais globais até a data
-        total_receitas_realizadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and l.realizado])
-        total_despesas_realizadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and l.realizado])
-        
-        total_receitas_vencidas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista < hoje])
-        total_despesas_vencidas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista < hoje])
-
-        total_receitas_agendadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista == hoje])
-        total_despesas_agendadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista == hoje])
-        
-        total_receitas_a_vencer = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista > hoje])
-        total_despesas_a_vencer = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista > hoje])
-
-        # Totais consolidados
-        saldo_realizado = total_receitas_realizadas - total_despesas_realizadas
-        total_receitas_pendentes = total_receitas_vencidas + total_receitas_agendadas + total_receitas_a_vencer
-        total_despesas_pendentes = total_despesas_vencidas + total_despesas_agendadas + total_despesas_a_vencer
-        saldo_projetado = saldo_realizado + total_receitas_pendentes - total_despesas_pendentes
-        saldo_vencido = total_receitas_vencidas - total_despesas_vencidas
-
-        # 1. SALDOS POR CONTA DO PLANO DE CONTAS
-        contas_plano = PlanoConta.query.filter_by(empresa_id=empresa_id, ativo=True).order_by(PlanoConta.codigo).all()
-        p_contas_map = {c.id: c for c in contas_plano}
-        
-        categorias_receitas = {}
-        categorias_despesas = {}
-
-        # Inicializar todas as contas analíticas
-        for c in contas_plano:
-            if c.natureza == 'analitica':
-                nome_exibicao = f"{c.codigo} - {c.nome}" if c.codigo else c.nome
-                item = {
-                    'realizado': 0.0,
-                    'a_vencer': 0.0,
-                    'vencido': 0.0,
-                    'agendado': 0.0,
-                    'total': 0.0,
-                    'codigo': c.codigo
-                }
-                if c.tipo == 'entrada':
-                    categorias_receitas[nome_exibicao] = item
-                else:
-                    categorias_despesas[nome_exibicao] = item
-
-        # Distribuir valores dos lançamentos
-        for l in lancamentos_ate_data:
-            if l.plano_conta_id and l.plano_conta_id in p_contas_map:
-                pc = p_contas_map[l.plano_conta_id]
-                nome_exibicao = f"{pc.codigo} - {pc.nome}" if pc.codigo else pc.nome
-                dest = categorias_receitas if pc.tipo == 'entrada' else categorias_despesas
-                
-                if nome_exibicao not in dest:
-                    # Conta existe mas não foi inicializada (ex: sintética), criar entrada
-                    dest[nome_exibicao] = {
-                        'realizado': 0.0,
-                        'a_vencer': 0.0,
-                        'vencido': 0.0,
-                        'agendado': 0.0,
-                        'total': 0.0,
-                        'codigo': pc.codigo or ''
-                    }
-                
-                if l.realizado:
-                    dest[nome_exibicao]['realizado'] += l.valor
-                elif l.data_prevista < hoje:
-                    dest[nome_exibicao]['vencido'] += l.valor
-                elif l.data_prevista == hoje:
-                    dest[nome_exibicao]['agendado'] += l.valor
-                else:
-                    dest[nome_exibicao]['a_vencer'] += l.valor
-                    
-                dest[nome_exibicao]['total'] = (dest[nome_exibicao]['realizado'] + 
-                                               dest[nome_exibicao]['vencido'] + 
-                                               dest[nome_exibicao]['agendado'] + 
-                                               dest[nome_exibicao]['a_vencer'])
-            else:
-                # Lançamento sem plano de contas - agrupar como "Sem Categoria"
-                cat_nome = "Sem Categoria"
-                dest = categorias_receitas if l.tipo == 'entrada' else categorias_despesas
-                
-                if cat_nome not in dest:
-                    dest[cat_nome] = {
-                        'realizado': 0.0,
-                        'a_vencer': 0.0,
-                        'vencido': 0.0,
-                        'agendado': 0.0,
-                        'total': 0.0,
-                        'codigo': '99.SEM'
-                    }
-                
-                if l.realizado:
-                    dest[cat_nome]['realizado'] += l.valor
-                elif l.data_prevista < hoje:
-                    dest[cat_nome]['vencido'] += l.valor
-                elif l.data_prevista == hoje:
-                    dest[cat_nome]['agendado'] += l.valor
-                else:
-                    dest[cat_nome]['a_vencer'] += l.valor
-                    
-                dest[cat_nome]['total'] = (dest[cat_nome]['realizado'] + 
-                                          dest[cat_nome]['vencido'] + 
-                                          dest[cat_nome]['agendado'] + 
-                                          dest[cat_nome]['a_vencer'])
-
-        # 2. SALDOS DAS CONTAS CAIXA
-        contas_caixa = ContaCaixa.query.filter(ContaCaixa.usuario_id.in_(usuarios_ids), ContaCaixa.ativo==True).all()
-
-        contas_caixa_detalhadas = []
-        for conta in contas_caixa:
-            lancs_conta = [l for l in lancamentos_ate_data if l.conta_caixa_id == conta.id]
-            
-            # Para o saldo atual da conta (realizado acumulado), precisamos considerar TODOS os lançamentos realizados
-            # até hoje, não apenas os do filtro. Mas o usuário quer ATÉ a data.
-            # Então calculamos o saldo acumulado realizado até a data_referencia.
-            # Se houver um saldo inicial na conta, deve ser considerado.
-            
-            saldo_inicial = getattr(conta, 'saldo_inicial', 0) or 0
-            
-            # Saldo realizado até a data de referência
-            rec_realizado = sum(l.valor for l in lancs_conta if l.tipo == 'entrada' and l.realizado)
-            desp_realizado = sum(l.valor for l in lancs_conta if l.tipo == 'saida' and l.realizado)
-            saldo_atual_conta = saldo_inicial + rec_realizado - desp_realizado
-            
-            # Pendentes até a data de referência
-            rec_pendente = sum(l.valor for l in lancs_conta if l.tipo == 'entrada' and not l.realizado)
-            desp_pendente = sum(l.valor for l in lancs_conta if l.tipo == 'saida' and not l.realizado)
-            
-            saldo_projetado_conta = saldo_atual_conta + rec_pendente - desp_pendente
-            
-            contas_caixa_detalhadas.append({
-                'conta': conta,
-                'saldo_atual': saldo_atual_conta,
-                'rec_pendente': rec_pendente,
-                'desp_pendente': desp_pendente,
-                'saldo_projetado': saldo_projetado_conta,
-                # Campos para compatibilidade com template atual
-                'rec_a_vencer': sum(l.valor for l in lancs_conta if l.tipo == 'entrada' and not l.realizado and l.data_prevista > hoje),
-                'desp_a_vencer': sum(l.valor for l in lancs_conta if l.tipo == 'saida' and not l.realizado and l.data_prevista > hoje),
-                'rec_vencido': sum(l.valor for l in lancs_conta if l.tipo == 'entrada' and not l.realizado and l.data_prevista < hoje),
-                'desp_vencido': sum(l.valor for l in lancs_conta if l.tipo == 'saida' and not l.realizado and l.data_prevista < hoje),
-                'rec_agendado': sum(l.valor for l in lancs_conta if l.tipo == 'entrada' and not l.realizado and l.data_prevista == hoje),
-                'desp_agendado': sum(l.valor for l in lancs_conta if l.tipo == 'saida' and not l.realizado and l.data_prevista == hoje),
-            })
-
-        saldo_total_caixa = sum(c['saldo_atual'] for c in contas_caixa_detalhadas)
-
-        print(f"=== SALDOS DEBUG === data_ref={data_referencia_str}, lancamentos={len(lancamentos_ate_data)}, entradas={total_receitas_realizadas}, saidas={total_despesas_realizadas}, contas_caixa={len(contas_caixa_detalhadas)}, cat_rec={len(categorias_receitas)}, cat_desp={len(categorias_despesas)}")
+        saldos = calcular_relatorio_saldos(empresa_id, usuarios_ids, data_referencia, hoje)
+        total_receitas_realizadas = saldos['total_receitas_realizadas']
+        total_despesas_realizadas = saldos['total_despesas_realizadas']
+        total_receitas_vencidas = saldos['total_receitas_vencidas']
+        total_despesas_vencidas = saldos['total_despesas_vencidas']
+        total_receitas_agendadas = saldos['total_receitas_agendadas']
+        total_despesas_agendadas = saldos['total_despesas_agendadas']
+        total_receitas_a_vencer = saldos['total_receitas_a_vencer']
+        total_despesas_a_vencer = saldos['total_despesas_a_vencer']
+        total_receitas_pendentes = saldos['total_receitas_pendentes']
+        total_despesas_pendentes = saldos['total_despesas_pendentes']
+        saldo_realizado = saldos['saldo_realizado']
+        saldo_projetado = saldos['saldo_projetado']
+        saldo_vencido = saldos['saldo_vencido']
+        categorias_receitas = saldos['categorias_receitas']
+        categorias_despesas = saldos['categorias_despesas']
+        contas_caixa_detalhadas = saldos['contas_caixa_detalhadas']
+        saldo_total_caixa = saldos['saldo_total_caixa']
+
+        print(f"=== SALDOS DEBUG === data_ref={data_referencia_str}, lancamentos={saldos['quantidade_lancamentos']}, entradas={total_receitas_realizadas}, saidas={total_despesas_realizadas}, contas_caixa={len(contas_caixa_detalhadas)}, cat_rec={len(categorias_receitas)}, cat_desp={len(categorias_despesas)}")
         print(f"=== CATEGORIAS RECEITAS === {dict(list(categorias_receitas.items())[:3])}")
         print(f"=== CATEGORIAS DESPESAS === {dict(list(categorias_despesas.items())[:3])}")
         for cc in contas_caixa_detalhadas[:2]:
@@ -9366,6 +11999,7 @@ def relatorio_saldos():
                              sum_saldo_projetado_contas=0)
 
 @app.route('/relatorios/saldos/exportar/<formato>')
+@em_segundo_plano('exportacao', max_tentativas=3, quando=lambda formato, **_: formato == 'pdf')
 def exportar_relatorio_saldos(formato):
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
@@ -9392,115 +12026,24 @@ def exportar_relatorio_saldos(formato):
         except ValueError:
             pass
             
-    # ------ REPLICAR LÓGICA DO RELATÓRIO SALDOS PRINCIPAL ------
-    lancamentos_ate_data = Lancamento.query.filter(
-        Lancamento.empresa_id == empresa_id,
-        Lancamento.data_prevista <= data_referencia
-    ).all()
-
-    total_receitas_realizadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and l.realizado])
-    total_despesas_realizadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and l.realizado])
-    
-    total_receitas_vencidas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista < hoje])
-    total_despesas_vencidas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista < hoje])
-
-    total_receitas_agendadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista == hoje])
-    total_despesas_agendadas = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista == hoje])
-    
-    total_receitas_a_vencer = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'entrada' and not l.realizado and l.data_prevista > hoje])
-    total_despesas_a_vencer = sum([l.valor for l in lancamentos_ate_data if l.tipo == 'saida' and not l.realizado and l.data_prevista > hoje])
-
-    saldo_realizado = total_receitas_realizadas - total_despesas_realizadas
-    total_receitas_pendentes = total_receitas_vencidas + total_receitas_agendadas + total_receitas_a_vencer
-    total_despesas_pendentes = total_despesas_vencidas + total_despesas_agendadas + total_despesas_a_vencer
-    saldo_projetado = saldo_realizado + total_receitas_pendentes - total_despesas_pendentes
-    saldo_vencido = total_receitas_vencidas - total_despesas_vencidas
-
-    # 1. SALDOS POR CONTA DO PLANO DE CONTAS
-    contas_plano = PlanoConta.query.filter_by(empresa_id=empresa_id, ativo=True).order_by(PlanoConta.codigo).all()
-    p_contas_map = {c.id: c for c in contas_plano}
-    
-    categorias_receitas = {}
-    categorias_despesas = {}
-
-    for c in contas_plano:
-        if c.natureza == 'analitica':
-            nome_exibicao = f"{c.codigo} - {c.nome}" if c.codigo else c.nome
-            item = {'realizado': 0.0, 'a_vencer': 0.0, 'vencido': 0.0, 'agendado': 0.0, 'total': 0.0, 'codigo': c.codigo}
-            if c.tipo == 'entrada':
-                categorias_receitas[nome_exibicao] = item
-            else:
-                categorias_despesas[nome_exibicao] = item
-
-    for l in lancamentos_ate_data:
-        if l.plano_conta_id and l.plano_conta_id in p_contas_map:
-            pc = p_contas_map[l.plano_conta_id]
-            nome_exibicao = f"{pc.codigo} - {pc.nome}" if pc.codigo else pc.nome
-            dest = categorias_receitas if pc.tipo == 'entrada' else categorias_despesas
-            
-            if nome_exibicao not in dest:
-                dest[nome_exibicao] = {'realizado': 0.0, 'a_vencer': 0.0, 'vencido': 0.0, 'agendado': 0.0, 'total': 0.0, 'codigo': pc.codigo or ''}
-            
-            if l.realizado:
-                dest[nome_exibicao]['realizado'] += l.valor
-            elif l.data_prevista < hoje:
-                dest[nome_exibicao]['vencido'] += l.valor
-            elif l.data_prevista == hoje:
-                dest[nome_exibicao]['agendado'] += l.valor
-            else:
-                dest[nome_exibicao]['a_vencer'] += l.valor
-                
-            dest[nome_exibicao]['total'] = (dest[nome_exibicao]['realizado'] + dest[nome_exibicao]['vencido'] + dest[nome_exibicao]['agendado'] + dest[nome_exibicao]['a_vencer'])
-        else:
-            cat_nome = "Sem Categoria"
-            dest = categorias_receitas if l.tipo == 'entrada' else categorias_despesas
-            if cat_nome not in dest:
-                dest[cat_nome] = {'realizado': 0.0, 'a_vencer': 0.0, 'vencido': 0.0, 'agendado': 0.0, 'total': 0.0, 'codigo': ''}
-            
-            if l.realizado:
-                dest[cat_nome]['realizado'] += l.valor
-            elif l.data_prevista < hoje:
-                dest[cat_nome]['vencido'] += l.valor
-            elif l.data_prevista == hoje:
-                dest[cat_nome]['agendado'] += l.valor
-            else:
-                dest[cat_nome]['a_vencer'] += l.valor
-                
-            dest[cat_nome]['total'] = (dest[cat_nome]['realizado'] + dest[cat_nome]['vencido'] + dest[cat_nome]['agendado'] + dest[cat_nome]['a_vencer'])
-
-    # 3. CONTAS CAIXA DETALHADAS
-    contas_caixa = ContaCaixa.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-    contas_caixa_detalhadas = []
-    
-    for c in contas_caixa:
-        saldo_r = c.saldo_inicial
-        l_realizados = [l for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.realizado]
-        saldo_r += sum([l.valor for l in l_realizados if l.tipo == 'entrada'])
-        saldo_r -= sum([l.valor for l in l_realizados if l.tipo == 'saida'])
-        
-        # Pendentes de Entradas
-        r_pend_hoje = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'entrada' and not l.realizado and l.data_prevista == hoje])
-        r_pend_futuro = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'entrada' and not l.realizado and l.data_prevista > hoje])
-        r_vencidos = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'entrada' and not l.realizado and l.data_prevista < hoje])
-        
-        # Pendentes de Saídas
-        d_pend_hoje = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'saida' and not l.realizado and l.data_prevista == hoje])
-        d_pend_futuro = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'saida' and not l.realizado and l.data_prevista > hoje])
-        d_vencidos = sum([l.valor for l in lancamentos_ate_data if l.conta_caixa_id == c.id and l.tipo == 'saida' and not l.realizado and l.data_prevista < hoje])
-        
-        proj_final = saldo_r + (r_pend_hoje + r_pend_futuro + r_vencidos) - (d_pend_hoje + d_pend_futuro + d_vencidos)
-        
-        contas_caixa_detalhadas.append({
-            'conta': c,
-            'saldo_atual': saldo_r,
-            'rec_a_vencer': r_pend_futuro,
-            'rec_vencido': r_vencidos,
-            'rec_agendado': r_pend_hoje,
-            'desp_a_vencer': d_pend_futuro,
-            'desp_vencido': d_vencidos,
-            'desp_agendado': d_pend_hoje,
-            'saldo_projetado': proj_final
-        })
+    # Mesmo cálculo do relatório de saldos principal
+    saldos = calcular_relatorio_saldos(empresa_id, usuarios_ids, data_referencia, hoje)
+    total_receitas_realizadas = saldos['total_receitas_realizadas']
+    total_despesas_realizadas = saldos['total_despesas_realizadas']
+    total_receitas_vencidas = saldos['total_receitas_vencidas']
+    total_despesas_vencidas = saldos['total_despesas_vencidas']
+    total_receitas_agendadas = saldos['total_receitas_agendadas']
+    total_despesas_agendadas = saldos['total_despesas_agendadas']
+    total_receitas_a_vencer = saldos['total_receitas_a_vencer']
+    total_despesas_a_vencer = saldos['total_despesas_a_vencer']
+    total_receitas_pendentes = saldos['total_receitas_pendentes']
+    total_despesas_pendentes = saldos['total_despesas_pendentes']
+    saldo_realizado = saldos['saldo_realizado']
+    saldo_projetado = saldos['saldo_projetado']
+    saldo_vencido = saldos['saldo_vencido']
+    categorias_receitas = saldos['categorias_receitas']
+    categorias_despesas = saldos['categorias_despesas']
+    contas_caixa_detalhadas = saldos['contas_caixa_detalhadas']
 
     # Preparar dados para exportação
     dados = {
@@ -9530,8 +12073,7 @@ def exportar_relatorio_saldos(formato):
     
     # Preparar filtros para o cabeçalho
     filtros = {
-        'data_inicio': data_inicio_str,
-        'data_fim': data_fim_str
+        'data_fim': data_referencia.strftime('%d/%m/%Y')
     }
     
     if formato.lower() == 'excel':
@@ -9562,102 +12104,15 @@ def relatorio_lancamentos():
     usuarios_ids = [u.id for u in usuarios_empresa]
     
     # Obter filtros do request (conforme requisitos)
-    tipo_filtro = request.args.get('tipo', '')
-    categoria_filtro = request.args.get('categoria', '')
-    status_filtro = request.args.get('status', '')
-    cliente_filtro = request.args.get('cliente', '')
-    fornecedor_filtro = request.args.get('fornecedor', '')
-    descricao_filtro = request.args.get('descricao', '')
-    valor_min_str = request.args.get('valor_min', '')
-    valor_max_str = request.args.get('valor_max', '')
-    data_inicio_str = request.args.get('data_inicio', '')
-    data_fim_str = request.args.get('data_fim', '')
-    
-    # Converter strings de data para objetos datetime
-    data_inicio = None
-    data_fim = None
+    filtro = FiltroLancamentos.da_requisicao(request.args, empresa_id, perfil='relatorio')
+    if filtro.datas_invalidas:
+        flash('Data inválida. Use o formato DD/MM/AAAA.', 'error')
     
-    if data_inicio_str:
-        try:
-            data_inicio = datetime.strptime(data_inicio_str, '%d/%m/%Y').date()
-        except ValueError:
-            flash('Data de início inválida. Use o formato DD/MM/AAAA.', 'error')
-            data_inicio_str = ''
-    
-    if data_fim_str:
-        try:
-            data_fim = datetime.strptime(data_fim_str, '%d/%m/%Y').date()
-        except ValueError:
-            flash('Data de fim inválida. Use o formato DD/MM/AAAA.', 'error')
-            data_fim_str = ''
-    
-    # Construir query base
-    query = Lancamento.query.options(
+    # Construir query com os filtros
+    query = filtro.consulta().options(
         joinedload(Lancamento.compra).joinedload(Compra.fornecedor),
         joinedload(Lancamento.venda).joinedload(Venda.cliente)
-    ).filter(Lancamento.empresa_id == empresa_id)
-    
-    # Aplicar filtros
-    if tipo_filtro:
-        query = query.filter(Lancamento.tipo == tipo_filtro)
-    
-    if categoria_filtro:
-        query = query.filter(Lancamento.categoria == categoria_filtro)
-    
-    if status_filtro == 'realizado':
-        query = query.filter(Lancamento.realizado == True)
-    elif status_filtro == 'pendente':
-        query = query.filter(Lancamento.realizado == False)
-    
-    if data_inicio:
-        query = query.filter(Lancamento.data_prevista >= data_inicio)
-    if data_fim:
-        query = query.filter(Lancamento.data_prevista <= data_fim)
-    
-    # Aplicar filtros de cliente e fornecedor
-    if cliente_filtro:
-        # Buscar lançamentos que têm venda vinculada com cliente específico
-        query = query.join(Venda, Lancamento.venda_id == Venda.id).join(Cliente, Venda.cliente_id == Cliente.id).filter(Cliente.nome.ilike(f'%{cliente_filtro}%'))
-
-    if fornecedor_filtro:
-        # Buscar lançamentos que têm compra vinculada com fornecedor específico
-        query = query.join(Compra, Lancamento.compra_id == Compra.id).join(Fornecedor, Compra.fornecedor_id == Fornecedor.id).filter(Fornecedor.nome.ilike(f'%{fornecedor_filtro}%'))
-
-    # Filtro por busca geral (descrição ou valor)
-    busca = request.args.get('busca', '').strip()
-    if busca:
-        termo = f"%{busca}%"
-        try:
-            valor_busca = float(busca.replace(',', '.'))
-            query = query.filter(or_(
-                Lancamento.descricao.ilike(termo),
-                Lancamento.valor == valor_busca,
-                Lancamento.produto_servico.ilike(termo)
-            ))
-        except ValueError:
-            query = query.filter(or_(
-                Lancamento.descricao.ilike(termo),
-                Lancamento.produto_servico.ilike(termo)
-            ))
-
-    # Aplicar filtro de descrição (conforme requisitos)
-    if descricao_filtro:
-        query = query.filter(Lancamento.descricao.ilike(f'%{descricao_filtro}%'))
-
-    # Aplicar filtro de valor (conforme requisitos)
-    if valor_min_str:
-        try:
-            valor_min = float(valor_min_str.replace(',', '.'))
-            query = query.filter(Lancamento.valor >= valor_min)
-        except ValueError:
-            pass
-
-    if valor_max_str:
-        try:
-            valor_max = float(valor_max_str.replace(',', '.'))
-            query = query.filter(Lancamento.valor <= valor_max)
-        except ValueError:
-            pass
+    )
     
     # Carregar lançamentos
     lancamentos = query.order_by(Lancamento.data_prevista.desc()).all()
@@ -9673,16 +12128,16 @@ def relatorio_lancamentos():
     
     # Criar objeto de filtros para o template (com novos filtros)
     filtros = type('Filtros', (), {
-        'tipo': tipo_filtro,
-        'categoria': categoria_filtro,
-        'data_inicio': data_inicio_str,
-        'data_fim': data_fim_str,
-        'status': status_filtro,
-        'cliente': cliente_filtro,
-        'fornecedor': fornecedor_filtro,
-        'descricao': descricao_filtro,
-        'valor_min': valor_min_str,
-        'valor_max': valor_max_str
+        'tipo': request.args.get('tipo', ''),
+        'categoria': request.args.get('categoria', ''),
+        'data_inicio': filtro.data_inicio_texto,
+        'data_fim': filtro.data_fim_texto,
+        'status': request.args.get('status', ''),
+        'cliente': request.args.get('cliente', ''),
+        'fornecedor': request.args.get('fornecedor', ''),
+        'descricao': request.args.get('descricao', ''),
+        'valor_min': request.args.get('valor_min', ''),
+        'valor_max': request.args.get('valor_max', '')
     })()
     
     return render_template('relatorio_lancamentos.html', 
@@ -9695,6 +12150,7 @@ def relatorio_lancamentos():
                          filtros=filtros)
 
 @app.route('/relatorios/lancamentos/exportar/<formato>')
+@em_segundo_plano('exportacao', max_tentativas=3, quando=lambda formato, **_: formato == 'pdf')
 def exportar_relatorio_lancamentos(formato):
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
@@ -9709,57 +12165,26 @@ def exportar_relatorio_lancamentos(formato):
     usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
     usuarios_ids = [u.id for u in usuarios_empresa]
     
-    # Obter filtros
-    tipo_filtro = request.args.get('tipo', '')
-    categoria_filtro = request.args.get('categoria', '')
-    status_filtro = request.args.get('status', '')
-    data_inicio_str = request.args.get('data_inicio', '')
-    data_fim_str = request.args.get('data_fim', '')
-    
-    # Construir query base
-    query = Lancamento.query.filter(Lancamento.empresa_id == empresa_id)
-    
-    # Aplicar filtros
-    if tipo_filtro:
-        query = query.filter(Lancamento.tipo == tipo_filtro)
-    if categoria_filtro:
-        query = query.filter(Lancamento.categoria == categoria_filtro)
-    if status_filtro:
-        if status_filtro == 'realizado':
-            query = query.filter(Lancamento.realizado == True)
-        elif status_filtro == 'pendente':
-            query = query.filter(Lancamento.realizado == False)
-    
-    # Aplicar filtros de data
-    if data_inicio_str:
-        try:
-            data_inicio = datetime.strptime(data_inicio_str, '%d/%m/%Y').date()
-            query = query.filter(Lancamento.data_prevista >= data_inicio)
-        except ValueError:
-            pass
-    
-    if data_fim_str:
-        try:
-            data_fim = datetime.strptime(data_fim_str, '%d/%m/%Y').date()
-            query = query.filter(Lancamento.data_prevista <= data_fim)
-        except ValueError:
-            pass
-    
-    # Carregar lançamentos com relacionamentos
-    lancamentos = query.options(joinedload(Lancamento.cliente), joinedload(Lancamento.fornecedor)).all()
+    # Obter filtros (mesmos do relatório)
+    filtro = FiltroLancamentos.da_requisicao(request.args, empresa_id, perfil='relatorio')
+    query = filtro.consulta()
     
-    # Preparar dados para exportação
-    dados = {'lancamentos': lancamentos}
+    # Preparar dados para exportação: o Excel lê a consulta em lotes, o PDF monta a tabela inteira
+    if formato.lower() == 'excel':
+        dados = {'lancamentos': query}
+    else:
+        lancamentos = query.options(joinedload(Lancamento.cliente), joinedload(Lancamento.fornecedor)).all()
+        dados = {'lancamentos': lancamentos}
     
     titulo = f"Relatório de Lançamentos"
     
     # Preparar filtros para o cabeçalho
     filtros = {
-        'data_inicio': data_inicio_str,
-        'data_fim': data_fim_str,
-        'tipo': tipo_filtro,
-        'categoria': categoria_filtro,
-        'status': status_filtro
+        'data_inicio': filtro.data_inicio_texto,
+        'data_fim': filtro.data_fim_texto,
+        'tipo': request.args.get('tipo', ''),
+        'categoria': request.args.get('categoria', ''),
+        'status': request.args.get('status', '')
     }
     
     if formato.lower() == 'excel':
@@ -9774,6 +12199,191 @@ def exportar_relatorio_lancamentos(formato):
     flash('Erro ao exportar relatório.', 'error')
     return redirect(url_for('relatorio_lancamentos'))
 
+# ===== EXPORTAÇÃO DE LANÇAMENTOS EM STREAMING (CSV / NDJSON) =====
+
+# Campos exportados, na ordem das colunas do CSV
+CAMPOS_EXPORTACAO_LANCAMENTOS = [
+    'id', 'descricao', 'valor', 'tipo', 'categoria', 'data_prevista', 'data_realizada', 'realizado', 'status',
+    'conta_caixa_id', 'conta_caixa', 'cliente_id', 'cliente', 'fornecedor_id', 'fornecedor', 'plano_conta_id',
+    'nota_fiscal', 'observacoes', 'venda_id', 'compra_id', 'eh_transferencia', 'transferencia_id',
+    'data_criacao', 'data_ultima_edicao',
+]
+
+
+@event.listens_for(db.session, 'before_flush')
+def _lancamento_marcar_edicao(sessao, flush_context, instances):
+    """
+    Atualiza data_ultima_edicao de todo lançamento alterado, inclusive por
+    rotinas automáticas, para que a exportação incremental (since=) não perca
+    alterações. Uma data definida explicitamente pela rota é mantida.
+    """
+    from sqlalchemy import inspect as sa_inspect
+
+    agora = datetime.utcnow()
+    for obj in sessao.dirty:
+        if not isinstance(obj, Lancamento) or not sessao.is_modified(obj, include_collections=False):
+            continue
+        if not sa_inspect(obj).attrs.data_ultima_edicao.history.has_changes():
+            obj.data_ultima_edicao = agora
+
+
+def _parse_since_exportacao(valor):
+    """Data/hora do parâmetro since (ISO 8601 ou DD/MM/AAAA), em UTC sem fuso. Levanta ValueError se inválida."""
+    valor = valor.strip()
+    if '/' in valor:
+        return datetime.strptime(valor, '%d/%m/%Y')
+    momento = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    if momento.tzinfo is not None:
+        from datetime import timezone
+        momento = momento.astimezone(timezone.utc).replace(tzinfo=None)
+    return momento
+
+
+def consulta_exportacao_lancamentos(filtro, since=None):
+    """
+    Linhas da exportação CSV/NDJSON: só colunas (sem carregar objetos),
+    ordenadas por id e lidas em lotes com yield_per, que no PostgreSQL usa
+    cursor no servidor. since restringe aos lançamentos criados ou editados a
+    partir daquele momento.
+    """
+    conta, cliente, fornecedor = db.aliased(ContaCaixa), db.aliased(Cliente), db.aliased(Fornecedor)
+    consulta = filtro.consulta()
+    if since is not None:
+        consulta = consulta.filter(db.or_(Lancamento.data_ultima_edicao >= since, Lancamento.data_criacao >= since))
+
+    return consulta.outerjoin(conta, Lancamento.conta_caixa_id == conta.id).outerjoin(
+        cliente, Lancamento.cliente_id == cliente.id
+    ).outerjoin(fornecedor, Lancamento.fornecedor_id == fornecedor.id).with_entities(
+        Lancamento.id, Lancamento.descricao, Lancamento.valor, Lancamento.tipo, Lancamento.categoria,
+        Lancamento.data_prevista, Lancamento.data_realizada, Lancamento.realizado,
+        Lancamento.conta_caixa_id, conta.nome.label('conta_caixa'),
+        Lancamento.cliente_id, cliente.nome.label('cliente'),
+        Lancamento.fornecedor_id, fornecedor.nome.label('fornecedor'),
+        Lancamento.plano_conta_id, Lancamento.nota_fiscal, Lancamento.observacoes,
+        Lancamento.venda_id, Lancamento.compra_id, Lancamento.eh_transferencia, Lancamento.transferencia_id,
+        Lancamento.data_criacao, Lancamento.data_ultima_edicao,
+    ).order_by(None).order_by(Lancamento.id).yield_per(app.config['EXPORTACAO_TAMANHO_LOTE'])
+
+
+def gerar_exportacao_lancamentos(linhas, formato, separador=',', comprimir=False, hoje=None, tamanho_bloco=64 * 1024):
+    """
+    Gera o corpo da exportação em blocos de ~tamanho_bloco bytes (antes da
+    compressão), para uso como resposta em streaming. Com comprimir=True os
+    blocos saem em gzip.
+    """
+    import csv
+    import io
+    import zlib
+
+    hoje = hoje or datetime.now().date()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=separador, lineterminator='\n') if formato == 'csv' else None
+
+    def bloco():
+        dados = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(dados) if compressor else dados
+
+    if escritor:
+        escritor.writerow(CAMPOS_EXPORTACAO_LANCAMENTOS)
+
+    for linha in linhas:
+        registro = dict(linha._mapping)
+        registro['status'] = status_lancamento_exportacao(linha.data_prevista, linha.data_realizada, hoje).lower()
+        for campo in ('data_prevista', 'data_realizada', 'data_criacao', 'data_ultima_edicao'):
+            if registro[campo] is not None:
+                registro[campo] = registro[campo].isoformat()
+
+        if escritor:
+            escritor.writerow([
+                ('true' if valor else 'false') if isinstance(valor, bool) else ('' if valor is None else valor)
+                for valor in (registro[campo] for campo in CAMPOS_EXPORTACAO_LANCAMENTOS)
+            ])
+        else:
+            buffer.write(json.dumps({campo: registro[campo] for campo in CAMPOS_EXPORTACAO_LANCAMENTOS}, ensure_ascii=False))
+            buffer.write('\n')
+
+        if buffer.tell() >= tamanho_bloco:
+            dados = bloco()
+            if dados:
+                yield dados
+
+    dados = bloco()
+    if compressor:
+        dados += compressor.flush()
+    if dados:
+        yield dados
+
+
+@app.route('/api/lancamentos/exportar/<formato>')
+def api_exportar_lancamentos(formato):
+    """
+    Exporta lançamentos em CSV ou NDJSON (um objeto JSON por linha), em
+    streaming. Aceita os mesmos filtros de /lancamentos; sem filtro de data
+    exporta todos os lançamentos. Parâmetros próprios:
+      since      exporta só os lançamentos criados ou editados desde essa data/hora (UTC)
+      separador  ',' (padrão) ou ';' para o CSV
+
+    O cabeçalho X-Exportado-Em traz o momento da consulta menos a margem
+    EXPORTACAO_MARGEM_SINCRONIA, a usar como since na próxima sincronização:
+    transações abertas durante a consulta podem gravar lançamentos com data de
+    edição anterior a ela, então as sincronizações se sobrepõem e o cliente deve
+    atualizar pelo id. Lançamentos excluídos não aparecem na exportação
+    incremental (cabeçalho X-Exportacao-Exclusoes: nao-informadas); para
+    detectá-los, compare os ids com uma exportação completa.
+    Com Accept-Encoding: gzip a resposta é comprimida.
+    """
+    from flask import Response, stream_with_context
+
+    if 'usuario_id' not in session:
+        return jsonify({'error': 'Usuário não autenticado'}), 401
+
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    if not usuario or usuario.tipo == 'admin':
+        return jsonify({'error': 'Acesso negado'}), 403
+
+    formato = formato.lower()
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Formato inválido. Use csv ou ndjson.'}), 400
+
+    separador = request.args.get('separador', ',')
+    if separador not in (',', ';'):
+        return jsonify({'error': "Separador inválido. Use ',' ou ';'."}), 400
+
+    since = None
+    if request.args.get('since'):
+        try:
+            since = _parse_since_exportacao(request.args['since'])
+        except ValueError:
+            return jsonify({'error': 'Parâmetro since inválido. Use ISO 8601 (ex.: 2024-01-31T23:59:00Z).'}), 400
+
+    empresa_id = obter_empresa_id_sessao(session, usuario)
+    filtro = FiltroLancamentos.da_requisicao(request.args, empresa_id)
+    if filtro.datas_invalidas:
+        return jsonify({'error': 'Data inválida', 'campos': filtro.datas_invalidas}), 400
+
+    exportado_em = datetime.utcnow()
+    comprimir = request.accept_encodings['gzip'] > 0
+    corpo = gerar_exportacao_lancamentos(
+        consulta_exportacao_lancamentos(filtro, since), formato, separador, comprimir, hoje=filtro.hoje
+    )
+
+    extensao, mimetype = ('csv', 'text/csv') if formato == 'csv' else ('ndjson', 'application/x-ndjson')
+    resposta = Response(stream_with_context(corpo), mimetype=mimetype)
+    resposta.headers['Content-Disposition'] = (
+        f"attachment; filename=lancamentos_{exportado_em.strftime('%Y%m%d_%H%M%S')}.{extensao}"
+    )
+    margem = timedelta(seconds=app.config['EXPORTACAO_MARGEM_SINCRONIA'])
+    resposta.headers['X-Exportado-Em'] = (exportado_em - margem).isoformat() + 'Z'
+    resposta.headers['X-Exportacao-Exclusoes'] = 'nao-informadas'
+    resposta.headers['Vary'] = 'Accept-Encoding'
+    if comprimir:
+        resposta.headers['Content-Encoding'] = 'gzip'
+    return resposta
+
+
 @app.route('/relatorios/clientes')
 def relatorio_clientes():
     if 'usuario_id' not in session:
@@ -10123,6 +12733,7 @@ def relatorio_clientes():
                              sum_ticket_medio=0)
 
 @app.route('/relatorios/clientes/exportar/<formato>')
+@em_segundo_plano('exportacao', max_tentativas=3, quando=lambda formato, **_: formato == 'pdf')
 def exportar_relatorio_clientes(formato):
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
@@ -10294,6 +12905,7 @@ def relatorio_produtos():
                          filtros=filtros)
 
 @app.route('/relatorios/produtos/exportar/<formato>')
+@em_segundo_plano('exportacao', max_tentativas=3, quando=lambda formato, **_: formato == 'pdf')
 def exportar_relatorio_produtos(formato):
     if 'usuario_id' not in session:
         return redirect(url_for('login'))
@@ -10334,6 +12946,95 @@ def exportar_relatorio_produtos(formato):
     flash('Erro ao exportar relatório.', 'error')
     return redirect(url_for('relatorio_produtos'))
 
+def _totais_estoque_por_produto(empresa_id, data_limite=None):
+    """
+    Totais por produto para o relatório de estoque, até data_limite (inclusive) ou
+    de todo o período: {produto: (estoque, quantidade_comprada, custo_compras)}.
+    Usa o razão de estoque quando a empresa já o tem (uma consulta agrupada, com
+    itens de carrinho e ajustes); senão agrupa compras e vendas pelo nome do produto.
+    Retorna (totais, chave), sendo chave a função que leva Produto.nome à chave de totais.
+    """
+    M = MovimentoEstoque
+    if db.session.query(M.id).filter(M.empresa_id == empresa_id).first():
+        compra = M.origem == 'compra'
+        query = db.session.query(
+            M.produto,
+            db.func.coalesce(db.func.sum(M.quantidade), 0).label('estoque'),
+            db.func.coalesce(db.func.sum(db.case((compra, M.quantidade), else_=0)), 0).label('qtd_compras'),
+            db.func.coalesce(db.func.sum(db.case((compra, M.quantidade * M.custo_unitario), else_=0)), 0).label('custo_compras')
+        ).filter(M.empresa_id == empresa_id)
+        if data_limite:
+            query = query.filter(M.data <= data_limite)
+        totais = {l.produto: (float(l.estoque), float(l.qtd_compras), float(l.custo_compras))
+                  for l in query.group_by(M.produto)}
+        return totais, normalizar_nome_produto
+
+    quantidade_compra = db.func.coalesce(Compra.quantidade, 1)
+    compras = db.session.query(
+        Compra.produto,
+        db.func.sum(quantidade_compra).label('qtd_compras'),
+        db.func.sum(db.func.coalesce(Compra.preco_custo, Compra.valor, 0) * quantidade_compra).label('custo_compras')
+    ).filter(Compra.empresa_id == empresa_id, Compra.tipo_compra == 'mercadoria')
+    vendas = db.session.query(
+        Venda.produto,
+        db.func.sum(db.func.coalesce(Venda.quantidade, 0)).label('qtd_vendas')
+    ).filter(Venda.empresa_id == empresa_id, Venda.tipo_venda == 'produto')
+    if data_limite:
+        compras = compras.filter(Compra.data_prevista <= data_limite)
+        vendas = vendas.filter(Venda.data_prevista <= data_limite)
+
+    totais = {}
+    for l in compras.group_by(Compra.produto):
+        totais[l.produto] = (float(l.qtd_compras or 0), float(l.qtd_compras or 0), float(l.custo_compras or 0))
+    for l in vendas.group_by(Venda.produto):
+        estoque, qtd_compras, custo_compras = totais.get(l.produto, (0.0, 0.0, 0.0))
+        totais[l.produto] = (estoque - float(l.qtd_vendas or 0), qtd_compras, custo_compras)
+    return totais, (lambda nome: nome)
+
+
+def montar_relatorio_estoque(empresa_id, data_filtro, usar_data_atual):
+    """
+    Linhas do relatório de estoque de todos os produtos da empresa, em uma passada:
+    estoque (atual ou na data_filtro), preço médio de compra e valor do estoque a
+    custo e a venda. Produtos inativos sem estoque ficam de fora.
+    """
+    totais, chave = _totais_estoque_por_produto(empresa_id, None if usar_data_atual else data_filtro)
+    produtos = Produto.query.join(Usuario, Produto.usuario_id == Usuario.id).filter(
+        Usuario.empresa_id == empresa_id
+    ).all()
+
+    estoque_lista = []
+    for produto in produtos:
+        estoque_na_data, total_qtd_compras, total_custo_compras = totais.get(chave(produto.nome), (0.0, 0.0, 0.0))
+        preco_medio_compra = total_custo_compras / total_qtd_compras if total_qtd_compras > 0 else (produto.preco_custo or 0)
+
+        if usar_data_atual:
+            # Usar estoque atual do produto (já calculado)
+            estoque_atual = produto.estoque or 0
+        else:
+            estoque_atual = int(estoque_na_data) if estoque_na_data.is_integer() else estoque_na_data
+
+        if not (produto.ativo or estoque_atual > 0):
+            continue
+
+        estoque_lista.append({
+            'id': produto.id,
+            'nome': produto.nome,
+            'descricao': produto.descricao or '',
+            'estoque': estoque_atual,
+            'preco_custo': produto.preco_custo or 0,
+            'preco_medio_compra': preco_medio_compra,
+            'preco_venda': produto.preco_venda or 0,
+            'valor_estoque_custo': estoque_atual * preco_medio_compra,
+            'valor_estoque': estoque_atual * (produto.preco_venda or 0),
+            'margem': ((produto.preco_venda or 0) - preco_medio_compra) / preco_medio_compra * 100 if preco_medio_compra > 0 else 0,
+            'qtd_compras': int(total_qtd_compras) if total_qtd_compras.is_integer() else total_qtd_compras,
+            'ativo': produto.ativo
+        })
+
+    estoque_lista.sort(key=lambda x: x['nome'])
+    return estoque_lista
+
 @app.route('/relatorios/estoque')
 def relatorio_estoque():
     if 'usuario_id' not in session:
@@ -10350,94 +13051,28 @@ def relatorio_estoque():
         return redirect(url_for('relatorios'))
 
     # Obter filtro de data (conforme requisitos: data específica para cálculo temporal)
-    data_filtro_str = request.args.get('data_filtro', '')
-
-    # Processar filtro de data
-    data_filtro = None
-    usar_data_atual = True
-
-    if data_filtro_str:
-        try:
-            data_filtro = datetime.strptime(data_filtro_str, '%d/%m/%Y').date()
-            usar_data_atual = False
-        except ValueError:
-            flash('Data inválida.', 'error')
-
-    # Se não há filtro de data ou data é hoje, usar estoque atual
-    hoje = datetime.now().date()
-    if not data_filtro or data_filtro >= hoje:
-        data_filtro = hoje
-        usar_data_atual = True
-
-    # Buscar todos os produtos da empresa
-    produtos = Produto.query.filter_by(usuario_id=usuario.id).all()
-
-    # Buscar todos os usuários da empresa para multi-tenancy
-    empresa_id = obter_empresa_id_sessao(session, usuario)
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
-
-    # Calcular estoque para cada produto (temporal ou atual)
-    estoque_lista = []
-
-    for produto in produtos:
-        # Buscar todas as compras deste produto (para calcular preço médio)
-        compras_produto = Compra.query.filter(
-            Compra.empresa_id == empresa_id,
-            Compra.produto == produto.nome,
-            Compra.tipo_compra == 'mercadoria'
-        )
-        if not usar_data_atual and data_filtro:
-            compras_produto = compras_produto.filter(Compra.data_prevista <= data_filtro)
-        compras_produto = compras_produto.all()
-
-        # Calcular preço médio de compra ponderado por quantidade
-        total_custo_compras = sum((c.preco_custo or c.valor or 0) * (c.quantidade or 1) for c in compras_produto)
-        total_qtd_compras = sum(c.quantidade or 1 for c in compras_produto)
-        preco_medio_compra = total_custo_compras / total_qtd_compras if total_qtd_compras > 0 else (produto.preco_custo or 0)
-
-        if usar_data_atual:
-            # Usar estoque atual do produto (já calculado)
-            estoque_atual = produto.estoque or 0
-        else:
-            quantidade_comprada = sum([c.quantidade or 0 for c in compras_produto])
+    data_filtro_str = request.args.get('data_filtro', '')
 
-            # Vendas (saída): somar quantidade de vendas até data_filtro
-            vendas = Venda.query.filter(
-                Venda.empresa_id == empresa_id,
-                Venda.produto == produto.nome,
-                Venda.tipo_venda == 'produto',
-                Venda.data_prevista <= data_filtro
-            ).all()
+    # Processar filtro de data
+    data_filtro = None
+    usar_data_atual = True
 
-            quantidade_vendida = sum([v.quantidade or 0 for v in vendas])
-
-            # Estoque temporal = compras - vendas até a data
-            estoque_atual = quantidade_comprada - quantidade_vendida
-
-        # Adicionar à lista apenas se ativo ou tiver estoque
-        if produto.ativo or estoque_atual > 0:
-            valor_estoque_venda = estoque_atual * (produto.preco_venda or 0)
-            valor_estoque_custo = estoque_atual * preco_medio_compra
-            margem = ((produto.preco_venda or 0) - preco_medio_compra) / preco_medio_compra * 100 if preco_medio_compra > 0 else 0
-
-            estoque_lista.append({
-                'id': produto.id,
-                'nome': produto.nome,
-                'descricao': produto.descricao,
-                'estoque': estoque_atual,
-                'preco_custo': produto.preco_custo or 0,
-                'preco_medio_compra': preco_medio_compra,
-                'preco_venda': produto.preco_venda or 0,
-                'valor_estoque_custo': valor_estoque_custo,
-                'valor_estoque': valor_estoque_venda,
-                'margem': margem,
-                'qtd_compras': total_qtd_compras,
-                'ativo': produto.ativo
-            })
+    if data_filtro_str:
+        try:
+            data_filtro = datetime.strptime(data_filtro_str, '%d/%m/%Y').date()
+            usar_data_atual = False
+        except ValueError:
+            flash('Data inválida.', 'error')
 
-    # Ordenar por nome
-    estoque_lista.sort(key=lambda x: x['nome'])
+    # Se não há filtro de data ou data é hoje, usar estoque atual
+    hoje = datetime.now().date()
+    if not data_filtro or data_filtro >= hoje:
+        data_filtro = hoje
+        usar_data_atual = True
+
+    # Estoque e valorização de todos os produtos da empresa (consultas agrupadas)
+    empresa_id = obter_empresa_id_sessao(session, usuario)
+    estoque_lista = montar_relatorio_estoque(empresa_id, data_filtro, usar_data_atual)
 
     # Calcular totais
     total_produtos = len(estoque_lista)
@@ -10496,60 +13131,9 @@ def exportar_relatorio_estoque(formato):
         data_filtro = hoje
         usar_data_atual = True
 
-    # Buscar produtos e calcular estoque (mesmo código do relatório)
-    produtos = Produto.query.filter_by(usuario_id=usuario.id).all()
+    # Produtos e estoque (mesmo cálculo do relatório)
     empresa_id = obter_empresa_id_sessao(session, usuario)
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
-
-    estoque_lista = []
-
-    for produto in produtos:
-        compras_produto = Compra.query.filter(
-            Compra.empresa_id == empresa_id,
-            Compra.produto == produto.nome,
-            Compra.tipo_compra == 'mercadoria'
-        )
-        if not usar_data_atual and data_filtro:
-            compras_produto = compras_produto.filter(Compra.data_prevista <= data_filtro)
-        compras_produto = compras_produto.all()
-
-        total_custo_compras = sum((c.preco_custo or c.valor or 0) * (c.quantidade or 1) for c in compras_produto)
-        total_qtd_compras = sum(c.quantidade or 1 for c in compras_produto)
-        preco_medio_compra = total_custo_compras / total_qtd_compras if total_qtd_compras > 0 else (produto.preco_custo or 0)
-
-        if usar_data_atual:
-            estoque_atual = produto.estoque or 0
-        else:
-            quantidade_comprada = sum([c.quantidade or 0 for c in compras_produto])
-            vendas = Venda.query.filter(
-                Venda.empresa_id == empresa_id,
-                Venda.produto == produto.nome,
-                Venda.tipo_venda == 'produto',
-                Venda.data_prevista <= data_filtro
-            ).all()
-            quantidade_vendida = sum([v.quantidade or 0 for v in vendas])
-            estoque_atual = quantidade_comprada - quantidade_vendida
-
-        if produto.ativo or estoque_atual > 0:
-            valor_estoque_venda = estoque_atual * (produto.preco_venda or 0)
-            valor_estoque_custo = estoque_atual * preco_medio_compra
-            margem = ((produto.preco_venda or 0) - preco_medio_compra) / preco_medio_compra * 100 if preco_medio_compra > 0 else 0
-
-            estoque_lista.append({
-                'nome': produto.nome,
-                'descricao': produto.descricao or '',
-                'estoque': estoque_atual,
-                'preco_custo': produto.preco_custo or 0,
-                'preco_medio_compra': preco_medio_compra,
-                'preco_venda': produto.preco_venda or 0,
-                'valor_estoque_custo': valor_estoque_custo,
-                'valor_estoque': valor_estoque_venda,
-                'margem': margem,
-                'qtd_compras': total_qtd_compras,
-            })
-
-    estoque_lista.sort(key=lambda x: x['nome'])
+    estoque_lista = montar_relatorio_estoque(empresa_id, data_filtro, usar_data_atual)
 
     # Calcular totais
     total_produtos = len(estoque_lista)
@@ -10559,112 +13143,62 @@ def exportar_relatorio_estoque(formato):
     total_margem = ((total_valor_venda - total_valor_custo) / total_valor_custo * 100) if total_valor_custo > 0 else 0
 
     # Gerar Excel
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-    from openpyxl.utils import get_column_letter
+    from openpyxl.styles import Alignment
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Estoque"
+    planilha = PlanilhaStreaming()
+    ws = planilha.aba("Estoque", [30, 40, 15, 15, 15, 18, 15, 12, 20, 20])
 
     # Cabeçalho
-    ws.merge_cells('A1:J1')
-    ws['A1'] = f"RELATÓRIO DE ESTOQUE - {empresa.nome_fantasia or empresa.razao_social}"
-    ws['A1'].font = Font(size=14, bold=True)
-    ws['A1'].alignment = Alignment(horizontal='center')
-
-    ws.merge_cells('A2:J2')
-    ws['A2'] = f"Data de Referência: {data_filtro.strftime('%d/%m/%Y')} {'(Atual)' if usar_data_atual else '(Histórico)'}"
-    ws['A2'].font = Font(size=10)
-    ws['A2'].alignment = Alignment(horizontal='center')
+    planilha.registrar_estilo('titulo_estoque', font=Font(size=14, bold=True), alignment=Alignment(horizontal='center'))
+    planilha.registrar_estilo('subtitulo_estoque', font=Font(size=10), alignment=Alignment(horizontal='center'))
+    planilha.mesclar(ws, 'A1:J1')
+    planilha.linha(ws, [f"RELATÓRIO DE ESTOQUE - {empresa.nome_fantasia or empresa.razao_social}"], 'titulo_estoque')
+    planilha.mesclar(ws, 'A2:J2')
+    planilha.linha(ws, [f"Data de Referência: {data_filtro.strftime('%d/%m/%Y')} {'(Atual)' if usar_data_atual else '(Histórico)'}"], 'subtitulo_estoque')
+    planilha.linha(ws)
 
     # Resumo
-    ws['A4'] = "Total de Produtos:"
-    ws['B4'] = total_produtos
-    ws['D4'] = "Quantidade Total:"
-    ws['E4'] = total_quantidade
-    ws['G4'] = "Valor Total (Custo):"
-    ws['H4'] = total_valor_custo
-    ws['I4'] = "Valor Total (Venda):"
-    ws['J4'] = total_valor_venda
-
-    for cell in ['A4', 'D4', 'G4', 'I4']:
-        ws[cell].font = Font(bold=True)
+    planilha.linha(ws, [
+        "Total de Produtos:", total_produtos, None,
+        "Quantidade Total:", total_quantidade, None,
+        "Valor Total (Custo):", total_valor_custo,
+        "Valor Total (Venda):", total_valor_venda
+    ], {1: 'negrito', 4: 'negrito', 7: 'negrito', 9: 'negrito'})
+    planilha.linha(ws)
 
     # Cabeçalho da tabela
     headers = ['Produto', 'Descrição', 'Qtd. Estoque', 'Qtd. Compras', 'P. Custo Unit.',
                'P. Médio Compra', 'P. Venda', 'Margem (%)', 'Vlr. Est. (Custo)', 'Vlr. Est. (Venda)']
-
-    for col, header in enumerate(headers, start=1):
-        cell = ws.cell(row=6, column=col)
-        cell.value = header
-        cell.font = Font(bold=True, color='FFFFFF')
-        cell.fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-        cell.alignment = Alignment(horizontal='center', vertical='center')
+    planilha.linha(ws, headers, planilha.estilo_cabecalho('366092'))
 
     # Dados
-    row = 7
-    for item in estoque_lista:
-        ws.cell(row=row, column=1).value = item['nome']
-        ws.cell(row=row, column=2).value = item['descricao']
-        ws.cell(row=row, column=3).value = item['estoque']
-        ws.cell(row=row, column=4).value = item['qtd_compras']
-        ws.cell(row=row, column=5).value = item['preco_custo']
-        ws.cell(row=row, column=6).value = item['preco_medio_compra']
-        ws.cell(row=row, column=7).value = item['preco_venda']
-        ws.cell(row=row, column=8).value = round(item['margem'], 2)
-        ws.cell(row=row, column=9).value = item['valor_estoque_custo']
-        ws.cell(row=row, column=10).value = item['valor_estoque']
-
-        # Alinhamento
-        for col in [3, 4, 5, 6, 7, 8, 9, 10]:
-            ws.cell(row=row, column=col).alignment = Alignment(horizontal='right')
-
-        # Formato de moeda
-        for col in [5, 6, 7, 9, 10]:
-            ws.cell(row=row, column=col).number_format = 'R$ #,##0.00'
-
-        row += 1
+    numero = planilha.registrar_estilo('numero_direita', alignment=Alignment(horizontal='right'))
+    moeda = planilha.registrar_estilo('moeda_direita', alignment=Alignment(horizontal='right'), number_format=PlanilhaStreaming.MOEDA)
+    planilha.linhas(ws, (
+        [
+            item['nome'],
+            item['descricao'],
+            item['estoque'],
+            item['qtd_compras'],
+            item['preco_custo'],
+            item['preco_medio_compra'],
+            item['preco_venda'],
+            round(item['margem'], 2),
+            item['valor_estoque_custo'],
+            item['valor_estoque'],
+        ]
+        for item in estoque_lista
+    ), {3: numero, 4: numero, 5: moeda, 6: moeda, 7: moeda, 8: numero, 9: moeda, 10: moeda})
 
     # Linha de total
-    ws.cell(row=row, column=1).value = "TOTAL GERAL"
-    ws.cell(row=row, column=1).font = Font(bold=True)
-    ws.cell(row=row, column=3).value = total_quantidade
-    ws.cell(row=row, column=8).value = round(total_margem, 2)
-    ws.cell(row=row, column=9).value = total_valor_custo
-    ws.cell(row=row, column=10).value = total_valor_venda
-
-    for col in [1, 3, 8, 9, 10]:
-        ws.cell(row=row, column=col).font = Font(bold=True)
-
-    for col in [9, 10]:
-        ws.cell(row=row, column=col).number_format = 'R$ #,##0.00'
-
-    # Ajustar largura das colunas
-    ws.column_dimensions['A'].width = 30
-    ws.column_dimensions['B'].width = 40
-    ws.column_dimensions['C'].width = 15
-    ws.column_dimensions['D'].width = 15
-    ws.column_dimensions['E'].width = 15
-    ws.column_dimensions['F'].width = 18
-    ws.column_dimensions['G'].width = 15
-    ws.column_dimensions['H'].width = 12
-    ws.column_dimensions['I'].width = 20
-    ws.column_dimensions['J'].width = 20
-
-    # Salvar em BytesIO
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
+    planilha.linha(ws, [
+        "TOTAL GERAL", None, total_quantidade, None, None, None, None,
+        round(total_margem, 2), total_valor_custo, total_valor_venda
+    ], {1: 'negrito', 3: 'negrito', 8: 'negrito', 9: 'moeda_negrito', 10: 'moeda_negrito'})
 
     filename = f"relatorio_estoque_{data_filtro.strftime('%Y%m%d')}.xlsx"
 
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return planilha.enviar(filename)
 
 @app.route('/relatorios/fornecedores')
 def relatorio_fornecedores():
@@ -11564,6 +14098,7 @@ def criar_permissoes_padrao(usuario_id):
             )
             db.session.add(permissao)
     
+    registrar_alteracao_permissoes('usuario', [usuario_id])
     db.session.commit()
 
 def criar_permissoes_por_categoria(usuario_id, categoria_id):
@@ -11586,6 +14121,7 @@ def criar_permissoes_por_categoria(usuario_id, categoria_id):
         )
         db.session.add(permissao)
     
+    registrar_alteracao_permissoes('usuario', [usuario_id])
     db.session.commit()
 
 def atualizar_permissoes_usuario(usuario_id, permissoes_dict):
@@ -11607,6 +14143,7 @@ def atualizar_permissoes_usuario(usuario_id, permissoes_dict):
             )
             db.session.add(permissao)
     
+    registrar_alteracao_permissoes('usuario', [usuario_id])
     db.session.commit()
 
 def obter_permissoes_usuario(usuario_id):
@@ -11796,6 +14333,7 @@ def editar_categoria_usuario(categoria_id):
                     )
                     db.session.add(permissao)
         
+        registrar_alteracao_permissoes('categoria', [categoria.id])
         db.session.commit()
         
         # Sincronizar permissões para todos os usuários desta categoria
@@ -11852,6 +14390,7 @@ def deletar_categoria_usuario(categoria_id):
     
     # Desativar permissões da categoria
     PermissaoCategoria.query.filter_by(categoria_id=categoria.id).update({'ativo': False})
+    registrar_alteracao_permissoes('categoria', [categoria.id])
     
     db.session.commit()
     flash('Categoria removida com sucesso!', 'success')
@@ -12151,22 +14690,20 @@ def admin_recalcular_saldos():
 
     if request.method == 'POST':
         try:
-            # Buscar todas as contas caixa
+            # Conferir e reconstruir o snapshot diário a partir dos lançamentos realizados
+            divergencias = verificar_saldos_contas_caixa()
+            if divergencias:
+                app.logger.info(f"💰 {len(divergencias)} divergência(s) no snapshot de saldos - reconstruindo")
+            reconstruir_saldos_contas_caixa()
+
             contas = ContaCaixa.query.all()
+            saldos_realizados = saldos_contas_caixa_ate([conta.id for conta in contas])
             contas_atualizadas = 0
 
             for conta in contas:
-                # Buscar todos os lançamentos REALIZADOS desta conta
-                lancamentos_realizados = Lancamento.query.filter_by(
-                    conta_caixa_id=conta.id,
-                    realizado=True
-                ).all()
-
                 # Calcular saldo: saldo_inicial + entradas - saidas
-                total_entradas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'entrada'])
-                total_saidas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'saida'])
-
-                saldo_calculado = conta.saldo_inicial + total_entradas - total_saidas
+                total_entradas, total_saidas = saldos_realizados.get(conta.id, (0.0, 0.0))
+                saldo_calculado = (conta.saldo_inicial or 0) + total_entradas - total_saidas
 
                 # Atualizar apenas se houver diferença
                 if abs(conta.saldo_atual - saldo_calculado) > 0.01:  # Tolerância de 1 centavo
@@ -12190,18 +14727,16 @@ def admin_recalcular_saldos():
 
     # GET: Mostrar página com informações das contas
     contas = ContaCaixa.query.all()
+    saldos_realizados = saldos_contas_caixa_ate([conta.id for conta in contas])
+    quantidades = dict(db.session.query(Lancamento.conta_caixa_id, db.func.count(Lancamento.id)).filter(
+        Lancamento.realizado == True,
+        Lancamento.conta_caixa_id.isnot(None)
+    ).group_by(Lancamento.conta_caixa_id).all())
     informacoes_contas = []
 
     for conta in contas:
-        # Buscar lançamentos realizados
-        lancamentos_realizados = Lancamento.query.filter_by(
-            conta_caixa_id=conta.id,
-            realizado=True
-        ).all()
-
-        total_entradas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'entrada'])
-        total_saidas = sum([l.valor for l in lancamentos_realizados if l.tipo == 'saida'])
-        saldo_calculado = conta.saldo_inicial + total_entradas - total_saidas
+        total_entradas, total_saidas = saldos_realizados.get(conta.id, (0.0, 0.0))
+        saldo_calculado = (conta.saldo_inicial or 0) + total_entradas - total_saidas
 
         diferenca = conta.saldo_atual - saldo_calculado
 
@@ -12212,7 +14747,7 @@ def admin_recalcular_saldos():
             'diferenca': diferenca,
             'total_entradas': total_entradas,
             'total_saidas': total_saidas,
-            'qtd_lancamentos': len(lancamentos_realizados)
+            'qtd_lancamentos': quantidades.get(conta.id, 0)
         })
 
     return render_template('admin_recalcular_saldos.html', informacoes_contas=informacoes_contas)
@@ -12488,6 +15023,11 @@ def editar_venda(venda_id):
                     num_lancamentos = len(lancamentos_vinculados)
                     valor_por_parcela = venda.valor_final / num_lancamentos
 
+                    # Itens do carrinho ficam na parcela que já os guardava (a primeira)
+                    import json
+                    portador_itens = next((l for l in lancamentos_vinculados if l.itens_carrinho), lancamentos_vinculados[0])
+                    portador_itens.itens_carrinho = json.dumps(itens_validos, ensure_ascii=False)
+
                     for i, lanc in enumerate(lancamentos_vinculados, 1):
                         lanc.descricao = f'{venda.cliente.nome if venda.cliente else "Cliente"} - {venda.produto} - Parcela {i}/{num_lancamentos}'
                         lanc.valor = valor_por_parcela
@@ -12807,6 +15347,11 @@ def editar_compra(compra_id):
                     num_lancamentos = len(lancamentos_vinculados)
                     valor_por_parcela = compra.valor / num_lancamentos
 
+                    # Itens do carrinho ficam na parcela que já os guardava (a primeira)
+                    import json
+                    portador_itens = next((l for l in lancamentos_vinculados if l.itens_carrinho), lancamentos_vinculados[0])
+                    portador_itens.itens_carrinho = json.dumps(itens_validos, ensure_ascii=False)
+
                     for i, lanc in enumerate(lancamentos_vinculados, 1):
                         lanc.descricao = f'{compra.fornecedor.nome if compra.fornecedor else "Fornecedor"} - {compra.produto} - Parcela {i}/{num_lancamentos}'
                         lanc.valor = valor_por_parcela
@@ -13657,28 +16202,35 @@ def importacao_ofx():
         flash('Por favor, envie um arquivo no formato .ofx', 'error')
         return redirect(request.url)
 
-    if OfxParser is None:
-        flash('Erro no sistema: biblioteca ofxparse não está instalada.', 'error')
-        return redirect(request.url)
-
     conta_caixa_id_selecionada = request.form.get('conta_caixa_id', type=int)
 
     try:
-        ofx = OfxParser.parse(file)
-        statement = ofx.account.statement
+        # Leitura em streaming com matching por lote (ver conciliacao())
+        leitor = LeitorOfx(file)
+        conciliador = ConciliadorOfx.da_empresa(empresa_id)
+        transacoes_ofx = []
+        for lote in leitor.lotes():
+            transacoes_ofx.extend(lote)
+            conciliador.adicionar(lote)
 
         # Carregar regras de conciliação para sugestão automática
-        regras_empresa = []
+        indice_regras = IndiceRegrasConciliacao([])
         try:
-            regras_empresa = ConciliacaoRegra.query.filter_by(empresa_id=empresa_id).all()
+            indice_regras = IndiceRegrasConciliacao.da_empresa(empresa_id)
         except Exception:
             db.session.rollback()
 
         # Dicionário rápido categoria_id → nome para evitar queries em loop
         cat_nomes = {str(cat.id): cat.nome for cat in categorias}
 
+        # Lançamentos já existentes para as transações (mesmo matching da conciliação, janela de ±15 dias)
+        matches_existentes = []
+        if leitor.quantidade:
+            matches_existentes = conciliador.resultado(leitor.data_minima - timedelta(days=15),
+                                                       leitor.data_maxima + timedelta(days=15))
+
         ofx_items = []
-        for tx in statement.transactions:
+        for tx, (lanc_existente, _score) in zip(transacoes_ofx, matches_existentes):
             tx_amount = float(tx.amount)
             tipo = 'entrada' if tx_amount >= 0 else 'saida'
             valor = abs(tx_amount)
@@ -13689,17 +16241,7 @@ def importacao_ofx():
             fitid = tx.id or ''
 
             # Sugestão automática via ConciliacaoRegra
-            regra_sugerida = None
-            if regras_empresa and memo:
-                best_score = 0
-                best_regra = None
-                for regra in regras_empresa:
-                    s = regra.score_match(memo)
-                    if s > best_score:
-                        best_score = s
-                        best_regra = regra
-                if best_score >= 30:
-                    regra_sugerida = best_regra
+            regra_sugerida = indice_regras.sugerir(memo) if indice_regras else None
 
             ofx_items.append({
                 'fitid': fitid,
@@ -13713,7 +16255,12 @@ def importacao_ofx():
                     'categoria_nome': cat_nomes.get(str(regra_sugerida.categoria_id), ''),
                     'cliente_id': regra_sugerida.cliente_id,
                     'fornecedor_id': regra_sugerida.fornecedor_id,
-                } if regra_sugerida else None
+                } if regra_sugerida else None,
+                'lancamento_existente': {
+                    'id': lanc_existente.id,
+                    'descricao': lanc_existente.descricao,
+                    'data_br': lanc_existente.data_prevista.strftime('%d/%m/%Y'),
+                } if lanc_existente else None
             })
 
         flash(f'Arquivo OFX processado: {len(ofx_items)} transação(ões) encontrada(s).', 'success')
@@ -13877,8 +16424,9 @@ def importacao_ofx_gerar():
 
 
 @app.route('/api/backup/exportar-geral', methods=['GET'])
+@em_segundo_plano('backup', max_tentativas=3)
 def api_exportar_backup_geral():
-    """Exporta backup completo de todos os dados em CSV"""
+    """Exporta backup completo de todos os dados em Excel (uma aba por cadastro)"""
     if 'usuario_id' not in session:
         return jsonify({'error': 'Usuário não autenticado'}), 401
     
@@ -13887,54 +16435,27 @@ def api_exportar_backup_geral():
         return jsonify({'error': 'Usuário não encontrado'}), 403
     
     try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        from openpyxl.utils import get_column_letter
-        import io
-        from datetime import datetime
-        
-        # Criar workbook
-        wb = Workbook()
-        wb.remove(wb.active)  # Remover planilha padrão
+        lote = app.config['EXPORTACAO_TAMANHO_LOTE']
+        planilha = PlanilhaStreaming()
+        moeda = 'moeda'
         
         # Buscar todos os usuários da empresa
         empresa_id = obter_empresa_id_sessao(session, usuario)
 
-        usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-        usuarios_ids = [u.id for u in usuarios_empresa]
+        usuarios_ids = [u.id for u in Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()]
         
         # ===== ABA 1: RESUMO GERAL =====
-        ws_resumo = wb.create_sheet("📊 RESUMO GERAL", 0)
+        ws_resumo = planilha.aba("📊 RESUMO GERAL", [25, 20])
         
-        # Estilos
-        titulo_font = Font(name='Arial', size=16, bold=True, color="FFFFFF")
-        titulo_fill = PatternFill(start_color="2F5597", end_color="2F5597", fill_type="solid")
-        titulo_align = Alignment(horizontal="center", vertical="center")
-        
-        subtitulo_font = Font(name='Arial', size=12, bold=True, color="FFFFFF")
-        subtitulo_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        subtitulo_align = Alignment(horizontal="left", vertical="center")
-        
-        texto_font = Font(name='Arial', size=10)
-        texto_align = Alignment(horizontal="left", vertical="center")
-        
-        # Título principal
-        ws_resumo.merge_cells('A1:F1')
-        cell_titulo = ws_resumo.cell(row=1, column=1, value=f"BACKUP COMPLETO - {usuario.empresa.razao_social if usuario.empresa else 'Sistema'}")
-        cell_titulo.font = titulo_font
-        cell_titulo.fill = titulo_fill
-        cell_titulo.alignment = titulo_align
-        
-        # Data do backup
-        ws_resumo.merge_cells('A2:F2')
-        cell_data = ws_resumo.cell(row=2, column=1, value=f"Gerado em: {datetime.now().strftime('%d/%m/%Y às %H:%M:%S')}")
-        cell_data.font = texto_font
-        cell_data.alignment = Alignment(horizontal="center", vertical="center")
+        # Título principal e data do backup
+        planilha.mesclar(ws_resumo, 'A1:F1')
+        planilha.linha(ws_resumo, [f"BACKUP COMPLETO - {usuario.empresa.razao_social if usuario.empresa else 'Sistema'}"], 'titulo')
+        planilha.mesclar(ws_resumo, 'A2:F2')
+        planilha.linha(ws_resumo, [f"Gerado em: {datetime.now().strftime('%d/%m/%Y às %H:%M:%S')}"], 'centralizado')
+        planilha.linha(ws_resumo)
         
         # Estatísticas gerais
-        ws_resumo.cell(row=4, column=1, value="ESTATÍSTICAS GERAIS").font = subtitulo_font
-        ws_resumo.cell(row=4, column=1).fill = subtitulo_fill
-        ws_resumo.cell(row=4, column=1).alignment = subtitulo_align
+        planilha.linha(ws_resumo, ["ESTATÍSTICAS GERAIS"], 'subtitulo')
         
         # Contar registros
         total_lancamentos = Lancamento.query.filter(Lancamento.empresa_id == empresa_id).count()
@@ -13946,20 +16467,14 @@ def api_exportar_backup_geral():
         total_produtos = Produto.query.filter(Produto.usuario_id.in_(usuarios_ids)).count()
         
         # Calcular totais financeiros
-        lancamentos_receita = Lancamento.query.filter(
-            Lancamento.empresa_id == empresa_id,
-            Lancamento.tipo == 'entrada',
-            Lancamento.realizado == True
-        ).all()
-        total_entradas = sum(l.valor for l in lancamentos_receita)
-        
-        lancamentos_despesa = Lancamento.query.filter(
+        totais_realizados = dict(db.session.query(
+            Lancamento.tipo, db.func.coalesce(db.func.sum(Lancamento.valor), 0)
+        ).filter(
             Lancamento.empresa_id == empresa_id,
-            Lancamento.tipo == 'saida',
             Lancamento.realizado == True
-        ).all()
-        total_saidas = sum(l.valor for l in lancamentos_despesa)
-        
+        ).group_by(Lancamento.tipo).all())
+        total_entradas = totais_realizados.get('entrada', 0)
+        total_saidas = totais_realizados.get('saida', 0)
         saldo_geral = total_entradas - total_saidas
         
         # Adicionar estatísticas
@@ -13977,346 +16492,177 @@ def api_exportar_backup_geral():
             ("SALDO GERAL", f"R$ {saldo_geral:,.2f}")
         ]
         
-        for i, (descricao, valor) in enumerate(stats, 5):
-            ws_resumo.cell(row=i, column=1, value=descricao).font = texto_font
-            ws_resumo.cell(row=i, column=2, value=valor).font = texto_font
-            if descricao.startswith("TOTAL") or descricao.startswith("SALDO"):
-                ws_resumo.cell(row=i, column=1).font = Font(name='Arial', size=10, bold=True)
-                ws_resumo.cell(row=i, column=2).font = Font(name='Arial', size=10, bold=True)
-        
-        # Ajustar larguras
-        ws_resumo.column_dimensions['A'].width = 25
-        ws_resumo.column_dimensions['B'].width = 20
+        for descricao, valor in stats:
+            destaque = descricao.startswith("TOTAL") or descricao.startswith("SALDO")
+            planilha.linha(ws_resumo, [descricao, valor], 'negrito' if destaque else None)
         
         # ===== ABA 2: LANÇAMENTOS FINANCEIROS =====
-        ws_lancamentos = wb.create_sheet("💰 LANÇAMENTOS")
-        
-        # Cabeçalhos
-        headers_lancamentos = [
-            'ID', 'Descrição', 'Valor', 'Tipo', 'Categoria', 'Data Prevista', 
+        ws_lancamentos = planilha.aba("💰 LANÇAMENTOS", [8, 30, 12, 10, 15, 12, 12, 8, 18, 20, 20, 25, 15, 20, 20], 'A2')
+        planilha.linha(ws_lancamentos, [
+            'ID', 'Descrição', 'Valor', 'Tipo', 'Categoria', 'Data Prevista',
             'Data Realizada', 'Realizado', 'Conta Caixa', 'Cliente', 'Fornecedor',
-            'Observações', 'Tags', 'Centro Custo', 'Projeto', 'Documento', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_lancamentos, 1):
-            cell = ws_lancamentos.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="2F5597", end_color="2F5597", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar lançamentos
-        lancamentos = Lancamento.query.filter(Lancamento.empresa_id == empresa_id).order_by(Lancamento.data_prevista.desc()).all()
-        
-        for row, lancamento in enumerate(lancamentos, 2):
-            ws_lancamentos.cell(row=row, column=1, value=lancamento.id)
-            ws_lancamentos.cell(row=row, column=2, value=lancamento.descricao)
-            ws_lancamentos.cell(row=row, column=3, value=lancamento.valor)
-            ws_lancamentos.cell(row=row, column=4, value=lancamento.tipo.upper())
-            ws_lancamentos.cell(row=row, column=5, value=lancamento.categoria)
-            ws_lancamentos.cell(row=row, column=6, value=lancamento.data_prevista.strftime('%d/%m/%Y') if lancamento.data_prevista else '')
-            ws_lancamentos.cell(row=row, column=7, value=lancamento.data_realizada.strftime('%d/%m/%Y') if lancamento.data_realizada else '')
-            ws_lancamentos.cell(row=row, column=8, value='SIM' if lancamento.realizado else 'NÃO')
-            ws_lancamentos.cell(row=row, column=9, value=lancamento.conta_caixa.nome if lancamento.conta_caixa else '')
-            ws_lancamentos.cell(row=row, column=10, value=lancamento.cliente.nome if lancamento.cliente else '')
-            ws_lancamentos.cell(row=row, column=11, value=lancamento.fornecedor.nome if lancamento.fornecedor else '')
-            ws_lancamentos.cell(row=row, column=12, value=lancamento.observacoes or '')
-            ws_lancamentos.cell(row=row, column=13, value=lancamento.tags or '')
-            ws_lancamentos.cell(row=row, column=14, value=lancamento.centro_custo or '')
-            ws_lancamentos.cell(row=row, column=15, value=lancamento.projeto or '')
-            ws_lancamentos.cell(row=row, column=16, value=lancamento.documento or '')
-            ws_lancamentos.cell(row=row, column=17, value=lancamento.usuario.nome)
-            
-            # Formatação de valor
-            ws_lancamentos.cell(row=row, column=3).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_lancamentos = [8, 30, 12, 10, 15, 12, 12, 8, 18, 20, 20, 25, 20, 15, 15, 15, 20]
-        for col, width in enumerate(column_widths_lancamentos, 1):
-            ws_lancamentos.column_dimensions[get_column_letter(col)].width = width
-        
-        # Congelar primeira linha
-        ws_lancamentos.freeze_panes = 'A2'
+            'Observações', 'Nota Fiscal', 'Produto/Serviço', 'Usuário'
+        ], planilha.estilo_cabecalho('2F5597'))
+        
+        lancamentos = db.session.query(
+            Lancamento.id, Lancamento.descricao, Lancamento.valor, Lancamento.tipo, Lancamento.categoria,
+            Lancamento.data_prevista, Lancamento.data_realizada, Lancamento.realizado,
+            ContaCaixa.nome, Cliente.nome, Fornecedor.nome, Lancamento.observacoes,
+            Lancamento.nota_fiscal, Lancamento.produto_servico, Usuario.nome
+        ).outerjoin(ContaCaixa, Lancamento.conta_caixa_id == ContaCaixa.id).outerjoin(
+            Cliente, Lancamento.cliente_id == Cliente.id
+        ).outerjoin(Fornecedor, Lancamento.fornecedor_id == Fornecedor.id).outerjoin(
+            Usuario, Lancamento.usuario_id == Usuario.id
+        ).filter(Lancamento.empresa_id == empresa_id).order_by(Lancamento.data_prevista.desc()).yield_per(lote)
+        
+        planilha.linhas(ws_lancamentos, (
+            [
+                l_id, descricao, valor, (tipo or '').upper(), categoria,
+                data_prevista.strftime('%d/%m/%Y') if data_prevista else '',
+                data_realizada.strftime('%d/%m/%Y') if data_realizada else '',
+                'SIM' if realizado else 'NÃO',
+                conta or '', cliente or '', fornecedor or '', observacoes or '',
+                nota_fiscal or '', produto_servico or '', usuario_nome or ''
+            ]
+            for (l_id, descricao, valor, tipo, categoria, data_prevista, data_realizada, realizado,
+                 conta, cliente, fornecedor, observacoes, nota_fiscal, produto_servico, usuario_nome) in lancamentos
+        ), {3: moeda})
         
         # ===== ABA 3: VENDAS =====
-        ws_vendas = wb.create_sheet("🛒 VENDAS")
-        
-        headers_vendas = [
-            'ID', 'Produto', 'Quantidade', 'Preço Unitário', 'Preço Total', 
+        ws_vendas = planilha.aba("🛒 VENDAS", [8, 30, 12, 15, 15, 12, 20, 8, 12, 25, 20], 'A2')
+        planilha.linha(ws_vendas, [
+            'ID', 'Produto', 'Quantidade', 'Preço Unitário', 'Preço Total',
             'Tipo Venda', 'Cliente', 'Realizado', 'Data Realizada', 'Observações', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_vendas, 1):
-            cell = ws_vendas.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar vendas
-        vendas = Venda.query.filter(Venda.empresa_id == empresa_id).order_by(Venda.data_criacao.desc()).all()
-        
-        for row, venda in enumerate(vendas, 2):
-            ws_vendas.cell(row=row, column=1, value=venda.id)
-            ws_vendas.cell(row=row, column=2, value=venda.produto)
-            ws_vendas.cell(row=row, column=3, value=venda.quantidade)
-            ws_vendas.cell(row=row, column=4, value=venda.preco_unitario)
-            ws_vendas.cell(row=row, column=5, value=venda.preco_total)
-            ws_vendas.cell(row=row, column=6, value=venda.tipo_venda.upper())
-            ws_vendas.cell(row=row, column=7, value=venda.cliente.nome if venda.cliente else '')
-            ws_vendas.cell(row=row, column=8, value='SIM' if venda.realizado else 'NÃO')
-            ws_vendas.cell(row=row, column=9, value=venda.data_realizada.strftime('%d/%m/%Y') if venda.data_realizada else '')
-            ws_vendas.cell(row=row, column=10, value=venda.observacoes or '')
-            ws_vendas.cell(row=row, column=11, value=venda.usuario.nome)
-            
-            # Formatação de valores
-            ws_vendas.cell(row=row, column=4).number_format = 'R$ #,##0.00'
-            ws_vendas.cell(row=row, column=5).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_vendas = [8, 30, 12, 15, 15, 12, 20, 8, 12, 25, 20]
-        for col, width in enumerate(column_widths_vendas, 1):
-            ws_vendas.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_vendas.freeze_panes = 'A2'
+        ], planilha.estilo_cabecalho('28A745'))
+        
+        vendas = db.session.query(
+            Venda.id, Venda.produto, Venda.quantidade, Venda.valor, Venda.valor_final, Venda.tipo_venda,
+            Cliente.nome, Venda.realizado, Venda.data_realizada, Venda.observacoes, Usuario.nome
+        ).outerjoin(Cliente, Venda.cliente_id == Cliente.id).outerjoin(
+            Usuario, Venda.usuario_id == Usuario.id
+        ).filter(Venda.empresa_id == empresa_id).order_by(Venda.data_criacao.desc()).yield_per(lote)
+        
+        # Venda.valor é o total da venda; valor_final é o total depois do desconto
+        planilha.linhas(ws_vendas, (
+            [
+                v_id, produto, quantidade,
+                (valor or 0) / quantidade if quantidade else (valor or 0),
+                valor_final if valor_final is not None else (valor or 0),
+                (tipo_venda or '').upper(), cliente or '',
+                'SIM' if realizado else 'NÃO',
+                data_realizada.strftime('%d/%m/%Y') if data_realizada else '',
+                observacoes or '', usuario_nome or ''
+            ]
+            for (v_id, produto, quantidade, valor, valor_final, tipo_venda, cliente,
+                 realizado, data_realizada, observacoes, usuario_nome) in vendas
+        ), {4: moeda, 5: moeda})
         
         # ===== ABA 4: COMPRAS =====
-        ws_compras = wb.create_sheet("🛍️ COMPRAS")
-        
-        headers_compras = [
-            'ID', 'Produto', 'Quantidade', 'Preço Unitário', 'Preço Total', 
+        ws_compras = planilha.aba("🛍️ COMPRAS", [8, 30, 12, 15, 15, 12, 20, 8, 12, 25, 20], 'A2')
+        planilha.linha(ws_compras, [
+            'ID', 'Produto', 'Quantidade', 'Preço Unitário', 'Preço Total',
             'Tipo Compra', 'Fornecedor', 'Realizado', 'Data Realizada', 'Observações', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_compras, 1):
-            cell = ws_compras.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="FFC107", end_color="FFC107", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar compras
-        compras = Compra.query.filter(Compra.empresa_id == empresa_id).order_by(Compra.data_criacao.desc()).all()
-        
-        for row, compra in enumerate(compras, 2):
-            ws_compras.cell(row=row, column=1, value=compra.id)
-            ws_compras.cell(row=row, column=2, value=compra.produto)
-            ws_compras.cell(row=row, column=3, value=compra.quantidade)
-            ws_compras.cell(row=row, column=4, value=compra.preco_unitario)
-            ws_compras.cell(row=row, column=5, value=compra.preco_total)
-            ws_compras.cell(row=row, column=6, value=compra.tipo_compra.upper())
-            ws_compras.cell(row=row, column=7, value=compra.fornecedor.nome if compra.fornecedor else '')
-            ws_compras.cell(row=row, column=8, value='SIM' if compra.realizado else 'NÃO')
-            ws_compras.cell(row=row, column=9, value=compra.data_realizada.strftime('%d/%m/%Y') if compra.data_realizada else '')
-            ws_compras.cell(row=row, column=10, value=compra.observacoes or '')
-            ws_compras.cell(row=row, column=11, value=compra.usuario.nome)
-            
-            # Formatação de valores
-            ws_compras.cell(row=row, column=4).number_format = 'R$ #,##0.00'
-            ws_compras.cell(row=row, column=5).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_compras = [8, 30, 12, 15, 15, 12, 20, 8, 12, 25, 20]
-        for col, width in enumerate(column_widths_compras, 1):
-            ws_compras.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_compras.freeze_panes = 'A2'
+        ], planilha.estilo_cabecalho('FFC107'))
+        
+        compras = db.session.query(
+            Compra.id, Compra.produto, Compra.quantidade, Compra.preco_custo, Compra.valor, Compra.tipo_compra,
+            Fornecedor.nome, Compra.realizado, Compra.data_realizada, Compra.observacoes, Usuario.nome
+        ).outerjoin(Fornecedor, Compra.fornecedor_id == Fornecedor.id).outerjoin(
+            Usuario, Compra.usuario_id == Usuario.id
+        ).filter(Compra.empresa_id == empresa_id).order_by(Compra.data_criacao.desc()).yield_per(lote)
+        
+        planilha.linhas(ws_compras, (
+            [
+                c_id, produto, quantidade,
+                preco_custo if preco_custo is not None else ((valor or 0) / quantidade if quantidade else (valor or 0)),
+                valor or 0,
+                (tipo_compra or '').upper(), fornecedor or '',
+                'SIM' if realizado else 'NÃO',
+                data_realizada.strftime('%d/%m/%Y') if data_realizada else '',
+                observacoes or '', usuario_nome or ''
+            ]
+            for (c_id, produto, quantidade, preco_custo, valor, tipo_compra, fornecedor,
+                 realizado, data_realizada, observacoes, usuario_nome) in compras
+        ), {4: moeda, 5: moeda})
         
         # ===== ABA 5: CONTAS CAIXA =====
-        ws_contas = wb.create_sheet("🏦 CONTAS CAIXA")
-        
-        headers_contas = [
-            'ID', 'Nome', 'Tipo', 'Saldo Atual', 'Ativo', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_contas, 1):
-            cell = ws_contas.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="17A2B8", end_color="17A2B8", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar contas caixa
-        contas = ContaCaixa.query.filter(ContaCaixa.usuario_id.in_(usuarios_ids)).all()
-        
-        for row, conta in enumerate(contas, 2):
-            ws_contas.cell(row=row, column=1, value=conta.id)
-            ws_contas.cell(row=row, column=2, value=conta.nome)
-            ws_contas.cell(row=row, column=3, value=conta.tipo.upper())
-            ws_contas.cell(row=row, column=4, value=conta.saldo_atual)
-            ws_contas.cell(row=row, column=5, value='SIM' if conta.ativo else 'NÃO')
-            ws_contas.cell(row=row, column=6, value=conta.usuario.nome)
-            
-            # Formatação de saldo
-            ws_contas.cell(row=row, column=4).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_contas = [8, 25, 12, 15, 8, 20]
-        for col, width in enumerate(column_widths_contas, 1):
-            ws_contas.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_contas.freeze_panes = 'A2'
-        
-        # ===== ABA 6: CLIENTES =====
-        ws_clientes = wb.create_sheet("👥 CLIENTES")
-        
-        headers_clientes = [
-            'ID', 'Nome', 'Email', 'Telefone', 'Endereço', 'CPF/CNPJ', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_clientes, 1):
-            cell = ws_clientes.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="6F42C1", end_color="6F42C1", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar clientes
-        clientes = Cliente.query.filter(Cliente.empresa_id == empresa_id).all()
-        
-        for row, cliente in enumerate(clientes, 2):
-            ws_clientes.cell(row=row, column=1, value=cliente.id)
-            ws_clientes.cell(row=row, column=2, value=cliente.nome)
-            ws_clientes.cell(row=row, column=3, value=cliente.email or '')
-            ws_clientes.cell(row=row, column=4, value=cliente.telefone or '')
-            ws_clientes.cell(row=row, column=5, value=cliente.endereco or '')
-            ws_clientes.cell(row=row, column=6, value=cliente.cpf_cnpj or '')
-            ws_clientes.cell(row=row, column=7, value=cliente.usuario.nome)
-        
-        # Ajustar larguras
-        column_widths_clientes = [8, 30, 25, 15, 30, 18, 20]
-        for col, width in enumerate(column_widths_clientes, 1):
-            ws_clientes.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_clientes.freeze_panes = 'A2'
-        
-        # ===== ABA 7: FORNECEDORES =====
-        ws_fornecedores = wb.create_sheet("🏭 FORNECEDORES")
-        
-        headers_fornecedores = [
-            'ID', 'Nome', 'Email', 'Telefone', 'Endereço', 'CPF/CNPJ', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_fornecedores, 1):
-            cell = ws_fornecedores.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="DC3545", end_color="DC3545", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar fornecedores
-        fornecedores = Fornecedor.query.filter(Fornecedor.empresa_id == empresa_id).all()
-        
-        for row, fornecedor in enumerate(fornecedores, 2):
-            ws_fornecedores.cell(row=row, column=1, value=fornecedor.id)
-            ws_fornecedores.cell(row=row, column=2, value=fornecedor.nome)
-            ws_fornecedores.cell(row=row, column=3, value=fornecedor.email or '')
-            ws_fornecedores.cell(row=row, column=4, value=fornecedor.telefone or '')
-            ws_fornecedores.cell(row=row, column=5, value=fornecedor.endereco or '')
-            ws_fornecedores.cell(row=row, column=6, value=fornecedor.cpf_cnpj or '')
-            ws_fornecedores.cell(row=row, column=7, value=fornecedor.usuario.nome)
-        
-        # Ajustar larguras
-        column_widths_fornecedores = [8, 30, 25, 15, 30, 18, 20]
-        for col, width in enumerate(column_widths_fornecedores, 1):
-            ws_fornecedores.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_fornecedores.freeze_panes = 'A2'
-        
-        # ===== ABA 6: PRODUTOS/ESTOQUE =====
-        ws_produtos = wb.create_sheet("📦 PRODUTOS/ESTOQUE")
-        
-        headers_produtos = [
-            'ID', 'Nome', 'Descrição', 'Preço Custo', 'Preço Venda', 
-            'Estoque Atual', 'Categoria', 'Data Criação', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_produtos, 1):
-            cell = ws_produtos.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="FF6B35", end_color="FF6B35", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar produtos
-        produtos = Produto.query.filter(Produto.usuario_id.in_(usuarios_ids)).order_by(Produto.nome).all()
-        
-        for row, produto in enumerate(produtos, 2):
-            ws_produtos.cell(row=row, column=1, value=produto.id)
-            ws_produtos.cell(row=row, column=2, value=produto.nome)
-            ws_produtos.cell(row=row, column=3, value=produto.descricao or '')
-            ws_produtos.cell(row=row, column=4, value=produto.preco_custo or 0)
-            ws_produtos.cell(row=row, column=5, value=produto.preco_venda or 0)
-            ws_produtos.cell(row=row, column=6, value=produto.estoque)
-            ws_produtos.cell(row=row, column=7, value=produto.categoria or '')
-            ws_produtos.cell(row=row, column=8, value=produto.data_criacao.strftime('%d/%m/%Y') if produto.data_criacao else '')
-            ws_produtos.cell(row=row, column=9, value=produto.usuario.nome)
-            
-            # Formatação de valores
-            ws_produtos.cell(row=row, column=4).number_format = 'R$ #,##0.00'
-            ws_produtos.cell(row=row, column=5).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_produtos = [8, 30, 40, 15, 15, 12, 20, 12, 20]
-        for col, width in enumerate(column_widths_produtos, 1):
-            ws_produtos.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_produtos.freeze_panes = 'A2'
-        
-        # ===== ABA 7: SALDOS DE CONTAS CAIXA =====
-        ws_saldos = wb.create_sheet("💰 SALDOS CONTAS")
+        ws_contas = planilha.aba("🏦 CONTAS CAIXA", [8, 25, 12, 15, 8, 20], 'A2')
+        planilha.linha(ws_contas, ['ID', 'Nome', 'Tipo', 'Saldo Atual', 'Ativo', 'Usuário'],
+                       planilha.estilo_cabecalho('17A2B8'))
+        
+        contas = db.session.query(
+            ContaCaixa.id, ContaCaixa.nome, ContaCaixa.tipo, ContaCaixa.saldo_atual, ContaCaixa.ativo, Usuario.nome
+        ).join(Usuario, ContaCaixa.usuario_id == Usuario.id).filter(ContaCaixa.usuario_id.in_(usuarios_ids)).yield_per(lote)
+        
+        planilha.linhas(ws_contas, (
+            [c_id, nome, (tipo or '').upper(), saldo_atual, 'SIM' if ativo else 'NÃO', usuario_nome]
+            for c_id, nome, tipo, saldo_atual, ativo, usuario_nome in contas
+        ), {4: moeda})
+        
+        # ===== ABA 6: CLIENTES / ABA 7: FORNECEDORES =====
+        for modelo, titulo_aba, cor in ((Cliente, "👥 CLIENTES", '6F42C1'), (Fornecedor, "🏭 FORNECEDORES", 'DC3545')):
+            ws_cadastro = planilha.aba(titulo_aba, [8, 30, 25, 15, 30, 18, 20], 'A2')
+            planilha.linha(ws_cadastro, ['ID', 'Nome', 'Email', 'Telefone', 'Endereço', 'CPF/CNPJ', 'Usuário'],
+                           planilha.estilo_cabecalho(cor))
+            
+            cadastros = db.session.query(
+                modelo.id, modelo.nome, modelo.email, modelo.telefone, modelo.endereco, modelo.cpf_cnpj, Usuario.nome
+            ).outerjoin(Usuario, modelo.usuario_id == Usuario.id).filter(modelo.empresa_id == empresa_id).yield_per(lote)
+            
+            planilha.linhas(ws_cadastro, (
+                [c_id, nome, email or '', telefone or '', endereco or '', cpf_cnpj or '', usuario_nome or '']
+                for c_id, nome, email, telefone, endereco, cpf_cnpj, usuario_nome in cadastros
+            ))
         
-        headers_saldos = [
-            'ID', 'Nome da Conta', 'Saldo Atual', 'Tipo', 'Descrição', 
+        # ===== ABA 8: PRODUTOS/ESTOQUE =====
+        ws_produtos = planilha.aba("📦 PRODUTOS E ESTOQUE", [8, 30, 40, 15, 15, 12, 8, 12, 20], 'A2')
+        planilha.linha(ws_produtos, [
+            'ID', 'Nome', 'Descrição', 'Preço Custo', 'Preço Venda',
+            'Estoque Atual', 'Ativo', 'Data Criação', 'Usuário'
+        ], planilha.estilo_cabecalho('FF6B35'))
+        
+        produtos = db.session.query(
+            Produto.id, Produto.nome, Produto.descricao, Produto.preco_custo, Produto.preco_venda,
+            Produto.estoque, Produto.ativo, Produto.data_criacao, Usuario.nome
+        ).join(Usuario, Produto.usuario_id == Usuario.id).filter(
+            Produto.usuario_id.in_(usuarios_ids)
+        ).order_by(Produto.nome).yield_per(lote)
+        
+        planilha.linhas(ws_produtos, (
+            [
+                p_id, nome, descricao or '', preco_custo or 0, preco_venda or 0, estoque,
+                'SIM' if ativo else 'NÃO',
+                data_criacao.strftime('%d/%m/%Y') if data_criacao else '',
+                usuario_nome
+            ]
+            for p_id, nome, descricao, preco_custo, preco_venda, estoque, ativo, data_criacao, usuario_nome in produtos
+        ), {4: moeda, 5: moeda})
+        
+        # ===== ABA 9: SALDOS DE CONTAS CAIXA =====
+        ws_saldos = planilha.aba("💰 SALDOS CONTAS", [8, 25, 15, 12, 30, 12, 8, 20], 'A2')
+        planilha.linha(ws_saldos, [
+            'ID', 'Nome da Conta', 'Saldo Atual', 'Tipo', 'Descrição',
             'Data Criação', 'Ativo', 'Usuário'
-        ]
-        
-        for col, header in enumerate(headers_saldos, 1):
-            cell = ws_saldos.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="6F42C1", end_color="6F42C1", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Buscar contas caixa
-        contas_caixa = ContaCaixa.query.filter(ContaCaixa.usuario_id.in_(usuarios_ids)).order_by(ContaCaixa.nome).all()
-        
-        for row, conta in enumerate(contas_caixa, 2):
-            ws_saldos.cell(row=row, column=1, value=conta.id)
-            ws_saldos.cell(row=row, column=2, value=conta.nome)
-            ws_saldos.cell(row=row, column=3, value=conta.saldo_atual)
-            ws_saldos.cell(row=row, column=4, value=conta.tipo or '')
-            ws_saldos.cell(row=row, column=5, value=conta.descricao or '')
-            ws_saldos.cell(row=row, column=6, value=conta.data_criacao.strftime('%d/%m/%Y') if conta.data_criacao else '')
-            ws_saldos.cell(row=row, column=7, value='SIM' if conta.ativo else 'NÃO')
-            ws_saldos.cell(row=row, column=8, value=conta.usuario.nome)
-            
-            # Formatação de saldo
-            ws_saldos.cell(row=row, column=3).number_format = 'R$ #,##0.00'
-        
-        # Ajustar larguras
-        column_widths_saldos = [8, 25, 15, 12, 30, 12, 8, 20]
-        for col, width in enumerate(column_widths_saldos, 1):
-            ws_saldos.column_dimensions[get_column_letter(col)].width = width
-        
-        ws_saldos.freeze_panes = 'A2'
-        
-        # Salvar workbook em memória com tratamento de erro
-        try:
-            output = io.BytesIO()
-            wb.save(output)
-            output.seek(0)
-            
-            # Verificar se o arquivo foi criado corretamente
-            if output.getvalue():
-                # Retornar arquivo Excel
-                from flask import send_file
-                nome_arquivo = f"backup_completo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                return send_file(
-                    output,
-                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                    as_attachment=True,
-                    download_name=nome_arquivo
-                )
-            else:
-                app.logger.error("Arquivo de backup vazio gerado")
-                return jsonify({'error': 'Erro ao gerar arquivo de backup'}), 500
-                
-        except Exception as save_error:
-            app.logger.error(f"Erro ao salvar workbook: {str(save_error)}")
-            return jsonify({'error': 'Erro ao salvar arquivo de backup'}), 500
+        ], planilha.estilo_cabecalho('6F42C1'))
+        
+        contas_caixa = db.session.query(
+            ContaCaixa.id, ContaCaixa.nome, ContaCaixa.saldo_atual, ContaCaixa.tipo, ContaCaixa.descricao,
+            ContaCaixa.data_criacao, ContaCaixa.ativo, Usuario.nome
+        ).join(Usuario, ContaCaixa.usuario_id == Usuario.id).filter(
+            ContaCaixa.usuario_id.in_(usuarios_ids)
+        ).order_by(ContaCaixa.nome).yield_per(lote)
+        
+        planilha.linhas(ws_saldos, (
+            [
+                c_id, nome, saldo_atual, tipo or '', descricao or '',
+                data_criacao.strftime('%d/%m/%Y') if data_criacao else '',
+                'SIM' if ativo else 'NÃO', usuario_nome
+            ]
+            for c_id, nome, saldo_atual, tipo, descricao, data_criacao, ativo, usuario_nome in contas_caixa
+        ), {3: moeda})
+        
+        nome_arquivo = f"backup_completo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        return planilha.enviar(nome_arquivo)
         
     except Exception as e:
         app.logger.error(f"Erro ao exportar backup geral: {str(e)}")
@@ -14427,6 +16773,482 @@ def api_exportar_modelo():
         app.logger.error(f"Erro ao exportar modelo: {str(e)}")
         return jsonify({'error': 'Erro ao gerar modelo'}), 500
 
+# ===== LEITURA DE PLANILHAS DE IMPORTAÇÃO =====
+
+# Mapear títulos da planilha para nomes internos (demais títulos viram maiúsculas)
+MAPEAMENTO_CABECALHOS_IMPORTACAO = {
+    'Tipo': 'TIPO',
+    'Descrição': 'DESCRICAO',
+    'Valor': 'VALOR',
+    'Quantidade': 'QUANTIDADE',
+    'Qtd': 'QUANTIDADE',
+    'Qtd.': 'QUANTIDADE',
+    'Valor Unitário': 'VALOR_UNITARIO',
+    'Valor Unitario': 'VALOR_UNITARIO',
+    'Preço Unitário': 'VALOR_UNITARIO',
+    'Preco Unitario': 'VALOR_UNITARIO',
+    'Preço': 'VALOR_UNITARIO',
+    'Preco': 'VALOR_UNITARIO',
+    'Desconto': 'DESCONTO',
+    'Desc': 'DESCONTO',
+    'Categoria': 'CATEGORIA',
+    'Data Prevista': 'DATA_PREVISTA',
+    'Data Realizada': 'DATA_REALIZADA',
+    'Conta Caixa': 'CONTA_CAIXA',
+    'Conta': 'CONTA_CAIXA',
+    'Caixa': 'CONTA_CAIXA',
+    'Conta/Caixa': 'CONTA_CAIXA',
+    'Conta - Caixa': 'CONTA_CAIXA',
+    'Conta_Caixa': 'CONTA_CAIXA',
+    'CONTA_CAIXA': 'CONTA_CAIXA',
+    'conta_caixa': 'CONTA_CAIXA',
+    'conta caixa': 'CONTA_CAIXA',
+    'conta': 'CONTA_CAIXA',
+    'caixa': 'CONTA_CAIXA',
+    'Tipo Cliente/Fornecedor': 'TIPO_CLIENTE_FORNECEDOR',
+    'Cliente/Fornecedor': 'CLIENTE_FORNECEDOR',
+    'Observações': 'OBSERVACOES',
+    'Tipo Produto/Serviço': 'TIPO_PRODUTO_SERVICO',
+    'Nome Produto/Serviço': 'NOME_PRODUTO_SERVICO',
+    'Tipo Produto/Servico': 'TIPO_PRODUTO_SERVICO',
+    'Nome Produto/Servico': 'NOME_PRODUTO_SERVICO',
+    'Parcelado': 'PARCELADO',
+    'Parcelado?': 'PARCELADO',
+    'Quantidade de Parcelas': 'QUANTIDADE_PARCELAS',
+    'Nota Fiscal': 'NOTA_FISCAL',
+    'NF': 'NOTA_FISCAL',
+    'Nota_Fiscal': 'NOTA_FISCAL',
+}
+
+# Usados quando a planilha não tem nenhuma linha de cabeçalho
+CABECALHOS_PADRAO_IMPORTACAO = ['Tipo', 'Descrição', 'Quantidade', 'Valor Unitário', 'Desconto', 'Categoria', 'Data Prevista']
+
+
+def _textos_cabecalho(valores):
+    return [str(valor).strip() if valor else '' for valor in valores]
+
+
+def _eh_linha_cabecalho(textos):
+    """Linha de cabeçalho da planilha modelo: começa com Tipo, Descrição."""
+    return (len(textos) >= 2 and
+            textos[0].lower() in ['tipo'] and
+            textos[1].lower() in ['descrição', 'descricao', 'description'])
+
+
+class PlanilhaImportacao:
+    """
+    Planilha de importação aberta em modo somente leitura (openpyxl read_only).
+
+    Detecta a aba de dados e a linha de cabeçalho e percorre as linhas com
+    iter_rows(values_only=True), sem carregar o workbook inteiro nem acessar
+    linhas por índice. Compartilhada pela prévia e pela importação.
+    """
+
+    # O cabeçalho é procurado nas primeiras 9 linhas da aba
+    LINHAS_BUSCA_CABECALHO = 9
+
+    def __init__(self, arquivo):
+        from openpyxl import load_workbook
+
+        # data_only=True garante que, se houver fórmulas, seja lido o valor calculado
+        self.workbook = load_workbook(arquivo, read_only=True, data_only=True)
+        try:
+            self.aba = self._detectar_aba()
+            self.linha_cabecalho, self.cabecalhos = self._detectar_cabecalho()
+        except Exception:
+            self.fechar()
+            raise
+        if not self.cabecalhos:
+            self.cabecalhos = list(CABECALHOS_PADRAO_IMPORTACAO)
+        self.cabecalhos_normalizados = [
+            MAPEAMENTO_CABECALHOS_IMPORTACAO.get(cabecalho, cabecalho.upper())
+            for cabecalho in self.cabecalhos
+        ]
+
+    def _primeiras_linhas(self, aba, quantidade):
+        return list(aba.iter_rows(max_row=quantidade, values_only=True))
+
+    def _detectar_aba(self):
+        # 1. Aba específica de dados (planilha modelo)
+        for nome in ("📊 DADOS", "DADOS"):
+            if nome in self.workbook.sheetnames:
+                return self.workbook[nome]
+
+        # 2. Aba cuja primeira linha contém os cabeçalhos de dados
+        for nome in self.workbook.sheetnames:
+            aba = self.workbook[nome]
+            primeira = self._primeiras_linhas(aba, 1)
+            if primeira and _eh_linha_cabecalho(_textos_cabecalho(primeira[0])):
+                return aba
+
+        # 3. Aba ativa
+        return self.workbook.active
+
+    def _detectar_cabecalho(self):
+        """Retorna (número da linha, títulos) do cabeçalho; fallback para a primeira linha."""
+        linhas = self._primeiras_linhas(self.aba, self.LINHAS_BUSCA_CABECALHO)
+        for numero, valores in enumerate(linhas, start=1):
+            textos = _textos_cabecalho(valores)
+            if _eh_linha_cabecalho(textos):
+                return numero, textos
+        return 1, _textos_cabecalho(linhas[0]) if linhas else []
+
+    def tem_linha(self, numero):
+        """Indica se a aba tem a linha informada (mesmo que vazia)."""
+        return bool(self._primeiras_linhas(self.aba, numero)[numero - 1:])
+
+    def linhas(self):
+        """
+        Gera (número da linha, valores, dados) para cada linha não vazia após o
+        cabeçalho. dados mapeia o cabeçalho normalizado para o valor da célula;
+        colunas ausentes no fim da linha aparecem como None.
+        """
+        quantidade_colunas = len(self.cabecalhos_normalizados)
+        linhas_lidas = 0
+        try:
+            for numero, valores in enumerate(
+                    self.aba.iter_rows(min_row=self.linha_cabecalho + 1, values_only=True),
+                    start=self.linha_cabecalho + 1):
+                if not any(valores):
+                    continue
+                linhas_lidas += 1
+                colunas = tuple(valores[:quantidade_colunas])
+                if len(colunas) < quantidade_colunas:
+                    colunas += (None,) * (quantidade_colunas - len(colunas))
+                yield numero, valores, dict(zip(self.cabecalhos_normalizados, colunas))
+        finally:
+            # max_row não é confiável em modo somente leitura (None sem dimensões gravadas)
+            app.logger.info(f"Linhas com dados lidas da aba '{self.aba.title}': {linhas_lidas}")
+            self.fechar()
+
+    def fechar(self):
+        """Fecha o arquivo do workbook (pode ser chamado mais de uma vez)."""
+        self.workbook.close()
+
+
+# ===== GRAVAÇÃO DA IMPORTAÇÃO EM LOTES =====
+
+class CadastrosImportacao:
+    """
+    Resolve as contas caixa, clientes, fornecedores e categorias citados nas
+    linhas de uma importação sem consultar o banco a cada linha.
+
+    Os cadastros da empresa são carregados uma vez. Os que faltam são criados
+    em memória na ordem das linhas (a busca parcial por nome das linhas
+    seguintes já os enxerga, como na gravação linha a linha) e vão para o banco
+    juntos em gravar().
+    """
+
+    def __init__(self, usuario_id, empresa_id, contas, clientes, fornecedores, categorias, codigos):
+        self.usuario_id = usuario_id
+        self.empresa_id = empresa_id
+        # {nome em minúsculas: objeto}
+        self.contas = contas
+        self.clientes = clientes
+        self.fornecedores = fornecedores
+        # {(nome, tipo): PlanoConta}
+        self.categorias = categorias
+        # Códigos das categorias ativas da empresa
+        self.codigos = codigos
+        self.novos = []
+        # Resultado da busca por nome em cada cache; limpo quando o cache recebe um cadastro novo
+        self.buscas = {}
+
+    @classmethod
+    def da_empresa(cls, empresa_id, usuario_id):
+        usuarios_ids = [u.id for u in Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()]
+        contas = {c.nome.lower(): c for c in ContaCaixa.query.filter(
+            ContaCaixa.usuario_id.in_(usuarios_ids), ContaCaixa.ativo == True
+        ).all()}
+        clientes = {c.nome.lower(): c for c in Cliente.query.filter(Cliente.empresa_id == empresa_id).all()}
+        fornecedores = {f.nome.lower(): f for f in Fornecedor.query.filter(Fornecedor.empresa_id == empresa_id).all()}
+
+        categorias = {}
+        codigos = set()
+        for categoria in PlanoConta.query.filter(
+            PlanoConta.empresa_id == empresa_id, PlanoConta.ativo == True
+        ).order_by(PlanoConta.id).all():
+            categorias.setdefault((categoria.nome, categoria.tipo), categoria)
+            codigos.add(categoria.codigo)
+
+        return cls(usuario_id, empresa_id, contas, clientes, fornecedores, categorias, codigos)
+
+    def _buscar(self, cache, nome_input):
+        """Busca exata e depois parcial pelo nome, como buscar_conta_caixa/buscar_cliente."""
+        if not nome_input:
+            return None
+        nome = str(nome_input).strip().lower()
+        buscas = self.buscas.setdefault(id(cache), {})
+        if nome not in buscas:
+            encontrado = cache.get(nome)
+            if encontrado is None:
+                encontrado = next((obj for nome_cached, obj in cache.items()
+                                   if nome in nome_cached or nome_cached in nome), None)
+            buscas[nome] = encontrado
+        return buscas[nome]
+
+    def _registrar(self, cache, nome, obj):
+        cache[nome] = obj
+        self.buscas.pop(id(cache), None)
+        self.novos.append(obj)
+
+    def conta_caixa(self, nome_input):
+        """Conta caixa pelo nome, criada se não existir."""
+        conta = self._buscar(self.contas, nome_input)
+        if conta is None and nome_input:
+            nome_original = str(nome_input).strip()
+            conta = nova_conta_caixa_importacao(nome_original, self.usuario_id)
+            self._registrar(self.contas, nome_original.lower(), conta)
+        return conta
+
+    def cliente(self, nome_input, criar=False):
+        cliente = self._buscar(self.clientes, nome_input)
+        if cliente is None and criar and nome_input:
+            cliente = Cliente(nome=nome_input, usuario_id=self.usuario_id, empresa_id=self.empresa_id)
+            self._registrar(self.clientes, nome_input.lower(), cliente)
+        return cliente
+
+    def fornecedor(self, nome_input, criar=False):
+        fornecedor = self._buscar(self.fornecedores, nome_input)
+        if fornecedor is None and criar and nome_input:
+            fornecedor = Fornecedor(nome=nome_input, usuario_id=self.usuario_id, empresa_id=self.empresa_id)
+            self._registrar(self.fornecedores, nome_input.lower(), fornecedor)
+        return fornecedor
+
+    def categoria(self, nome_categoria, tipo_lancamento):
+        """Categoria do plano de contas com o mesmo nome e tipo, criada se não existir."""
+        if not nome_categoria:
+            return None
+        nome_original = str(nome_categoria).strip()
+        chave = (nome_original, tipo_lancamento)
+        categoria = self.categorias.get(chave)
+        if categoria is None:
+            codigo = codigo_categoria_importacao(nome_original, self.usuario_id, self.codigos.__contains__)
+            self.codigos.add(codigo)
+            categoria = nova_categoria_importacao(nome_original, tipo_lancamento, codigo,
+                                                  self.usuario_id, self.empresa_id)
+            self.categorias[chave] = categoria
+            self.novos.append(categoria)
+        return categoria
+
+    def gravar(self, linhas):
+        """
+        Grava os cadastros novos num único flush e troca, em cada linha preparada,
+        as referências (conta_caixa, cliente, fornecedor, plano_conta) pelos IDs.
+        """
+        if self.novos:
+            db.session.add_all(self.novos)
+            db.session.flush()
+            app.logger.info(f"✅ {len(self.novos)} cadastro(s) criado(s) automaticamente na importação")
+            self.novos = []
+
+        for linha in linhas:
+            for campo in ('conta_caixa', 'cliente', 'fornecedor', 'plano_conta'):
+                obj = linha.pop(campo)
+                linha[f'{campo}_id'] = obj.id if obj is not None else None
+
+
+class GravadorImportacao:
+    """
+    Grava as linhas preparadas de uma importação de planilha em lotes de
+    tamanho_lote linhas, um commit por lote.
+
+    Os lançamentos de um lote entram num único flush (INSERT em lote), assim
+    como as vendas, compras e vínculos gerados por eles. Ao fim de cada lote o
+    registro Importacao recebe o progresso (linhas processadas, totais e IDs
+    criados) na mesma transação, então uma importação interrompida pode ser
+    acompanhada e desfeita. Se um lote falha, ele é refeito linha a linha para
+    que só as linhas com erro fiquem de fora. O estoque dos produtos
+    movimentados é recalculado uma vez por produto, em atualizar_estoque().
+    """
+
+    def __init__(self, registro, usuario_id, empresa_id, erros, tamanho_lote=None):
+        self.registro = registro
+        self.usuario_id = usuario_id
+        self.empresa_id = empresa_id
+        self.erros = erros
+        self.tamanho_lote = tamanho_lote or app.config['IMPORTACAO_TAMANHO_LOTE']
+        self.sucessos = 0
+        self.linhas_processadas = 0
+        self.total_entradas = 0.0
+        self.total_saidas = 0.0
+        # Resumos do que foi gravado: (id, descrição) e (id, cliente/fornecedor)
+        self.lancamentos = []
+        self.vendas = []
+        self.compras = []
+        # {nome normalizado: [(modelo, id) da primeira venda/compra do produto, id da primeira compra]}
+        self.produtos_estoque = {}
+
+    def gravar(self, linhas):
+        for inicio in range(0, len(linhas), self.tamanho_lote):
+            lote = linhas[inicio:inicio + self.tamanho_lote]
+            try:
+                self._gravar_lote(lote)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f"[Import] Lote da linha {lote[0]['linha']} falhou ({e}); gravando linha a linha")
+                for linha in lote:
+                    try:
+                        self._gravar_lote([linha])
+                    except Exception as e_linha:
+                        db.session.rollback()
+                        self.erros.append(f"Linha {linha['linha']}: {str(e_linha)}")
+                        app.logger.error(f"Erro na linha {linha['linha']}: {str(e_linha)}")
+                        self.linhas_processadas += 1
+                        self.registro.linhas_processadas = self.linhas_processadas
+                        self.registro.erros = len(self.erros)
+                        registrar_progresso_job(self.linhas_processadas, self.registro.linhas_total)
+                        db.session.commit()
+
+    @staticmethod
+    def _montar_lancamentos(linha, usuario_id, empresa_id):
+        """Lançamentos de uma linha: um só, ou um por parcela (mês a mês a partir da data prevista)."""
+        import calendar
+
+        campos = dict(
+            tipo=linha['tipo'],
+            categoria=linha['categoria'],
+            plano_conta_id=linha['plano_conta_id'],
+            usuario_id=usuario_id,
+            empresa_id=empresa_id,
+            conta_caixa_id=linha['conta_caixa_id'],
+            cliente_id=linha['cliente_id'],
+            fornecedor_id=linha['fornecedor_id'],
+            produto_servico=linha['produto_servico'],
+            tipo_produto_servico=linha['tipo_produto_servico'],
+            itens_carrinho=linha['itens_carrinho'],
+            nota_fiscal=linha['nota_fiscal'],
+            usuario_criacao_id=usuario_id  # Registrar quem criou
+        )
+        quantidade_parcelas = linha['quantidade_parcelas']
+        if quantidade_parcelas <= 1:
+            return [Lancamento(
+                descricao=linha['descricao'],
+                valor=linha['valor'],
+                data_prevista=linha['data_prevista'],
+                data_realizada=linha['data_realizada'],
+                realizado=linha['realizado'],
+                observacoes=linha['observacoes'],
+                **campos
+            )]
+
+        # Usar valor_total da operação (incluindo descontos) para calcular valor da parcela
+        valor_total_operacao = linha['valor_total'] if linha['valor_total'] is not None else linha['valor']
+        valor_parcela = valor_total_operacao / quantidade_parcelas
+        data_prevista = linha['data_prevista']
+
+        lancamentos = []
+        for i in range(quantidade_parcelas):
+            # Adicionar meses garantindo que o dia existe no mês destino (28-31)
+            mes = data_prevista.month + i
+            ano = data_prevista.year
+            while mes > 12:
+                mes -= 12
+                ano += 1
+            dia = min(data_prevista.day, calendar.monthrange(ano, mes)[1])
+            data_parcela = data_prevista if i == 0 else date(ano, mes, dia)
+
+            lancamentos.append(Lancamento(
+                descricao=f"{linha['descricao']} - Parcela {i+1}/{quantidade_parcelas}",
+                valor=valor_parcela,
+                data_prevista=data_parcela,
+                data_realizada=linha['data_realizada'] if i == 0 and linha['data_realizada'] else None,
+                realizado=linha['realizado'] if i == 0 else False,
+                observacoes=f"{linha['observacoes'] or ''} - Parcela {i+1}/{quantidade_parcelas}".strip(),
+                **campos
+            ))
+        return lancamentos
+
+    def _gravar_lote(self, lote):
+        por_linha = [self._montar_lancamentos(linha, self.usuario_id, self.empresa_id) for linha in lote]
+        lancamentos = [lancamento for grupo in por_linha for lancamento in grupo]
+        db.session.add_all(lancamentos)
+        db.session.flush()
+
+        # Vendas/compras vinculadas à primeira parcela de cada linha
+        vendas, compras, movimentos = [], [], []
+        for linha, grupo in zip(lote, por_linha):
+            if linha['criar_venda']:
+                venda = montar_venda_automatica(grupo[0], self.usuario_id, linha['valor_total'], linha['quantidade'])
+                if venda:
+                    if linha['atualiza_estoque']:
+                        venda.produto = normalizar_nome_produto(venda.produto)
+                        movimentos.append(venda)
+                    vendas.append((grupo[0], venda))
+                else:
+                    app.logger.error("Falha ao criar venda")
+            if linha['criar_compra']:
+                compra = montar_compra_automatica(grupo[0], self.usuario_id, linha['valor_total'], linha['quantidade'])
+                if compra:
+                    if linha['atualiza_estoque']:
+                        movimentos.append(compra)
+                    compras.append((grupo[0], compra))
+                else:
+                    app.logger.error("Falha ao criar compra")
+
+        if vendas or compras:
+            db.session.add_all([venda for _, venda in vendas] + [compra for _, compra in compras])
+            db.session.flush()
+            # Vínculos não precisam dos IDs gerados: um único executemany
+            db.session.execute(Vinculo.__table__.insert(), [
+                dict(lado_a_tipo='lancamento', lado_a_id=lancamento.id, lado_b_tipo=tipo,
+                     lado_b_id=destino.id, usuario_id=self.usuario_id)
+                for tipo, pares in (('venda', vendas), ('compra', compras))
+                for lancamento, destino in pares
+            ])
+
+        novos_lancamentos = [(l.id, l.descricao) for l in lancamentos]
+        novas_vendas = [(v.id, v.cliente.nome if v.cliente else 'N/A') for _, v in vendas]
+        novas_compras = [(c.id, c.fornecedor.nome if c.fornecedor else 'N/A') for _, c in compras]
+        entradas = sum(l.valor for l in lancamentos if l.tipo == 'entrada')
+        saidas = sum(l.valor for l in lancamentos if l.tipo == 'saida')
+        novos_movimentos = [(type(mov), mov.id, normalizar_nome_produto(mov.produto)) for mov in movimentos]
+
+        # Progresso gravado na mesma transação do lote
+        registro = self.registro
+        registro.linhas_processadas = self.linhas_processadas + len(lote)
+        registro.sucessos = self.sucessos + len(lote)
+        registro.erros = len(self.erros)
+        registro.total_lancamentos = len(self.lancamentos) + len(novos_lancamentos)
+        registro.total_entradas = self.total_entradas + entradas
+        registro.total_saidas = self.total_saidas + saidas
+        registro.total_vendas = len(self.vendas) + len(novas_vendas)
+        registro.total_compras = len(self.compras) + len(novas_compras)
+        registro.lancamentos_ids = json.dumps([str(i) for i, _ in self.lancamentos + novos_lancamentos])
+        registro.vendas_ids = json.dumps([str(i) for i, _ in self.vendas + novas_vendas])
+        registro.compras_ids = json.dumps([str(i) for i, _ in self.compras + novas_compras])
+        registrar_progresso_job(registro.linhas_processadas, registro.linhas_total)
+        db.session.commit()
+
+        self.linhas_processadas += len(lote)
+        self.sucessos += len(lote)
+        self.total_entradas += entradas
+        self.total_saidas += saidas
+        self.lancamentos.extend(novos_lancamentos)
+        self.vendas.extend(novas_vendas)
+        self.compras.extend(novas_compras)
+        for modelo, mov_id, nome in novos_movimentos:
+            produto = self.produtos_estoque.setdefault(nome, [(modelo, mov_id), None])
+            if modelo is Compra and produto[1] is None:
+                produto[1] = mov_id
+
+    def atualizar_estoque(self):
+        """
+        Recalcula o estoque de cada produto movimentado pela importação uma única
+        vez, a partir da primeira venda/compra do produto (que o cria no estoque
+        se preciso) e, havendo compras, da primeira compra (preço médio).
+        """
+        for nome, ((modelo, mov_id), compra_id) in self.produtos_estoque.items():
+            if modelo is Venda:
+                sucesso, mensagem = atualizar_estoque_venda(db.session.get(Venda, mov_id), self.usuario_id)
+            if compra_id is not None:
+                sucesso, mensagem = atualizar_estoque_compra(db.session.get(Compra, compra_id), self.usuario_id)
+            if sucesso:
+                app.logger.info(f"Estoque atualizado para '{nome}': {mensagem}")
+            else:
+                app.logger.warning(f"Aviso no estoque para '{nome}': {mensagem}")
+
+
 @app.route('/api/importacao/preview', methods=['POST'])
 def api_preview_importacao():
     """Gera prévia da importação sem salvar no banco"""
@@ -14436,167 +17258,38 @@ def api_preview_importacao():
     usuario = db.session.get(Usuario, session['usuario_id'])
     if not usuario or usuario.tipo == 'admin':
         return jsonify({'error': 'Acesso negado'}), 403
-    
-    try:
-        if 'arquivo' not in request.files:
-            return jsonify({'error': 'Nenhum arquivo enviado'}), 400
-        
-        arquivo = request.files['arquivo']
-        if arquivo.filename == '':
-            return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
-        
-        if not arquivo.filename.endswith(('.xlsx', '.xls')):
-            return jsonify({'error': 'Formato de arquivo não suportado. Use .xlsx ou .xls'}), 400
-        
-        # Ler arquivo Excel
-        # data_only=True garante que, se houver fórmulas, seja lido o valor calculado
-        from openpyxl import load_workbook
-        wb = load_workbook(arquivo, data_only=True)
-        
-        # Detectar automaticamente a aba com dados
-        ws = None
-        
-        # 1. Tentar encontrar aba específica de dados (planilha modelo)
-        if "📊 DADOS" in wb.sheetnames:
-            ws = wb["📊 DADOS"]
-        elif "DADOS" in wb.sheetnames:
-            ws = wb["DADOS"]
-        else:
-            # 2. Procurar por aba que contenha cabeçalhos de dados
-            for sheet_name in wb.sheetnames:
-                sheet = wb[sheet_name]
-                if sheet.max_row > 0:
-                    # Verificar se a primeira linha contém cabeçalhos de dados
-                    first_row = [str(cell.value).strip() if cell.value else '' for cell in sheet[1]]
-                    if (len(first_row) >= 2 and 
-                        first_row[0].lower() in ['tipo'] and 
-                        first_row[1].lower() in ['descrição', 'descricao', 'description']):
-                        ws = sheet
-                        break
-            
-            # 3. Se não encontrou, usar aba ativa
-            if not ws:
-                ws = wb.active
-        
-        # Encontrar automaticamente a linha com os cabeçalhos
-        header_row = 1
-        headers = []
-        
-        # Detectar cabeçalhos automaticamente
-        headers = []
-        header_row = 1
-        
-        # Procurar pela linha com cabeçalhos de dados
-        for row_num in range(1, min(10, ws.max_row + 1)):  # Verificar até 10 linhas
-            row_headers = [str(cell.value).strip() if cell.value else '' for cell in ws[row_num]]
-            
-            # Verificar se esta linha contém cabeçalhos de dados
-            if (len(row_headers) >= 2 and 
-                row_headers[0].lower() in ['tipo'] and 
-                row_headers[1].lower() in ['descrição', 'descricao', 'description']):
-                headers = row_headers
-                header_row = row_num
-                break
-        
-        # Se não encontrou, usar a primeira linha como fallback
-        if not headers:
-            headers = [str(cell.value).strip() if cell.value else '' for cell in ws[1]]
-        
-        app.logger.info(f"Aba selecionada: {ws.title}")
-        app.logger.info(f"Total de linhas na aba: {ws.max_row}")
-        app.logger.info(f"Cabeçalhos encontrados na linha {header_row}: {headers}")
-        
-        # Mapear títulos para nomes internos
-        header_mapping = {
-            'Tipo': 'TIPO',
-            'Descrição': 'DESCRICAO', 
-            'Valor': 'VALOR',
-            'Quantidade': 'QUANTIDADE',
-            'Qtd': 'QUANTIDADE',
-            'Qtd.': 'QUANTIDADE',
-            'Valor Unitário': 'VALOR_UNITARIO',
-            'Valor Unitario': 'VALOR_UNITARIO',
-            'Preço Unitário': 'VALOR_UNITARIO',
-            'Preco Unitario': 'VALOR_UNITARIO',
-            'Preço': 'VALOR_UNITARIO',
-            'Preco': 'VALOR_UNITARIO',
-            'Desconto': 'DESCONTO',
-            'Desc': 'DESCONTO',
-            'Categoria': 'CATEGORIA',
-            'Data Prevista': 'DATA_PREVISTA',
-            'Data Realizada': 'DATA_REALIZADA',
-            'Conta Caixa': 'CONTA_CAIXA',
-            'Conta': 'CONTA_CAIXA',
-            'Caixa': 'CONTA_CAIXA',
-            'Conta/Caixa': 'CONTA_CAIXA',
-            'Conta - Caixa': 'CONTA_CAIXA',
-            'Conta_Caixa': 'CONTA_CAIXA',
-            'CONTA_CAIXA': 'CONTA_CAIXA',
-            'conta_caixa': 'CONTA_CAIXA',
-            'conta caixa': 'CONTA_CAIXA',
-            'conta': 'CONTA_CAIXA',
-            'caixa': 'CONTA_CAIXA',
-            'Tipo Cliente/Fornecedor': 'TIPO_CLIENTE_FORNECEDOR',
-            'Cliente/Fornecedor': 'CLIENTE_FORNECEDOR',
-            'Observações': 'OBSERVACOES',
-            'Tipo Produto/Serviço': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Serviço': 'NOME_PRODUTO_SERVICO',
-            'Tipo Produto/Servico': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Servico': 'NOME_PRODUTO_SERVICO',
-            'Parcelado': 'PARCELADO',
-            'Quantidade de Parcelas': 'QUANTIDADE_PARCELAS',
-            'Nota Fiscal': 'NOTA_FISCAL',
-            'NF': 'NOTA_FISCAL',
-            'Nota_Fiscal': 'NOTA_FISCAL',
-            # Manter compatibilidade com títulos antigos
-            'TIPO': 'TIPO',
-            'DESCRICAO': 'DESCRICAO',
-            'VALOR': 'VALOR',
-            'CATEGORIA': 'CATEGORIA',
-            'DATA_PREVISTA': 'DATA_PREVISTA',
-            'DATA_REALIZADA': 'DATA_REALIZADA',
-            'CONTA_CAIXA': 'CONTA_CAIXA',
-            'CLIENTE': 'CLIENTE',
-            'FORNECEDOR': 'FORNECEDOR',
-            'OBSERVACOES': 'OBSERVACOES',
-            'TAGS': 'TAGS',
-            'CENTRO_CUSTO': 'CENTRO_CUSTO',
-            'PROJETO': 'PROJETO',
-            'DOCUMENTO': 'DOCUMENTO',
-            'NOTA_FISCAL': 'NOTA_FISCAL',
-            # Variações adicionais para garantir compatibilidade
-            'Tipo Produto/Serviço': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Serviço': 'NOME_PRODUTO_SERVICO',
-            'Parcelado?': 'PARCELADO',
-            'TIPO_PRODUTO_SERVICO': 'TIPO_PRODUTO_SERVICO',
-            'NOME_PRODUTO_SERVICO': 'NOME_PRODUTO_SERVICO',
-            'PARCELADO': 'PARCELADO',
-            'QUANTIDADE_PARCELAS': 'QUANTIDADE_PARCELAS'
-        }
+    
+    planilha = None
+    try:
+        if 'arquivo' not in request.files:
+            return jsonify({'error': 'Nenhum arquivo enviado'}), 400
         
-        # Normalizar cabeçalhos usando mapeamento direto
-        normalized_headers = []
+        arquivo = request.files['arquivo']
+        if arquivo.filename == '':
+            return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
-        # Garantir que headers não está vazio
-        if not headers:
-            headers = ['Tipo', 'Descrição', 'Quantidade', 'Valor Unitário', 'Desconto', 'Categoria', 'Data Prevista']
+        if not arquivo.filename.endswith(('.xlsx', '.xls')):
+            return jsonify({'error': 'Formato de arquivo não suportado. Use .xlsx ou .xls'}), 400
         
-        for header in headers:
-            # Usar o mapeamento existente ou converter para maiúsculas
-            normalized_header = header_mapping.get(header, header.upper())
-            normalized_headers.append(normalized_header)
+        # Ler arquivo Excel em modo somente leitura (aba e cabeçalho detectados automaticamente)
+        planilha = PlanilhaImportacao(arquivo)
+        ws = planilha.aba
+        header_row = planilha.linha_cabecalho
+        normalized_headers = planilha.cabecalhos_normalizados
         
+        app.logger.info(f"Aba selecionada: {ws.title}")
+        app.logger.info(f"Cabeçalhos encontrados na linha {header_row}: {planilha.cabecalhos}")
         app.logger.info(f"Cabeçalhos normalizados: {normalized_headers}")
         
         # Não validar cabeçalhos obrigatórios - aceitar qualquer planilha
         # Apenas verificar se há pelo menos uma linha de dados
-        if ws.max_row < 2:
+        if not planilha.tem_linha(2):
             return jsonify({
                 'error': 'Planilha não contém dados para importar'
             }), 400
         
         # Verificar se há dados após os cabeçalhos
-        if header_row >= ws.max_row:
+        if not planilha.tem_linha(header_row + 1):
             return jsonify({
                 'error': 'Planilha não contém dados após os cabeçalhos'
             }), 400
@@ -14624,24 +17317,9 @@ def api_preview_importacao():
         preview_data = []
         erros = []
         
-        for row_num in range(header_row + 1, ws.max_row + 1):
+        # Linhas não vazias após o cabeçalho, já mapeadas pelos cabeçalhos normalizados
+        for row_num, row_data, dados in planilha.linhas():
             try:
-                # Verificar se a linha existe
-                if row_num > ws.max_row:
-                    break
-                    
-                row_data = [cell.value for cell in ws[row_num]]
-                
-                # Pular linhas vazias
-                if not any(row_data):
-                    continue
-                
-                # Criar dicionário de dados baseado nos cabeçalhos
-                dados = {}
-                for i, valor in enumerate(row_data):
-                    if i < len(normalized_headers):
-                        dados[normalized_headers[i]] = valor
-                
                 # Verificar se há pelo menos um campo essencial preenchido
                 campos_essenciais = ['TIPO', 'DESCRICAO', 'VALOR', 'CATEGORIA', 'DATA_PREVISTA']
                 tem_dados = any(str(dados.get(campo, '')).strip() for campo in campos_essenciais)
@@ -14920,8 +17598,13 @@ def api_preview_importacao():
         import traceback
         app.logger.error(f"Traceback: {traceback.format_exc()}")
         return jsonify({'error': f'Erro ao processar arquivo: {str(e)}'}), 500
+    finally:
+        # O workbook somente leitura mantém o arquivo aberto até ser fechado
+        if planilha:
+            planilha.fechar()
 
 @app.route('/api/importacao/importar', methods=['POST'])
+@em_segundo_plano('importacao')
 def api_importar_dados():
     """Importa dados de planilha Excel com validação inteligente e integração completa"""
     if 'usuario_id' not in session:
@@ -14931,6 +17614,7 @@ def api_importar_dados():
     if not usuario or usuario.tipo == 'admin':
         return jsonify({'error': 'Acesso negado'}), 403
     
+    planilha = None
     try:
         if 'arquivo' not in request.files:
             return jsonify({'error': 'Nenhum arquivo enviado'}), 400
@@ -14942,199 +17626,42 @@ def api_importar_dados():
         if not arquivo.filename.endswith(('.xlsx', '.xls')):
             return jsonify({'error': 'Formato de arquivo não suportado. Use .xlsx ou .xls'}), 400
         
-        # Ler arquivo Excel
-        # data_only=True garante que, se houver fórmulas, seja lido o valor calculado
-        from openpyxl import load_workbook
-        wb = load_workbook(arquivo, data_only=True)
-        
-        # Detectar automaticamente a aba com dados
-        ws = None
-        
-        # 1. Tentar encontrar aba específica de dados (planilha modelo)
-        if "📊 DADOS" in wb.sheetnames:
-            ws = wb["📊 DADOS"]
-        elif "DADOS" in wb.sheetnames:
-            ws = wb["DADOS"]
-        else:
-            # 2. Procurar por aba que contenha cabeçalhos de dados
-            for sheet_name in wb.sheetnames:
-                sheet = wb[sheet_name]
-                if sheet.max_row > 0:
-                    # Verificar se a primeira linha contém cabeçalhos de dados
-                    first_row = [str(cell.value).strip() if cell.value else '' for cell in sheet[1]]
-                    if (len(first_row) >= 2 and 
-                        first_row[0].lower() in ['tipo'] and 
-                        first_row[1].lower() in ['descrição', 'descricao', 'description']):
-                        ws = sheet
-                        break
-            
-            # 3. Se não encontrou, usar aba ativa
-            if not ws:
-                ws = wb.active
-        
-        # Encontrar automaticamente a linha com os cabeçalhos
-        header_row = 1
-        headers = []
-        
-        # Detectar cabeçalhos automaticamente
-        headers = []
-        header_row = 1
-        
-        # Procurar pela linha com cabeçalhos de dados
-        for row_num in range(1, min(10, ws.max_row + 1)):  # Verificar até 10 linhas
-            row_headers = [str(cell.value).strip() if cell.value else '' for cell in ws[row_num]]
-            
-            # Verificar se esta linha contém cabeçalhos de dados
-            if (len(row_headers) >= 2 and 
-                row_headers[0].lower() in ['tipo'] and 
-                row_headers[1].lower() in ['descrição', 'descricao', 'description']):
-                headers = row_headers
-                header_row = row_num
-                break
-        
-        # Se não encontrou, usar a primeira linha como fallback
-        if not headers:
-            headers = [str(cell.value).strip() if cell.value else '' for cell in ws[1]]
+        # Ler arquivo Excel em modo somente leitura (aba e cabeçalho detectados automaticamente)
+        planilha = PlanilhaImportacao(arquivo)
+        ws = planilha.aba
+        header_row = planilha.linha_cabecalho
+        normalized_headers = planilha.cabecalhos_normalizados
         
         app.logger.info(f"Aba selecionada: {ws.title}")
-        app.logger.info(f"Total de linhas na aba: {ws.max_row}")
-        app.logger.info(f"Cabeçalhos encontrados na linha {header_row}: {headers}")
-        
-        # Mapear títulos para nomes internos
-        header_mapping = {
-            'Tipo': 'TIPO',
-            'Descrição': 'DESCRICAO', 
-            'Valor': 'VALOR',
-            'Quantidade': 'QUANTIDADE',
-            'Qtd': 'QUANTIDADE',
-            'Qtd.': 'QUANTIDADE',
-            'Valor Unitário': 'VALOR_UNITARIO',
-            'Valor Unitario': 'VALOR_UNITARIO',
-            'Preço Unitário': 'VALOR_UNITARIO',
-            'Preco Unitario': 'VALOR_UNITARIO',
-            'Preço': 'VALOR_UNITARIO',
-            'Preco': 'VALOR_UNITARIO',
-            'Desconto': 'DESCONTO',
-            'Desc': 'DESCONTO',
-            'Categoria': 'CATEGORIA',
-            'Data Prevista': 'DATA_PREVISTA',
-            'Data Realizada': 'DATA_REALIZADA',
-            'Conta Caixa': 'CONTA_CAIXA',
-            'Conta': 'CONTA_CAIXA',
-            'Caixa': 'CONTA_CAIXA',
-            'Conta/Caixa': 'CONTA_CAIXA',
-            'Conta - Caixa': 'CONTA_CAIXA',
-            'Conta_Caixa': 'CONTA_CAIXA',
-            'CONTA_CAIXA': 'CONTA_CAIXA',
-            'conta_caixa': 'CONTA_CAIXA',
-            'conta caixa': 'CONTA_CAIXA',
-            'conta': 'CONTA_CAIXA',
-            'caixa': 'CONTA_CAIXA',
-            'Tipo Cliente/Fornecedor': 'TIPO_CLIENTE_FORNECEDOR',
-            'Cliente/Fornecedor': 'CLIENTE_FORNECEDOR',
-            'Observações': 'OBSERVACOES',
-            'Tipo Produto/Serviço': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Serviço': 'NOME_PRODUTO_SERVICO',
-            'Tipo Produto/Servico': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Servico': 'NOME_PRODUTO_SERVICO',
-            'Parcelado': 'PARCELADO',
-            'Quantidade de Parcelas': 'QUANTIDADE_PARCELAS',
-            # Manter compatibilidade com títulos antigos
-            'TIPO': 'TIPO',
-            'DESCRICAO': 'DESCRICAO',
-            'VALOR': 'VALOR',
-            'CATEGORIA': 'CATEGORIA',
-            'DATA_PREVISTA': 'DATA_PREVISTA',
-            'DATA_REALIZADA': 'DATA_REALIZADA',
-            'CONTA_CAIXA': 'CONTA_CAIXA',
-            'CLIENTE': 'CLIENTE',
-            'FORNECEDOR': 'FORNECEDOR',
-            'OBSERVACOES': 'OBSERVACOES',
-            'TAGS': 'TAGS',
-            'CENTRO_CUSTO': 'CENTRO_CUSTO',
-            'PROJETO': 'PROJETO',
-            'DOCUMENTO': 'DOCUMENTO',
-            # Variações adicionais para garantir compatibilidade
-            'Tipo Produto/Serviço': 'TIPO_PRODUTO_SERVICO',
-            'Nome Produto/Serviço': 'NOME_PRODUTO_SERVICO',
-            'Parcelado?': 'PARCELADO',
-            'TIPO_PRODUTO_SERVICO': 'TIPO_PRODUTO_SERVICO',
-            'NOME_PRODUTO_SERVICO': 'NOME_PRODUTO_SERVICO',
-            'PARCELADO': 'PARCELADO',
-            'QUANTIDADE_PARCELAS': 'QUANTIDADE_PARCELAS'
-        }
-        
-        # Normalizar cabeçalhos usando mapeamento direto
-        normalized_headers = []
-        
-        # Garantir que headers não está vazio
-        if not headers:
-            headers = ['Tipo', 'Descrição', 'Quantidade', 'Valor Unitário', 'Desconto', 'Categoria', 'Data Prevista']
-        
-        for header in headers:
-            # Usar o mapeamento existente ou converter para maiúsculas
-            normalized_header = header_mapping.get(header, header.upper())
-            normalized_headers.append(normalized_header)
-        
+        app.logger.info(f"Cabeçalhos encontrados na linha {header_row}: {planilha.cabecalhos}")
         app.logger.info(f"Cabeçalhos normalizados: {normalized_headers}")
         
         # Não validar cabeçalhos obrigatórios - aceitar qualquer planilha
         # Apenas verificar se há pelo menos uma linha de dados
-        if ws.max_row < 2:
+        if not planilha.tem_linha(2):
             return jsonify({
                 'error': 'Planilha não contém dados para importar'
             }), 400
         
         # Verificar se há dados após os cabeçalhos
-        if header_row >= ws.max_row:
+        if not planilha.tem_linha(header_row + 1):
             return jsonify({
                 'error': 'Planilha não contém dados após os cabeçalhos'
             }), 400
         
-        # Buscar todos os usuários da empresa para validações
         empresa_id = obter_empresa_id_sessao(session, usuario)
 
-        usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-        usuarios_ids = [u.id for u in usuarios_empresa]
-        
-        # Cache de dados para otimização
-        contas_caixa_cache = {c.nome.lower(): c for c in ContaCaixa.query.filter(
-            ContaCaixa.usuario_id.in_(usuarios_ids), ContaCaixa.ativo==True
-        ).all()}
-        
-        clientes_cache = {c.nome.lower(): c for c in Cliente.query.filter(
-            Cliente.empresa_id == empresa_id
-        ).all()}
-        
-        fornecedores_cache = {f.nome.lower(): f for f in Fornecedor.query.filter(
-            Fornecedor.empresa_id == empresa_id
-        ).all()}
+        # Contas caixa, clientes, fornecedores e categorias carregados uma vez;
+        # os que faltarem são criados juntos depois de ler a planilha
+        cadastros = CadastrosImportacao.da_empresa(empresa_id, usuario.id)
         
-        # Processar linhas
-        sucessos = 0
+        # Preparar linhas (validação e valores padrão), sem gravar nada ainda
         erros = []
-        lancamentos_criados = []
-        vendas_criadas = []
-        compras_criadas = []
+        linhas_preparadas = []
         
-        for row_num in range(header_row + 1, ws.max_row + 1):
+        # Linhas não vazias após o cabeçalho, já mapeadas pelos cabeçalhos normalizados
+        for row_num, row_data, dados in planilha.linhas():
             try:
-                # Verificar se a linha existe
-                if row_num > ws.max_row:
-                    break
-                    
-                row_data = [cell.value for cell in ws[row_num]]
-                
-                # Pular linhas vazias
-                if not any(row_data):
-                    continue
-                
-                # Criar dicionário de dados baseado nos cabeçalhos
-                dados = {}
-                for i, valor in enumerate(row_data):
-                    if i < len(normalized_headers):
-                        dados[normalized_headers[i]] = valor
-                
                 # Verificar se há pelo menos um campo essencial preenchido
                 campos_essenciais = ['TIPO', 'DESCRICAO', 'VALOR', 'CATEGORIA', 'DATA_PREVISTA']
                 tem_dados = any(str(dados.get(campo, '')).strip() for campo in campos_essenciais)
@@ -15199,15 +17726,8 @@ def api_importar_dados():
                     valor_total = None
                 
                 # Buscar ou criar categoria no plano de contas automaticamente
-                categoria_id = None  # Sempre inicializar para garantir vinculação plano_conta_id
-                if categoria_raw:
-                    categoria_id = buscar_ou_criar_categoria_plano_contas(categoria_raw, tipo, usuario.id, empresa_id)
-                    if categoria_id:
-                        categoria = categoria_raw
-                    else:
-                        categoria = 'Importado'  # Fallback se não conseguir criar
-                else:
-                    categoria = 'Importado'
+                plano_conta = cadastros.categoria(categoria_raw, tipo)
+                categoria = categoria_raw if plano_conta else 'Importado'
                 
                 # Processar datas com múltiplos formatos
                 data_prevista = processar_data(data_prevista_raw)
@@ -15254,57 +17774,31 @@ def api_importar_dados():
                 tipo_cliente_fornecedor = str(dados.get('TIPO_CLIENTE_FORNECEDOR', '')).strip().lower()
                 nome_cliente_fornecedor = str(dados.get('CLIENTE_FORNECEDOR', '')).strip()
                 
-                cliente_id = None
-                fornecedor_id = None
-                conta_caixa_id = None  # Inicializar explicitamente para evitar uso de locals()
+                cliente = None
+                fornecedor = None
+                conta_caixa = None
                 
                 # Vinculação inteligente baseada no tipo cliente/fornecedor da planilha
                 if tipo_cliente_fornecedor and nome_cliente_fornecedor:
                     if tipo_cliente_fornecedor in ['cliente', 'client']:
                         # Buscar ou criar cliente automaticamente
-                        cliente_id = buscar_cliente(nome_cliente_fornecedor, clientes_cache)
-                        if not cliente_id:
-                            # Criar cliente automaticamente se não existir
-                            novo_cliente = Cliente(
-                                nome=nome_cliente_fornecedor,
-                                usuario_id=usuario.id,
-                                empresa_id=empresa_id
-                            )
-                            db.session.add(novo_cliente)
-                            db.session.flush()
-                            cliente_id = novo_cliente.id
-                            clientes_cache[nome_cliente_fornecedor.lower()] = novo_cliente
-                            app.logger.info(f"Cliente criado automaticamente: {nome_cliente_fornecedor} (ID: {cliente_id})")
+                        cliente = cadastros.cliente(nome_cliente_fornecedor, criar=True)
                     
                     elif tipo_cliente_fornecedor in ['fornecedor', 'supplier']:
                         # Buscar ou criar fornecedor automaticamente
-                        fornecedor_id = buscar_fornecedor(nome_cliente_fornecedor, fornecedores_cache)
-                        if not fornecedor_id:
-                            # Criar fornecedor automaticamente se não existir
-                            novo_fornecedor = Fornecedor(
-                                nome=nome_cliente_fornecedor,
-                                usuario_id=usuario.id,
-                                empresa_id=empresa_id
-                            )
-                            db.session.add(novo_fornecedor)
-                            db.session.flush()
-                            fornecedor_id = novo_fornecedor.id
-                            fornecedores_cache[nome_cliente_fornecedor.lower()] = novo_fornecedor
-                            app.logger.info(f"Fornecedor criado automaticamente: {nome_cliente_fornecedor} (ID: {fornecedor_id})")
+                        fornecedor = cadastros.fornecedor(nome_cliente_fornecedor, criar=True)
                 else:
                     # Fallback para lógica antiga se não houver tipo específico
                     # Buscar ou criar conta caixa automaticamente
-                    conta_caixa_id = buscar_ou_criar_conta_caixa(row_data[6] if len(row_data) > 6 else None, contas_caixa_cache, usuario.id, empresa_id)
+                    conta_caixa = cadastros.conta_caixa(row_data[6] if len(row_data) > 6 else None)
 
-                    # Buscar cliente com busca inteligente
-                    cliente_id = buscar_cliente(row_data[7] if len(row_data) > 7 else None, clientes_cache)
-
-                    # Buscar fornecedor com busca inteligente
-                    fornecedor_id = buscar_fornecedor(row_data[8] if len(row_data) > 8 else None, fornecedores_cache)
+                    # Buscar cliente e fornecedor com busca inteligente
+                    cliente = cadastros.cliente(row_data[7] if len(row_data) > 7 else None)
+                    fornecedor = cadastros.fornecedor(row_data[8] if len(row_data) > 8 else None)
 
                 # Buscar conta caixa via coluna CONTA_CAIXA se ainda não definida pelo fallback
-                if conta_caixa_id is None:
-                    conta_caixa_id = buscar_ou_criar_conta_caixa(dados.get('CONTA_CAIXA'), contas_caixa_cache, usuario.id, empresa_id)
+                if conta_caixa is None:
+                    conta_caixa = cadastros.conta_caixa(dados.get('CONTA_CAIXA'))
                 
                 # Calcular status automaticamente baseado na data de realização
                 hoje = datetime.now().date()
@@ -15354,250 +17848,48 @@ def api_importar_dados():
                     except Exception as e_cart:
                         app.logger.warning(f'[Import] Erro ao gerar itens_carrinho: {e_cart}')
                 
-                # Criar lançamento financeiro
-                if is_parcelado and quantidade_parcelas > 1:
-                    # Criar lançamentos parcelados
-                    # Usar valor_total da operação (incluindo descontos) para calcular valor da parcela
-                    valor_total_operacao = valor_total if valor_total is not None else valor
-                    valor_parcela = valor_total_operacao / quantidade_parcelas
-
-                    for i in range(quantidade_parcelas):
-                        # Calcular data da parcela (mês a mês) - adiciona meses corretamente
-                        if i == 0:
-                            data_parcela = data_prevista
-                        else:
-                            # Adicionar meses considerando variação de dias (28-31)
-                            mes = data_prevista.month + i
-                            ano = data_prevista.year
-                            while mes > 12:
-                                mes -= 12
-                                ano += 1
-                            # Garantir que o dia existe no mês destino
-                            import calendar
-                            ultimo_dia_mes = calendar.monthrange(ano, mes)[1]
-                            dia = min(data_prevista.day, ultimo_dia_mes)
-                            data_parcela = date(ano, mes, dia)
-                        
-                        # Criar lançamento da parcela
-                        novo_lancamento = Lancamento(
-                            descricao=f"{descricao} - Parcela {i+1}/{quantidade_parcelas}",
-                            valor=valor_parcela,
-                            tipo=tipo,
-                            categoria=categoria,
-                            plano_conta_id=categoria_id,
-                            data_prevista=data_parcela,
-                            data_realizada=data_realizada if i == 0 and data_realizada else None,
-                            realizado=realizado if i == 0 else False,
-                            usuario_id=usuario.id,
-                            empresa_id=empresa_id,
-                            conta_caixa_id=conta_caixa_id,
-                            cliente_id=cliente_id,
-                            fornecedor_id=fornecedor_id,
-                            observacoes=f"{observacoes or ''} - Parcela {i+1}/{quantidade_parcelas}".strip(),
-                            produto_servico=produto_servico_final,
-                            tipo_produto_servico=tipo_produto_servico,
-                            itens_carrinho=itens_carrinho_importacao,
-                            nota_fiscal=nota_fiscal,
-                            usuario_criacao_id=usuario.id  # Registrar quem criou
-                        )
-                        
-                        db.session.add(novo_lancamento)
-                        db.session.flush()  # Para obter o ID
-                        
-                        lancamentos_criados.append(novo_lancamento)
-                        
-                        # LÓGICA MELHORADA: Vinculação automática aos módulos baseada no tipo cliente/fornecedor
-                        if i == 0:  # Apenas na primeira parcela
-                            deve_criar_venda = False
-                            deve_criar_compra = False
-                            
-                            # Lógica baseada no tipo cliente/fornecedor da planilha
-                            if tipo_cliente_fornecedor == 'cliente':
-                                deve_criar_venda = True
-                                app.logger.info(f"Vinculação automática: Cliente identificado → Criando VENDA (ID Cliente: {cliente_id})")
-                                
-                            elif tipo_cliente_fornecedor == 'fornecedor':
-                                deve_criar_compra = True
-                                app.logger.info(f"Vinculação automática: Fornecedor identificado → Criando COMPRA (ID Fornecedor: {fornecedor_id})")
-                                
-                                # Se fornecedor + mercadoria, vincular também ao estoque
-                                if eh_produto:
-                                    app.logger.info(f"Vinculação automática: Fornecedor + Produto → Vinculando aos módulos COMPRAS + ESTOQUE")
-                            
-                            # Fallback para lógica antiga se não houver tipo específico
-                            elif not tipo_cliente_fornecedor:
-                                # Se tem cliente, sempre criar venda
-                                if cliente_id:
-                                    deve_criar_venda = True
-                                    app.logger.info(f"Fallback: Cliente encontrado → Criando venda (Cliente ID: {cliente_id})")
-                                
-                                # Se tem fornecedor, sempre criar compra
-                                if fornecedor_id:
-                                    deve_criar_compra = True
-                                    app.logger.info(f"Fallback: Fornecedor encontrado → Criando compra (Fornecedor ID: {fornecedor_id})")
-                                
-                                # Se não tem cliente/fornecedor específico, usar lógica baseada no tipo e produto/serviço
-                                if not cliente_id and not fornecedor_id and produto_servico_final:
-                                    if tipo == 'entrada':
-                                        deve_criar_venda = True
-                                        app.logger.info(f"Fallback: Entrada com produto/serviço → Criando venda automática: {produto_servico_final}")
-                                    elif tipo == 'saida':
-                                        deve_criar_compra = True
-                                        app.logger.info(f"Fallback: Saída com produto/serviço → Criando compra automática: {produto_servico_final}")
-                            
-                            # Criar venda se necessário
-                            if deve_criar_venda:
-                                venda = criar_venda_automatica(novo_lancamento, usuario.id, valor_total, quantidade)
-                                if venda:
-                                    vendas_criadas.append(venda)
-                                    # Criar vínculo
-                                    criar_vinculo('lancamento', novo_lancamento.id, 'venda', venda.id, usuario.id)
-                                    app.logger.info(f"Venda criada com sucesso: ID {venda.id}")
-                                    
-                                    # Atualizar estoque se for produto
-                                    if eh_produto and produto_servico_final:
-                                        sucesso_estoque, mensagem_estoque = atualizar_estoque_venda(venda, usuario.id)
-                                        if sucesso_estoque:
-                                            app.logger.info(f"Estoque atualizado para venda {venda.id}: {mensagem_estoque}")
-                                        else:
-                                            app.logger.warning(f"Aviso no estoque para venda {venda.id}: {mensagem_estoque}")
-                                    elif eh_servico:
-                                        app.logger.info(f"Venda de serviço {venda.id} - não afeta estoque")
-                                else:
-                                    app.logger.error("Falha ao criar venda")
-                            
-                            # Criar compra se necessário
-                            if deve_criar_compra:
-                                compra = criar_compra_automatica(novo_lancamento, usuario.id, valor_total, quantidade)
-                                if compra:
-                                    compras_criadas.append(compra)
-                                    # Criar vínculo
-                                    criar_vinculo('lancamento', novo_lancamento.id, 'compra', compra.id, usuario.id)
-                                    app.logger.info(f"Compra criada com sucesso: ID {compra.id}")
-                                    
-                                    # Atualizar estoque se for produto
-                                    if eh_produto and produto_servico_final:
-                                        sucesso_estoque, mensagem_estoque = atualizar_estoque_compra(compra, usuario.id)
-                                        if sucesso_estoque:
-                                            app.logger.info(f"Estoque atualizado para compra {compra.id}: {mensagem_estoque}")
-                                        else:
-                                            app.logger.warning(f"Aviso no estoque para compra {compra.id}: {mensagem_estoque}")
-                                    elif eh_servico:
-                                        app.logger.info(f"Compra de serviço {compra.id} - não afeta estoque")
-                                else:
-                                    app.logger.error("Falha ao criar compra")
-                else:
-                    # Criar lançamento único
-                    novo_lancamento = Lancamento(
-                        descricao=descricao,
-                        valor=valor,
-                        tipo=tipo,
-                        categoria=categoria,
-                        plano_conta_id=categoria_id,
-                        data_prevista=data_prevista,
-                        data_realizada=data_realizada,
-                        realizado=realizado,
-                        usuario_id=usuario.id,
-                        empresa_id=empresa_id,
-                        conta_caixa_id=conta_caixa_id,
-                        cliente_id=cliente_id,
-                        fornecedor_id=fornecedor_id,
-                        observacoes=observacoes,
-                        produto_servico=produto_servico_final,
-                        tipo_produto_servico=tipo_produto_servico,
-                        itens_carrinho=itens_carrinho_importacao,
-                        nota_fiscal=nota_fiscal,
-                        usuario_criacao_id=usuario.id  # Registrar quem criou
-                    )
-                    
-                    db.session.add(novo_lancamento)
-                    db.session.flush()  # Para obter o ID
-                    
-                    lancamentos_criados.append(novo_lancamento)
-                    
-                    # LÓGICA MELHORADA: Vinculação automática aos módulos baseada no tipo cliente/fornecedor
-                    deve_criar_venda = False
-                    deve_criar_compra = False
-                    
-                    # Lógica baseada no tipo cliente/fornecedor da planilha
-                    if tipo_cliente_fornecedor == 'cliente':
-                        deve_criar_venda = True
-                        app.logger.info(f"Vinculação automática: Cliente identificado → Criando VENDA (ID Cliente: {cliente_id})")
-                        
-                    elif tipo_cliente_fornecedor == 'fornecedor':
-                        deve_criar_compra = True
-                        app.logger.info(f"Vinculação automática: Fornecedor identificado → Criando COMPRA (ID Fornecedor: {fornecedor_id})")
-                        
-                        # Se fornecedor + mercadoria, vincular também ao estoque
-                        if eh_produto:
-                            app.logger.info(f"Vinculação automática: Fornecedor + Produto → Vinculando aos módulos COMPRAS + ESTOQUE")
-                    
-                    # Fallback para lógica antiga se não houver tipo específico
-                    elif not tipo_cliente_fornecedor:
-                        # Se tem cliente, sempre criar venda
-                        if cliente_id:
-                            deve_criar_venda = True
-                            app.logger.info(f"Fallback: Cliente encontrado → Criando venda (Cliente ID: {cliente_id})")
-                        
-                        # Se tem fornecedor, sempre criar compra
-                        if fornecedor_id:
-                            deve_criar_compra = True
-                            app.logger.info(f"Fallback: Fornecedor encontrado → Criando compra (Fornecedor ID: {fornecedor_id})")
-                        
-                        # Se não tem cliente/fornecedor específico, usar lógica baseada no tipo e produto/serviço
-                        if not cliente_id and not fornecedor_id and produto_servico_final:
-                            if tipo == 'entrada':
-                                deve_criar_venda = True
-                                app.logger.info(f"Fallback: Entrada com produto/serviço → Criando venda automática: {produto_servico_final}")
-                            elif tipo == 'saida':
-                                deve_criar_compra = True
-                                app.logger.info(f"Fallback: Saída com produto/serviço → Criando compra automática: {produto_servico_final}")
-                    
-                    # Criar venda se necessário
-                    if deve_criar_venda:
-                        venda = criar_venda_automatica(novo_lancamento, usuario.id, valor_total, quantidade)
-                        if venda:
-                            vendas_criadas.append(venda)
-                            # Criar vínculo
-                            criar_vinculo('lancamento', novo_lancamento.id, 'venda', venda.id, usuario.id)
-                            app.logger.info(f"Venda criada com sucesso: ID {venda.id}")
-                            
-                            # Atualizar estoque se for produto
-                            if eh_produto and produto_servico_final:
-                                sucesso_estoque, mensagem_estoque = atualizar_estoque_venda(venda, usuario.id)
-                                if sucesso_estoque:
-                                    app.logger.info(f"Estoque atualizado para venda {venda.id}: {mensagem_estoque}")
-                                else:
-                                    app.logger.warning(f"Aviso no estoque para venda {venda.id}: {mensagem_estoque}")
-                            elif eh_servico:
-                                app.logger.info(f"Venda de serviço {venda.id} - não afeta estoque")
-                        else:
-                            app.logger.error("Falha ao criar venda")
-                    
-                    # Criar compra se necessário
-                    if deve_criar_compra:
-                        compra = criar_compra_automatica(novo_lancamento, usuario.id, valor_total, quantidade)
-                        if compra:
-                            compras_criadas.append(compra)
-                            # Criar vínculo
-                            criar_vinculo('lancamento', novo_lancamento.id, 'compra', compra.id, usuario.id)
-                            app.logger.info(f"Compra criada com sucesso: ID {compra.id}")
-                            
-                            # Atualizar estoque se for produto
-                            if eh_produto and produto_servico_final:
-                                sucesso_estoque, mensagem_estoque = atualizar_estoque_compra(compra, usuario.id)
-                                if sucesso_estoque:
-                                    app.logger.info(f"Estoque atualizado para compra {compra.id}: {mensagem_estoque}")
-                                else:
-                                    app.logger.warning(f"Aviso no estoque para compra {compra.id}: {mensagem_estoque}")
-                            elif eh_servico:
-                                app.logger.info(f"Compra de serviço {compra.id} - não afeta estoque")
-                        else:
-                            app.logger.error("Falha ao criar compra")
-
-                # Nota: Saldo da conta caixa é calculado dinamicamente, não precisa atualizar aqui
-
-                sucessos += 1
+                # Vinculação automática aos módulos baseada no tipo cliente/fornecedor
+                deve_criar_venda = False
+                deve_criar_compra = False
+                if tipo_cliente_fornecedor == 'cliente':
+                    deve_criar_venda = True
+                elif tipo_cliente_fornecedor == 'fornecedor':
+                    deve_criar_compra = True
+                elif not tipo_cliente_fornecedor:
+                    # Fallback: cliente gera venda, fornecedor gera compra
+                    deve_criar_venda = cliente is not None
+                    deve_criar_compra = fornecedor is not None
+                    # Sem cliente/fornecedor, usar o tipo do lançamento quando há produto/serviço
+                    if not cliente and not fornecedor and produto_servico_final:
+                        deve_criar_venda = tipo == 'entrada'
+                        deve_criar_compra = tipo == 'saida'
+                
+                linhas_preparadas.append({
+                    'linha': row_num,
+                    'descricao': descricao,
+                    'valor': valor,
+                    'valor_total': valor_total,
+                    'quantidade': quantidade,
+                    'quantidade_parcelas': quantidade_parcelas if is_parcelado else 1,
+                    'tipo': tipo,
+                    'categoria': categoria,
+                    'plano_conta': plano_conta,
+                    'data_prevista': data_prevista,
+                    'data_realizada': data_realizada,
+                    'realizado': realizado,
+                    'conta_caixa': conta_caixa,
+                    'cliente': cliente,
+                    'fornecedor': fornecedor,
+                    'observacoes': observacoes,
+                    'produto_servico': produto_servico_final,
+                    'tipo_produto_servico': tipo_produto_servico,
+                    'itens_carrinho': itens_carrinho_importacao,
+                    'nota_fiscal': nota_fiscal,
+                    'criar_venda': deve_criar_venda,
+                    'criar_compra': deve_criar_compra,
+                    # Venda/compra de produto movimenta o estoque
+                    'atualiza_estoque': bool(eh_produto and produto_servico_final),
+                })
                 
             except Exception as e:
                 erro_msg = f"Linha {row_num}: {str(e)}"
@@ -15606,53 +17898,50 @@ def api_importar_dados():
                 # Continuar processamento mesmo com erro
                 continue
         
-        # Commit das alterações
-        db.session.commit()
-        
-        # Log da importação
-        app.logger.info(f"Importação concluída: {sucessos} sucessos, {len(erros)} erros")
-        
-        # Salvar registro da importação
-        total_receitas_import = sum([l.valor for l in lancamentos_criados if l.tipo == 'entrada'])
-        total_despesas_import = sum([l.valor for l in lancamentos_criados if l.tipo == 'saida'])
-        
-        # Salvar IDs dos registros criados para poder desfazer depois
-        import json
-        lancamentos_ids = [str(l.id) for l in lancamentos_criados]
-        vendas_ids = [str(v.id) for v in vendas_criadas]
-        compras_ids = [str(c.id) for c in compras_criadas]
-        
+        # Cadastros novos gravados de uma vez; o registro da importação acompanha o progresso
+        cadastros.gravar(linhas_preparadas)
         registro_importacao = Importacao(
             usuario_id=usuario.id,
             nome_arquivo=arquivo.filename,
-            total_lancamentos=len(lancamentos_criados),
-            total_entradas=total_receitas_import,
-            total_saidas=total_despesas_import,
-            total_vendas=len(vendas_criadas),
-            total_compras=len(compras_criadas),
-            sucessos=sucessos,
-            erros=len(erros),
-            status='concluida',
-            lancamentos_ids=json.dumps(lancamentos_ids),
-            vendas_ids=json.dumps(vendas_ids),
-            compras_ids=json.dumps(compras_ids)
+            status='processando',
+            linhas_total=len(linhas_preparadas),
+            linhas_processadas=0,
+            erros=len(erros)
         )
         db.session.add(registro_importacao)
         db.session.commit()
         
+        # Lançamentos, vendas e compras em lotes (um commit por lote)
+        gravador = GravadorImportacao(registro_importacao, usuario.id, empresa_id, erros)
+        gravador.gravar(linhas_preparadas)
+        try:
+            gravador.atualizar_estoque()
+        except Exception as e:
+            # Os lotes já estão gravados: a falha no estoque não deixa a importação em processamento
+            db.session.rollback()
+            erros.append(f"Estoque: não foi possível recalcular o estoque dos produtos importados: {str(e)}")
+            app.logger.error(f"Erro ao atualizar estoque da importação {registro_importacao.id}: {str(e)}")
+        
+        registro_importacao.erros = len(erros)
+        registro_importacao.status = 'concluida'
+        db.session.commit()
+        
+        # Log da importação
+        app.logger.info(f"Importação concluída: {gravador.sucessos} sucessos, {len(erros)} erros")
+        
         return jsonify({
             'success': True,
-            'sucessos': sucessos,
+            'sucessos': gravador.sucessos,
             'erros': erros,
-            'total_processados': sucessos + len(erros),
-            'lancamentos_criados': len(lancamentos_criados),
-            'vendas_criadas': len(vendas_criadas),
-            'compras_criadas': len(compras_criadas),
+            'total_processados': gravador.sucessos + len(erros),
+            'lancamentos_criados': len(gravador.lancamentos),
+            'vendas_criadas': len(gravador.vendas),
+            'compras_criadas': len(gravador.compras),
             'importacao_id': registro_importacao.id,
             'detalhes': {
-                'lancamentos': [{'id': l.id, 'descricao': l.descricao} for l in lancamentos_criados],
-                'vendas': [{'id': v.id, 'cliente': v.cliente.nome if v.cliente else 'N/A'} for v in vendas_criadas],
-                'compras': [{'id': c.id, 'fornecedor': c.fornecedor.nome if c.fornecedor else 'N/A'} for c in compras_criadas]
+                'lancamentos': [{'id': i, 'descricao': d} for i, d in gravador.lancamentos],
+                'vendas': [{'id': i, 'cliente': nome} for i, nome in gravador.vendas],
+                'compras': [{'id': i, 'fornecedor': nome} for i, nome in gravador.compras]
             }
         })
         
@@ -15660,6 +17949,10 @@ def api_importar_dados():
         db.session.rollback()
         app.logger.error(f"Erro ao importar dados: {str(e)}")
         return jsonify({'error': f'Erro ao processar arquivo: {str(e)}'}), 500
+    finally:
+        # O workbook somente leitura mantém o arquivo aberto até ser fechado
+        if planilha:
+            planilha.fechar()
 
 @app.route('/api/importacao/listar')
 def api_listar_importacoes():
@@ -15687,7 +17980,9 @@ def api_listar_importacoes():
             'total_compras': imp.total_compras,
             'sucessos': imp.sucessos,
             'erros': imp.erros,
-            'status': imp.status
+            'status': imp.status,
+            'linhas_total': imp.linhas_total or 0,
+            'linhas_processadas': imp.linhas_processadas or 0
         })
     
     return jsonify({'importacoes': dados})
@@ -15711,6 +18006,12 @@ def api_desfazer_importacao(importacao_id):
         if importacao.status == 'desfeita':
             return jsonify({'error': 'Importação já foi desfeita'}), 400
         
+        # Os lotes são gravados um a um: só desfazer depois que a importação terminou
+        if importacao.status == 'processando':
+            return jsonify({'error': 'Importação ainda em processamento. Aguarde a conclusão para desfazê-la.'}), 409
+        if importacao.status != 'concluida':
+            return jsonify({'error': 'Importação não pode ser desfeita'}), 400
+        
         # Buscar lançamentos, vendas e compras pelos IDs salvos
         import json
         lancamentos_ids = json.loads(importacao.lancamentos_ids) if importacao.lancamentos_ids else []
@@ -15896,6 +18197,56 @@ def buscar_conta_caixa(nome_input, cache):
     
     return None
 
+def nova_conta_caixa_importacao(nome_original, usuario_id):
+    """Monta a conta caixa criada automaticamente na importação, com o tipo deduzido do nome"""
+    nome = nome_original.lower()
+    tipo_conta = 'Dinheiro'  # Padrão
+    if any(palavra in nome for palavra in ['banco', 'conta', 'corrente', 'poupança']):
+        tipo_conta = 'Conta Corrente'
+    elif any(palavra in nome for palavra in ['cartão', 'cartao', 'credito', 'crédito']):
+        tipo_conta = 'Cartão'
+    elif any(palavra in nome for palavra in ['nubank', 'inter', 'itau', 'bradesco', 'santander']):
+        tipo_conta = 'Conta Digital'
+
+    return ContaCaixa(
+        nome=nome_original,
+        tipo=tipo_conta,
+        saldo_inicial=0.0,
+        saldo_atual=0.0,
+        ativo=True,
+        descricao=f'Conta criada automaticamente durante importação - {nome_original}',
+        usuario_id=usuario_id,
+        data_criacao=datetime.utcnow()
+    )
+
+def codigo_categoria_importacao(nome_original, usuario_id, codigo_em_uso):
+    """Gera o código (99.XXXXX, 99.XXXXX.1, ...) de uma categoria criada na importação.
+    codigo_em_uso(codigo) informa se o código já pertence a outra categoria ativa."""
+    codigo_base = f"99.{nome_original[:5].upper()}"
+    codigo = codigo_base
+    contador = 1
+    while codigo_em_uso(codigo):
+        codigo = f"{codigo_base}.{contador}"
+        contador += 1
+        if contador > 999:  # Limite de segurança
+            codigo = f"99.IMP{usuario_id}{int(datetime.utcnow().timestamp())}"
+            break
+    return codigo
+
+def nova_categoria_importacao(nome_original, tipo_lancamento, codigo, usuario_id, empresa_id):
+    """Monta a categoria do plano de contas criada automaticamente na importação"""
+    return PlanoConta(
+        nome=nome_original,
+        tipo=tipo_lancamento,
+        natureza='analitica',
+        nivel=1,
+        codigo=codigo,  # Código único garantido
+        descricao=f"Categoria criada automaticamente durante importação - {nome_original}",
+        usuario_id=usuario_id,
+        empresa_id=empresa_id,
+        data_criacao=datetime.utcnow()
+    )
+
 def buscar_ou_criar_conta_caixa(nome_input, cache, usuario_id, empresa_id):
     """Busca conta caixa e cria automaticamente se não existir"""
     if not nome_input:
@@ -15911,26 +18262,7 @@ def buscar_ou_criar_conta_caixa(nome_input, cache, usuario_id, empresa_id):
     
     # Se não encontrou, criar automaticamente
     try:
-        # Determinar tipo baseado no nome
-        tipo_conta = 'Dinheiro'  # Padrão
-        if any(palavra in nome for palavra in ['banco', 'conta', 'corrente', 'poupança']):
-            tipo_conta = 'Conta Corrente'
-        elif any(palavra in nome for palavra in ['cartão', 'cartao', 'credito', 'crédito']):
-            tipo_conta = 'Cartão'
-        elif any(palavra in nome for palavra in ['nubank', 'inter', 'itau', 'bradesco', 'santander']):
-            tipo_conta = 'Conta Digital'
-        
-        # Criar nova conta caixa
-        nova_conta = ContaCaixa(
-            nome=nome_original,
-            tipo=tipo_conta,
-            saldo_inicial=0.0,
-            saldo_atual=0.0,
-            ativo=True,
-            descricao=f'Conta criada automaticamente durante importação - {nome_original}',
-            usuario_id=usuario_id,
-            data_criacao=datetime.utcnow()
-        )
+        nova_conta = nova_conta_caixa_importacao(nome_original, usuario_id)
         
         db.session.add(nova_conta)
         db.session.commit()
@@ -15970,29 +18302,12 @@ def buscar_ou_criar_categoria_plano_contas(nome_categoria, tipo_lancamento, usua
             app.logger.info(f"✅ Categoria '{nome_original}' já existe no plano de contas (ID: {categoria_existe.id})")
             return categoria_existe.id
         
-        # Se não encontrou, criar automaticamente
-        # Gerar código único para evitar duplicatas
-        codigo_base = f"99.{nome_original[:5].upper()}"
-        codigo = codigo_base
-        contador = 1
-        while PlanoConta.query.filter_by(empresa_id=empresa_id, codigo=codigo, ativo=True).first():
-            codigo = f"{codigo_base}.{contador}"
-            contador += 1
-            if contador > 999:  # Limite de segurança
-                codigo = f"99.IMP{usuario_id}{int(datetime.utcnow().timestamp())}"
-                break
-
-        nova_categoria = PlanoConta(
-            nome=nome_original,
-            tipo=tipo_lancamento,
-            natureza='analitica',
-            nivel=1,
-            codigo=codigo,  # Código único garantido
-            descricao=f"Categoria criada automaticamente durante importação - {nome_original}",
-            usuario_id=usuario_id,
-            empresa_id=empresa_id,
-            data_criacao=datetime.utcnow()
+        # Se não encontrou, criar automaticamente com código único para evitar duplicatas
+        codigo = codigo_categoria_importacao(
+            nome_original, usuario_id,
+            lambda c: PlanoConta.query.filter_by(empresa_id=empresa_id, codigo=c, ativo=True).first() is not None
         )
+        nova_categoria = nova_categoria_importacao(nome_original, tipo_lancamento, codigo, usuario_id, empresa_id)
         
         db.session.add(nova_categoria)
         db.session.commit()
@@ -16005,8 +18320,8 @@ def buscar_ou_criar_categoria_plano_contas(nome_categoria, tipo_lancamento, usua
         app.logger.error(f"❌ Erro ao criar categoria '{nome_original}': {str(e)}")
         return None
 
-def criar_venda_automatica(lancamento, usuario_id, valor_total=None, quantidade=1):
-    """Cria uma venda automaticamente baseada no lançamento financeiro"""
+def montar_venda_automatica(lancamento, usuario_id, valor_total=None, quantidade=1):
+    """Monta (sem gravar) a venda correspondente a um lançamento importado; o chamador grava em lote"""
     try:
         
         # Usar valor_total se fornecido, senão usar valor do lançamento
@@ -16042,19 +18357,14 @@ def criar_venda_automatica(lancamento, usuario_id, valor_total=None, quantidade=
             nota_fiscal=lancamento.nota_fiscal
         )
         
-        db.session.add(venda)
-        db.session.flush()  # Para obter o ID
-        
-        app.logger.info(f"✅ Venda criada automaticamente: ID {venda.id}, Produto: {venda.produto}, Valor: R$ {venda.valor}")
-        
         return venda
         
     except Exception as e:
-        app.logger.error(f"❌ Erro ao criar venda automática: {str(e)}")
+        app.logger.error(f"❌ Erro ao montar venda automática: {str(e)}")
         return None
 
-def criar_compra_automatica(lancamento, usuario_id, valor_total=None, quantidade=1):
-    """Cria uma compra automaticamente baseada no lançamento financeiro"""
+def montar_compra_automatica(lancamento, usuario_id, valor_total=None, quantidade=1):
+    """Monta (sem gravar) a compra correspondente a um lançamento importado; o chamador grava em lote"""
     try:
         
         # Usar valor_total se fornecido, senão usar valor do lançamento
@@ -16092,15 +18402,10 @@ def criar_compra_automatica(lancamento, usuario_id, valor_total=None, quantidade
             nota_fiscal=lancamento.nota_fiscal
         )
         
-        db.session.add(compra)
-        db.session.flush()  # Para obter o ID
-        
-        app.logger.info(f"✅ Compra criada automaticamente: ID {compra.id}, Produto: {compra.produto}, Valor: R$ {compra.valor}")
-        
         return compra
         
     except Exception as e:
-        app.logger.error(f"❌ Erro ao criar compra automática: {str(e)}")
+        app.logger.error(f"❌ Erro ao montar compra automática: {str(e)}")
         return None
 
 def atualizar_estoque_venda(venda, usuario_id):
@@ -16161,29 +18466,16 @@ def atualizar_estoque_compra(compra, usuario_id):
         if not hasattr(compra, 'produto') or not compra.produto:
             return True, "Produto não especificado - estoque não será atualizado"
 
-        # Buscar lançamento vinculado para pegar itens_carrinho
-        lancamento = Lancamento.query.filter_by(compra_id=compra.id).first()
-        itens_para_processar = []
-
-        if lancamento and lancamento.itens_carrinho:
-            # Compra com múltiplos produtos (carrinho)
-            try:
-                import json
-                itens_carrinho = json.loads(lancamento.itens_carrinho)
-
-                for item in itens_carrinho:
-                    # Processar apenas mercadorias
-                    if item.get('tipo') == 'mercadoria':
-                        itens_para_processar.append({
-                            'nome': item['nome'],
-                            'quantidade': item['qtd'],
-                            'preco_custo': item['preco']
-                        })
-
-                app.logger.info(f"🛒 Processando {len(itens_para_processar)} produtos do carrinho")
-            except Exception as e:
-                app.logger.warning(f"⚠️ Erro ao parsear itens_carrinho: {e}, processando como produto único")
-                itens_para_processar = []
+        # Itens do carrinho (compra com múltiplos produtos), apenas mercadorias
+        itens_para_processar = [{
+            'nome': item.nome,
+            'quantidade': item.quantidade,
+            'preco_custo': item.preco_unitario
+        } for item in ItemCarrinho.query.filter_by(compra_id=compra.id, tipo='mercadoria').order_by(
+            ItemCarrinho.lancamento_id, ItemCarrinho.ordem
+        )]
+        if itens_para_processar:
+            app.logger.info(f"🛒 Processando {len(itens_para_processar)} produtos do carrinho")
 
         # Se não tem itens do carrinho, processar como produto único (comportamento antigo)
         if not itens_para_processar:
@@ -17913,318 +20205,347 @@ def processar_data(valor_data):
 
 # ===== FUNÇÕES DE EXPORTAÇÃO =====
 
+# ===== EXPORTAÇÃO EXCEL EM STREAMING =====
+
+class PlanilhaStreaming:
+    """
+    Planilha Excel gerada no modo write_only do openpyxl: cada linha é gravada
+    no arquivo assim que é adicionada, então a memória não cresce com o número
+    de linhas. Os estilos são NamedStyles registrados uma vez no workbook e
+    referenciados pelo nome nas células, em vez de Font/PatternFill por célula.
+
+    No modo write_only larguras de coluna e painéis congelados precisam ser
+    definidos antes da primeira linha (ver aba()), e as linhas só podem ser
+    acrescentadas em ordem.
+    """
+
+    MOEDA = 'R$ #,##0.00'
+    MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def __init__(self):
+        self.wb = Workbook(write_only=True)
+        self.estilos = set()
+
+        from openpyxl.styles import PatternFill, Alignment
+        self.registrar_estilo('titulo', font=Font(name='Arial', size=16, bold=True, color='FFFFFF'),
+                              fill=PatternFill(start_color='2F5597', end_color='2F5597', fill_type='solid'),
+                              alignment=Alignment(horizontal='center', vertical='center'))
+        self.registrar_estilo('subtitulo', font=Font(name='Arial', size=12, bold=True, color='FFFFFF'),
+                              fill=PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid'),
+                              alignment=Alignment(horizontal='left', vertical='center'))
+        self.registrar_estilo('titulo_relatorio', font=Font(bold=True, size=14))
+        self.registrar_estilo('empresa', font=Font(bold=True, size=16))
+        self.registrar_estilo('centralizado', alignment=Alignment(horizontal='center'))
+        self.registrar_estilo('negrito', font=Font(bold=True))
+        self.registrar_estilo('moeda', number_format=self.MOEDA)
+        self.registrar_estilo('moeda_negrito', font=Font(bold=True), number_format=self.MOEDA)
+        self.registrar_estilo('cabecalho', font=Font(bold=True))
+
+    def registrar_estilo(self, nome, **atributos):
+        """Registra o NamedStyle no workbook (uma vez) e retorna o nome para uso nas células."""
+        from openpyxl.styles import NamedStyle
+
+        if nome not in self.estilos:
+            self.wb.add_named_style(NamedStyle(name=nome, **atributos))
+            self.estilos.add(nome)
+        return nome
+
+    def estilo_cabecalho(self, cor, cor_fonte='FFFFFF'):
+        """Cabeçalho de tabela em negrito sobre a cor de fundo informada."""
+        from openpyxl.styles import PatternFill, Alignment
+
+        return self.registrar_estilo(
+            f'cabecalho_{cor}',
+            font=Font(bold=True, color=cor_fonte),
+            fill=PatternFill(start_color=cor, end_color=cor, fill_type='solid'),
+            alignment=Alignment(horizontal='center', vertical='center')
+        )
+
+    def aba(self, titulo, larguras=None, congelar=None):
+        """Cria uma aba com as larguras de coluna e o painel congelado já definidos."""
+        from openpyxl.utils import get_column_letter
+
+        ws = self.wb.create_sheet(titulo)
+        for coluna, largura in enumerate(larguras or [], 1):
+            ws.column_dimensions[get_column_letter(coluna)].width = largura
+        if congelar:
+            ws.freeze_panes = congelar
+        return ws
+
+    def mesclar(self, ws, intervalo):
+        """Mescla células (ex.: 'A1:F1'); deve ser chamado antes de gravar a linha."""
+        ws.merged_cells.add(intervalo)
+
+    def linha(self, ws, valores=(), estilos=None):
+        """
+        Acrescenta uma linha. estilos é o nome de um estilo para a linha toda ou
+        {número da coluna (1 = A): nome do estilo}.
+        """
+        from openpyxl.cell import WriteOnlyCell
+
+        if not estilos:
+            ws.append(list(valores))
+            return
+        celulas = []
+        for coluna, valor in enumerate(valores, 1):
+            estilo = estilos if isinstance(estilos, str) else estilos.get(coluna)
+            if estilo:
+                celula = WriteOnlyCell(ws, value=valor)
+                celula.style = estilo
+                celulas.append(celula)
+            else:
+                celulas.append(valor)
+        ws.append(celulas)
+
+    def linhas(self, ws, registros, estilos=None):
+        """Acrescenta as linhas de um iterável (ex.: consulta com yield_per). Retorna quantas foram gravadas."""
+        total = 0
+        for valores in registros:
+            self.linha(ws, valores, estilos)
+            total += 1
+        return total
+
+    def salvar(self, prefixo='exportacao'):
+        """
+        Grava o workbook num arquivo temporário e retorna o arquivo aberto, no
+        início. O arquivo é apagado quando fechado, o que o send_file faz ao
+        terminar a resposta.
+        """
+        import tempfile
+
+        arquivo = tempfile.NamedTemporaryFile(suffix='.xlsx', prefix=f'{prefixo}_')
+        self.wb.save(arquivo)
+        arquivo.seek(0)
+        return arquivo
+
+    def enviar(self, nome_arquivo):
+        """Resposta de download da planilha."""
+        return send_file(self.salvar(), mimetype=self.MIMETYPE, as_attachment=True, download_name=nome_arquivo)
+
+
+def status_lancamento_exportacao(data_prevista, data_realizada, hoje):
+    """Status exibido nas exportações: Realizado, Agendado, Vencido ou Pendente."""
+    if data_realizada and data_realizada <= hoje:
+        return "Realizado"
+    if data_realizada and data_realizada > hoje:
+        return "Agendado"
+    if not data_realizada and data_prevista and data_prevista < hoje:
+        return "Vencido"
+    return "Pendente"
+
+
+def linhas_lancamentos_exportacao(consulta):
+    """
+    Colunas dos lançamentos para as exportações, lidas em lotes com yield_per
+    (cursor no servidor no PostgreSQL). O nome do cliente/fornecedor vem por
+    outer join, com a mesma prioridade de antes: cliente, fornecedor, cliente
+    da venda, fornecedor da compra.
+    """
+    cliente, fornecedor = db.aliased(Cliente), db.aliased(Fornecedor)
+    venda, compra = db.aliased(Venda), db.aliased(Compra)
+    cliente_venda, fornecedor_compra = db.aliased(Cliente), db.aliased(Fornecedor)
+
+    return consulta.outerjoin(cliente, Lancamento.cliente_id == cliente.id).outerjoin(
+        fornecedor, Lancamento.fornecedor_id == fornecedor.id
+    ).outerjoin(venda, Lancamento.venda_id == venda.id).outerjoin(
+        cliente_venda, venda.cliente_id == cliente_venda.id
+    ).outerjoin(compra, Lancamento.compra_id == compra.id).outerjoin(
+        fornecedor_compra, compra.fornecedor_id == fornecedor_compra.id
+    ).with_entities(
+        Lancamento.data_prevista,
+        Lancamento.data_realizada,
+        Lancamento.descricao,
+        Lancamento.categoria,
+        Lancamento.tipo,
+        db.func.coalesce(
+            db.func.nullif(cliente.nome, ''), db.func.nullif(fornecedor.nome, ''),
+            db.func.nullif(cliente_venda.nome, ''), db.func.nullif(fornecedor_compra.nome, ''), ''
+        ).label('cliente_fornecedor'),
+        Lancamento.valor,
+        Lancamento.nota_fiscal,
+    ).yield_per(app.config['EXPORTACAO_TAMANHO_LOTE'])
+
+
 def exportar_relatorio_excel(dados, nome_arquivo, titulo, usuario=None, filtros=None):
-    """Exporta relatório para Excel"""
+    """
+    Exporta relatório para Excel. Retorna o arquivo temporário aberto (ver
+    PlanilhaStreaming.salvar); dados['lancamentos'] é a consulta dos
+    lançamentos, lida em lotes.
+    """
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Relatório"
-        
-        linha_atual = 1
-        
+        planilha = PlanilhaStreaming()
+
+        # Larguras fixas por relatório: no modo write_only não é possível
+        # medir o conteúdo depois de gravado
+        if 'contas_caixa' in dados and 'categorias_receitas' in dados:
+            larguras = [32, 18, 18, 18, 18, 18]
+        elif 'lancamentos' in dados:
+            larguras = [16, 16, 40, 22, 10, 30, 14, 14, 12]
+        elif 'clientes_dados' in dados:
+            larguras = [30, 30, 16, 16, 16, 16, 16, 18]
+        else:
+            larguras = [8, 30, 40, 14, 14, 10, 16, 22]
+        ws = planilha.aba("Relatório", larguras)
+
         # Cabeçalho da empresa
         if usuario and usuario.empresa:
             empresa_nome = usuario.empresa.razao_social or usuario.empresa.nome_fantasia or 'Empresa'
             empresa_cnpj = usuario.empresa.cnpj or ''
-            
-            ws[f'A{linha_atual}'] = empresa_nome
-            ws[f'A{linha_atual}'].font = Font(bold=True, size=16)
-            linha_atual += 1
-            
+
+            planilha.linha(ws, [empresa_nome], 'empresa')
             if empresa_cnpj:
-                ws[f'A{linha_atual}'] = f"CNPJ: {empresa_cnpj}"
-                linha_atual += 1
-        
+                planilha.linha(ws, [f"CNPJ: {empresa_cnpj}"])
+
         # Título do relatório
-        ws[f'A{linha_atual}'] = titulo
-        ws[f'A{linha_atual}'].font = Font(bold=True, size=14)
-        linha_atual += 1
-        
+        planilha.linha(ws, [titulo], 'titulo_relatorio')
+
         # Informações do período e filtros
         if filtros:
             if filtros.get('data_inicio') and filtros.get('data_fim'):
-                ws[f'A{linha_atual}'] = f"Período: {filtros['data_inicio']} a {filtros['data_fim']}"
+                planilha.linha(ws, [f"Período: {filtros['data_inicio']} a {filtros['data_fim']}"])
             elif filtros.get('data_inicio'):
-                ws[f'A{linha_atual}'] = f"A partir de: {filtros['data_inicio']}"
+                planilha.linha(ws, [f"A partir de: {filtros['data_inicio']}"])
             elif filtros.get('data_fim'):
-                ws[f'A{linha_atual}'] = f"Até: {filtros['data_fim']}"
+                planilha.linha(ws, [f"Até: {filtros['data_fim']}"])
             else:
-                ws[f'A{linha_atual}'] = "Período: Todos os registros"
-            linha_atual += 1
-            
+                planilha.linha(ws, ["Período: Todos os registros"])
+
             if filtros.get('tipo'):
-                ws[f'A{linha_atual}'] = f"Tipo: {filtros['tipo'].title()}"
-                linha_atual += 1
+                planilha.linha(ws, [f"Tipo: {filtros['tipo'].title()}"])
             if filtros.get('categoria'):
-                ws[f'A{linha_atual}'] = f"Categoria: {filtros['categoria']}"
-                linha_atual += 1
+                planilha.linha(ws, [f"Categoria: {filtros['categoria']}"])
             if filtros.get('status'):
-                ws[f'A{linha_atual}'] = f"Status: {filtros['status'].title()}"
-                linha_atual += 1
-        
+                planilha.linha(ws, [f"Status: {filtros['status'].title()}"])
+
         # Data de geração
-        ws[f'A{linha_atual}'] = f"Gerado em: {datetime.now().strftime('%d/%m/%Y às %H:%M')} por {usuario.nome if usuario else 'Sistema'}"
-        linha_atual += 2  # Espaço extra antes da tabela
-        
+        planilha.linha(ws, [f"Gerado em: {datetime.now().strftime('%d/%m/%Y às %H:%M')} por {usuario.nome if usuario else 'Sistema'}"])
+        planilha.linha(ws)  # Espaço extra antes da tabela
+
         # Cabeçalhos
         if 'contas_caixa' in dados and 'categorias_receitas' in dados:
             # BLOCO 1: RESUMO DO PERÍODO
-            ws[f'A{linha_atual}'] = "RESUMO GERAL"
-            ws[f'A{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
+            planilha.linha(ws, ["RESUMO GERAL"], 'negrito')
+            planilha.linha(ws, ["Item", "Realizado", "A Vencer", "Vencido", "Agendado Hoje", "Total Esperado"], 'cabecalho')
+
             resumo = dados['resumo']
-            ws[f'A{linha_atual}'] = "Item"
-            ws[f'B{linha_atual}'] = "Realizado"
-            ws[f'C{linha_atual}'] = "A Vencer"
-            ws[f'D{linha_atual}'] = "Vencido"
-            ws[f'E{linha_atual}'] = "Agendado Hoje"
-            ws[f'F{linha_atual}'] = "Total Esperado"
-            for col in ['A', 'B', 'C', 'D', 'E', 'F']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            # Entradas Totais Gerais
-            ws[f'A{linha_atual}'] = "Total Entradas"
-            ws[f'B{linha_atual}'] = resumo['total_entradas_realizado']
-            ws[f'C{linha_atual}'] = resumo['total_receitas_a_vencer']
-            ws[f'D{linha_atual}'] = resumo['total_receitas_vencidas']
-            ws[f'E{linha_atual}'] = resumo['total_receitas_agendadas']
-            ws[f'F{linha_atual}'] = resumo['total_geral_receitas']
-            linha_atual += 1
-            
-            # Saídas Totais Gerais
-            ws[f'A{linha_atual}'] = "Total Saídas"
-            ws[f'B{linha_atual}'] = resumo['total_saidas_realizado']
-            ws[f'C{linha_atual}'] = resumo['total_saidas_a_vencer']
-            ws[f'D{linha_atual}'] = resumo['total_saidas_vencidas']
-            ws[f'E{linha_atual}'] = resumo['total_saidas_agendadas']
-            ws[f'F{linha_atual}'] = resumo['total_geral_saidas']
-            linha_atual += 1
-            
-            # Saldos
-            ws[f'A{linha_atual}'] = "SALDO"
-            ws[f'A{linha_atual}'].font = Font(bold=True)
-            ws[f'B{linha_atual}'] = resumo['saldo_realizado']
-            ws[f'B{linha_atual}'].font = Font(bold=True)
-            ws[f'C{linha_atual}'] = resumo['saldo_a_vencer']
-            ws[f'C{linha_atual}'].font = Font(bold=True)
-            ws[f'D{linha_atual}'] = resumo['saldo_vencido']
-            ws[f'D{linha_atual}'].font = Font(bold=True)
-            ws[f'E{linha_atual}'] = resumo['saldo_agendado']
-            ws[f'E{linha_atual}'].font = Font(bold=True)
-            ws[f'F{linha_atual}'] = resumo['saldo_projetado']
-            ws[f'F{linha_atual}'].font = Font(bold=True)
-            linha_atual += 3
-            
+            planilha.linha(ws, [
+                "Total Entradas",
+                resumo['total_entradas_realizado'],
+                resumo['total_receitas_a_vencer'],
+                resumo['total_receitas_vencidas'],
+                resumo['total_receitas_agendadas'],
+                resumo['total_geral_receitas'],
+            ])
+            planilha.linha(ws, [
+                "Total Saídas",
+                resumo['total_saidas_realizado'],
+                resumo['total_saidas_a_vencer'],
+                resumo['total_saidas_vencidas'],
+                resumo['total_saidas_agendadas'],
+                resumo['total_geral_saidas'],
+            ])
+            planilha.linha(ws, [
+                "SALDO",
+                resumo['saldo_realizado'],
+                resumo['saldo_a_vencer'],
+                resumo['saldo_vencido'],
+                resumo['saldo_agendado'],
+                resumo['saldo_projetado'],
+            ], 'negrito')
+            planilha.linha(ws)
+            planilha.linha(ws)
+
             # BLOCO 2: SALDOS POR CONTAS CAIXA
-            ws[f'A{linha_atual}'] = "SALDOS POR CONTA / BANCO"
-            ws[f'A{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            ws[f'A{linha_atual}'] = "Conta / Banco"
-            ws[f'B{linha_atual}'] = "Saldo Realizado"
-            ws[f'C{linha_atual}'] = "Entradas Futuras"
-            ws[f'D{linha_atual}'] = "Saídas Futuras"
-            ws[f'E{linha_atual}'] = "Saldo Projetado"
-            for col in ['A', 'B', 'C', 'D', 'E']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
+            planilha.linha(ws, ["SALDOS POR CONTA / BANCO"], 'negrito')
+            planilha.linha(ws, ["Conta / Banco", "Saldo Realizado", "Entradas Futuras", "Saídas Futuras", "Saldo Projetado"], 'cabecalho')
+
             for cx in dados['contas_caixa']:
                 entradas_futuras = cx['rec_agendado'] + cx['rec_vencido'] + cx['rec_a_vencer']
                 saidas_futuras = cx['desp_agendado'] + cx['desp_vencido'] + cx['desp_a_vencer']
-                
-                ws[f'A{linha_atual}'] = cx['conta'].nome
-                ws[f'B{linha_atual}'] = cx['saldo_atual']
-                ws[f'C{linha_atual}'] = entradas_futuras
-                ws[f'D{linha_atual}'] = saidas_futuras
-                ws[f'E{linha_atual}'] = cx['saldo_projetado']
-                linha_atual += 1
-                
-            linha_atual += 2
-            
+                planilha.linha(ws, [cx['conta'].nome, cx['saldo_atual'], entradas_futuras, saidas_futuras, cx['saldo_projetado']])
+
+            planilha.linha(ws)
+            planilha.linha(ws)
+
             # BLOCO 3: SALDOS DO PLANO DE CONTAS
-            ws[f'A{linha_atual}'] = "PLANO DE CONTAS DE RECEITA"
-            ws[f'A{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            ws[f'A{linha_atual}'] = "Categoria de Receita"
-            ws[f'B{linha_atual}'] = "Realizado"
-            ws[f'C{linha_atual}'] = "A Vencer"
-            ws[f'D{linha_atual}'] = "Vencido"
-            ws[f'E{linha_atual}'] = "Agendado"
-            ws[f'F{linha_atual}'] = "Total"
-            for col in ['A', 'B', 'C', 'D', 'E', 'F']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            for cat, vals in sorted(dados['categorias_receitas'].items()):
-                if vals['total'] > 0:
-                    ws[f'A{linha_atual}'] = cat
-                    ws[f'B{linha_atual}'] = vals['realizado']
-                    ws[f'C{linha_atual}'] = vals['a_vencer']
-                    ws[f'D{linha_atual}'] = vals['vencido']
-                    ws[f'E{linha_atual}'] = vals['agendado']
-                    ws[f'F{linha_atual}'] = vals['total']
-                    linha_atual += 1
-                    
-            linha_atual += 2
-            
-            ws[f'A{linha_atual}'] = "PLANO DE CONTAS DE DESPESA"
-            ws[f'A{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            ws[f'A{linha_atual}'] = "Categoria de Despesa"
-            ws[f'B{linha_atual}'] = "Realizado"
-            ws[f'C{linha_atual}'] = "A Vencer"
-            ws[f'D{linha_atual}'] = "Vencido"
-            ws[f'E{linha_atual}'] = "Agendado"
-            ws[f'F{linha_atual}'] = "Total"
-            for col in ['A', 'B', 'C', 'D', 'E', 'F']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            linha_atual += 1
-            
-            for cat, vals in sorted(dados['categorias_despesas'].items()):
-                if vals['total'] > 0:
-                    ws[f'A{linha_atual}'] = cat
-                    ws[f'B{linha_atual}'] = vals['realizado']
-                    ws[f'C{linha_atual}'] = vals['a_vencer']
-                    ws[f'D{linha_atual}'] = vals['vencido']
-                    ws[f'E{linha_atual}'] = vals['agendado']
-                    ws[f'F{linha_atual}'] = vals['total']
-                    linha_atual += 1
-                
-        elif 'lancamentos' in dados:
-            # Relatório de lançamentos
-            ws[f'A{linha_atual}'] = "Data Vencimento"
-            ws[f'B{linha_atual}'] = "Data Realizado"
-            ws[f'C{linha_atual}'] = "Descrição"
-            ws[f'D{linha_atual}'] = "Categoria"
-            ws[f'E{linha_atual}'] = "Tipo"
-            ws[f'F{linha_atual}'] = "Cliente/Fornecedor"
-            ws[f'G{linha_atual}'] = "Valor"
-            ws[f'H{linha_atual}'] = "NF"
-            ws[f'I{linha_atual}'] = "Status"
-            
-            # Formatar cabeçalhos
-            for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            
-            linha_atual += 1
-            
-            # Dados dos lançamentos
-            for lancamento in dados['lancamentos']:
-                # Determinar status baseado na lógica atual
-                hoje = datetime.now().date()
-                if lancamento.data_realizada and lancamento.data_realizada <= hoje:
-                    status = "Realizado"
-                elif lancamento.data_realizada and lancamento.data_realizada > hoje:
-                    status = "Agendado"
-                elif not lancamento.data_realizada and lancamento.data_prevista and lancamento.data_prevista < hoje:
-                    status = "Vencido"
-                else:
-                    status = "Pendente"
-                
-                # Determinar cliente/fornecedor
-                cliente_fornecedor = ""
-                if lancamento.cliente:
-                    cliente_fornecedor = lancamento.cliente.nome
-                elif lancamento.fornecedor:
-                    cliente_fornecedor = lancamento.fornecedor.nome
-                elif lancamento.venda and lancamento.venda.cliente:
-                    cliente_fornecedor = lancamento.venda.cliente.nome
-                elif lancamento.compra and lancamento.compra.fornecedor:
-                    cliente_fornecedor = lancamento.compra.fornecedor.nome
-                
-                ws[f'A{linha_atual}'] = lancamento.data_prevista.strftime('%d/%m/%Y') if lancamento.data_prevista else ''
-                ws[f'B{linha_atual}'] = lancamento.data_realizada.strftime('%d/%m/%Y') if lancamento.data_realizada else ''
-                ws[f'C{linha_atual}'] = lancamento.descricao
-                ws[f'D{linha_atual}'] = lancamento.categoria or ''
-                ws[f'E{linha_atual}'] = lancamento.tipo.title()
-                ws[f'F{linha_atual}'] = cliente_fornecedor
-                ws[f'G{linha_atual}'] = lancamento.valor
-                ws[f'H{linha_atual}'] = lancamento.nota_fiscal or ''
-                ws[f'I{linha_atual}'] = status
-                linha_atual += 1
-                
+            planilha.linha(ws, ["PLANO DE CONTAS DE RECEITA"], 'negrito')
+            planilha.linha(ws, ["Categoria de Receita", "Realizado", "A Vencer", "Vencido", "Agendado", "Total"], 'cabecalho')
+            planilha.linhas(ws, (
+                [cat, vals['realizado'], vals['a_vencer'], vals['vencido'], vals['agendado'], vals['total']]
+                for cat, vals in sorted(dados['categorias_receitas'].items()) if vals['total'] > 0
+            ))
+
+            planilha.linha(ws)
+            planilha.linha(ws)
+
+            planilha.linha(ws, ["PLANO DE CONTAS DE DESPESA"], 'negrito')
+            planilha.linha(ws, ["Categoria de Despesa", "Realizado", "A Vencer", "Vencido", "Agendado", "Total"], 'cabecalho')
+            planilha.linhas(ws, (
+                [cat, vals['realizado'], vals['a_vencer'], vals['vencido'], vals['agendado'], vals['total']]
+                for cat, vals in sorted(dados['categorias_despesas'].items()) if vals['total'] > 0
+            ))
+
+        elif 'lancamentos' in dados:
+            # Relatório de lançamentos
+            planilha.linha(ws, ["Data Vencimento", "Data Realizado", "Descrição", "Categoria", "Tipo",
+                                "Cliente/Fornecedor", "Valor", "NF", "Status"], 'cabecalho')
+
+            hoje = datetime.now().date()
+            planilha.linhas(ws, (
+                [
+                    l.data_prevista.strftime('%d/%m/%Y') if l.data_prevista else '',
+                    l.data_realizada.strftime('%d/%m/%Y') if l.data_realizada else '',
+                    l.descricao,
+                    l.categoria or '',
+                    l.tipo.title(),
+                    l.cliente_fornecedor,
+                    l.valor,
+                    l.nota_fiscal or '',
+                    status_lancamento_exportacao(l.data_prevista, l.data_realizada, hoje),
+                ]
+                for l in linhas_lancamentos_exportacao(dados['lancamentos'])
+            ))
+
         elif 'clientes_dados' in dados:
             # Relatório de clientes
-            ws[f'A{linha_atual}'] = "Cliente"
-            ws[f'B{linha_atual}'] = "Email"
-            ws[f'C{linha_atual}'] = "Telefone"
-            ws[f'D{linha_atual}'] = "Total Entradas"
-            ws[f'E{linha_atual}'] = "Total Saídas"
-            ws[f'F{linha_atual}'] = "Total Geral"
-            ws[f'G{linha_atual}'] = "Saldo Aberto"
-            ws[f'H{linha_atual}'] = "Qtd. Lançamentos"
-            
-            # Formatar cabeçalhos
-            for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            
-            linha_atual += 1
-            
-            # Dados dos clientes
-            for cliente_dados in dados['clientes_dados']:
-                cliente = cliente_dados['cliente']
-                ws[f'A{linha_atual}'] = cliente.nome
-                ws[f'B{linha_atual}'] = cliente.email or ''
-                ws[f'C{linha_atual}'] = cliente.telefone or ''
-                ws[f'D{linha_atual}'] = cliente_dados['total_entradas']
-                ws[f'E{linha_atual}'] = cliente_dados['total_saidas']
-                ws[f'F{linha_atual}'] = cliente_dados['total_geral']
-                ws[f'G{linha_atual}'] = cliente_dados['saldo_aberto']
-                ws[f'H{linha_atual}'] = cliente_dados['quantidade_lancamentos']
-                linha_atual += 1
-                
+            planilha.linha(ws, ["Cliente", "Email", "Telefone", "Total Entradas", "Total Saídas",
+                                "Total Geral", "Saldo Aberto", "Qtd. Lançamentos"], 'cabecalho')
+
+            planilha.linhas(ws, (
+                [
+                    cliente_dados['cliente'].nome,
+                    cliente_dados['cliente'].email or '',
+                    cliente_dados['cliente'].telefone or '',
+                    cliente_dados['total_entradas'],
+                    cliente_dados['total_saidas'],
+                    cliente_dados['total_geral'],
+                    cliente_dados['saldo_aberto'],
+                    cliente_dados['quantidade_lancamentos'],
+                ]
+                for cliente_dados in dados['clientes_dados']
+            ))
+
         elif 'produtos' in dados:
             # Relatório de produtos/estoque
-            ws[f'A{linha_atual}'] = "ID"
-            ws[f'B{linha_atual}'] = "Nome"
-            ws[f'C{linha_atual}'] = "Descrição"
-            ws[f'D{linha_atual}'] = "Preço Custo"
-            ws[f'E{linha_atual}'] = "Preço Venda"
-            ws[f'F{linha_atual}'] = "Estoque"
-            ws[f'G{linha_atual}'] = "Valor Estoque"
-            ws[f'H{linha_atual}'] = "Usuário Criador"
-            
-            # Formatar cabeçalhos
-            for col in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']:
-                ws[f'{col}{linha_atual}'].font = Font(bold=True)
-            
-            linha_atual += 1
-            
-            # Dados dos produtos
-            for produto in dados['produtos']:
-                ws[f'A{linha_atual}'] = produto.id
-                ws[f'B{linha_atual}'] = produto.nome
-                ws[f'C{linha_atual}'] = produto.descricao or ''
-                ws[f'D{linha_atual}'] = produto.preco_custo or 0
-                ws[f'E{linha_atual}'] = produto.preco_venda or 0
-                ws[f'F{linha_atual}'] = produto.estoque or 0
-                ws[f'G{linha_atual}'] = getattr(produto, 'valor_estoque', 0)
-                ws[f'H{linha_atual}'] = getattr(produto, 'usuario_criador', {}).get('nome', '') if hasattr(produto, 'usuario_criador') else ''
-                linha_atual += 1
-        
-        # Ajustar largura das colunas
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
-        
-        # Salvar arquivo
-        caminho_arquivo = os.path.join('uploads', f"{nome_arquivo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-        wb.save(caminho_arquivo)
-        return caminho_arquivo
-        
+            planilha.linha(ws, ["ID", "Nome", "Descrição", "Preço Custo", "Preço Venda", "Estoque",
+                                "Valor Estoque", "Usuário Criador"], 'cabecalho')
+
+            planilha.linhas(ws, (
+                [
+                    produto.id,
+                    produto.nome,
+                    produto.descricao or '',
+                    produto.preco_custo or 0,
+                    produto.preco_venda or 0,
+                    produto.estoque or 0,
+                    getattr(produto, 'valor_estoque', 0),
+                    produto.usuario_criador.nome if getattr(produto, 'usuario_criador', None) else '',
+                ]
+                for produto in dados['produtos']
+            ))
+
+        return planilha.salvar(nome_arquivo)
+
     except Exception as e:
         app.logger.error(f"Erro ao exportar Excel: {str(e)}")
         return None
@@ -18479,131 +20800,23 @@ def api_lancamentos_totais():
     if not empresa_id_correta:
         return jsonify({'success': False, 'message': 'Erro ao obter empresa associada'}), 400
     
-    # Buscar todos os usuários da empresa correta
-    usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id_correta, ativo=True).all()
-    usuarios_ids = [u.id for u in usuarios_empresa]
-    
     # Aplicar os mesmos filtros da rota /lancamentos
-    query = Lancamento.query.options(
-        db.joinedload(Lancamento.cliente),
-        db.joinedload(Lancamento.fornecedor),
-        db.joinedload(Lancamento.usuario)
-    ).filter(Lancamento.empresa_id == empresa_id_correta)
-    
-    # Filtro por tipo
-    tipo = request.args.get('tipo')
-    if tipo:
-        query = query.filter(Lancamento.tipo == tipo)
-    
-    # Filtro por categoria
-    categoria = request.args.get('categoria')
-    if categoria:
-        query = query.filter(Lancamento.categoria == categoria)
-    
-    # Filtro por data
-    def _parse_data(valor: str):
-        if not valor:
-            return None
-        valor = valor.strip()
-        try:
-            if '/' in valor:
-                return datetime.strptime(valor, '%d/%m/%Y').date()
-            return datetime.strptime(valor, '%Y-%m-%d').date()
-        except ValueError:
-            return None
-
-    data_inicio_raw = request.args.get('data_inicio', '')
-    data_fim_raw = request.args.get('data_fim', '')
-    data_inicio_obj = _parse_data(data_inicio_raw)
-    data_fim_obj = _parse_data(data_fim_raw)
-
-    if data_inicio_obj and data_fim_obj and data_inicio_obj > data_fim_obj:
-        data_inicio_obj, data_fim_obj = data_fim_obj, data_inicio_obj
-
-    if data_inicio_obj and data_fim_obj:
-        query = query.filter(Lancamento.data_prevista.between(data_inicio_obj, data_fim_obj))
-    elif data_inicio_obj:
-        query = query.filter(Lancamento.data_prevista >= data_inicio_obj)
-    elif data_fim_obj:
-        query = query.filter(Lancamento.data_prevista <= data_fim_obj)
-    
-    # Filtro por status
-    status = request.args.get('status')
-    hoje = datetime.now().date()
-    if status == 'realizado':
-        query = query.filter(Lancamento.data_realizada.isnot(None), Lancamento.data_realizada <= hoje)
-    elif status == 'pendente':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.is_(None),
-                Lancamento.data_prevista >= hoje
-            )
-        )
-    elif status == 'agendado':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.isnot(None),
-                Lancamento.data_realizada > hoje
-            )
-        )
-    elif status == 'vencido':
-        query = query.filter(
-            db.and_(
-                Lancamento.data_realizada.is_(None),
-                Lancamento.data_prevista < hoje
-            )
-        )
-    
-    # Filtro por busca
-    busca = request.args.get('busca')
-    if busca and busca.strip():
-        busca_clean = busca.strip()
-        query = query.join(Cliente, Lancamento.cliente_id == Cliente.id, isouter=True).join(
-            Fornecedor, Lancamento.fornecedor_id == Fornecedor.id, isouter=True)
-        
-        try:
-            valor_busca = float(busca_clean.replace(',', '.'))
-            query = query.filter(
-                db.or_(
-                    Lancamento.descricao.ilike(f'%{busca_clean}%'),
-                    Cliente.nome.ilike(f'%{busca_clean}%'),
-                    Fornecedor.nome.ilike(f'%{busca_clean}%'),
-                    db.func.abs(Lancamento.valor - valor_busca) < 0.01
-                )
-            )
-        except ValueError:
-            query = query.filter(
-                db.or_(
-                    Lancamento.descricao.ilike(f'%{busca_clean}%'),
-                    Cliente.nome.ilike(f'%{busca_clean}%'),
-                    Fornecedor.nome.ilike(f'%{busca_clean}%')
-                )
-            )
+    filtro = FiltroLancamentos.da_requisicao(request.args, empresa_id_correta)
     
-    # Executar query
-    lancamentos = query.order_by(Lancamento.data_prevista.desc()).all()
-    
-    # Calcular totais
-    receitas_totais = sum([l.valor for l in lancamentos if l.tipo == 'entrada'])
-    despesas_totais = sum([l.valor for l in lancamentos if l.tipo == 'saida'])
+    # Calcular totais (mesma agregação SQL da rota /lancamentos, incluindo transferências)
+    totais = calcular_totais_lancamentos(filtro, excluir_transferencias=False)
+    receitas_totais = totais['entrada_total']
+    despesas_totais = totais['saida_total']
     saldo_atual = receitas_totais - despesas_totais
     
-    # Totais por status
-    entradas_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
-    saidas_realizadas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and ((l.data_realizada and l.data_realizada <= hoje) or (l.realizado and not l.data_realizada))])
-    entradas_agendadas = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and l.data_realizada and l.data_realizada > hoje])
-    saidas_agendadas = sum([l.valor for l in lancamentos if l.tipo == 'saida' and l.data_realizada and l.data_realizada > hoje])
-    receitas_pendentes = sum([l.valor for l in lancamentos if l.tipo == 'entrada' and not l.realizado and not l.data_realizada])
-    despesas_pendentes = sum([l.valor for l in lancamentos if l.tipo == 'saida' and not l.realizado and not l.data_realizada])
-    
     # Saldos por status
-    saldo_realizado = entradas_realizadas - saidas_realizadas
-    saldo_pendente = receitas_pendentes - despesas_pendentes
-    saldo_agendado = entradas_agendadas - saidas_agendadas
+    saldo_realizado = totais['entrada_realizada'] - totais['saida_realizada']
+    saldo_pendente = totais['entrada_pendente'] - totais['saida_pendente']
+    saldo_agendado = totais['entrada_agendada'] - totais['saida_agendada']
     
     return jsonify({
         'success': True,
-        'total_lancamentos': len(lancamentos),
+        'total_lancamentos': totais['quantidade'],
         'total_entradas': float(receitas_totais),
         'total_saidas': float(despesas_totais),
         'saldo_atual': float(saldo_atual),
@@ -18646,29 +20859,14 @@ def api_toggle_lancamento_status(lancamento_id):
             sub_usuario_id = session.get('sub_usuario_id')
             contador_id = session.get('contador_id')
             
-            permissao = PermissaoSubUsuario.query.filter_by(
-                sub_usuario_id=sub_usuario_id,
-                empresa_id=lancamento.empresa_id
-            ).first()
-            
-            if permissao:
+            if lancamento.empresa_id in empresas_permitidas_sub_usuario(sub_usuario_id):
                 # Verificar se o vínculo está autorizado
-                vinculo = VinculoContador.query.filter_by(
-                    contador_id=contador_id,
-                    empresa_id=lancamento.empresa_id,
-                    status='autorizado'
-                ).first()
-                if vinculo:
+                if lancamento.empresa_id in empresas_autorizadas_contador(contador_id):
                     tem_permissao = True
         else:
             # Usuário principal do contador: verificar vínculo autorizado
             contador_id = session.get('empresa_id')
-            vinculo = VinculoContador.query.filter_by(
-                contador_id=contador_id,
-                empresa_id=lancamento.empresa_id,
-                status='autorizado'
-            ).first()
-            if vinculo:
+            if lancamento.empresa_id in empresas_autorizadas_contador(contador_id):
                 tem_permissao = True
     
     if not tem_permissao:
@@ -18907,6 +21105,7 @@ def api_marcar_lancamentos_realizado_lote():
         return jsonify({'success': False, 'message': f'Erro ao atualizar: {str(e)}'}), 500
 
 @app.route('/backup/geral')
+@em_segundo_plano('backup', max_tentativas=3)
 def exportar_backup_geral():
     """Exporta backup geral com todos os relatórios em abas separadas"""
     if 'usuario_id' not in session:
@@ -18918,162 +21117,124 @@ def exportar_backup_geral():
         return redirect(url_for('dashboard'))
     
     try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill
-        
-        # Criar workbook
-        wb = Workbook()
-        
-        # Remover planilha padrão
-        wb.remove(wb.active)
+        lote = app.config['EXPORTACAO_TAMANHO_LOTE']
+        planilha = PlanilhaStreaming()
+        cabecalho = planilha.estilo_cabecalho('CCCCCC', cor_fonte='000000')
         
         # Obter todos os usuários da mesma empresa
         empresa_id = obter_empresa_id_sessao(session, usuario)
 
-        usuarios_empresa = Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()
-        usuarios_ids = [u.id for u in usuarios_empresa]
+        usuarios_ids = [u.id for u in Usuario.query.filter_by(empresa_id=empresa_id, ativo=True).all()]
         
         # 1. ABA: LANÇAMENTOS
-        ws_lancamentos = wb.create_sheet("Lançamentos")
-        ws_lancamentos.append(["Data Vencimento", "Data Realizado", "Descrição", "Categoria", "Tipo", "Cliente/Fornecedor", "Valor", "Status"])
-        
-        # Buscar todos os lançamentos
-        lancamentos = Lancamento.query.options(
-            joinedload(Lancamento.cliente), 
-            joinedload(Lancamento.fornecedor),
-            joinedload(Lancamento.venda),
-            joinedload(Lancamento.compra)
-        ).filter(Lancamento.empresa_id == empresa_id).order_by(Lancamento.data_prevista).all()
-        
-        for lancamento in lancamentos:
-            # Determinar status
-            hoje = datetime.now().date()
-            if lancamento.data_realizada and lancamento.data_realizada <= hoje:
-                status = "Realizado"
-            elif lancamento.data_realizada and lancamento.data_realizada > hoje:
-                status = "Agendado"
-            elif not lancamento.data_realizada and lancamento.data_prevista and lancamento.data_prevista < hoje:
-                status = "Vencido"
-            else:
-                status = "Pendente"
-            
-            # Determinar cliente/fornecedor
-            cliente_fornecedor = ""
-            if lancamento.cliente:
-                cliente_fornecedor = lancamento.cliente.nome
-            elif lancamento.fornecedor:
-                cliente_fornecedor = lancamento.fornecedor.nome
-            elif lancamento.venda and lancamento.venda.cliente:
-                cliente_fornecedor = lancamento.venda.cliente.nome
-            elif lancamento.compra and lancamento.compra.fornecedor:
-                cliente_fornecedor = lancamento.compra.fornecedor.nome
-            
-            ws_lancamentos.append([
-                lancamento.data_prevista.strftime('%d/%m/%Y') if lancamento.data_prevista else '',
-                lancamento.data_realizada.strftime('%d/%m/%Y') if lancamento.data_realizada else '',
-                lancamento.descricao,
-                lancamento.categoria or '',
-                lancamento.tipo.title(),
-                cliente_fornecedor,
-                lancamento.valor,
-                status
-            ])
-        
-        # 2. ABA: CLIENTES
-        ws_clientes = wb.create_sheet("Clientes")
-        ws_clientes.append(["Nome", "Email", "Telefone", "CPF/CNPJ", "Endereço", "Data Criação"])
-        
-        clientes = Cliente.query.filter(Cliente.empresa_id == empresa_id, Cliente.ativo == True).all()
-        for cliente in clientes:
-            ws_clientes.append([
-                cliente.nome,
-                cliente.email or '',
-                cliente.telefone or '',
-                cliente.cpf_cnpj or '',
-                cliente.endereco or '',
-                cliente.data_criacao.strftime('%d/%m/%Y') if cliente.data_criacao else ''
-            ])
-        
-        # 3. ABA: FORNECEDORES
-        ws_fornecedores = wb.create_sheet("Fornecedores")
-        ws_fornecedores.append(["Nome", "Email", "Telefone", "CPF/CNPJ", "Endereço", "Data Criação"])
+        ws_lancamentos = planilha.aba("Lançamentos")
+        planilha.linha(ws_lancamentos, ["Data Vencimento", "Data Realizado", "Descrição", "Categoria", "Tipo", "Cliente/Fornecedor", "Valor", "Status"], cabecalho)
         
-        fornecedores = Fornecedor.query.filter(Fornecedor.empresa_id == empresa_id, Fornecedor.ativo == True).all()
-        for fornecedor in fornecedores:
-            ws_fornecedores.append([
-                fornecedor.nome,
-                fornecedor.email or '',
-                fornecedor.telefone or '',
-                fornecedor.cpf_cnpj or '',
-                fornecedor.endereco or '',
-                fornecedor.data_criacao.strftime('%d/%m/%Y') if fornecedor.data_criacao else ''
-            ])
+        hoje = datetime.now().date()
+        lancamentos = Lancamento.query.filter(Lancamento.empresa_id == empresa_id).order_by(Lancamento.data_prevista)
+        planilha.linhas(ws_lancamentos, (
+            [
+                l.data_prevista.strftime('%d/%m/%Y') if l.data_prevista else '',
+                l.data_realizada.strftime('%d/%m/%Y') if l.data_realizada else '',
+                l.descricao,
+                l.categoria or '',
+                l.tipo.title(),
+                l.cliente_fornecedor,
+                l.valor,
+                status_lancamento_exportacao(l.data_prevista, l.data_realizada, hoje)
+            ]
+            for l in linhas_lancamentos_exportacao(lancamentos)
+        ))
+        
+        # 2. ABA: CLIENTES / 3. ABA: FORNECEDORES
+        for modelo, titulo_aba in ((Cliente, "Clientes"), (Fornecedor, "Fornecedores")):
+            ws_cadastro = planilha.aba(titulo_aba)
+            planilha.linha(ws_cadastro, ["Nome", "Email", "Telefone", "CPF/CNPJ", "Endereço", "Data Criação"], cabecalho)
+            
+            cadastros = db.session.query(
+                modelo.nome, modelo.email, modelo.telefone, modelo.cpf_cnpj, modelo.endereco, modelo.data_criacao
+            ).filter(modelo.empresa_id == empresa_id).yield_per(lote)
+            planilha.linhas(ws_cadastro, (
+                [
+                    nome,
+                    email or '',
+                    telefone or '',
+                    cpf_cnpj or '',
+                    endereco or '',
+                    data_criacao.strftime('%d/%m/%Y') if data_criacao else ''
+                ]
+                for nome, email, telefone, cpf_cnpj, endereco, data_criacao in cadastros
+            ))
         
         # 4. ABA: PRODUTOS
-        ws_produtos = wb.create_sheet("Produtos")
-        ws_produtos.append(["ID", "Nome", "Descrição", "Preço Custo", "Preço Venda", "Estoque", "Valor Estoque", "Usuário Criador"])
-        
-        produtos = buscar_produtos_empresa(usuario.empresa_id)
-        for produto in produtos:
-            ws_produtos.append([
-                produto.id,
-                produto.nome,
-                produto.descricao or '',
-                produto.preco_custo or 0,
-                produto.preco_venda or 0,
-                produto.estoque or 0,
-                getattr(produto, 'valor_estoque', 0),
-                getattr(produto, 'usuario_criador', {}).get('nome', '') if hasattr(produto, 'usuario_criador') else ''
-            ])
+        ws_produtos = planilha.aba("Produtos")
+        planilha.linha(ws_produtos, ["ID", "Nome", "Descrição", "Preço Custo", "Preço Venda", "Estoque", "Valor Estoque", "Usuário Criador"], cabecalho)
+        
+        produtos = db.session.query(
+            Produto.id, Produto.nome, Produto.descricao, Produto.preco_custo, Produto.preco_venda, Produto.estoque, Usuario.nome
+        ).join(Usuario, Produto.usuario_id == Usuario.id).filter(
+            Produto.usuario_id.in_(usuarios_ids)
+        ).order_by(Produto.nome).yield_per(lote)
+        planilha.linhas(ws_produtos, (
+            [
+                p_id,
+                nome,
+                descricao or '',
+                preco_custo or 0,
+                preco_venda or 0,
+                estoque or 0,
+                (estoque or 0) * (preco_venda or 0),
+                usuario_nome
+            ]
+            for p_id, nome, descricao, preco_custo, preco_venda, estoque, usuario_nome in produtos
+        ))
         
         # 5. ABA: VENDAS
-        ws_vendas = wb.create_sheet("Vendas")
-        ws_vendas.append(["ID", "Cliente", "Produto", "Quantidade", "Valor", "Data", "Observações", "Status"])
-        
-        vendas = Venda.query.options(joinedload(Venda.cliente)).filter(Venda.empresa_id == empresa_id).all()
-        for venda in vendas:
-            ws_vendas.append([
-                venda.id,
-                venda.cliente.nome if venda.cliente else '',
-                venda.produto,
-                venda.quantidade,
-                venda.valor,
-                venda.data.strftime('%d/%m/%Y') if venda.data else '',
-                venda.observacoes or '',
-                "Realizado" if venda.realizado else "Pendente"
-            ])
+        ws_vendas = planilha.aba("Vendas")
+        planilha.linha(ws_vendas, ["ID", "Cliente", "Produto", "Quantidade", "Valor", "Data", "Observações", "Status"], cabecalho)
+        
+        vendas = db.session.query(
+            Venda.id, Cliente.nome, Venda.produto, Venda.quantidade, Venda.valor,
+            Venda.data_prevista, Venda.observacoes, Venda.realizado
+        ).outerjoin(Cliente, Venda.cliente_id == Cliente.id).filter(Venda.empresa_id == empresa_id).yield_per(lote)
+        planilha.linhas(ws_vendas, (
+            [
+                v_id,
+                cliente or '',
+                produto,
+                quantidade,
+                valor,
+                data.strftime('%d/%m/%Y') if data else '',
+                observacoes or '',
+                "Realizado" if realizado else "Pendente"
+            ]
+            for v_id, cliente, produto, quantidade, valor, data, observacoes, realizado in vendas
+        ))
         
         # 6. ABA: COMPRAS
-        ws_compras = wb.create_sheet("Compras")
-        ws_compras.append(["ID", "Fornecedor", "Produto", "Quantidade", "Valor", "Data", "Observações", "Status"])
-        
-        compras = Compra.query.options(joinedload(Compra.fornecedor)).filter(Compra.empresa_id == empresa_id).all()
-        for compra in compras:
-            ws_compras.append([
-                compra.id,
-                compra.fornecedor.nome if compra.fornecedor else '',
-                compra.produto,
-                compra.quantidade,
-                compra.valor,
-                compra.data.strftime('%d/%m/%Y') if compra.data else '',
-                compra.observacoes or '',
-                "Realizado" if compra.realizado else "Pendente"
-            ])
-        
-        # Formatar cabeçalhos de todas as abas
-        header_font = Font(bold=True)
-        header_fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-        
-        for ws in wb.worksheets:
-            for cell in ws[1]:
-                cell.font = header_font
-                cell.fill = header_fill
-        
-        # Salvar arquivo
-        caminho_arquivo = os.path.join('uploads', f"backup_geral_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-        wb.save(caminho_arquivo)
-        
-        return send_file(caminho_arquivo, as_attachment=True, download_name=f"backup_geral_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
+        ws_compras = planilha.aba("Compras")
+        planilha.linha(ws_compras, ["ID", "Fornecedor", "Produto", "Quantidade", "Valor", "Data", "Observações", "Status"], cabecalho)
+        
+        compras = db.session.query(
+            Compra.id, Fornecedor.nome, Compra.produto, Compra.quantidade, Compra.valor,
+            Compra.data_prevista, Compra.observacoes, Compra.realizado
+        ).outerjoin(Fornecedor, Compra.fornecedor_id == Fornecedor.id).filter(Compra.empresa_id == empresa_id).yield_per(lote)
+        planilha.linhas(ws_compras, (
+            [
+                c_id,
+                fornecedor or '',
+                produto,
+                quantidade,
+                valor,
+                data.strftime('%d/%m/%Y') if data else '',
+                observacoes or '',
+                "Realizado" if realizado else "Pendente"
+            ]
+            for c_id, fornecedor, produto, quantidade, valor, data, observacoes, realizado in compras
+        ))
+        
+        nome_arquivo = f"backup_geral_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        return planilha.enviar(nome_arquivo)
         
     except Exception as e:
         app.logger.error(f"Erro ao gerar backup geral: {str(e)}")
@@ -19337,13 +21498,20 @@ def admin_excluir_conta(conta_id):
             Parcela.query.filter(Parcela.usuario_id.in_(usuarios_ids)).delete(synchronize_session=False)
 
         # ── 3. Lançamentos, Vendas, Compras ────────────────────────────────────
+        ItemCarrinho.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
         Lancamento.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
         Venda.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
         Compra.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
 
         # ── 4. DreConfiguracao e ContaCaixa (FK: plano_conta) ─────────────────
         DreConfiguracao.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
+        CuboPeriodoCache.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
+        CarteiraContadorCache.query.filter_by(contador_id=conta_id).delete(synchronize_session=False)
+        MovimentoEstoque.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
         if usuarios_ids:
+            SaldoContaCaixaDiario.query.filter(SaldoContaCaixaDiario.conta_caixa_id.in_(
+                db.session.query(ContaCaixa.id).filter(ContaCaixa.usuario_id.in_(usuarios_ids))
+            )).delete(synchronize_session=False)
             ContaCaixa.query.filter(ContaCaixa.usuario_id.in_(usuarios_ids)).delete(synchronize_session=False)
 
         # ── 5. PlanoConta: zerar pai_id (self-ref) antes de deletar ───────────
@@ -19373,7 +21541,11 @@ def admin_excluir_conta(conta_id):
             ).delete(synchronize_session=False)
         SubUsuarioContador.query.filter_by(contador_id=conta_id).delete(synchronize_session=False)
 
-        # ── 8. Vínculos de contador ────────────────────────────────────────────
+        # ── 8. Vínculos de contador (e as carteiras em cache que incluem esta empresa) ──
+        invalidar_carteiras_empresas([conta_id])
+        contadores_ids = [r.contador_id for r in VinculoContador.query.filter(
+            or_(VinculoContador.contador_id == conta_id, VinculoContador.empresa_id == conta_id)
+        ).with_entities(VinculoContador.contador_id)]
         VinculoContador.query.filter(
             or_(VinculoContador.contador_id == conta_id, VinculoContador.empresa_id == conta_id)
         ).delete(synchronize_session=False)
@@ -19390,6 +21562,11 @@ def admin_excluir_conta(conta_id):
                 {'categoria_id': None}, synchronize_session=False
             )
         if cat_ids:
+            registrar_alteracao_permissoes('sub_usuario', [
+                r.id for r in SubUsuarioContador.query.filter(
+                    SubUsuarioContador.categoria_id.in_(cat_ids)
+                ).with_entities(SubUsuarioContador.id)
+            ])
             SubUsuarioContador.query.filter(
                 SubUsuarioContador.categoria_id.in_(cat_ids)
             ).update({'categoria_id': None}, synchronize_session=False)
@@ -19406,11 +21583,27 @@ def admin_excluir_conta(conta_id):
                 {'criado_por': None}, synchronize_session=False
             )
 
-        # ── 13. Usuários e a conta ─────────────────────────────────────────────
+        # ── 13. Jobs em segundo plano (FK: usuario, empresa) ───────────────────
+        jobs_query = Job.query.filter(or_(Job.empresa_id == conta_id, Job.usuario_id.in_(usuarios_ids)))
+        jobs_ids = [r.id for r in jobs_query.with_entities(Job.id)]
+        jobs_query.delete(synchronize_session=False)
+
+        # ── 14. Usuários e a conta ─────────────────────────────────────────────
         Usuario.query.filter_by(empresa_id=conta_id).delete(synchronize_session=False)
         db.session.delete(conta)
+
+        # Invalidar o cache de permissões dos usuários, categorias e sub-usuários removidos
+        registrar_alteracao_permissoes('usuario', usuarios_ids)
+        registrar_alteracao_permissoes('categoria', cat_ids)
+        registrar_alteracao_permissoes('sub_usuario', sub_ids)
+        registrar_alteracao_permissoes('contador', contadores_ids)
         db.session.commit()
 
+        # Arquivos dos jobs em uploads/jobs/ (só depois do commit, como em limpar_jobs_antigos)
+        import shutil
+        for job_id in jobs_ids:
+            shutil.rmtree(pasta_job(job_id), ignore_errors=True)
+
         return jsonify({'success': True, 'message': 'Conta excluída com sucesso'})
 
     except Exception as e:
@@ -20024,6 +22217,318 @@ def admin_salvar_conta(conta_id):
 
 # ===== ROTAS DO PAINEL CONTADOR/BPO =====
 
+# ===== CARTEIRA DO CONTADOR/BPO =====
+
+def _valores_dre_por_empresa(empresa_ids, data_inicio, data_fim):
+    """
+    Soma com sinal dos lançamentos por empresa e conta do plano no período, no
+    modo híbrido da DRE (ver _valores_dre_por_dia), em uma única consulta.
+    Retorna {empresa_id: {plano_conta_id: valor}}.
+    """
+    valor_com_sinal = db.case(
+        (Lancamento.tipo == 'entrada', Lancamento.valor),
+        else_=-Lancamento.valor
+    )
+    linhas = db.session.query(
+        Lancamento.empresa_id,
+        Lancamento.plano_conta_id,
+        db.func.sum(valor_com_sinal)
+    ).filter(
+        Lancamento.empresa_id.in_(empresa_ids),
+        db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None)),
+        db.or_(
+            db.and_(Lancamento.realizado == True,  Lancamento.data_realizada.between(data_inicio, data_fim)),
+            db.and_(Lancamento.realizado == False, Lancamento.data_prevista.between(data_inicio, data_fim))
+        )
+    ).group_by(Lancamento.empresa_id, Lancamento.plano_conta_id).all()
+
+    valores = {}
+    for empresa_id, plano_conta_id, valor in linhas:
+        valores.setdefault(empresa_id, {})[plano_conta_id] = float(valor or 0)
+    return valores
+
+
+def calcular_carteira_contador(empresa_ids, inicio_periodo, fim_periodo, hoje):
+    """
+    Totais do período por empresa da carteira, com um número fixo de consultas
+    agrupadas (independente da quantidade de empresas): contas a receber e a
+    pagar, vencidos, realizados, saldo de cada conta caixa no fim do período e
+    resultado da DRE configurada.
+    Retorna lista de dicts por empresa, na ordem da razão social.
+    """
+    if not empresa_ids:
+        return []
+
+    empresas = Empresa.query.filter(Empresa.id.in_(empresa_ids)).order_by(Empresa.razao_social, Empresa.id).all()
+    totais = calcular_totais_dashboard_empresas([e.id for e in empresas], inicio_periodo, fim_periodo, hoje)
+
+    # Contas caixa ativas e saldo no fim do período (snapshot diário)
+    contas_por_empresa = {}
+    contas = db.session.query(ContaCaixa, Usuario.empresa_id).join(
+        Usuario, ContaCaixa.usuario_id == Usuario.id
+    ).filter(
+        Usuario.empresa_id.in_(empresa_ids),
+        ContaCaixa.ativo == True
+    ).order_by(ContaCaixa.nome, ContaCaixa.id).all()
+    saldos = saldos_contas_caixa_ate([conta.id for conta, _ in contas], fim_periodo)
+    for conta, empresa_id in contas:
+        entradas_conta, saidas_conta = saldos.get(conta.id, (0.0, 0.0))
+        contas_por_empresa.setdefault(empresa_id, []).append({
+            'id': conta.id,
+            'nome': conta.nome,
+            'tipo': conta.tipo,
+            'banco': conta.banco,
+            'saldo': (conta.saldo_inicial or 0) + entradas_conta - saidas_conta
+        })
+
+    # Resultado da DRE: linhas configuradas de todas as empresas + valores por conta
+    linhas_dre_por_empresa = {}
+    for linha_config in DreConfiguracao.query.filter(
+        DreConfiguracao.empresa_id.in_(empresa_ids),
+        DreConfiguracao.ativo == True
+    ).order_by(DreConfiguracao.empresa_id, DreConfiguracao.ordem).all():
+        linhas_dre_por_empresa.setdefault(linha_config.empresa_id, []).append(linha_config)
+    valores_dre = _valores_dre_por_empresa(empresa_ids, inicio_periodo, fim_periodo)
+
+    carteira = []
+    for empresa in empresas:
+        t = totais[empresa.id]
+        contas_caixa = contas_por_empresa.get(empresa.id, [])
+        valores_conta = valores_dre.get(empresa.id, {})
+        resultado_dre = sum(
+            valores_conta.get(linha.plano_conta_id, 0.0)
+            for linha in linhas_dre_por_empresa.get(empresa.id, [])
+            if linha.tipo_linha == 'conta' and linha.plano_conta_id
+        )
+        carteira.append({
+            'empresa_id': empresa.id,
+            'razao_social': empresa.razao_social,
+            'nome_fantasia': empresa.nome_fantasia,
+            'documento': empresa.cnpj or empresa.cpf,
+            'a_receber': t['pendente_periodo_entrada'],
+            'a_pagar': t['pendente_periodo_saida'],
+            'vencido_receber': t['vencido_entrada'],
+            'vencido_pagar': t['vencido_saida'],
+            'entradas_realizadas': t['realizado_periodo_entrada'],
+            'saidas_realizadas': t['realizado_periodo_saida'],
+            'saldo_caixa': sum(conta['saldo'] for conta in contas_caixa),
+            'contas_caixa': contas_caixa,
+            'resultado_dre': resultado_dre,
+        })
+    return carteira
+
+
+CAMPOS_CONSOLIDADOS_CARTEIRA = (
+    'a_receber', 'a_pagar', 'vencido_receber', 'vencido_pagar',
+    'entradas_realizadas', 'saidas_realizadas', 'saldo_caixa', 'resultado_dre',
+)
+
+
+def _carteira_em_cache(contador_id, empresa_ids, inicio_periodo, fim_periodo, hoje):
+    """Registro de CarteiraContadorCache de (contador, período, hoje), ou None; em_cache diz se as empresas conferem."""
+    registro = CarteiraContadorCache.query.filter_by(
+        contador_id=contador_id,
+        periodo_inicio=inicio_periodo,
+        periodo_fim=fim_periodo,
+        data_referencia=hoje
+    ).first()
+    if registro:
+        carteira = json.loads(registro.dados)
+        return registro, carteira, sorted(item['empresa_id'] for item in carteira) == empresa_ids
+    return None, None, False
+
+
+def obter_carteira_contador(contador_id, empresa_ids, inicio_periodo, fim_periodo, hoje=None):
+    """
+    Carteira do contador pelo CarteiraContadorCache; sem cache para (contador,
+    período, hoje) ou se as empresas autorizadas mudaram, calcula sem gravar
+    nada: o cache é preenchido por precalcular_carteiras_contadores.
+    Retorna (carteira, em_cache).
+    """
+    hoje = hoje or datetime.now().date()
+    empresa_ids = sorted(set(empresa_ids))
+    _, carteira, em_cache = _carteira_em_cache(contador_id, empresa_ids, inicio_periodo, fim_periodo, hoje)
+    if em_cache:
+        return carteira, True
+    return calcular_carteira_contador(empresa_ids, inicio_periodo, fim_periodo, hoje), False
+
+
+def preencher_carteira_contador(contador_id, empresa_ids, inicio_periodo, fim_periodo, hoje=None):
+    """
+    Calcula e grava a carteira do contador no cache se ela não estiver lá (ou
+    se as empresas autorizadas mudaram). Retorna True se gravou.
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    hoje = hoje or datetime.now().date()
+    empresa_ids = sorted(set(empresa_ids))
+    registro, _, em_cache = _carteira_em_cache(contador_id, empresa_ids, inicio_periodo, fim_periodo, hoje)
+    if em_cache:
+        return False
+
+    carteira = calcular_carteira_contador(empresa_ids, inicio_periodo, fim_periodo, hoje)
+    try:
+        if registro:
+            db.session.delete(registro)
+            db.session.flush()
+        db.session.add(CarteiraContadorCache(
+            contador_id=contador_id,
+            periodo_inicio=inicio_periodo,
+            periodo_fim=fim_periodo,
+            data_referencia=hoje,
+            dados=json.dumps(carteira)
+        ))
+        db.session.commit()
+    except IntegrityError:
+        # Outro processo gravou a mesma carteira ao mesmo tempo
+        db.session.rollback()
+        return False
+    return True
+
+
+def precalcular_carteiras_contadores():
+    """
+    Tarefa agendada: grava no cache a carteira do mês atual (período padrão da
+    API) de cada contador com empresas autorizadas, inclusive as removidas por
+    alterações desde a última execução, e descarta as de dias passados.
+    """
+    with app.app_context():
+        hoje = datetime.now().date()
+        inicio_periodo = hoje.replace(day=1)
+        fim_periodo = (inicio_periodo.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+        CarteiraContadorCache.query.filter(
+            CarteiraContadorCache.data_referencia < hoje
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+        gravadas = 0
+        contador_ids = [linha[0] for linha in db.session.query(VinculoContador.contador_id).filter(
+            VinculoContador.status == 'autorizado'
+        ).distinct()]
+        for contador_id in contador_ids:
+            try:
+                gravadas += preencher_carteira_contador(
+                    contador_id, empresas_autorizadas_contador(contador_id), inicio_periodo, fim_periodo, hoje
+                )
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"[Carteira] Erro ao pré-calcular contador {contador_id}: {str(e)}")
+        if gravadas:
+            app.logger.info(f"[Carteira] {gravadas} carteira(s) gravada(s) no cache")
+
+
+@event.listens_for(db.session, 'after_flush')
+def _carteira_invalidar(sessao, flush_context):
+    """Remove do cache as carteiras dos contadores autorizados em empresas com lançamentos, contas caixa ou DRE alterados."""
+    from sqlalchemy import inspect as sa_inspect
+
+    empresas = set()
+    usuarios = set()
+    for obj in list(sessao.new) + list(sessao.dirty) + list(sessao.deleted):
+        estado = sa_inspect(obj)
+        if isinstance(obj, (Lancamento, DreConfiguracao)):
+            # Estado carregado, sem consultar o banco (objetos excluídos), e o
+            # valor anterior se o lançamento mudou de empresa
+            empresas.add(estado.dict.get('empresa_id'))
+            empresas.update(estado.attrs.empresa_id.history.deleted or ())
+        elif isinstance(obj, ContaCaixa):
+            usuarios.add(estado.dict.get('usuario_id'))
+            usuarios.update(estado.attrs.usuario_id.history.deleted or ())
+    empresas.discard(None)
+    usuarios.discard(None)
+    if not empresas and not usuarios:
+        return
+
+    condicoes = []
+    if empresas:
+        condicoes.append(VinculoContador.empresa_id.in_(empresas))
+    if usuarios:
+        condicoes.append(VinculoContador.empresa_id.in_(
+            db.select(Usuario.empresa_id).where(Usuario.id.in_(usuarios))
+        ))
+    _excluir_carteiras_vinculadas(sessao.connection().execute, db.or_(*condicoes))
+
+
+def _excluir_carteiras_vinculadas(executar, condicao_vinculo):
+    """
+    Remove as carteiras em cache dos contadores com vínculo autorizado que
+    atende a condição. Só executa o DELETE se alguma carteira em cache casar
+    (o caso comum, empresa sem contador ou contador sem cache, é uma leitura).
+    """
+    tabela = CarteiraContadorCache.__table__
+    contadores = db.select(VinculoContador.contador_id).where(
+        VinculoContador.status == 'autorizado', condicao_vinculo
+    )
+    existe = executar(db.select(tabela.c.id).where(tabela.c.contador_id.in_(contadores)).limit(1)).first()
+    if existe:
+        executar(tabela.delete().where(tabela.c.contador_id.in_(contadores)))
+
+
+def invalidar_carteiras_empresas(empresa_ids):
+    """
+    Remove as carteiras em cache dos contadores autorizados nas empresas. Para
+    exclusões/alterações em massa (Query.delete/update), que não passam pelo
+    after_flush de _carteira_invalidar.
+    """
+    empresa_ids = {empresa_id for empresa_id in empresa_ids if empresa_id}
+    if empresa_ids:
+        _excluir_carteiras_vinculadas(db.session.execute, VinculoContador.empresa_id.in_(empresa_ids))
+
+
+@app.route('/contador/api/carteira')
+def api_carteira_contador():
+    """
+    API JSON (somente leitura): totais do período de todas as empresas
+    vinculadas autorizadas e o consolidado da carteira. Parâmetros: data_inicio
+    e data_fim (DD/MM/AAAA ou AAAA-MM-DD; padrão: mês atual). Sub-usuários veem
+    apenas as empresas que têm permissão de acessar.
+    """
+    if 'usuario_id' not in session and 'sub_usuario_id' not in session:
+        return jsonify({'erro': 'Não autenticado'}), 401
+
+    tipo_usuario = session.get('usuario_tipo')
+    if session.get('tipo_conta') != 'contador_bpo' and tipo_usuario != 'sub_contador':
+        return jsonify({'erro': 'Acesso negado. Apenas contadores/BPO.'}), 403
+
+    if tipo_usuario == 'sub_contador':
+        contador_id = session.get('contador_id')
+    elif session.get('acesso_contador'):
+        contador_id = session.get('empresa_id_original')
+    else:
+        contador_id = session.get('empresa_id')
+    if not contador_id:
+        return jsonify({'erro': 'Contador não identificado'}), 403
+
+    hoje = datetime.now().date()
+    data_inicio = _parse_data_filtro(request.args.get('data_inicio')) or hoje.replace(day=1)
+    data_fim = _parse_data_filtro(request.args.get('data_fim')) or (
+        (data_inicio.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    )
+    if data_inicio > data_fim:
+        data_inicio, data_fim = data_fim, data_inicio
+
+    empresas_autorizadas = empresas_autorizadas_contador(contador_id)
+    carteira, em_cache = obter_carteira_contador(contador_id, empresas_autorizadas, data_inicio, data_fim, hoje)
+
+    # Sub-usuários: apenas as empresas permitidas (o cache é do contador)
+    if tipo_usuario == 'sub_contador':
+        permitidas = empresas_permitidas_sub_usuario(session.get('sub_usuario_id_original') or session.get('sub_usuario_id'))
+        carteira = [item for item in carteira if item['empresa_id'] in permitidas]
+
+    return jsonify({
+        'data_inicio': data_inicio.strftime('%d/%m/%Y'),
+        'data_fim': data_fim.strftime('%d/%m/%Y'),
+        'data_referencia': hoje.strftime('%d/%m/%Y'),
+        'em_cache': em_cache,
+        'empresas': carteira,
+        'consolidado': {
+            'quantidade_empresas': len(carteira),
+            **{campo: sum(item[campo] for item in carteira) for campo in CAMPOS_CONSOLIDADOS_CARTEIRA}
+        }
+    })
+
+
 @app.route('/contador/dashboard')
 def dashboard_contador():
     """Dashboard do contador/BPO"""
@@ -20093,7 +22598,8 @@ def dashboard_contador():
         'sub_usuarios': len(sub_usuarios)
     }
 
-    # ✅ OTIMIZAÇÃO: Buscar lançamentos de hoje de TODAS as empresas de uma vez
+    # Contas de hoje por empresa: totais de todas as empresas autorizadas em uma
+    # única consulta agrupada; os lançamentos só das empresas da página exibida
     from datetime import date
     from collections import defaultdict
     hoje = date.today()
@@ -20101,44 +22607,56 @@ def dashboard_contador():
     # Coletar IDs de empresas autorizadas
     empresas_ids_autorizadas = [v.empresa_id for v in vinculos if v.status == 'autorizado']
 
-    # Buscar TODOS os lançamentos do dia de TODAS as empresas autorizadas em UMA query
-    lancamentos_hoje = []
+    totais_hoje = defaultdict(lambda: {'entrada': 0.0, 'saida': 0.0})
     if empresas_ids_autorizadas:
-        lancamentos_hoje = Lancamento.query.filter(
+        for empresa_id_atual, tipo, total in db.session.query(
+            Lancamento.empresa_id, Lancamento.tipo, db.func.coalesce(db.func.sum(Lancamento.valor), 0)
+        ).filter(
             Lancamento.empresa_id.in_(empresas_ids_autorizadas),
-            Lancamento.data_prevista == hoje
-        ).all()
-
-    # Agrupar lançamentos por empresa_id em memória
+            Lancamento.data_prevista == hoje,
+            Lancamento.tipo.in_(('entrada', 'saida'))
+        ).group_by(Lancamento.empresa_id, Lancamento.tipo):
+            totais_hoje[empresa_id_atual][tipo] = float(total or 0)
+
+    # Empresas com lançamentos hoje, na ordem dos vínculos, paginadas
+    vinculos_com_lancamentos = [v for v in vinculos if v.status == 'autorizado' and v.empresa_id in totais_hoje]
+    por_pagina = app.config['EMPRESAS_POR_PAGINA']
+    total_paginas_empresas = (len(vinculos_com_lancamentos) + por_pagina - 1) // por_pagina
+    pagina_empresas = min(max(request.args.get('pagina_empresas', 1, type=int), 1), max(total_paginas_empresas, 1))
+    vinculos_pagina = vinculos_com_lancamentos[(pagina_empresas - 1) * por_pagina:pagina_empresas * por_pagina]
+
+    # Agrupar lançamentos da página por empresa_id em memória
     lancamentos_por_empresa = defaultdict(lambda: {'entradas': [], 'saidas': []})
-    for lancamento in lancamentos_hoje:
-        if lancamento.tipo == 'entrada':
-            lancamentos_por_empresa[lancamento.empresa_id]['entradas'].append(lancamento)
-        elif lancamento.tipo == 'saida':
-            lancamentos_por_empresa[lancamento.empresa_id]['saidas'].append(lancamento)
+    if vinculos_pagina:
+        for lancamento in Lancamento.query.filter(
+            Lancamento.empresa_id.in_([v.empresa_id for v in vinculos_pagina]),
+            Lancamento.data_prevista == hoje
+        ).order_by(Lancamento.id).all():
+            if lancamento.tipo == 'entrada':
+                lancamentos_por_empresa[lancamento.empresa_id]['entradas'].append(lancamento)
+            elif lancamento.tipo == 'saida':
+                lancamentos_por_empresa[lancamento.empresa_id]['saidas'].append(lancamento)
 
     # Montar lista de empresas com lançamentos
     empresas_com_lancamentos = []
-    for vinculo in vinculos:
-        if vinculo.status == 'autorizado':
-            empresa_id_atual = vinculo.empresa_id
-            if empresa_id_atual in lancamentos_por_empresa:
-                entradas = lancamentos_por_empresa[empresa_id_atual]['entradas']
-                saidas = lancamentos_por_empresa[empresa_id_atual]['saidas']
-
-                empresas_com_lancamentos.append({
-                    'empresa': vinculo.empresa,
-                    'entradas': entradas,
-                    'saidas': saidas,
-                    'total_entradas': sum(l.valor for l in entradas),
-                    'total_saidas': sum(l.valor for l in saidas)
-                })
+    for vinculo in vinculos_pagina:
+        empresa_id_atual = vinculo.empresa_id
+        empresas_com_lancamentos.append({
+            'empresa': vinculo.empresa,
+            'entradas': lancamentos_por_empresa[empresa_id_atual]['entradas'],
+            'saidas': lancamentos_por_empresa[empresa_id_atual]['saidas'],
+            'total_entradas': totais_hoje[empresa_id_atual]['entrada'],
+            'total_saidas': totais_hoje[empresa_id_atual]['saida']
+        })
     
     return render_template('contador_dashboard.html',
                          vinculos=vinculos,
                          sub_usuarios=sub_usuarios,
                          stats=stats,
                          empresas_com_lancamentos=empresas_com_lancamentos,
+                         pagina_empresas=pagina_empresas,
+                         total_paginas_empresas=total_paginas_empresas,
+                         total_empresas_com_lancamentos=len(vinculos_com_lancamentos),
                          categorias=categorias if 'categorias' in locals() else [])
 
 @app.route('/contador/vincular-empresa', methods=['POST'])
@@ -20298,9 +22816,11 @@ def contador_excluir_vinculo(vinculo_id):
                     sub_usuario_id=sub.id,
                     empresa_id=vinculo.empresa_id
                 ).delete()
+            registrar_alteracao_permissoes('sub_usuario', [sub.id for sub in sub_usuarios])
         
         # Excluir vínculo
         db.session.delete(vinculo)
+        registrar_alteracao_permissoes('contador', [contador_id])
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Vínculo excluído com sucesso'})
@@ -20461,6 +22981,7 @@ def contador_salvar_permissoes(sub_usuario_id):
         )
         db.session.add(nova_permissao)
     
+    registrar_alteracao_permissoes('sub_usuario', [sub_usuario_id])
     db.session.commit()
     
     flash('Permissões atualizadas com sucesso!', 'success')
@@ -20492,6 +23013,7 @@ def contador_excluir_sub_usuario(sub_usuario_id):
             
             # Excluir sub-usuário
             db.session.delete(sub_usuario)
+            registrar_alteracao_permissoes('sub_usuario', [sub_usuario_id])
             db.session.commit()
             
             return jsonify({'success': True})
@@ -20726,6 +23248,7 @@ def autorizar_vinculo(vinculo_id):
         if vinculo:
             vinculo.status = 'autorizado'
             vinculo.data_autorizacao = datetime.utcnow()
+            registrar_alteracao_permissoes('contador', [vinculo.contador_id])
             db.session.commit()
 
             flash('Vínculo autorizado com sucesso!', 'success')
@@ -20755,6 +23278,7 @@ def rejeitar_vinculo(vinculo_id):
 
         if vinculo:
             vinculo.status = 'rejeitado'
+            registrar_alteracao_permissoes('contador', [vinculo.contador_id])
             db.session.commit()
 
             flash('Vínculo rejeitado com sucesso!', 'success')
@@ -20860,12 +23384,41 @@ scheduler.add_job(
     replace_existing=True
 )
 
+# Pré-cálculo diário do cubo de períodos fechados (DRE e fluxo de caixa)
+scheduler.add_job(
+    func=precalcular_cubos_periodos,
+    trigger=CronTrigger(hour=2, minute=30),
+    id='precalcular_cubos_periodos',
+    name='Pré-calcular cubo de períodos',
+    replace_existing=True
+)
+
+# Pré-cálculo da carteira do mês atual dos contadores/BPO
+scheduler.add_job(
+    func=precalcular_carteiras_contadores,
+    trigger='interval',
+    minutes=app.config['CARTEIRA_MINUTOS_PRECALCULO'],
+    id='precalcular_carteiras_contadores',
+    name='Pré-calcular carteiras dos contadores',
+    replace_existing=True
+)
+
+# Limpeza diária dos jobs em segundo plano terminados e de seus arquivos
+scheduler.add_job(
+    func=limpar_jobs_antigos,
+    trigger=CronTrigger(hour=3, minute=0),
+    id='limpar_jobs_antigos',
+    name='Remover jobs antigos',
+    replace_existing=True
+)
+
 # Iniciar o scheduler
 scheduler.start()
 app.logger.info("✅ Scheduler de atualização de assinaturas iniciado")
 
 # Garantir que o scheduler seja desligado quando o app for finalizado
 atexit.register(lambda: scheduler.shutdown())
+atexit.register(executor_jobs.parar)
 
 # ============================================================
 # ROTA TEMPORÁRIA: MIGRAÇÃO DE TRANSFERÊNCIAS
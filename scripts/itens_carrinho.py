@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Migração dos carrinhos em JSON (Lancamento.itens_carrinho) para a tabela item_carrinho.
+
+Uso:
+    python scripts/itens_carrinho.py migrar [--empresa ID ...]
+
+Apaga e regrava os itens a partir do JSON dos lançamentos. Na primeira
+inicialização da aplicação a migração é feita automaticamente; o script serve
+para refazê-la, por exemplo após correções manuais no banco.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, migrar_itens_carrinho  # type: ignore
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Itens de carrinho (item_carrinho)")
+    parser.add_argument('comando', choices=['migrar'])
+    parser.add_argument('--empresa', type=int, action='append', dest='empresas',
+                        help='ID da empresa (pode ser repetido). Padrão: todas.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        total_itens = migrar_itens_carrinho(args.empresas)
+        print(f"✅ Itens de carrinho migrados: {total_itens} item(ns).")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Manutenção do razão de movimentos de estoque (MovimentoEstoque).
+
+Uso:
+    python scripts/movimentos_estoque.py verificar [--empresa ID ...]
+    python scripts/movimentos_estoque.py reconstruir [--empresa ID ...]
+
+"verificar" compara o razão com as vendas e compras existentes e termina com
+código 1 se houver divergências. "reconstruir" apaga e recria as linhas de
+venda/compra do razão (os ajustes manuais são mantidos).
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, reconstruir_movimentos_estoque, verificar_movimentos_estoque  # type: ignore
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Razão de movimentos de estoque")
+    parser.add_argument('comando', choices=['verificar', 'reconstruir'])
+    parser.add_argument('--empresa', type=int, action='append', dest='empresas',
+                        help='ID da empresa (pode ser repetido). Padrão: todas.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.comando == 'reconstruir':
+            total_linhas = reconstruir_movimentos_estoque(args.empresas)
+            print(f"✅ Razão de estoque reconstruído: {total_linhas} linha(s).")
+            return 0
+
+        divergencias = verificar_movimentos_estoque(args.empresas)
+        for d in divergencias:
+            print(f"❌ Empresa {d['empresa_id']}, {d['origem']} {d['origem_id']}, produto '{d['produto']}' "
+                  f"em {d['data']}: faltam {d['quantidade']:+g} unidade(s) no razão")
+        if divergencias:
+            print(f"\n{len(divergencias)} divergência(s). Execute 'reconstruir' para corrigir.")
+            return 1
+        print("✅ Razão de estoque consistente com as vendas e compras.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Manutenção do snapshot diário de saldos das contas caixa (SaldoContaCaixaDiario).
+
+Uso:
+    python scripts/saldos_contas_caixa.py verificar [--conta ID ...]
+    python scripts/saldos_contas_caixa.py reconstruir [--conta ID ...]
+
+"verificar" compara o snapshot com a soma completa dos lançamentos realizados e
+termina com código 1 se houver divergências. "reconstruir" apaga e recria o
+snapshot a partir dos lançamentos.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, reconstruir_saldos_contas_caixa, verificar_saldos_contas_caixa  # type: ignore
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Snapshot diário de saldos das contas caixa")
+    parser.add_argument('comando', choices=['verificar', 'reconstruir'])
+    parser.add_argument('--conta', type=int, action='append', dest='contas',
+                        help='ID da conta caixa (pode ser repetido). Padrão: todas.')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.comando == 'reconstruir':
+            total_linhas = reconstruir_saldos_contas_caixa(args.contas)
+            print(f"✅ Snapshot reconstruído: {total_linhas} linha(s).")
+            return 0
+
+        divergencias = verificar_saldos_contas_caixa(args.contas)
+        for d in divergencias:
+            print(f"❌ Conta {d['conta_caixa_id']} em {d['data']}: {d['campo']} "
+                  f"esperado {d['esperado']} / registrado {d['registrado']}")
+        if divergencias:
+            print(f"\n{len(divergencias)} divergência(s). Execute 'reconstruir' para corrigir.")
+            return 1
+        print("✅ Snapshot de saldos consistente com os lançamentos.")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
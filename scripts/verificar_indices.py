@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Verifica se as consultas mais usadas do sistema utilizam índices.
+
+Executa EXPLAIN (PostgreSQL) ou EXPLAIN QUERY PLAN (SQLite) sobre as consultas
+do dashboard, da listagem de lançamentos, dos relatórios e da DRE, e termina com
+código de saída 1 se alguma delas cair em varredura sequencial da tabela.
+
+Uso:
+    python scripts/verificar_indices.py
+"""
+
+import os
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from app import app, db, Lancamento, Venda, Compra, Parcela, MovimentoEstoque, ItemCarrinho, FiltroLancamentos, garantir_indices_modelos  # type: ignore
+
+
+def consultas_principais():
+    """Retorna (nome, query) das consultas críticas de performance."""
+    empresa_id = 1
+    inicio, fim, hoje = date(2024, 1, 1), date(2024, 1, 31), date(2024, 1, 15)
+    sem_transferencia = db.or_(Lancamento.eh_transferencia == False, Lancamento.eh_transferencia.is_(None))
+
+    return [
+        ('dashboard: pendentes do período', Lancamento.query.filter(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.tipo == 'entrada',
+            Lancamento.realizado == False,
+            Lancamento.data_prevista >= inicio,
+            Lancamento.data_prevista <= fim,
+        )),
+        ('dashboard: realizados do período', Lancamento.query.filter(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.realizado == True,
+            Lancamento.data_realizada >= inicio,
+            Lancamento.data_realizada <= fim,
+            sem_transferencia,
+        )),
+        ('dashboard: agendados hoje', Lancamento.query.filter(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.data_realizada == hoje,
+            Lancamento.realizado == False,
+        )),
+        ('lancamentos: listagem', Lancamento.query.filter(
+            Lancamento.empresa_id == empresa_id,
+        ).order_by(Lancamento.data_prevista.desc(), Lancamento.id.desc()).limit(50)),
+        # Caminho comum de /lancamentos, /api/lancamentos/totais e relatórios
+        ('lancamentos: filtro compilado', FiltroLancamentos(
+            empresa_id, hoje=hoje, data_inicio=inicio, data_fim=fim, status='vencido'
+        ).consulta().order_by(Lancamento.data_prevista.desc(), Lancamento.id.desc()).limit(50)),
+        ('lancamentos: filtro por conta caixa', FiltroLancamentos(
+            empresa_id, hoje=hoje, conta_caixa_id=1, status='realizado'
+        ).consulta()),
+        ('relatorio_saldos: até a data', Lancamento.query.filter(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.data_prevista <= fim,
+        )),
+        ('saldo por conta caixa', Lancamento.query.filter(
+            Lancamento.conta_caixa_id == 1,
+            Lancamento.realizado == True,
+            Lancamento.data_realizada <= fim,
+        )),
+        ('calcular_dre: consulta agrupada', db.session.query(
+            Lancamento.plano_conta_id, db.func.sum(Lancamento.valor)
+        ).filter(
+            Lancamento.empresa_id == empresa_id,
+            Lancamento.plano_conta_id.in_([1, 2, 3]),
+            sem_transferencia,
+        ).group_by(Lancamento.plano_conta_id)),
+        ('vendas: listagem', Venda.query.filter(
+            Venda.empresa_id == empresa_id,
+            Venda.data_prevista >= inicio,
+            Venda.data_prevista <= fim,
+        )),
+        ('compras: listagem', Compra.query.filter(
+            Compra.empresa_id == empresa_id,
+            Compra.data_prevista >= inicio,
+            Compra.data_prevista <= fim,
+        )),
+        ('parcelas da venda', Parcela.query.filter(Parcela.venda_id == 1).order_by(Parcela.numero)),
+        ('parcelas da compra', Parcela.query.filter(Parcela.compra_id == 1).order_by(Parcela.numero)),
+        ('estoque: razão do produto até a data', MovimentoEstoque.query.filter(
+            MovimentoEstoque.empresa_id == empresa_id,
+            MovimentoEstoque.produto == 'Produto',
+            MovimentoEstoque.data <= fim,
+        )),
+        ('estoque: movimentos da venda', MovimentoEstoque.query.filter(
+            MovimentoEstoque.origem == 'venda',
+            MovimentoEstoque.origem_id.in_([1, 2, 3]),
+        )),
+        ('itens de carrinho do produto', ItemCarrinho.query.filter(ItemCarrinho.produto_id == 1)),
+        ('itens de carrinho da compra', ItemCarrinho.query.filter(ItemCarrinho.compra_id.in_([1, 2, 3]))),
+    ]
+
+
+def plano_execucao(query):
+    """Retorna as linhas do plano de execução da consulta no banco atual."""
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+    if db.engine.dialect.name == 'postgresql':
+        # Com seqscan desabilitado o planner só escolhe varredura sequencial
+        # quando não existe índice utilizável para a consulta.
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        linhas = db.session.execute(text(f"EXPLAIN {sql}")).fetchall()
+        return [linha[0] for linha in linhas]
+
+    linhas = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+    return [linha[-1] for linha in linhas]
+
+
+def usa_varredura_sequencial(plano):
+    """Detecta varredura sequencial em planos do SQLite ou PostgreSQL."""
+    for linha in plano:
+        if 'Seq Scan' in linha:
+            return True
+        if linha.startswith('SCAN ') and 'USING' not in linha:
+            return True
+    return False
+
+
+def verificar_indices():
+    """Executa o EXPLAIN das consultas principais. Retorna a lista de falhas."""
+    falhas = []
+    with app.app_context():
+        garantir_indices_modelos()
+        for nome, query in consultas_principais():
+            plano = plano_execucao(query)
+            db.session.rollback()
+            if usa_varredura_sequencial(plano):
+                falhas.append(nome)
+                print(f"❌ {nome}")
+                for linha in plano:
+                    print(f"     {linha}")
+            else:
+                print(f"✅ {nome}")
+    return falhas
+
+
+if __name__ == "__main__":
+    falhas = verificar_indices()
+    if falhas:
+        print(f"\n{len(falhas)} consulta(s) sem índice: {', '.join(falhas)}")
+        sys.exit(1)
+    print("\nTodas as consultas principais utilizam índices.")
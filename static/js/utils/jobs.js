@@ -0,0 +1,59 @@
+/**
+ * Jobs em segundo plano
+ * Rotas demoradas (importação, backups, exportações em PDF) respondem 202 com
+ * o id do job; estas funções acompanham o job e obtêm o resultado.
+ */
+
+class JobUtils {
+    static INTERVALO = 1500;
+
+    static esperar(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    // Consulta o status até o job terminar; onProgresso recebe cada status
+    static async acompanhar(statusUrl, onProgresso) {
+        while (true) {
+            const response = await fetch(statusUrl, { headers: { 'Accept': 'application/json' } });
+            const status = await response.json();
+            if (!response.ok) throw new Error(status.error || 'Erro ao consultar o job');
+            if (onProgresso) onProgresso(status);
+            if (status.terminado) return status;
+            await this.esperar(this.INTERVALO);
+        }
+    }
+
+    // JSON da rota: direto, ou o resultado do job quando ela foi enfileirada (202)
+    static async resultado(response, onProgresso) {
+        const data = await response.json();
+        if (response.status !== 202 || !data.job_id) return data;
+        await this.acompanhar(data.status_url, onProgresso);
+        const resultado = await fetch(data.resultado_url, { headers: { 'Accept': 'application/json' } });
+        return resultado.json();
+    }
+
+    // Download gerado em segundo plano: enfileira, acompanha e baixa o arquivo
+    static async baixar(url, onProgresso) {
+        const response = await fetch(url, { headers: { 'Accept': 'application/json' } });
+        if (response.status !== 202) {
+            // Jobs desabilitados: a própria resposta já é o arquivo
+            if (!response.ok) throw new Error('Erro ao gerar o arquivo');
+            const nome = /filename="?([^";]+)"?/.exec(response.headers.get('Content-Disposition') || '');
+            const link = document.createElement('a');
+            link.href = URL.createObjectURL(await response.blob());
+            link.download = nome ? nome[1] : '';
+            link.click();
+            URL.revokeObjectURL(link.href);
+            return;
+        }
+        const data = await response.json();
+        const status = await this.acompanhar(data.status_url, onProgresso);
+        if (status.status === 'erro' && !status.tem_arquivo) {
+            throw new Error(status.mensagem || 'Erro ao gerar o arquivo');
+        }
+        window.location.href = data.resultado_url;
+    }
+}
+
+// Exportar para uso global
+window.JobUtils = JobUtils;
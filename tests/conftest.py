@@ -0,0 +1,72 @@
+"""
+Configuração dos testes: o app é importado com um banco SQLite temporário e
+com a pasta de trabalho (uploads/, logs/) num diretório temporário. Cada teste
+começa com as tabelas vazias e o cache de permissões vazio.
+"""
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+PASTA_TESTES = tempfile.mkdtemp(prefix='asafinance-testes-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(PASTA_TESTES, 'testes.db')
+os.environ['PERMISSOES_ARQUIVO_SINAL'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(PASTA_TESTES)
+
+import app as aplicacao  # noqa: E402
+
+# As tarefas agendadas não rodam durante os testes (e o desligamento no atexit
+# não escreve no stderr já fechado pelo pytest)
+aplicacao.scheduler.pause()
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+
+@pytest.fixture(autouse=True)
+def banco(monkeypatch):
+    """Tabelas vazias, rotas executadas na própria requisição e executor de jobs parado."""
+    aplicacao.app.config['TESTING'] = True
+    monkeypatch.setitem(aplicacao.app.config, 'JOBS_HABILITADOS', False)
+    # Os testes executam os jobs chamando o executor diretamente
+    monkeypatch.setattr(aplicacao.executor_jobs, 'iniciar', lambda: None)
+    with aplicacao.app.app_context():
+        # O SQLite não verifica as chaves estrangeiras: a ordem das tabelas não importa
+        for tabela in aplicacao.db.metadata.tables.values():
+            aplicacao.db.session.execute(tabela.delete())
+        aplicacao.db.session.commit()
+    aplicacao.cache_permissoes.limpar()
+    with aplicacao.app.app_context():
+        yield aplicacao.db
+        aplicacao.db.session.rollback()
+
+
+@pytest.fixture
+def m():
+    return aplicacao
+
+
+def criar_empresa(cnpj='11.111.111/0001-11', razao_social='Empresa Teste', tipo_conta='empresa', usuario='master'):
+    """Empresa com assinatura ativa e seu usuário principal. Retorna (empresa, usuario)."""
+    db = aplicacao.db
+    empresa = aplicacao.Empresa(cnpj=cnpj, razao_social=razao_social, tipo_conta=tipo_conta,
+                                dias_assinatura=30, data_inicio_assinatura=datetime.utcnow())
+    db.session.add(empresa)
+    db.session.flush()
+    usuario = aplicacao.Usuario(nome=usuario.title(), usuario=usuario, email=f'{usuario}@teste.com', senha='x',
+                                tipo='usuario_principal', empresa_id=empresa.id)
+    db.session.add(usuario)
+    db.session.commit()
+    return empresa, usuario
+
+
+def cliente_logado(usuario, **sessao):
+    """Cliente de teste com a sessão do usuário (e chaves extras da sessão)."""
+    cliente = aplicacao.app.test_client()
+    with cliente.session_transaction() as s:
+        s.update(usuario_id=usuario.id, usuario_tipo=usuario.tipo, usuario_nome=usuario.nome,
+                 empresa_id=usuario.empresa_id, tipo_conta='empresa')
+        s.update(sessao)
+    return cliente
@@ -0,0 +1,111 @@
+import pytest
+
+from conftest import criar_empresa, cliente_logado
+
+AJAX = {'X-Requested-With': 'XMLHttpRequest'}
+
+
+@pytest.fixture
+def usuario_restrito(m, banco):
+    """Usuário comum com permissão só de visualizar clientes."""
+    empresa, _ = criar_empresa()
+    usuario = m.Usuario(nome='Restrito', usuario='restrito', email='restrito@teste.com', senha='x',
+                        tipo='usuario', empresa_id=empresa.id)
+    banco.session.add(usuario)
+    banco.session.commit()
+    m.atualizar_permissoes_usuario(usuario.id, {'clientes': ['visualizar']})
+    return usuario
+
+
+@pytest.fixture
+def contador(m, banco):
+    """Contador/BPO com vínculo autorizado a uma empresa cliente. Retorna (contador_id, empresa_id)."""
+    empresa, _ = criar_empresa()
+    escritorio, _ = criar_empresa(cnpj='22.222.222/0001-22', razao_social='Contabilidade',
+                                  tipo_conta='contador_bpo', usuario='contador')
+    banco.session.add(m.VinculoContador(contador_id=escritorio.id, empresa_id=empresa.id, status='autorizado'))
+    banco.session.commit()
+    return escritorio.id, empresa.id
+
+
+def test_alteracao_de_permissoes_vale_na_requisicao_seguinte(m, usuario_restrito):
+    cliente = cliente_logado(usuario_restrito)
+    assert cliente.get('/clientes', headers=AJAX).status_code == 200
+    assert cliente.get('/fornecedores', headers=AJAX).status_code == 403
+
+    m.atualizar_permissoes_usuario(usuario_restrito.id, {'fornecedores': ['visualizar']})
+
+    assert cliente.get('/fornecedores', headers=AJAX).status_code == 200
+    assert cliente.get('/clientes', headers=AJAX).status_code == 403
+
+
+def test_commit_descarta_a_entrada_e_sobe_a_versao(m, banco, contador):
+    contador_id, empresa_id = contador
+    assert m.empresas_autorizadas_contador(contador_id) == {empresa_id}
+    assert ('contador', contador_id, None) in m.cache_permissoes.itens
+
+    vinculo = m.VinculoContador.query.filter_by(contador_id=contador_id).one()
+    vinculo.status = 'rejeitado'
+    m.registrar_alteracao_permissoes('contador', [contador_id])
+    banco.session.commit()
+
+    assert ('contador', contador_id, None) not in m.cache_permissoes.itens
+    assert 'permissoes_alteradas' not in banco.session.info
+    m.cache_permissoes.sincronizar()
+    assert m.cache_permissoes.versoes[('contador', contador_id)] == 1
+    assert m.empresas_autorizadas_contador(contador_id) == frozenset()
+
+
+def test_rollback_mantem_o_cache_e_esquece_a_alteracao(m, banco, contador):
+    contador_id, empresa_id = contador
+    assert m.empresas_autorizadas_contador(contador_id) == {empresa_id}
+
+    vinculo = m.VinculoContador.query.filter_by(contador_id=contador_id).one()
+    vinculo.status = 'rejeitado'
+    m.registrar_alteracao_permissoes('contador', [contador_id])
+    banco.session.rollback()
+
+    assert 'permissoes_alteradas' not in banco.session.info
+    assert ('contador', contador_id, None) in m.cache_permissoes.itens
+    m.cache_permissoes.sincronizar()
+    assert ('contador', contador_id) not in m.cache_permissoes.versoes
+    assert m.empresas_autorizadas_contador(contador_id) == {empresa_id}
+
+    # Um commit posterior sem alterações de permissão não descarta a entrada
+    banco.session.commit()
+    assert ('contador', contador_id, None) in m.cache_permissoes.itens
+
+
+def test_outro_processo_avisa_pelo_arquivo_de_sinal(m, banco, usuario_restrito, tmp_path, monkeypatch):
+    monkeypatch.setattr(m.cache_permissoes, 'arquivo_sinal', str(tmp_path / 'permissoes.versao'))
+    cliente = cliente_logado(usuario_restrito)
+    assert cliente.get('/fornecedores', headers=AJAX).status_code == 403
+
+    # Alteração gravada por outro processo: banco e arquivo de sinal, sem passar pelo after_commit deste
+    banco.session.add(m.Permissao(usuario_id=usuario_restrito.id, modulo='fornecedores', acao='visualizar', ativo=True))
+    tabela = m.VersaoPermissao.__table__
+    banco.session.execute(tabela.update().where(
+        tabela.c.escopo == 'usuario', tabela.c.referencia_id == usuario_restrito.id
+    ).values(versao=tabela.c.versao + 1))
+    banco.session.commit()
+    assert cliente.get('/fornecedores', headers=AJAX).status_code == 403
+
+    m.cache_permissoes.sinalizar()
+
+    assert cliente.get('/fornecedores', headers=AJAX).status_code == 200
+
+
+def test_vinculo_removido_encerra_o_acesso_do_contador(m, banco, contador):
+    contador_id, empresa_id = contador
+    usuario_contador = m.Usuario.query.filter_by(empresa_id=contador_id).one()
+    cliente = cliente_logado(usuario_contador, tipo_conta='contador_bpo', acesso_contador=True,
+                             empresa_id=empresa_id, empresa_id_original=contador_id)
+    assert cliente.get('/clientes', headers=AJAX).status_code == 200
+
+    m.VinculoContador.query.filter_by(contador_id=contador_id).delete()
+    m.registrar_alteracao_permissoes('contador', [contador_id])
+    banco.session.commit()
+
+    cliente.get('/clientes', headers=AJAX)
+    with cliente.session_transaction() as sessao:
+        assert 'acesso_contador' not in sessao
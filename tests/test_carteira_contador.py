@@ -0,0 +1,116 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from conftest import criar_empresa, cliente_logado
+
+
+@pytest.fixture
+def carteira(m, banco):
+    """Contador com duas empresas autorizadas e uma pendente, cada uma com um lançamento no mês."""
+    escritorio, usuario_contador = criar_empresa(cnpj='99.999.999/0001-99', razao_social='Contabilidade',
+                                                 tipo_conta='contador_bpo', usuario='contador')
+    empresas = {}
+    for i, status in enumerate(('autorizado', 'autorizado', 'pendente')):
+        empresa, usuario = criar_empresa(cnpj=f'1{i}.111.111/0001-11', razao_social=f'Cliente {i}', usuario=f'cliente{i}')
+        banco.session.add(m.VinculoContador(contador_id=escritorio.id, empresa_id=empresa.id, status=status))
+        banco.session.add(lancamento(m, usuario, 100.0 * (i + 1)))
+        empresas[status, i] = usuario
+    banco.session.commit()
+    return {
+        'contador_id': escritorio.id,
+        'http': cliente_logado(usuario_contador, tipo_conta='contador_bpo'),
+        'autorizado': empresas['autorizado', 0],
+        'pendente': empresas['pendente', 2],
+    }
+
+
+def lancamento(m, usuario, valor):
+    return m.Lancamento(descricao='Venda', valor=valor, tipo='entrada', categoria='Vendas',
+                        data_prevista=date.today(), realizado=False,
+                        usuario_id=usuario.id, empresa_id=usuario.empresa_id)
+
+
+def linhas_cache(m):
+    return m.CarteiraContadorCache.query.count()
+
+
+def test_consulta_nao_grava_o_cache(m, carteira):
+    resposta = carteira['http'].get('/contador/api/carteira')
+
+    dados = resposta.get_json()
+    assert resposta.status_code == 200
+    assert dados['em_cache'] is False
+    assert dados['consolidado']['quantidade_empresas'] == 2
+    assert dados['consolidado']['a_receber'] == pytest.approx(300.0)
+    assert linhas_cache(m) == 0
+
+
+def test_tarefa_agendada_preenche_o_cache_do_mes(m, carteira):
+    m.precalcular_carteiras_contadores()
+    assert linhas_cache(m) == 1
+
+    dados = carteira['http'].get('/contador/api/carteira').get_json()
+
+    assert dados['em_cache'] is True
+    assert dados['consolidado']['a_receber'] == pytest.approx(300.0)
+
+
+def test_lancamento_de_empresa_autorizada_invalida_o_cache(m, banco, carteira):
+    m.precalcular_carteiras_contadores()
+
+    banco.session.add(lancamento(m, carteira['autorizado'], 50.0))
+    banco.session.commit()
+
+    assert linhas_cache(m) == 0
+    dados = carteira['http'].get('/contador/api/carteira').get_json()
+    assert dados['em_cache'] is False
+    assert dados['consolidado']['a_receber'] == pytest.approx(350.0)
+
+
+def test_empresa_sem_vinculo_autorizado_nao_executa_delete(m, banco, carteira):
+    m.precalcular_carteiras_contadores()
+    comandos = []
+
+    def registrar(conn, cursor, sql, *args):
+        comandos.append(sql)
+
+    event.listen(banco.engine, 'before_cursor_execute', registrar)
+    try:
+        banco.session.add(lancamento(m, carteira['pendente'], 50.0))
+        banco.session.commit()
+    finally:
+        event.remove(banco.engine, 'before_cursor_execute', registrar)
+
+    assert linhas_cache(m) == 1
+    assert not [sql for sql in comandos if sql.startswith('DELETE FROM carteira_contador_cache')]
+
+
+def test_conta_caixa_e_exclusao_em_massa_invalidam_o_cache(m, banco, carteira):
+    m.precalcular_carteiras_contadores()
+    usuario = carteira['autorizado']
+    banco.session.add(m.ContaCaixa(nome='Banco', tipo='conta_corrente', saldo_inicial=10.0, saldo_atual=10.0,
+                                   usuario_id=usuario.id))
+    banco.session.commit()
+    assert linhas_cache(m) == 0
+
+    m.precalcular_carteiras_contadores()
+    m.invalidar_carteiras_empresas([usuario.empresa_id])
+    banco.session.commit()
+    assert linhas_cache(m) == 0
+
+
+def test_nova_empresa_autorizada_ignora_o_cache(m, banco, carteira):
+    m.precalcular_carteiras_contadores()
+    vinculo = m.VinculoContador.query.filter_by(empresa_id=carteira['pendente'].empresa_id).one()
+    vinculo.status = 'autorizado'
+    m.registrar_alteracao_permissoes('contador', [carteira['contador_id']])
+    banco.session.commit()
+
+    dados = carteira['http'].get('/contador/api/carteira').get_json()
+    assert dados['em_cache'] is False
+    assert dados['consolidado']['quantidade_empresas'] == 3
+
+    m.precalcular_carteiras_contadores()
+    assert carteira['http'].get('/contador/api/carteira').get_json()['em_cache'] is True
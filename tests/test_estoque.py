@@ -0,0 +1,134 @@
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import criar_empresa
+
+# (tipo_compra, produto, quantidade, preco_custo, data) e (tipo_venda, produto, quantidade, data)
+COMPRAS = [
+    ('mercadoria', 'Caneta', 10, 2.0, date(2026, 1, 5)),
+    ('mercadoria', 'Caneta', 30, 3.0, date(2026, 2, 10)),
+    ('mercadoria', 'Lápis', 50, 1.0, date(2026, 1, 20)),
+    ('servico', 'Caneta', 99, 9.0, date(2026, 1, 6)),
+    ('mercadoria', 'Borracha', 5, 0.5, date(2026, 3, 1)),
+]
+VENDAS = [
+    ('produto', 'Caneta', 4, date(2026, 1, 10)),
+    ('produto', 'Caneta', 6, date(2026, 2, 15)),
+    ('mercadoria', 'Caneta', 7, date(2026, 2, 16)),
+    ('servico', 'Lápis', 3, date(2026, 1, 25)),
+    ('produto', 'Lápis', 8, date(2026, 1, 30)),
+]
+
+
+def totais_baseline(data_limite=None):
+    """Estoque e preço médio como antes do razão: compras de mercadoria menos vendas de produto."""
+    totais = {}
+    for tipo, produto, quantidade, preco_custo, data in COMPRAS:
+        if tipo == 'mercadoria' and (data_limite is None or data <= data_limite):
+            estoque, qtd_compras, custo = totais.get(produto, (0, 0, 0.0))
+            totais[produto] = (estoque + quantidade, qtd_compras + quantidade, custo + preco_custo * quantidade)
+    for tipo, produto, quantidade, data in VENDAS:
+        if tipo == 'produto' and (data_limite is None or data <= data_limite):
+            estoque, qtd_compras, custo = totais.get(produto, (0, 0, 0.0))
+            totais[produto] = (estoque - quantidade, qtd_compras, custo)
+    return totais
+
+
+@pytest.fixture
+def loja(m, banco):
+    empresa, usuario = criar_empresa()
+    empresa.tipo_empresa = 'comercio'
+    cliente = m.Cliente(nome='Cliente', empresa_id=empresa.id, usuario_id=usuario.id)
+    fornecedor = m.Fornecedor(nome='Fornecedor', empresa_id=empresa.id, usuario_id=usuario.id)
+    banco.session.add_all([cliente, fornecedor])
+    banco.session.flush()
+    for tipo, produto, quantidade, preco_custo, data in COMPRAS:
+        banco.session.add(m.Compra(fornecedor_id=fornecedor.id, produto=produto, quantidade=quantidade,
+                                   valor=preco_custo * quantidade, preco_custo=preco_custo, tipo_compra=tipo,
+                                   data_prevista=data, usuario_id=usuario.id, empresa_id=empresa.id))
+    for tipo, produto, quantidade, data in VENDAS:
+        banco.session.add(m.Venda(cliente_id=cliente.id, produto=produto, quantidade=quantidade,
+                                  valor=10.0 * quantidade, tipo_venda=tipo, data_prevista=data,
+                                  usuario_id=usuario.id, empresa_id=empresa.id))
+    for nome in ('Caneta', 'Lápis', 'Borracha'):
+        banco.session.add(m.Produto(nome=nome, preco_custo=1.0, preco_venda=5.0, usuario_id=usuario.id))
+    banco.session.commit()
+    return empresa.id
+
+
+@pytest.mark.parametrize('data_limite', [None, date(2026, 1, 31), date(2026, 2, 15)])
+def test_razao_confere_com_compras_e_vendas(m, loja, data_limite):
+    esperado = totais_baseline(data_limite)
+
+    resumo = m.resumo_estoque(loja, data_limite=data_limite)
+
+    assert set(resumo) == set(esperado)
+    for produto, (estoque, qtd_compras, custo) in esperado.items():
+        quantidade, preco_medio = resumo[m.normalizar_nome_produto(produto)]
+        assert quantidade == estoque
+        assert preco_medio == pytest.approx(custo / qtd_compras)
+    assert m.verificar_movimentos_estoque() == []
+
+
+@pytest.mark.parametrize('data_limite', [None, date(2026, 1, 31)])
+def test_relatorio_pelo_razao_igual_ao_agrupamento_de_compras_e_vendas(m, banco, loja, data_limite):
+    pelo_razao = m.montar_relatorio_estoque(loja, data_limite, data_limite is None)
+
+    m.MovimentoEstoque.query.delete()
+    banco.session.commit()
+    sem_razao = m.montar_relatorio_estoque(loja, data_limite, data_limite is None)
+
+    assert pelo_razao == sem_razao
+    esperado = totais_baseline(data_limite)
+    for linha in pelo_razao:
+        estoque, qtd_compras, custo = esperado.get(linha['nome'], (0, 0, 0.0))
+        assert linha['qtd_compras'] == qtd_compras
+        # Sem compras até a data, vale o preço de custo do cadastro
+        assert linha['preco_medio_compra'] == pytest.approx(custo / qtd_compras if qtd_compras else 1.0)
+        if data_limite is not None:
+            assert linha['estoque'] == estoque
+
+
+def test_edicao_e_exclusao_atualizam_o_razao(m, banco, loja):
+    venda = m.Venda.query.filter_by(produto='Caneta', quantidade=4).one()
+    venda.quantidade = 1
+    venda.data_prevista = date(2026, 3, 1)
+    compra = m.Compra.query.filter_by(produto='Lápis').one()
+    banco.session.delete(compra)
+    banco.session.commit()
+
+    resumo = m.resumo_estoque(loja)
+    assert resumo['Caneta'][0] == 40 - 1 - 6
+    assert resumo['Lápis'] == (-8, None)
+    assert m.resumo_estoque(loja, data_limite=date(2026, 1, 31))['Caneta'][0] == 10
+    assert m.verificar_movimentos_estoque() == []
+
+
+def test_mudanca_de_tipo_tira_a_venda_do_razao(m, banco, loja):
+    venda = m.Venda.query.filter_by(produto='Caneta', quantidade=6).one()
+    venda.tipo_venda = 'servico'
+    banco.session.commit()
+
+    assert m.resumo_estoque(loja)['Caneta'][0] == 40 - 4
+    assert m.verificar_movimentos_estoque() == []
+
+
+def test_reconstruir_gera_o_mesmo_razao(m, banco, loja):
+    antes = m.resumo_estoque(loja)
+    m.MovimentoEstoque.query.filter(m.MovimentoEstoque.origem == 'venda').delete()
+    banco.session.commit()
+    assert m.verificar_movimentos_estoque() != []
+
+    m.reconstruir_movimentos_estoque([loja])
+
+    assert m.resumo_estoque(loja) == antes
+    assert m.verificar_movimentos_estoque() == []
+
+
+def test_compra_sem_preco_custo_usa_valor_por_quantidade(m):
+    # Compras gravadas antes da coluna preco_custo podem não ter o valor
+    compra = SimpleNamespace(produto='Caneta', quantidade=10, preco_custo=None, valor=40.0, tipo='mercadoria')
+
+    assert m._itens_estoque('compra', compra, []) == {('Caneta', 4.0): 10.0}
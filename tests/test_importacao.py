@@ -0,0 +1,73 @@
+import io
+
+from openpyxl import Workbook
+
+from conftest import criar_empresa, cliente_logado
+
+
+def planilha(*linhas):
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Tipo', 'Descrição', 'Valor', 'Categoria', 'Data Prevista'])
+    for linha in linhas:
+        ws.append(list(linha))
+    arquivo = io.BytesIO()
+    wb.save(arquivo)
+    return arquivo.getvalue()
+
+
+def importar(cliente, conteudo):
+    return cliente.post('/api/importacao/importar', data={'arquivo': (io.BytesIO(conteudo), 'lancamentos.xlsx')},
+                        content_type='multipart/form-data')
+
+
+def test_desfazer_importacao_em_processamento_retorna_409(m, banco):
+    _, usuario = criar_empresa()
+    importacao = m.Importacao(usuario_id=usuario.id, nome_arquivo='x.xlsx', status='processando',
+                              linhas_total=10, linhas_processadas=5)
+    banco.session.add(importacao)
+    banco.session.commit()
+
+    resposta = cliente_logado(usuario).post(f'/api/importacao/{importacao.id}/desfazer')
+
+    assert resposta.status_code == 409
+    banco.session.refresh(importacao)
+    assert importacao.status == 'processando'
+
+
+def test_desfazer_importacao_desfeita_retorna_400(m, banco):
+    _, usuario = criar_empresa()
+    importacao = m.Importacao(usuario_id=usuario.id, nome_arquivo='x.xlsx', status='desfeita')
+    banco.session.add(importacao)
+    banco.session.commit()
+
+    assert cliente_logado(usuario).post(f'/api/importacao/{importacao.id}/desfazer').status_code == 400
+
+
+def test_desfazer_importacao_concluida_remove_lancamentos(m, banco):
+    _, usuario = criar_empresa()
+    cliente = cliente_logado(usuario)
+    resposta = importar(cliente, planilha(('Entrada', 'Venda A', 10, 'Vendas', '01/01/2026'),
+                                          ('Saída', 'Aluguel', 5, 'Aluguel', '02/01/2026')))
+    importacao_id = resposta.get_json()['importacao_id']
+    assert m.Lancamento.query.filter_by(usuario_id=usuario.id).count() == 2
+
+    assert cliente.post(f'/api/importacao/{importacao_id}/desfazer').status_code == 200
+    assert m.Lancamento.query.filter_by(usuario_id=usuario.id).count() == 0
+    assert banco.session.get(m.Importacao, importacao_id) is None
+    assert cliente.post(f'/api/importacao/{importacao_id}/desfazer').status_code == 404
+
+
+def test_falha_no_estoque_conclui_importacao_com_erro(m, banco, monkeypatch):
+    _, usuario = criar_empresa()
+
+    def falhar(self):
+        raise RuntimeError('estoque indisponível')
+
+    monkeypatch.setattr(m.GravadorImportacao, 'atualizar_estoque', falhar)
+    resposta = importar(cliente_logado(usuario), planilha(('Entrada', 'Venda A', 10, 'Vendas', '01/01/2026')))
+
+    importacao = banco.session.get(m.Importacao, resposta.get_json()['importacao_id'])
+    assert importacao.status == 'concluida'
+    assert importacao.erros == 1
+    assert m.Lancamento.query.filter_by(usuario_id=usuario.id).count() == 1
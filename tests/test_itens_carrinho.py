@@ -0,0 +1,93 @@
+import pytest
+
+from conftest import criar_empresa, cliente_logado
+
+
+@pytest.fixture
+def loja(m, banco):
+    empresa, usuario = criar_empresa()
+    empresa.tipo_empresa = 'comercio'
+    cliente = m.Cliente(nome='Cliente', empresa_id=empresa.id, usuario_id=usuario.id)
+    fornecedor = m.Fornecedor(nome='Fornecedor', empresa_id=empresa.id, usuario_id=usuario.id)
+    banco.session.add_all([cliente, fornecedor])
+    banco.session.commit()
+    return {'empresa_id': empresa.id, 'cliente_id': cliente.id, 'fornecedor_id': fornecedor.id,
+            'http': cliente_logado(usuario)}
+
+
+def carrinho(itens, tipo, **campos):
+    return {
+        'item_nome[]': [nome for nome, _, _ in itens],
+        'item_preco[]': [str(preco) for _, preco, _ in itens],
+        'item_qtd[]': [str(qtd) for _, _, qtd in itens],
+        'item_tipo[]': [tipo] * len(itens),
+        'data_prevista': '01/02/2026',
+        'tipo_pagamento': 'a_vista',
+        'numero_parcelas': '1',
+        **campos,
+    }
+
+
+def itens(m, **filtro):
+    return sorted((item.nome, item.quantidade, item.preco_unitario)
+                  for item in m.ItemCarrinho.query.filter_by(**filtro))
+
+
+def nova_compra(m, loja, itens_compra):
+    loja['http'].post('/compras/nova', data=carrinho(itens_compra, 'mercadoria', fornecedor_id=loja['fornecedor_id']))
+    return m.Compra.query.order_by(m.Compra.id.desc()).first()
+
+
+def nova_venda(m, loja, itens_venda):
+    loja['http'].post('/vendas/nova', data=carrinho(itens_venda, 'produto', cliente_id=loja['cliente_id']))
+    return m.Venda.query.order_by(m.Venda.id.desc()).first()
+
+
+def test_nova_compra_grava_os_itens_do_carrinho(m, loja):
+    compra = nova_compra(m, loja, [('Caneta', 2, 10), ('Lápis', 1, 20)])
+
+    assert itens(m, compra_id=compra.id) == [('Caneta', 10.0, 2.0), ('Lápis', 20.0, 1.0)]
+    lancamento = m.Lancamento.query.filter_by(compra_id=compra.id).one()
+    assert itens(m, lancamento_id=lancamento.id) == itens(m, compra_id=compra.id)
+    # O razão é só de inclusão: o produto principal ('Caneta, Lápis') gravado antes
+    # dos itens é estornado e fica com saldo zero
+    resumo = {produto: valores for produto, valores in m.resumo_estoque(loja['empresa_id']).items() if valores[0]}
+    assert resumo == {'Caneta': (10, 2.0), 'Lápis': (20, 1.0)}
+
+
+def test_edicao_da_venda_substitui_os_itens(m, loja):
+    nova_compra(m, loja, [('Caneta', 2, 10), ('Lápis', 1, 20)])
+    venda = nova_venda(m, loja, [('Caneta', 5, 3), ('Lápis', 3, 4)])
+    assert itens(m, venda_id=venda.id) == [('Caneta', 3.0, 5.0), ('Lápis', 4.0, 3.0)]
+
+    resposta = loja['http'].post(f'/vendas/{venda.id}/editar',
+                                 data=carrinho([('Caneta', 5, 6)], 'produto', cliente_id=loja['cliente_id']))
+
+    assert resposta.status_code == 302
+    assert itens(m, venda_id=venda.id) == [('Caneta', 6.0, 5.0)]
+    assert m.resumo_estoque(loja['empresa_id'])['Caneta'][0] == 4
+    assert m.resumo_estoque(loja['empresa_id'])['Lápis'][0] == 20
+    assert m.verificar_movimentos_estoque() == []
+
+
+def test_exclusao_da_venda_remove_os_itens(m, loja):
+    nova_compra(m, loja, [('Caneta', 2, 10)])
+    venda = nova_venda(m, loja, [('Caneta', 5, 3), ('Lápis', 3, 4)])
+
+    loja['http'].get(f'/vendas/{venda.id}/deletar')
+
+    assert m.db.session.get(m.Venda, venda.id) is None
+    assert itens(m, venda_id=venda.id) == []
+    assert m.resumo_estoque(loja['empresa_id'])['Caneta'][0] == 10
+    assert m.verificar_movimentos_estoque() == []
+
+
+def test_migracao_do_json_reproduz_os_itens(m, banco, loja):
+    compra = nova_compra(m, loja, [('Caneta', 2, 10), ('Lápis', 1, 20)])
+    antes = itens(m, compra_id=compra.id)
+    m.ItemCarrinho.query.delete()
+    banco.session.commit()
+
+    m.migrar_itens_carrinho()
+
+    assert itens(m, compra_id=compra.id) == antes
@@ -0,0 +1,125 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from conftest import criar_empresa, cliente_logado
+
+
+@pytest.fixture
+def jobs(m, monkeypatch):
+    monkeypatch.setitem(m.app.config, 'JOBS_HABILITADOS', True)
+    return m.executor_jobs
+
+
+def enfileirar_backup(m, cliente):
+    resposta = cliente.get('/api/backup/exportar-geral', headers={'Accept': 'application/json'})
+    assert resposta.status_code == 202
+    return m.db.session.get(m.Job, resposta.get_json()['job_id'])
+
+
+def executar(m, jobs, job):
+    assert jobs.reivindicar(job, datetime.utcnow())
+    jobs._executar(job.id)
+    m.db.session.expire_all()
+    return m.db.session.get(m.Job, job.id)
+
+
+def test_job_guarda_apenas_a_identidade_da_sessao(m, banco, jobs):
+    _, usuario = criar_empresa()
+    cliente = cliente_logado(usuario, filtro_lancamentos={'tipo': 'entrada'}, _csrf_token='segredo')
+
+    job = enfileirar_backup(m, cliente)
+
+    sessao = json.loads(job.parametros)['sessao']
+    assert set(sessao) <= set(m._CHAVES_SESSAO_JOB)
+    assert sessao['usuario_id'] == usuario.id
+    assert sessao['empresa_id'] == usuario.empresa_id
+    assert job.status == 'pendente'
+
+
+def test_job_repete_a_rota_e_entrega_o_anexo(m, banco, jobs):
+    _, usuario = criar_empresa()
+    cliente = cliente_logado(usuario)
+
+    job = executar(m, jobs, enfileirar_backup(m, cliente))
+
+    assert job.status == 'concluido'
+    assert job.tentativas == 1
+    assert job.arquivo_nome.startswith('backup_completo_') and job.arquivo_nome.endswith('.xlsx')
+    assert os.path.exists(job.arquivo)
+
+    status = cliente.get(f'/api/jobs/{job.id}').get_json()
+    assert status['terminado'] and status['tem_arquivo']
+    resultado = cliente.get(f'/api/jobs/{job.id}/resultado')
+    assert resultado.status_code == 200
+    assert 'attachment' in resultado.headers['Content-Disposition']
+    assert resultado.data[:2] == b'PK'
+
+
+def test_job_de_outro_usuario_nao_e_visivel(m, banco, jobs):
+    _, usuario = criar_empresa()
+    _, outro = criar_empresa(cnpj='22.222.222/0001-22', usuario='outro')
+    job = enfileirar_backup(m, cliente_logado(usuario))
+
+    assert cliente_logado(outro).get(f'/api/jobs/{job.id}').status_code == 404
+
+
+def test_erro_da_rota_encerra_o_job_sem_nova_tentativa(m, banco, jobs, monkeypatch):
+    _, usuario = criar_empresa()
+    job = enfileirar_backup(m, cliente_logado(usuario))
+    assert job.max_tentativas == 3
+
+    def falhar():
+        raise RuntimeError('falha na rota')
+
+    monkeypatch.setattr(m.app, 'full_dispatch_request', falhar)
+    job = executar(m, jobs, job)
+
+    assert job.status == 'erro'
+    assert job.tentativas == 1
+    assert 'falha na rota' in job.mensagem
+
+
+def test_resposta_5xx_encerra_o_job_sem_nova_tentativa(m, banco, jobs, monkeypatch):
+    _, usuario = criar_empresa()
+    job = enfileirar_backup(m, cliente_logado(usuario))
+
+    def falhar(*args, **kwargs):
+        raise RuntimeError('planilha indisponível')
+
+    monkeypatch.setattr(m, 'PlanilhaStreaming', falhar)
+    job = executar(m, jobs, job)
+
+    assert job.status == 'erro'
+    assert json.loads(job.resultado)['status_code'] == 500
+
+
+def test_falha_transitoria_antes_da_rota_reagenda_o_job(m, banco, jobs, monkeypatch):
+    _, usuario = criar_empresa()
+    job = enfileirar_backup(m, cliente_logado(usuario))
+
+    def falhar(job):
+        raise OperationalError('SELECT 1', {}, Exception('conexão perdida'))
+
+    monkeypatch.setattr(m, 'executar_job', falhar)
+    job = executar(m, jobs, job)
+
+    assert job.status == 'pendente'
+    assert job.tentativas == 1
+    assert job.executar_apos > datetime.utcnow()
+
+
+def test_reivindicacao_respeita_o_limite_por_empresa(m, banco, jobs):
+    _, usuario = criar_empresa()
+    cliente = cliente_logado(usuario)
+    primeiro = enfileirar_backup(m, cliente)
+    segundo = enfileirar_backup(m, cliente)
+
+    assert jobs.limite_por_empresa == 1
+    assert jobs.reivindicar(primeiro, datetime.utcnow())
+    assert not jobs.reivindicar(segundo, datetime.utcnow())
+    m.db.session.expire_all()
+    assert m.db.session.get(m.Job, segundo.id).status == 'pendente'